@@ -22,6 +22,7 @@ REM Copiar archivos
 echo 📋 Copiando archivos...
 copy smartperlahub.db "%INSTALL_DIR%\" >nul
 copy smartperlahub_mcp_fixed.py "%INSTALL_DIR%\" >nul
+copy smartperlahub_ingest.py "%INSTALL_DIR%\" >nul
 copy *.md "%INSTALL_DIR%\" 2>nul
 
 echo ✅ Archivos copiados a %INSTALL_DIR%
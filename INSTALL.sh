@@ -48,6 +48,7 @@ mkdir -p "$INSTALL_DIR"
 echo "📋 Copiando archivos del sistema..."
 cp smartperlahub.db "$INSTALL_DIR/"
 cp smartperlahub_mcp_fixed.py "$INSTALL_DIR/"
+cp smartperlahub_ingest.py "$INSTALL_DIR/"
 cp *.md "$INSTALL_DIR/" 2>/dev/null || true
 cp *.json "$INSTALL_DIR/" 2>/dev/null || true
 
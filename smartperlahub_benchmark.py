@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+SmartPerlahub - Benchmark del servidor MCP
+
+Arranca smartperlahub_mcp_fixed.py como lo hace Claude Desktop (JSON-RPC por
+stdio, el bucle real de main()) y le envía una mezcla de llamadas tools/call
+con `--concurrencia` peticiones en vuelo. Mide la latencia de cada petición
+(desde que se escribe hasta que llega su respuesta) y devuelve en JSON el
+rendimiento y los percentiles por herramienta, para comparar ejecuciones:
+
+    python3 smartperlahub_sintetico.py --db bench_10x.db --escala 10
+    python3 smartperlahub_benchmark.py --db bench_10x.db --salida antes.json
+    # ... cambio ...
+    python3 smartperlahub_benchmark.py --db bench_10x.db --comparar antes.json
+
+Con --comparar termina con código 1 si el p95 de alguna herramienta empeora
+más que --tolerancia.
+
+Con --transporte http el servidor arranca en modo HTTP (MCP_TRANSPORTE=http) y
+la carga se reparte entre --clientes sesiones de un mismo proceso, como varios
+analistas conectados a un servidor compartido; con --transporte stdio cada
+cliente tiene su propio proceso (un servidor en frío por analista):
+
+    python3 smartperlahub_benchmark.py --db bench_10x.db --clientes 20 --concurrencia 20
+    python3 smartperlahub_benchmark.py --db bench_10x.db --clientes 20 --concurrencia 20 --transporte http
+
+--url mide un servidor HTTP ya arrancado en lugar de lanzar uno.
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+SERVIDOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "smartperlahub_mcp_fixed.py")
+
+PERCENTILES = (50, 90, 95, 99)
+
+CONSULTAS_SQL = [
+    "SELECT hotel_id, COUNT(*) AS n FROM restrictions GROUP BY hotel_id ORDER BY n DESC LIMIT 20",
+    "SELECT provider_name, COUNT(*), AVG(duration_ms), MAX(duration_ms) FROM provider_searches GROUP BY provider_name",
+    "SELECT COUNT(*) FROM client_searches WHERE hotel_id = {hotel}",
+    "SELECT * FROM exceptions WHERE occurred_at >= '{desde}' AND occurred_at < '{hasta}' ORDER BY occurred_at LIMIT 50",
+    "SELECT restriction_type, COUNT(*) FROM restrictions WHERE hotel_id = {hotel} GROUP BY restriction_type",
+]
+
+BUSQUEDAS = ["Room mapping failed", "mapp*", "timeout TGX*", '"not found" OR NullReference*', "DBL CLASSIC 5481"]
+
+
+class Contexto:
+    """Datos de la base de datos con los que se generan los argumentos"""
+
+    def __init__(self, db_path):
+        self.hoteles = [22, 5481]
+        self.desde = self.hasta = None
+        if os.path.isfile(db_path):
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            try:
+                self._leer(conn)
+            finally:
+                conn.close()
+
+    def _leer(self, conn):
+        tablas = {fila[0] for fila in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        origen = "rollup_restrictions" if "rollup_restrictions" in tablas else "restrictions"
+        suma = "SUM(row_count)" if origen == "rollup_restrictions" else "COUNT(*)"
+        self.hoteles = [fila[0] for fila in conn.execute(
+            f"SELECT hotel_id FROM {origen} WHERE hotel_id IS NOT NULL "
+            f"GROUP BY hotel_id ORDER BY {suma} DESC LIMIT 50"
+        )] or self.hoteles
+        # Extremos por el índice de fecha (o por rowid: las filas llegan en orden)
+        desde = conn.execute("SELECT MIN(occurred_at) FROM restrictions").fetchone()[0]
+        hasta = conn.execute("SELECT MAX(occurred_at) FROM restrictions").fetchone()[0]
+        if desde and hasta:
+            self.desde, self.hasta = desde[:19], hasta[:19]
+
+    def hotel(self, rng):
+        # Los primeros hoteles (los más activos) se piden más a menudo
+        return self.hoteles[min(len(self.hoteles) - 1, int(rng.expovariate(0.25)))]
+
+    def ventana(self, rng):
+        """{} (todo) o una ventana de 1 a 6 horas con segundos sueltos en los bordes"""
+        if not self.desde or rng.random() < 0.5:
+            return {}
+        inicio = datetime.fromisoformat(self.desde).timestamp()
+        fin = datetime.fromisoformat(self.hasta).timestamp()
+        duracion = rng.uniform(3600, 6 * 3600)
+        desde = rng.uniform(inicio, max(inicio, fin - duracion))
+        formato = "%Y-%m-%dT%H:%M:%S"
+        return {
+            "desde": datetime.fromtimestamp(desde).strftime(formato),
+            "hasta": datetime.fromtimestamp(desde + duracion).strftime(formato),
+        }
+
+
+def _consulta_sql(rng, ctx):
+    ventana = ctx.ventana(rng) or {"desde": ctx.desde or "2000-01-01", "hasta": ctx.hasta or "2100-01-01"}
+    consulta = rng.choice(CONSULTAS_SQL).format(hotel=ctx.hotel(rng), **ventana)
+    return {"query": consulta, "limite": 100}
+
+
+# Generadores de argumentos de cada herramienta
+ARGUMENTOS = {
+    "analizar_hotel": lambda rng, ctx: {"hotel_id": ctx.hotel(rng), **ctx.ventana(rng)},
+    "analizar_restricciones": lambda rng, ctx: dict(
+        ctx.ventana(rng), **({"hotel_id": ctx.hotel(rng)} if rng.random() < 0.3 else {})),
+    "analizar_excepciones": lambda rng, ctx: ctx.ventana(rng),
+    "resumen_sistema": lambda rng, ctx: ctx.ventana(rng),
+    "problemas_criticos": lambda rng, ctx: ctx.ventana(rng),
+    "analizar_latencias": lambda rng, ctx: dict(
+        ctx.ventana(rng), **({"agrupar": rng.choice(["proveedor", "conector", "hotel"])} if rng.random() < 0.5 else {})),
+    "buscar_excepciones": lambda rng, ctx: {"consulta": rng.choice(BUSQUEDAS), **ctx.ventana(rng)},
+    "consulta_sql": _consulta_sql,
+}
+
+# Mezclas de carga: {herramienta: peso}
+MEZCLAS = {
+    "mixta": {
+        "analizar_hotel": 25, "analizar_restricciones": 15, "analizar_excepciones": 10,
+        "resumen_sistema": 10, "problemas_criticos": 5, "analizar_latencias": 10,
+        "buscar_excepciones": 10, "consulta_sql": 15,
+    },
+    "analitica": {
+        "analizar_restricciones": 25, "analizar_excepciones": 20, "resumen_sistema": 20,
+        "problemas_criticos": 15, "analizar_latencias": 20,
+    },
+    "hotel": {"analizar_hotel": 1},
+    "sql": {"consulta_sql": 1},
+    "busqueda": {"buscar_excepciones": 1},
+}
+
+
+def percentil(ordenados, p):
+    """Percentil por rango más cercano de una lista ordenada"""
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, max(0, math.ceil(p / 100 * len(ordenados)) - 1))]
+
+
+def estadisticas(latencias, errores, duracion):
+    ordenados = sorted(latencias)
+    resultado = {
+        "llamadas": len(ordenados),
+        "errores": errores,
+        "peticiones_por_s": len(ordenados) / duracion if duracion else 0.0,
+        "media_ms": sum(ordenados) / len(ordenados) if ordenados else None,
+    }
+    for p in PERCENTILES:
+        resultado[f"p{p}_ms"] = percentil(ordenados, p)
+    resultado["max_ms"] = ordenados[-1] if ordenados else None
+    return resultado
+
+
+class ClienteStdio:
+    """Servidor MCP en un subproceso; las respuestas se leen en un hilo aparte"""
+
+    def __init__(self, db_path, entorno=None):
+        env = dict(os.environ, DB_PATH=db_path, **(entorno or {}))
+        self.proceso = subprocess.Popen(
+            [sys.executable, SERVIDOR], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, env=env,
+        )
+        self._lock = threading.Lock()
+        self._pendientes = {}
+        self._siguiente = 0
+        self._lector = threading.Thread(target=self._leer, daemon=True)
+        self._lector.start()
+
+    def _leer(self):
+        for linea in self.proceso.stdout:
+            fin = time.perf_counter()
+            try:
+                mensaje = json.loads(linea)
+            except ValueError:
+                continue
+            with self._lock:
+                pendiente = self._pendientes.pop(mensaje.get("id"), None)
+            if pendiente is not None:
+                pendiente["fin"] = fin
+                pendiente["respuesta"] = mensaje
+                pendiente["evento"].set()
+                if pendiente["aviso"]:
+                    pendiente["aviso"](pendiente)
+        # EOF: el servidor ha terminado; nadie más va a responder
+        with self._lock:
+            pendientes, self._pendientes = list(self._pendientes.values()), {}
+        for pendiente in pendientes:
+            pendiente["respuesta"] = {"error": {"message": "el servidor ha terminado"}}
+            pendiente["fin"] = time.perf_counter()
+            pendiente["evento"].set()
+            if pendiente["aviso"]:
+                pendiente["aviso"](pendiente)
+
+    def enviar(self, metodo, params=None, aviso=None, **datos):
+        """Envía una petición; devuelve su registro (con "evento" para esperarla)"""
+        with self._lock:
+            self._siguiente += 1
+            pendiente = dict(datos, id=self._siguiente, evento=threading.Event(), aviso=aviso)
+            self._pendientes[pendiente["id"]] = pendiente
+        mensaje = {"jsonrpc": "2.0", "id": pendiente["id"], "method": metodo, "params": params or {}}
+        linea = (json.dumps(mensaje) + "\n").encode("utf-8")
+        pendiente["inicio"] = time.perf_counter()
+        self.proceso.stdin.write(linea)
+        self.proceso.stdin.flush()
+        return pendiente
+
+    def llamar(self, metodo, params=None, timeout=600):
+        pendiente = self.enviar(metodo, params)
+        if not pendiente["evento"].wait(timeout):
+            raise TimeoutError(f"{metodo} sin respuesta en {timeout} s")
+        return pendiente["respuesta"]
+
+    def cerrar(self):
+        try:
+            self.proceso.stdin.close()
+        except OSError:
+            pass
+        self.proceso.wait()
+        self._lector.join()
+
+
+class ServidorHTTPLocal:
+    """Servidor MCP en modo HTTP en un subproceso, en un puerto libre"""
+
+    def __init__(self, db_path, entorno=None):
+        env = dict(os.environ, DB_PATH=db_path, MCP_TRANSPORTE="http", MCP_HTTP_PUERTO="0", **(entorno or {}))
+        self.proceso = subprocess.Popen(
+            [sys.executable, SERVIDOR], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, env=env,
+        )
+        # El servidor anuncia su URL en stderr al empezar a escuchar
+        self.url = None
+        for linea in self.proceso.stderr:
+            texto = linea.decode("utf-8", "replace")
+            if "http://" in texto:
+                self.url = texto[texto.index("http://"):].strip()
+                break
+        if self.url is None:
+            self.proceso.wait()
+            raise RuntimeError("El servidor HTTP ha terminado sin empezar a escuchar")
+        threading.Thread(target=self.proceso.stderr.read, daemon=True).start()
+
+    def cerrar(self):
+        self.proceso.terminate()
+        self.proceso.wait()
+
+
+def _mensaje_sse(datos, msg_id):
+    """Mensaje JSON-RPC con el id pedido dentro de un cuerpo text/event-stream"""
+    for evento in datos.decode("utf-8").replace("\r\n", "\n").split("\n\n"):
+        lineas = [linea[5:].lstrip() for linea in evento.split("\n") if linea.startswith("data:")]
+        if lineas:
+            mensaje = json.loads("\n".join(lineas))
+            if isinstance(mensaje, dict) and mensaje.get("id") == msg_id:
+                return mensaje
+    return None
+
+
+class ClienteHTTP:
+    """Sesión MCP por streamable HTTP, como un analista conectado a un
+    servidor compartido; cada petición en vuelo usa una conexión keep-alive
+    de un pool de hilos. Con 429 espera Retry-After y reintenta"""
+
+    def __init__(self, url, token=None, hilos=4):
+        partes = urlsplit(url)
+        self.host, self.puerto, self.ruta = partes.hostname, partes.port or 80, partes.path or "/"
+        self.cabeceras = {"Content-Type": "application/json", "Accept": "application/json, text/event-stream"}
+        if token:
+            self.cabeceras["Authorization"] = f"Bearer {token}"
+        self.rechazadas = 0
+        self._lock = threading.Lock()
+        self._siguiente = 0
+        self._locales = threading.local()
+        self._conexiones = []
+        self._executor = ThreadPoolExecutor(max_workers=max(1, hilos))
+
+    def _conexion(self):
+        conexion = getattr(self._locales, "conexion", None)
+        if conexion is None:
+            conexion = http.client.HTTPConnection(self.host, self.puerto, timeout=600)
+            self._locales.conexion = conexion
+            with self._lock:
+                self._conexiones.append(conexion)
+        return conexion
+
+    def _post(self, mensaje):
+        """Respuesta JSON-RPC a un mensaje (None si el servidor responde 202)"""
+        cuerpo = json.dumps(mensaje).encode("utf-8")
+        reintentos = 0
+        while True:
+            conexion = self._conexion()
+            try:
+                conexion.request("POST", self.ruta, body=cuerpo, headers=self.cabeceras)
+                respuesta = conexion.getresponse()
+                datos = respuesta.read()
+            except (http.client.HTTPException, ConnectionError):
+                # Conexión keep-alive cerrada por el servidor: se abre otra
+                conexion.close()
+                self._locales.conexion = None
+                reintentos += 1
+                if reintentos > 1:
+                    raise
+                continue
+            sesion = respuesta.getheader("Mcp-Session-Id")
+            if sesion:
+                self.cabeceras["Mcp-Session-Id"] = sesion
+            if respuesta.status == 429:
+                with self._lock:
+                    self.rechazadas += 1
+                time.sleep(float(respuesta.getheader("Retry-After") or 1))
+                continue
+            if respuesta.status == 202:
+                return None
+            if "text/event-stream" in (respuesta.getheader("Content-Type") or ""):
+                return _mensaje_sse(datos, mensaje.get("id"))
+            if not datos:
+                return {"error": {"message": f"HTTP {respuesta.status}"}}
+            return json.loads(datos)
+
+    def _completar(self, pendiente, mensaje):
+        try:
+            respuesta = self._post(mensaje)
+        except Exception as e:
+            respuesta = {"error": {"message": str(e)}}
+        pendiente["fin"] = time.perf_counter()
+        pendiente["respuesta"] = respuesta or {}
+        pendiente["evento"].set()
+        if pendiente["aviso"]:
+            pendiente["aviso"](pendiente)
+
+    def enviar(self, metodo, params=None, aviso=None, **datos):
+        """Envía una petición; devuelve su registro (con "evento" para esperarla)"""
+        with self._lock:
+            self._siguiente += 1
+            pendiente = dict(datos, id=self._siguiente, evento=threading.Event(), aviso=aviso)
+        mensaje = {"jsonrpc": "2.0", "id": pendiente["id"], "method": metodo, "params": params or {}}
+        pendiente["inicio"] = time.perf_counter()
+        self._executor.submit(self._completar, pendiente, mensaje)
+        return pendiente
+
+    def llamar(self, metodo, params=None, timeout=600):
+        pendiente = self.enviar(metodo, params)
+        if not pendiente["evento"].wait(timeout):
+            raise TimeoutError(f"{metodo} sin respuesta en {timeout} s")
+        return pendiente["respuesta"]
+
+    def cerrar(self):
+        self._executor.shutdown(wait=True)
+        if "Mcp-Session-Id" in self.cabeceras:
+            # Cierra la sesión en el servidor (si sigue vivo)
+            try:
+                conexion = self._conexion()
+                conexion.request("DELETE", self.ruta, headers=self.cabeceras)
+                conexion.getresponse().read()
+            except (http.client.HTTPException, OSError):
+                pass
+        for conexion in self._conexiones:
+            conexion.close()
+
+
+def _es_error(respuesta):
+    return "error" in respuesta or bool((respuesta.get("result") or {}).get("isError"))
+
+
+def _esperar_provision(cliente, herramientas, timeout=600):
+    """Espera a que termine la revisión de índices y derivadas del arranque"""
+    if "diagnostico_indices" not in herramientas:
+        return
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        respuesta = cliente.llamar("tools/call", {"name": "diagnostico_indices", "arguments": {}})
+        texto = "".join(c.get("text", "") for c in (respuesta.get("result") or {}).get("content", []))
+        if "en_curso" not in texto and "pendiente" not in texto:
+            return
+        time.sleep(0.5)
+
+
+def ejecutar(db_path, mezcla="mixta", peticiones=500, concurrencia=4, semilla=1, calentamiento=1,
+             formato=None, entorno=None, progreso=None, transporte="stdio", clientes=1, url=None, token=None):
+    """Ejecuta la carga contra un servidor nuevo (o el de `url`) repartida
+    entre `clientes` sesiones y devuelve el informe (dict)"""
+    pesos = MEZCLAS[mezcla]
+    rng = random.Random(semilla)
+    ctx = Contexto(db_path)
+    servidor = None
+    if transporte == "http" and url is None:
+        servidor = ServidorHTTPLocal(db_path, entorno)
+    sesiones = []
+    try:
+        for _ in range(max(1, clientes)):
+            if transporte == "http":
+                sesiones.append(ClienteHTTP(url or servidor.url, token, hilos=concurrencia))
+            else:
+                sesiones.append(ClienteStdio(db_path, entorno))
+            sesiones[-1].llamar("initialize", {"protocolVersion": "2024-11-05", "capabilities": {},
+                                               "clientInfo": {"name": "smartperlahub-benchmark", "version": "1.0"}})
+        cliente = sesiones[0]
+        herramientas = {t["name"] for t in cliente.llamar("tools/list")["result"]["tools"]}
+        nombres = [n for n in pesos if n in herramientas]
+        if not nombres:
+            raise ValueError(f"Ninguna herramienta de la mezcla '{mezcla}' está disponible")
+        for cliente in sesiones:
+            _esperar_provision(cliente, herramientas)
+
+        def argumentos(nombre):
+            args = ARGUMENTOS[nombre](rng, ctx)
+            if formato:
+                args["formato"] = formato
+            return args
+
+        # Calentamiento (no se mide): cada herramienta de la mezcla, en serie
+        for cliente in sesiones:
+            for nombre in nombres:
+                for _ in range(calentamiento):
+                    cliente.llamar("tools/call", {"name": nombre, "arguments": argumentos(nombre)})
+
+        plan = rng.choices(nombres, weights=[pesos[n] for n in nombres], k=peticiones)
+        hueco = threading.Semaphore(concurrencia)
+        lock = threading.Lock()
+        terminadas = []
+
+        def aviso(pendiente):
+            with lock:
+                terminadas.append(pendiente)
+                hechas = len(terminadas)
+            hueco.release()
+            if progreso:
+                progreso(hechas, peticiones)
+
+        inicio = time.perf_counter()
+        enviadas = []
+        for i, nombre in enumerate(plan):
+            hueco.acquire()
+            # Las peticiones se reparten por turnos entre las sesiones
+            enviadas.append(sesiones[i % len(sesiones)].enviar(
+                "tools/call", {"name": nombre, "arguments": argumentos(nombre)}, aviso, herramienta=nombre,
+            ))
+        for pendiente in enviadas:
+            pendiente["evento"].wait()
+        duracion = time.perf_counter() - inicio
+    finally:
+        for cliente in sesiones:
+            cliente.cerrar()
+        if servidor is not None:
+            servidor.cerrar()
+
+    por_herramienta = {}
+    for pendiente in enviadas:
+        datos = por_herramienta.setdefault(pendiente["herramienta"], ([], [0]))
+        datos[0].append((pendiente["fin"] - pendiente["inicio"]) * 1000)
+        datos[1][0] += _es_error(pendiente["respuesta"])
+
+    return {
+        "version": 1,
+        "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "configuracion": {
+            "db": os.path.abspath(db_path),
+            "mezcla": mezcla,
+            "peticiones": peticiones,
+            "concurrencia": concurrencia,
+            "transporte": transporte,
+            "clientes": max(1, clientes),
+            "semilla": semilla,
+            "formato": formato,
+            "entorno": entorno or {},
+        },
+        "sistema": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "plataforma": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "duracion_s": duracion,
+        "rechazadas_429": sum(getattr(cliente, "rechazadas", 0) for cliente in sesiones),
+        "total": estadisticas(
+            [ms for latencias, _ in por_herramienta.values() for ms in latencias],
+            sum(errores[0] for _, errores in por_herramienta.values()), duracion,
+        ),
+        "herramientas": {
+            nombre: estadisticas(latencias, errores[0], duracion)
+            for nombre, (latencias, errores) in sorted(por_herramienta.items())
+        },
+    }
+
+
+def comparar(anterior, actual, tolerancia=0.2):
+    """Líneas de texto con la variación por herramienta y lista de regresiones
+    (p95 que empeora más que `tolerancia`)"""
+    lineas = [f"{'herramienta':<24} {'p50 ms':>18} {'p95 ms':>18} {'pet/s':>16}"]
+    if anterior.get("configuracion") != actual.get("configuracion"):
+        lineas.insert(0, "⚠️ Los informes no tienen la misma configuración (db, mezcla, concurrencia...)")
+    regresiones = []
+    filas = dict(actual["herramientas"], TOTAL=actual["total"])
+    previas = dict(anterior["herramientas"], TOTAL=anterior["total"])
+    for nombre, datos in filas.items():
+        previo = previas.get(nombre)
+        if not previo or not previo.get("p95_ms") or not datos.get("p95_ms"):
+            continue
+
+        def celda(clave, ancho):
+            antes, ahora = previo[clave], datos[clave]
+            return f"{antes:,.1f}→{ahora:,.1f} ({(ahora - antes) / antes:+.0%})".rjust(ancho) if antes else "-".rjust(ancho)
+
+        lineas.append(f"{nombre:<24} {celda('p50_ms', 18)} {celda('p95_ms', 18)} {celda('peticiones_por_s', 16)}")
+        if nombre != "TOTAL" and datos["p95_ms"] > previo["p95_ms"] * (1 + tolerancia):
+            regresiones.append(nombre)
+    return lineas, regresiones
+
+
+def resumen(informe):
+    """Tabla legible del informe"""
+    lineas = [
+        f"{informe['total']['llamadas']:,} peticiones en {informe['duracion_s']:.2f} s "
+        f"({informe['total']['peticiones_por_s']:,.1f} pet/s, concurrencia "
+        f"{informe['configuracion']['concurrencia']}, {informe['configuracion'].get('transporte', 'stdio')} "
+        f"con {informe['configuracion'].get('clientes', 1)} clientes)",
+        f"{'herramienta':<24} {'llamadas':>8} {'err':>4} {'pet/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'máx':>9}",
+    ]
+    for nombre, datos in dict(informe["herramientas"], TOTAL=informe["total"]).items():
+        lineas.append(
+            f"{nombre:<24} {datos['llamadas']:>8,} {datos['errores']:>4} {datos['peticiones_por_s']:>8.1f} "
+            + " ".join(f"{datos[c]:>9.1f}" for c in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))
+        )
+    return lineas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del servidor MCP de SmartPerlahub (stdio o HTTP)")
+    parser.add_argument("--db", default=os.getenv("DB_PATH", "smartperlahub.db"),
+                        help="Base de datos (o directorio Parquet) que sirve el servidor")
+    parser.add_argument("--mezcla", choices=sorted(MEZCLAS), default="mixta", help="Carga de trabajo")
+    parser.add_argument("--peticiones", type=int, default=500, help="Llamadas medidas")
+    parser.add_argument("--concurrencia", type=int, default=4, help="Peticiones en vuelo a la vez")
+    parser.add_argument("--transporte", choices=["stdio", "http"], default="stdio",
+                        help="stdio: un proceso por cliente; http: un servidor compartido")
+    parser.add_argument("--clientes", type=int, default=1,
+                        help="Sesiones entre las que se reparten las peticiones")
+    parser.add_argument("--url", help="Servidor HTTP ya arrancado (implica --transporte http)")
+    parser.add_argument("--token", default=os.getenv("MCP_HTTP_TOKEN"), help="Token Bearer del servidor HTTP")
+    parser.add_argument("--semilla", type=int, default=1, help="Semilla de la secuencia de llamadas")
+    parser.add_argument("--calentamiento", type=int, default=1,
+                        help="Llamadas sin medir por herramienta antes de empezar")
+    parser.add_argument("--formato", choices=["texto", "json", "csv", "ndjson"],
+                        help="Formato de salida pedido a las herramientas")
+    parser.add_argument("--sin-cache", action="store_true", help="Arrancar el servidor con CACHE_MB=0")
+    parser.add_argument("--env", action="append", default=[], metavar="VAR=VALOR",
+                        help="Variable de entorno extra para el servidor (repetible)")
+    parser.add_argument("--salida", help="Fichero JSON del informe (por defecto, stdout)")
+    parser.add_argument("--comparar", metavar="JSON", help="Informe anterior con el que comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.2,
+                        help="Empeoramiento del p95 que se considera regresión (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    entorno = dict(valor.split("=", 1) for valor in args.env)
+    if args.sin_cache:
+        entorno["CACHE_MB"] = "0"
+
+    def progreso(hechas, total):
+        if hechas % max(1, total // 10) == 0:
+            print(f"  ... {hechas:,}/{total:,}", file=sys.stderr)
+
+    informe = ejecutar(
+        args.db, mezcla=args.mezcla, peticiones=args.peticiones, concurrencia=args.concurrencia,
+        semilla=args.semilla, calentamiento=args.calentamiento, formato=args.formato,
+        entorno=entorno, progreso=progreso, transporte="http" if args.url else args.transporte,
+        clientes=args.clientes, url=args.url, token=args.token,
+    )
+    for linea in resumen(informe):
+        print(linea, file=sys.stderr)
+
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+    else:
+        print(texto)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            anterior = json.load(f)
+        lineas, regresiones = comparar(anterior, informe, args.tolerancia)
+        print("", file=sys.stderr)
+        for linea in lineas:
+            print(linea, file=sys.stderr)
+        if regresiones:
+            print(f"⚠️ Regresión de p95 (> {args.tolerancia:.0%}): {', '.join(regresiones)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
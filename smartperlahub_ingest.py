@@ -0,0 +1,713 @@
+#!/usr/bin/env python3
+"""
+SmartPerlahub - Carga masiva de logs de auditoría de PerlAhub en smartperlahub.db
+
+Lee ficheros de log (una entrada JSON por línea, opcionalmente .gz), los
+analiza en un pool de procesos y los inserta por lotes con executemany dentro
+de transacciones grandes en modo WAL. El avance de cada fichero se guarda en
+ingest_checkpoints (offset en bytes del contenido sin comprimir) en la misma
+transacción que sus filas, por lo que una carga interrumpida se reanuda sin
+duplicar ni perder registros.
+
+Con --exportar-parquet DIR vuelca además las tablas a Parquet particionado
+por día (DIR/<tabla>/dia=AAAA-MM-DD/), el formato que lee el servidor con
+ALMACEN=parquet (necesita DuckDB).
+
+Uso:
+    python3 smartperlahub_ingest.py --db smartperlahub.db audit_logs_download/
+    python3 smartperlahub_ingest.py --db smartperlahub.db --exportar-parquet parquet/
+"""
+
+import argparse
+import csv
+import glob
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import smartperlahub_mcp_fixed as servidor
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS restrictions (
+    id INTEGER PRIMARY KEY,
+    trace_id TEXT,
+    restriction_type TEXT,
+    context_data TEXT,
+    hotel_id INTEGER,
+    occurred_at TEXT
+);
+CREATE TABLE IF NOT EXISTS exceptions (
+    id INTEGER PRIMARY KEY,
+    trace_id TEXT,
+    exception_type TEXT,
+    exception_message TEXT,
+    context_data TEXT,
+    occurred_at TEXT,
+    template_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS client_searches (
+    id INTEGER PRIMARY KEY,
+    trace_id TEXT,
+    hotel_id INTEGER,
+    duration_ms INTEGER,
+    request_data TEXT,
+    response_data TEXT,
+    initiated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS provider_searches (
+    id INTEGER PRIMARY KEY,
+    trace_id TEXT,
+    provider_name TEXT,
+    hotel_id INTEGER,
+    duration_ms INTEGER,
+    request_data TEXT,
+    response_data TEXT,
+    initiated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS connector_searches (
+    id INTEGER PRIMARY KEY,
+    trace_id TEXT,
+    connector_name TEXT,
+    hotel_id INTEGER,
+    duration_ms INTEGER,
+    request_data TEXT,
+    response_data TEXT,
+    initiated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS logins (
+    id INTEGER PRIMARY KEY,
+    trace_id TEXT,
+    user_data TEXT,
+    login_at TEXT
+);
+CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+    path TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+# Columnas que se insertan en cada tabla (id lo asigna SQLite)
+COLUMNAS = {
+    "restrictions": ("trace_id", "restriction_type", "context_data", "hotel_id", "occurred_at"),
+    "exceptions": ("trace_id", "exception_type", "exception_message", "context_data", "occurred_at", "template_id"),
+    "client_searches": ("trace_id", "hotel_id", "duration_ms", "request_data", "response_data", "initiated_at"),
+    "provider_searches": ("trace_id", "provider_name", "hotel_id", "duration_ms", "request_data", "response_data", "initiated_at"),
+    "connector_searches": ("trace_id", "connector_name", "hotel_id", "duration_ms", "request_data", "response_data", "initiated_at"),
+    "logins": ("trace_id", "user_data", "login_at"),
+}
+
+# AuditType (nombre normalizado o código) -> tabla
+TIPOS_AUDITORIA = {
+    "restriction": "restrictions",
+    "restrictions": "restrictions",
+    "exception": "exceptions",
+    "exceptions": "exceptions",
+    "clientsearch": "client_searches",
+    "providersearch": "provider_searches",
+    "connectorsearch": "connector_searches",
+    "login": "logins",
+    "13": "restrictions",
+}
+
+# Códigos numéricos de "Restriction" vistos en AuditReferences
+RESTRICCIONES = {
+    "11": "ExcludeHotelByConnection",
+}
+
+EXTENSIONES_LOG = (".log", ".jsonl", ".json", ".ndjson", ".txt", ".gz")
+
+
+def _normalizar(clave):
+    return str(clave).replace("_", "").replace("-", "").lower()
+
+
+def _campo(registro, *nombres):
+    """Primer valor presente entre varios nombres de campo (sin distinguir mayúsculas ni "_")"""
+    for nombre in nombres:
+        valor = registro.get(nombre)
+        if valor is not None:
+            return valor
+    buscados = {_normalizar(nombre) for nombre in nombres}
+    for clave, valor in registro.items():
+        if valor is not None and _normalizar(clave) in buscados:
+            return valor
+    return None
+
+
+def _texto(valor):
+    """Objetos JSON anidados se guardan como texto JSON"""
+    if valor is None or isinstance(valor, str):
+        return valor
+    return json.dumps(valor, ensure_ascii=False, separators=(",", ":"))
+
+
+def _entero(valor):
+    if valor is None or isinstance(valor, bool):
+        return None
+    try:
+        return int(float(valor))
+    except (TypeError, ValueError):
+        return None
+
+
+FORMATO_FECHA = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _fecha(valor):
+    """Fecha ISO 8601 en UTC con microsegundos (las marcas epoch en s o ms y los
+    textos con Z, offset, espacio o fecha sola acaban en el mismo formato)"""
+    if valor is None:
+        return None
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        segundos = valor / 1000 if valor > 1e11 else valor
+        return datetime.fromtimestamp(segundos, tz=timezone.utc).strftime(FORMATO_FECHA)
+    texto = str(valor).strip()
+    if not texto:
+        return None
+    if servidor.PATRON_RELATIVO.match(texto):
+        raise ValueError(f"Fecha relativa en un registro: '{texto}'")
+    return datetime.fromisoformat(servidor.normalizar_instante(texto)).strftime(FORMATO_FECHA)
+
+
+def _hotel(registro, contexto):
+    hotel = _entero(_campo(registro, "HotelId", "hotel_id", "hotelCode"))
+    if hotel is None and contexto:
+        hoteles = servidor.extraer_hoteles(contexto)
+        if len(hoteles) == 1:
+            hotel = hoteles.pop()
+    return hotel
+
+
+def tabla_registro(registro):
+    """Tabla destino según AuditType o, si falta, según los campos presentes"""
+    tipo = _campo(registro, "AuditType", "audit_type", "type", "table")
+    if tipo is not None:
+        tabla = TIPOS_AUDITORIA.get(_normalizar(tipo))
+        if tabla:
+            return tabla
+    if _campo(registro, "Restriction", "RestrictionType") is not None:
+        return "restrictions"
+    if _campo(registro, "ExceptionType", "Exception", "ExceptionMessage") is not None:
+        return "exceptions"
+    if _campo(registro, "DurationMs", "Duration", "ElapsedMs") is not None:
+        if _campo(registro, "Provider", "ProviderName") is not None:
+            return "provider_searches"
+        if _campo(registro, "Connector", "ConnectorName") is not None:
+            return "connector_searches"
+        return "client_searches"
+    if _campo(registro, "User", "UserData", "Login", "LoginAt") is not None:
+        return "logins"
+    return None
+
+
+def convertir_registro(registro):
+    """(tabla, fila) con las columnas de COLUMNAS[tabla], o None si no aplica"""
+    tabla = tabla_registro(registro)
+    if tabla is None:
+        return None
+
+    traza = _texto(_campo(registro, "TraceId", "trace_id"))
+    fecha = _fecha(_campo(registro, "CreatedAtUtc", "OccurredAt", "Timestamp", "Date", "time"))
+    contexto = _texto(_campo(registro, "Context", "ContextData", "Data"))
+
+    if tabla == "restrictions":
+        tipo = _campo(registro, "RestrictionType", "Restriction")
+        tipo = RESTRICCIONES.get(str(tipo), tipo)
+        return tabla, (traza, _texto(tipo), contexto, _hotel(registro, contexto), fecha)
+
+    if tabla == "exceptions":
+        mensaje = _texto(_campo(registro, "ExceptionMessage", "Message", "Exception"))
+        tipo = _texto(_campo(registro, "ExceptionType", "Exception")) or mensaje
+        # Huella de la plantilla del mensaje, calculada en el proceso que analiza
+        return tabla, (traza, tipo, mensaje, contexto, fecha, servidor.huella_excepcion(tipo))
+
+    if tabla == "logins":
+        usuario = _texto(_campo(registro, "User", "UserData", "Login"))
+        return tabla, (traza, usuario, _fecha(_campo(registro, "LoginAt")) or fecha)
+
+    peticion = _texto(_campo(registro, "Request", "RequestData"))
+    respuesta = _texto(_campo(registro, "Response", "ResponseData"))
+    duracion = _entero(_campo(registro, "DurationMs", "Duration", "ElapsedMs"))
+    inicio = _fecha(_campo(registro, "InitiatedAt", "StartedAt")) or fecha
+    hotel = _hotel(registro, peticion)
+
+    if tabla == "provider_searches":
+        proveedor = _texto(_campo(registro, "Provider", "ProviderName"))
+        return tabla, (traza, proveedor, hotel, duracion, peticion, respuesta, inicio)
+    if tabla == "connector_searches":
+        conector = _texto(_campo(registro, "Connector", "ConnectorName"))
+        return tabla, (traza, conector, hotel, duracion, peticion, respuesta, inicio)
+    return tabla, (traza, hotel, duracion, peticion, respuesta, inicio)
+
+
+def parsear_lote(lineas):
+    """Analiza un lote de líneas (en un proceso del pool): {tabla: [filas]}, errores"""
+    filas = {tabla: [] for tabla in COLUMNAS}
+    errores = 0
+    for linea in lineas:
+        linea = linea.strip()
+        if not linea:
+            continue
+        try:
+            registro = json.loads(linea)
+            convertido = convertir_registro(registro) if isinstance(registro, dict) else None
+        except (ValueError, TypeError):
+            convertido = None
+        if convertido is None:
+            errores += 1
+            continue
+        tabla, fila = convertido
+        filas[tabla].append(fila)
+    return filas, errores
+
+
+def abrir_log(ruta):
+    if ruta.endswith(".gz"):
+        return gzip.open(ruta, "rb")
+    return open(ruta, "rb")
+
+
+def lotes_fichero(ruta, offset=0, tamano_lote=5000):
+    """Generador de (offset_final, [líneas]) desde `offset` del contenido sin comprimir"""
+    with abrir_log(ruta) as fichero:
+        if offset:
+            fichero.seek(offset)
+            if fichero.tell() < offset:
+                # .gz más corto que el checkpoint (rotado): desde el principio
+                fichero.seek(0)
+                offset = 0
+        lote = []
+        for linea in fichero:
+            if not linea.endswith(b"\n"):
+                # Línea incompleta al final (fichero aún escribiéndose)
+                break
+            offset += len(linea)
+            lote.append(linea)
+            if len(lote) >= tamano_lote:
+                yield offset, lote
+                lote = []
+        if lote:
+            yield offset, lote
+
+
+def expandir_rutas(rutas):
+    """Ficheros de log a partir de ficheros, directorios o patrones glob"""
+    ficheros = []
+    for ruta in rutas:
+        if os.path.isdir(ruta):
+            for raiz, _, nombres in os.walk(ruta):
+                ficheros.extend(
+                    os.path.join(raiz, nombre) for nombre in nombres
+                    if nombre.lower().endswith(EXTENSIONES_LOG)
+                )
+        elif any(c in ruta for c in "*?["):
+            ficheros.extend(glob.glob(ruta, recursive=True))
+        else:
+            ficheros.append(ruta)
+    return sorted(set(os.path.abspath(f) for f in ficheros))
+
+
+def asegurar_columna_plantilla(conn):
+    """Añade exceptions.template_id y su índice a una base de datos anterior
+    (el servidor no modifica las tablas de auditoría)"""
+    columnas = servidor.columnas_tabla(conn, "exceptions")
+    if not columnas:
+        return False
+    if "template_id" not in columnas:
+        conn.execute("ALTER TABLE exceptions ADD COLUMN template_id INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_exceptions_template_id ON exceptions (template_id)")
+    return True
+
+
+def abrir_db(db_path, cache_mb=256):
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA cache_size = -{int(cache_mb) * 1024}")
+    conn.executescript(ESQUEMA)
+    # Bases de datos creadas antes de la columna template_id
+    asegurar_columna_plantilla(conn)
+    return conn
+
+
+def checkpoint(conn, ruta):
+    fila = conn.execute("SELECT offset FROM ingest_checkpoints WHERE path = ?", (ruta,)).fetchone()
+    return fila[0] if fila else 0
+
+
+class Cargador:
+    """Inserta lotes analizados con executemany en transacciones de `filas_transaccion`"""
+
+    def __init__(self, conn, filas_transaccion=100000):
+        self.conn = conn
+        self.filas_transaccion = filas_transaccion
+        self.pendientes = 0
+        self.insertadas = {tabla: 0 for tabla in COLUMNAS}
+        self.errores = 0
+        self.sentencias = {
+            tabla: f"INSERT INTO {tabla} ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})"
+            for tabla, cols in COLUMNAS.items()
+        }
+
+    def agregar(self, ruta, offset, filas, errores):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        total = 0
+        for tabla, lista in filas.items():
+            if lista:
+                self.conn.executemany(self.sentencias[tabla], lista)
+                self.insertadas[tabla] += len(lista)
+                total += len(lista)
+        self.errores += errores
+        # El checkpoint viaja en la misma transacción que las filas
+        self.conn.execute(
+            "INSERT INTO ingest_checkpoints (path, offset, rows, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET offset = excluded.offset, "
+            "rows = ingest_checkpoints.rows + excluded.rows, updated_at = excluded.updated_at",
+            (ruta, offset, total, datetime.now(timezone.utc).isoformat()),
+        )
+        self.pendientes += total
+        if self.pendientes >= self.filas_transaccion:
+            self.confirmar()
+        return total
+
+    def confirmar(self):
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+        self.pendientes = 0
+
+
+def _resultados_ordenados(ejecutor, trabajos, en_vuelo):
+    """Como Executor.map pero con un máximo de lotes en vuelo (memoria acotada)"""
+    pendientes = deque()
+    for contexto, lineas in trabajos:
+        pendientes.append((contexto, ejecutor.submit(parsear_lote, lineas)))
+        if len(pendientes) >= en_vuelo:
+            contexto, futuro = pendientes.popleft()
+            yield contexto, futuro.result()
+    while pendientes:
+        contexto, futuro = pendientes.popleft()
+        yield contexto, futuro.result()
+
+
+def _trabajos(conn, ficheros, tamano_lote):
+    for ruta in ficheros:
+        offset = checkpoint(conn, ruta)
+        if offset and not ruta.endswith(".gz") and os.path.getsize(ruta) < offset:
+            # Fichero truncado o rotado: se vuelve a leer desde el principio
+            # (los .gz se comprueban al descomprimir, en lotes_fichero)
+            offset = 0
+        for fin, lineas in lotes_fichero(ruta, offset, tamano_lote):
+            yield (ruta, fin), lineas
+
+
+def reiniciar_checkpoints(conn, ficheros):
+    """Borra los checkpoints de los ficheros para leerlos desde el principio.
+    Las filas no guardan su fichero de origen y no se pueden retirar, así que
+    solo se admite con las tablas de auditoría vacías (si no, se duplicarían)"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        con_filas = [
+            tabla for tabla in COLUMNAS
+            if conn.execute(f"SELECT 1 FROM {tabla} LIMIT 1").fetchone()
+        ]
+        if con_filas:
+            raise ValueError(
+                "--reiniciar necesita una base de datos sin filas cargadas "
+                f"(hay filas en {', '.join(con_filas)} y se duplicarían): usa una base nueva con --db"
+            )
+        conn.executemany("DELETE FROM ingest_checkpoints WHERE path = ?", [(ruta,) for ruta in ficheros])
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def cargar(conn, ficheros, procesos=None, tamano_lote=5000, filas_transaccion=100000,
+           reiniciar=False, progreso=None):
+    """Carga los ficheros desde su checkpoint y devuelve el Cargador con los totales"""
+    if reiniciar:
+        reiniciar_checkpoints(conn, ficheros)
+    cargador = Cargador(conn, filas_transaccion)
+    trabajos = _trabajos(conn, ficheros, tamano_lote)
+    try:
+        if procesos == 0:
+            resultados = ((contexto, parsear_lote(lineas)) for contexto, lineas in trabajos)
+            for (ruta, offset), (filas, errores) in resultados:
+                cargador.agregar(ruta, offset, filas, errores)
+                if progreso:
+                    progreso(cargador)
+        else:
+            with ProcessPoolExecutor(max_workers=procesos) as ejecutor:
+                en_vuelo = 2 * (procesos or os.cpu_count() or 1)
+                for (ruta, offset), (filas, errores) in _resultados_ordenados(ejecutor, trabajos, en_vuelo):
+                    cargador.agregar(ruta, offset, filas, errores)
+                    if progreso:
+                        progreso(cargador)
+        cargador.confirmar()
+    except BaseException:
+        # Lo confirmado hasta el último checkpoint se conserva
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    return cargador
+
+
+def _actualizar_derivados(conn, indices=False):
+    """Índices recomendados (opcional) y filas nuevas en las tablas derivadas"""
+    conn.isolation_level = ""
+    try:
+        resultado = {}
+        if indices:
+            resultado["indices"] = servidor.AsesorIndices(conn, True).diagnosticar()
+        resultado["derivados"] = servidor.actualizar_derivados(conn)
+        return resultado
+    finally:
+        conn.isolation_level = None
+
+
+def ingerir(db_path, rutas, procesos=None, tamano_lote=5000, filas_transaccion=100000,
+            reiniciar=False, derivados=True, progreso=None):
+    """Carga los ficheros de log en db_path y devuelve estadísticas de la carga"""
+    ficheros = expandir_rutas(rutas)
+    conn = abrir_db(db_path)
+    inicio = time.perf_counter()
+    try:
+        cargador = cargar(conn, ficheros, procesos, tamano_lote, filas_transaccion, reiniciar, progreso)
+        estadisticas = {
+            "ficheros": len(ficheros),
+            "filas": dict(cargador.insertadas),
+            "errores": cargador.errores,
+            "duracion_s": time.perf_counter() - inicio,
+        }
+        if derivados:
+            estadisticas.update(_actualizar_derivados(conn, indices=True))
+    finally:
+        conn.close()
+    return estadisticas
+
+
+def seguir(db_path, rutas, intervalo=2.0, tamano_lote=5000, filas_transaccion=100000,
+           derivados=True, aviso=None, ciclos=None):
+    """Modo seguimiento: añade en micro-lotes las líneas nuevas de los ficheros
+    (y los ficheros nuevos) cada `intervalo` segundos hasta Ctrl+C.
+
+    Cada ciclo confirma sus filas junto con los checkpoints y actualiza las
+    tablas derivadas de forma incremental (marcas de agua por rowid); solo se
+    abren los ficheros cuyo tamaño o mtime ha cambiado desde el ciclo anterior.
+    """
+    conn = abrir_db(db_path)
+    firmas = {}
+    ciclo = 0
+    try:
+        while ciclos is None or ciclo < ciclos:
+            ciclo += 1
+            cambiados = []
+            for ruta in expandir_rutas(rutas):
+                try:
+                    info = os.stat(ruta)
+                except OSError:
+                    continue
+                firma = (info.st_ino, info.st_size, info.st_mtime_ns)
+                if firmas.get(ruta) != firma:
+                    firmas[ruta] = firma
+                    cambiados.append(ruta)
+
+            if cambiados:
+                cargador = cargar(conn, cambiados, procesos=0, tamano_lote=tamano_lote,
+                                  filas_transaccion=filas_transaccion)
+                total = sum(cargador.insertadas.values())
+                if total and derivados:
+                    _actualizar_derivados(conn)
+                if total and aviso:
+                    aviso(cargador)
+
+            if ciclos is None or ciclo < ciclos:
+                time.sleep(intervalo)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+# Tipos de SQLite -> DuckDB para las columnas exportadas
+TIPOS_PARQUET = {"INTEGER": "BIGINT", "REAL": "DOUBLE"}
+
+# exception_hotels se exporta desnormalizada: el almacén Parquet no hace JOIN
+CONSULTAS_PARQUET = {
+    "exception_hotels": (
+        "SELECT eh.exception_rowid AS _rowid, eh.hotel_id, e.exception_type, e.occurred_at "
+        "FROM exception_hotels eh JOIN exceptions e ON e.rowid = eh.exception_rowid"
+    ),
+}
+
+
+def _columnas_exportadas(conn, tabla):
+    """[(columna, tipo DuckDB)] de la consulta que exporta `tabla`"""
+    if tabla == "exception_hotels":
+        return [("_rowid", "BIGINT"), ("hotel_id", "BIGINT"), ("exception_type", "VARCHAR"),
+                ("occurred_at", "VARCHAR")]
+    columnas = [("_rowid", "BIGINT")]
+    for fila in conn.execute(f"PRAGMA table_info({tabla})"):
+        columnas.append((fila[1], TIPOS_PARQUET.get((fila[2] or "").upper(), "VARCHAR")))
+    return columnas
+
+
+def _sql_texto(valor):
+    return "'" + valor.replace("'", "''") + "'"
+
+
+def exportar_parquet(db_path, destino, filas_lote=5000):
+    """Exporta las tablas a Parquet particionado por día (columna `dia`) con
+    DuckDB. Las filas pasan por un CSV temporal (COPY de DuckDB, mucho más
+    rápido que INSERT desde Python) y cada tabla se escribe en un directorio
+    nuevo que sustituye al anterior al terminar; devuelve {tabla: filas}"""
+    try:
+        import duckdb
+    except ImportError:
+        raise RuntimeError("--exportar-parquet necesita DuckDB: pip install duckdb")
+
+    conn = abrir_db(db_path)
+    os.makedirs(destino, exist_ok=True)
+    temporal = os.path.join(destino, ".exportando.csv")
+    duck = duckdb.connect(":memory:")
+    exportadas = {}
+    try:
+        # exception_hotels y template_id deben cubrir todas las filas
+        _actualizar_derivados(conn)
+        for tabla in servidor.TABLAS_PARQUET:
+            columnas = _columnas_exportadas(conn, tabla)
+            fecha = servidor.COLUMNA_FECHA.get(tabla, "occurred_at")
+            consulta = CONSULTAS_PARQUET.get(tabla, f"SELECT rowid AS _rowid, * FROM {tabla}")
+            filas = 0
+            with open(temporal, "w", newline="", encoding="utf-8") as f:
+                escritor = csv.writer(f)
+                cursor = conn.execute(consulta)
+                while True:
+                    lote = cursor.fetchmany(filas_lote)
+                    if not lote:
+                        break
+                    escritor.writerows(
+                        ["\\N" if valor is None else valor for valor in fila] for fila in lote
+                    )
+                    filas += len(lote)
+
+            salida = os.path.join(destino, tabla)
+            shutil.rmtree(salida, ignore_errors=True)
+            if not filas:
+                exportadas[tabla] = 0
+                continue
+            nueva = salida + ".nueva"
+            shutil.rmtree(nueva, ignore_errors=True)
+            tipos = "{" + ", ".join(f"{_sql_texto(c)}: {_sql_texto(t)}" for c, t in columnas) + "}"
+            duck.execute(
+                f"COPY (SELECT *, substr({fecha}, 1, 10) AS dia FROM read_csv({_sql_texto(temporal)}, "
+                f"columns = {tipos}, header = false, nullstr = '\\N', quote = '\"', escape = '\"')) "
+                f"TO {_sql_texto(nueva)} (FORMAT PARQUET, PARTITION_BY (dia))"
+            )
+            os.replace(nueva, salida)
+            exportadas[tabla] = filas
+    finally:
+        duck.close()
+        conn.close()
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return exportadas
+
+
+def _exportar(db_path, destino):
+    inicio = time.perf_counter()
+    exportadas = exportar_parquet(db_path, destino)
+    print(f"🦆 Parquet exportado en {destino} ({time.perf_counter() - inicio:.1f} s)")
+    for tabla, filas in exportadas.items():
+        print(f"• {tabla}: {filas:,}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Carga logs de auditoría de PerlAhub en SQLite")
+    parser.add_argument("rutas", nargs="*", help="Ficheros, directorios o patrones glob (admite .gz)")
+    parser.add_argument("--db", default=os.getenv("DB_PATH", "smartperlahub.db"), help="Base de datos destino")
+    parser.add_argument("--procesos", type=int, default=None,
+                        help="Procesos de análisis (por defecto, uno por CPU; 0 = sin pool)")
+    parser.add_argument("--lote", type=int, default=5000, help="Líneas por lote de análisis")
+    parser.add_argument("--transaccion", type=int, default=100000, help="Filas por transacción")
+    parser.add_argument("--reiniciar", action="store_true", help="Ignorar los checkpoints guardados (solo con la base de datos vacía)")
+    parser.add_argument("--sin-derivados", action="store_true",
+                        help="No crear índices ni actualizar las tablas derivadas al terminar")
+    parser.add_argument("--seguir", action="store_true",
+                        help="Tras la carga, seguir añadiendo las líneas nuevas (como tail -f)")
+    parser.add_argument("--intervalo", type=float, default=2.0,
+                        help="Segundos entre micro-lotes en modo --seguir")
+    parser.add_argument("--exportar-parquet", metavar="DIR",
+                        help="Al terminar, exportar las tablas a Parquet por día (ALMACEN=parquet)")
+    args = parser.parse_args(argv)
+    if not args.rutas and not args.exportar_parquet:
+        parser.error("indica ficheros de log o --exportar-parquet")
+    if args.seguir and args.exportar_parquet:
+        parser.error("--seguir no admite --exportar-parquet")
+
+    ultimo = [0.0]
+
+    def progreso(cargador):
+        ahora = time.monotonic()
+        if ahora - ultimo[0] >= 5:
+            ultimo[0] = ahora
+            total = sum(cargador.insertadas.values())
+            print(f"  ... {total:,} filas cargadas", file=sys.stderr)
+
+    if not args.rutas:
+        _exportar(args.db, args.exportar_parquet)
+        return
+
+    try:
+        estadisticas = ingerir(
+            args.db, args.rutas,
+            procesos=args.procesos,
+            tamano_lote=args.lote,
+            filas_transaccion=args.transaccion,
+            reiniciar=args.reiniciar,
+            derivados=not args.sin_derivados,
+            progreso=progreso,
+        )
+    except ValueError as error:
+        parser.error(str(error))
+
+    total = sum(estadisticas["filas"].values())
+    print(f"✅ {total:,} filas cargadas de {estadisticas['ficheros']} ficheros "
+          f"en {estadisticas['duracion_s']:.1f} s")
+    for tabla, filas in estadisticas["filas"].items():
+        print(f"• {tabla}: {filas:,}")
+    if estadisticas["errores"]:
+        print(f"⚠️ {estadisticas['errores']:,} líneas no reconocidas")
+
+    if args.exportar_parquet:
+        _exportar(args.db, args.exportar_parquet)
+
+    if args.seguir:
+        def aviso(cargador):
+            nuevas = ", ".join(f"{tabla}: +{filas:,}" for tabla, filas in cargador.insertadas.items() if filas)
+            print(f"{datetime.now():%H:%M:%S} {nuevas}", flush=True)
+
+        print(f"👀 Siguiendo los ficheros cada {args.intervalo:g} s (Ctrl+C para terminar)", flush=True)
+        seguir(
+            args.db, args.rutas,
+            intervalo=args.intervalo,
+            tamano_lote=args.lote,
+            filas_transaccion=args.transaccion,
+            derivados=not args.sin_derivados,
+            aviso=aviso,
+        )
+
+
+if __name__ == "__main__":
+    main()
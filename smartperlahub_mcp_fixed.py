@@ -4,139 +4,3681 @@ SmartPerlahub MCP Server - Versión corregida con esquemas MCP válidos
 """
 
 import asyncio
+import base64
+import contextvars
+import cProfile
+import csv
+import functools
+import glob
+import hashlib
+import hmac
+import importlib
+import io
 import json
+import math
+import re
+import secrets
+import signal
 import sqlite3
+import stat
 import sys
 import os
-from typing import Any, Dict, List, Optional
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import urlsplit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Tamaño máximo de una línea JSON-RPC leída de stdin
+LIMITE_LINEA = 64 * 1024 * 1024
+# Bytes pendientes a partir de los cuales se escribe sin esperar al final de la vuelta
+ESCRITURA_MAX = 1024 * 1024
+
+# Códigos de error JSON-RPC 2.0 (y el de recurso desconocido de MCP)
+ERROR_PARSEO = -32700
+SOLICITUD_INVALIDA = -32600
+METODO_NO_ENCONTRADO = -32601
+PARAMETROS_INVALIDOS = -32602
+ERROR_INTERNO = -32603
+RECURSO_NO_ENCONTRADO = -32002
+# Error de servidor (rango -32000..-32099): sesión o servidor saturados
+SERVIDOR_OCUPADO = -32000
+
+# Versiones del protocolo MCP que se aceptan en initialize (la primera es la
+# más reciente, la que se ofrece si el cliente pide otra)
+PROTOCOLOS = ("2025-03-26", "2024-11-05")
+
+
+class ErrorJSONRPC(Exception):
+    """Error que se devuelve como objeto `error` de JSON-RPC con su código"""
+
+    def __init__(self, codigo, mensaje):
+        super().__init__(mensaje)
+        self.codigo = codigo
+
+
+def codificar_json(mensaje):
+    """Mensaje JSON-RPC → bytes UTF-8 (orjson si está instalado)"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(mensaje, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # enteros de más de 64 bits o surrogates sueltos: json sí los admite
+            pass
+    return json.dumps(mensaje, separators=(",", ":"), default=str).encode("ascii")
+
+
+def decodificar_json(linea):
+    """bytes de una línea → objeto JSON; ValueError si no es JSON válido"""
+    if orjson is not None:
+        try:
+            return orjson.loads(linea)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(linea)
+
+
+class EscritorSalida:
+    """Agrupa las respuestas de una misma vuelta del bucle de eventos en una
+    sola escritura (y un solo flush) en stdout"""
+
+    def __init__(self):
+        self._pendiente = []
+        self._bytes = 0
+        self._programado = False
+
+    def escribir(self, datos):
+        self._pendiente.append(datos)
+        self._bytes += len(datos)
+        if self._bytes >= ESCRITURA_MAX:
+            self.vaciar()
+            return
+        if not self._programado:
+            try:
+                asyncio.get_running_loop().call_soon(self.vaciar)
+            except RuntimeError:
+                self.vaciar()
+                return
+            self._programado = True
+
+    def vaciar(self):
+        self._programado = False
+        if not self._pendiente:
+            return
+        datos = b"".join(self._pendiente)
+        self._pendiente.clear()
+        self._bytes = 0
+        salida = sys.stdout.buffer
+        salida.write(datos)
+        salida.flush()
+
+
+SALIDA = EscritorSalida()
+
+
+class _Solicitud:
+    """Petición tools/call en curso; permite abortar su SQL al cancelarla"""
+
+    def __init__(self, msg_id):
+        self.id = msg_id
+        self.cancelada = False
+        self._conexiones = set()
+        self._lock = threading.Lock()
+
+    def registrar(self, conn):
+        with self._lock:
+            if self.cancelada:
+                raise sqlite3.OperationalError("interrupted")
+            self._conexiones.add(conn)
+
+    def liberar(self, conn):
+        with self._lock:
+            self._conexiones.discard(conn)
+
+    def cancelar(self):
+        with self._lock:
+            self.cancelada = True
+            for conn in self._conexiones:
+                conn.interrupt()
+
+
+# Petición asociada al hilo worker que ejecuta la herramienta
+_solicitud_actual = contextvars.ContextVar("solicitud_actual", default=None)
+
+
+# Posiciones de cada sentencia registrada en una Medicion
+SQL_TEXTO, SQL_PARAMETROS, SQL_MS, SQL_FILAS, SQL_PASOS = range(5)
+
+# Instrucciones de la VM de SQLite entre llamadas al contador de pasos
+PASOS_PROGRESO = 10000
+FILAS_ITERACION = 512
+
+
+def huella_sql(sql):
+    """(sql_id, texto normalizado) de una sentencia: el id es la huella del SQL
+    con los espacios colapsados, estable entre procesos y sin recortar"""
+    normalizado = " ".join(str(sql).split())
+    return hashlib.blake2b(normalizado.encode("utf-8"), digest_size=8).hexdigest(), normalizado
+
+
+class Medicion:
+    """Tiempos y contadores de una llamada tools/call, de la cola del executor
+    a la respuesta escrita en stdout"""
+
+    def __init__(self, herramienta):
+        self.herramienta = herramienta
+        self.inicio = time.perf_counter()
+        self.espera_ms = 0.0
+        self.verificar_ms = 0.0
+        self.herramienta_ms = 0.0
+        self.serializacion_ms = 0.0
+        self.bytes = 0
+        self.cache = None
+        self.error = False
+        self.sentencias = []
+        self.actual = None
+    
+    def sentencia(self, sql, parametros):
+        registro = [sql, parametros, 0.0, 0, 0]
+        self.sentencias.append(registro)
+        return registro
+    
+    @property
+    def sql_ms(self):
+        return sum(registro[SQL_MS] for registro in self.sentencias)
+
+
+# Medición de la llamada que ejecuta el hilo actual (None = no se mide)
+_medicion_actual = contextvars.ContextVar("medicion_actual", default=None)
+
+
+def _contar_pasos():
+    """Progress handler: atribuye pasos de la VM a la sentencia en curso"""
+    medicion = _medicion_actual.get()
+    if medicion is not None and medicion.actual is not None:
+        medicion.actual[SQL_PASOS] += PASOS_PROGRESO
+    return 0
+
+
+class CursorMedido(sqlite3.Cursor):
+    """Cursor que suma a la medición en curso el tiempo pasado dentro de
+    SQLite y las filas devueltas por cada sentencia (también entre páginas
+    de consulta_sql, que se leen en llamadas distintas)"""
+
+    _sql = None
+    _parametros = ()
+    _medicion = None
+    _registro = None
+
+    def _activar(self, nueva=False):
+        medicion = _medicion_actual.get()
+        if medicion is None:
+            return None
+        if nueva or self._medicion is not medicion:
+            self._medicion = medicion
+            self._registro = medicion.sentencia(self._sql, self._parametros)
+        medicion.actual = self._registro
+        return self._registro
+
+    def _medir(self, registro, inicio, filas):
+        if registro is not None:
+            registro[SQL_MS] += (time.perf_counter() - inicio) * 1000
+            registro[SQL_FILAS] += filas
+
+    def execute(self, sql, parametros=()):
+        self._sql, self._parametros = sql, parametros
+        registro = self._activar(nueva=True)
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            self._medir(registro, inicio, 0)
+
+    def fetchone(self):
+        registro = self._activar()
+        inicio = time.perf_counter()
+        fila = super().fetchone()
+        self._medir(registro, inicio, fila is not None)
+        return fila
+
+    def fetchmany(self, size=None):
+        registro = self._activar()
+        inicio = time.perf_counter()
+        filas = super().fetchmany(self.arraysize if size is None else size)
+        self._medir(registro, inicio, len(filas))
+        return filas
+
+    def fetchall(self):
+        registro = self._activar()
+        inicio = time.perf_counter()
+        filas = super().fetchall()
+        self._medir(registro, inicio, len(filas))
+        return filas
+
+    def __next__(self):
+        registro = self._activar()
+        inicio = time.perf_counter()
+        try:
+            fila = super().__next__()
+        except StopIteration:
+            self._medir(registro, inicio, 0)
+            raise
+        self._medir(registro, inicio, 1)
+        return fila
+
+    def __iter__(self):
+        # `for fila in cursor` lee por lotes: medir fila a fila duplicaba el
+        # coste de los recorridos largos
+        while True:
+            filas = self.fetchmany(FILAS_ITERACION)
+            if not filas:
+                return
+            yield from filas
+
+
+class ConexionMedida(sqlite3.Connection):
+    """Conexión cuyas sentencias usan CursorMedido (conn.execute incluido)"""
+
+    def cursor(self, factory=CursorMedido):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+
+def progreso_base(conn):
+    """Progress handler propio de la conexión: el contador de pasos en las
+    medidas (ConexionMedida), ninguno en las demás"""
+    if isinstance(conn, ConexionMedida):
+        conn.set_progress_handler(_contar_pasos, PASOS_PROGRESO)
+    else:
+        conn.set_progress_handler(None, 0)
+
+
+class PoolConexiones:
+    """Pool de conexiones SQLite de solo lectura, reutilizadas entre workers"""
+
+    def __init__(self, db_path, tamano=4, mmap_mb=256, cache_mb=64, sentencias=256, medir=False):
+        self.uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+        self.tamano = max(1, tamano)
+        self.medir = medir
+        self.mmap_bytes = mmap_mb * 1024 * 1024
+        self.cache_kib = cache_mb * 1024
+        self.sentencias = sentencias
+        
+        # LIFO: se reutiliza primero la conexión con la caché más caliente
+        self._libres = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._creadas = 0
+        self._cerrado = False
+        self._separadas = set()
+        self._stats = {
+            "prestamos": 0,
+            "esperas": 0,
+            "espera_total_ms": 0.0,
+            "en_uso": 0,
+            "max_en_uso": 0,
+            "descartadas": 0,
+            "separadas": 0,
+        }
+
+    def _abrir(self):
+        conn = sqlite3.connect(
+            self.uri,
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.sentencias,
+            factory=ConexionMedida if self.medir else sqlite3.Connection,
+        )
+        progreso_base(conn)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_bytes)}")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_kib)}")
+        return conn
+
+    def _obtener(self):
+        try:
+            return self._libres.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            crear = self._creadas < self.tamano
+            if crear:
+                self._creadas += 1
+        if crear:
+            try:
+                return self._abrir()
+            except Exception:
+                with self._lock:
+                    self._creadas -= 1
+                raise
+        
+        # Pool agotado: esperar a que un worker devuelva su conexión
+        inicio = time.perf_counter()
+        conn = self._libres.get()
+        with self._lock:
+            self._stats["esperas"] += 1
+            self._stats["espera_total_ms"] += (time.perf_counter() - inicio) * 1000
+        return conn
+
+    def _devolver(self, conn, sana):
+        if sana and not self._cerrado:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                sana = False
+        if sana and not self._cerrado:
+            self._libres.put(conn)
+            return
+        conn.close()
+        with self._lock:
+            self._creadas -= 1
+            self._stats["descartadas"] += 1
+
+    @contextmanager
+    def conexion(self):
+        """Presta una conexión al hilo actual y la devuelve al terminar"""
+        if self._cerrado:
+            raise sqlite3.ProgrammingError("Pool de conexiones cerrado")
+        conn = self._obtener()
+        with self._lock:
+            self._stats["prestamos"] += 1
+            self._stats["en_uso"] += 1
+            self._stats["max_en_uso"] = max(self._stats["max_en_uso"], self._stats["en_uso"])
+        sana = True
+        try:
+            yield conn
+        except (sqlite3.ProgrammingError, sqlite3.InterfaceError):
+            sana = False
+            raise
+        finally:
+            with self._lock:
+                self._stats["en_uso"] -= 1
+                separada = conn in self._separadas
+                if separada:
+                    self._separadas.discard(conn)
+                    self._creadas -= 1
+                    self._stats["separadas"] += 1
+            if not separada:
+                self._devolver(conn, sana)
+
+    def separar(self, conn):
+        """La conexión prestada no vuelve al pool al terminar el préstamo (un
+        cursor de consulta_sql la usa entre páginas y la cierra); su hueco
+        queda libre para abrir otra"""
+        with self._lock:
+            self._separadas.add(conn)
+
+    def estadisticas(self):
+        with self._lock:
+            datos = dict(self._stats)
+            datos["abiertas"] = self._creadas
+        datos["libres"] = self._libres.qsize()
+        datos["tamano"] = self.tamano
+        datos["sentencias_cacheadas"] = self.sentencias
+        datos["mmap_mb"] = self.mmap_bytes // (1024 * 1024)
+        datos["cache_mb"] = self.cache_kib // 1024
+        return datos
+
+    def cerrar(self):
+        self._cerrado = True
+        while True:
+            try:
+                self._libres.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class CacheResultados:
+    """Caché LRU de resultados de herramientas con TTL y tope en bytes"""
+
+    def __init__(self, capacidad_bytes=32 * 1024 * 1024, ttl=300.0):
+        self.capacidad_bytes = capacidad_bytes
+        self.ttl = ttl
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "aciertos": 0,
+            "fallos": 0,
+            "expiradas": 0,
+            "desalojos": 0,
+            "invalidaciones": 0,
+            "demasiado_grandes": 0,
+        }
+
+    def obtener(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self._stats["fallos"] += 1
+                return None
+            expira, tamano, resultado = entrada
+            if expira <= ahora:
+                del self._entradas[clave]
+                self._bytes -= tamano
+                self._stats["expiradas"] += 1
+                self._stats["fallos"] += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self._stats["aciertos"] += 1
+            return resultado
+
+    def guardar(self, clave, resultado, tamano):
+        if self.capacidad_bytes <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            if tamano > self.capacidad_bytes:
+                self._stats["demasiado_grandes"] += 1
+                return
+            anterior = self._entradas.pop(clave, None)
+            if anterior is not None:
+                self._bytes -= anterior[1]
+            while self._entradas and self._bytes + tamano > self.capacidad_bytes:
+                _, (_, tamano_lru, _) = self._entradas.popitem(last=False)
+                self._bytes -= tamano_lru
+                self._stats["desalojos"] += 1
+            self._entradas[clave] = (time.monotonic() + self.ttl, tamano, resultado)
+            self._bytes += tamano
+
+    def invalidar(self, afectada=None):
+        """Vacía la caché, o solo las entradas cuya clave cumple `afectada`"""
+        with self._lock:
+            if afectada is None:
+                self._entradas.clear()
+                self._bytes = 0
+            else:
+                for clave in [c for c in self._entradas if afectada(c)]:
+                    self._bytes -= self._entradas.pop(clave)[1]
+            self._stats["invalidaciones"] += 1
+
+    def estadisticas(self):
+        with self._lock:
+            datos = dict(self._stats)
+            datos["entradas"] = len(self._entradas)
+            datos["bytes"] = self._bytes
+        datos["capacidad_bytes"] = self.capacidad_bytes
+        datos["ttl"] = self.ttl
+        consultas = datos["aciertos"] + datos["fallos"]
+        datos["tasa_aciertos"] = datos["aciertos"] / consultas if consultas else 0.0
+        return datos
+
+
+class CursoresConsulta:
+    """Cursores de consulta_sql abiertos entre páginas, identificados por un
+    token de continuación opaco; caducan tras `ttl` segundos sin uso"""
+
+    def __init__(self, maximo=8, ttl=120.0):
+        self.maximo = maximo
+        self.ttl = ttl
+        self._cursores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cerrar(self, entrada):
+        try:
+            entrada["cursor"].close()
+        finally:
+            entrada["conn"].close()
+
+    def _purgar(self, ahora):
+        caducados = [token for token, entrada in self._cursores.items() if entrada["expira"] <= ahora]
+        return [self._cursores.pop(token) for token in caducados]
+
+    def guardar(self, entrada):
+        """Registra un cursor con filas pendientes y devuelve su token"""
+        token = secrets.token_urlsafe(18)
+        ahora = time.monotonic()
+        entrada["expira"] = ahora + self.ttl
+        with self._lock:
+            cerrar = self._purgar(ahora)
+            while len(self._cursores) >= self.maximo:
+                cerrar.append(self._cursores.popitem(last=False)[1])
+            self._cursores[token] = entrada
+        for vieja in cerrar:
+            self._cerrar(vieja)
+        return token
+
+    def tomar(self, token):
+        """Retira el cursor para la página siguiente (None si no existe o caducó)"""
+        with self._lock:
+            cerrar = self._purgar(time.monotonic())
+            entrada = self._cursores.pop(token, None)
+        for vieja in cerrar:
+            self._cerrar(vieja)
+        return entrada
+
+    def cerrar(self, entrada=None):
+        if entrada is not None:
+            self._cerrar(entrada)
+            return
+        with self._lock:
+            entradas = list(self._cursores.values())
+            self._cursores.clear()
+        for vieja in entradas:
+            self._cerrar(vieja)
+
+    def abiertos(self):
+        with self._lock:
+            return len(self._cursores)
+
+
+# Límites de las cubetas de los histogramas de latencia (ms)
+CUBETAS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# Fases de una llamada: cola del executor, detección de cambios y tablas
+# derivadas, SQLite, resto del handler (formato del texto) y json.dumps + stdout
+FASES = ("espera", "verificar", "sql", "formato", "serializacion")
+
+
+class MetricasServidor:
+    """Histogramas por herramienta, estadísticas por sentencia SQL, registro
+    circular de consultas lentas y perfiles cProfile de las llamadas lentas"""
+
+    def __init__(self, umbral_lenta_ms=250.0, lentas=50, max_sentencias=500,
+                 perfil_umbral_ms=0.0, perfil_dir=None, perfiles=20):
+        self.umbral_lenta_ms = umbral_lenta_ms
+        self.max_sentencias = max_sentencias
+        self.perfil_umbral_ms = perfil_umbral_ms
+        self.perfil_dir = perfil_dir or os.path.join(tempfile.gettempdir(), "smartperlahub_perfiles")
+        self.inicio = datetime.now()
+        self._herramientas = {}
+        self._sentencias = {}
+        self._lentas = deque(maxlen=max(1, lentas))
+        self._perfiles = deque(maxlen=max(1, perfiles))
+        self._lock = threading.Lock()
+        # cProfile no admite dos perfiles activos a la vez (3.12+): uno por vez
+        self._lock_perfil = threading.Lock()
+    
+    def _herramienta(self, nombre):
+        datos = self._herramientas.get(nombre)
+        if datos is None:
+            datos = self._herramientas[nombre] = {
+                "llamadas": 0,
+                "errores": 0,
+                "cubetas": [0] * (len(CUBETAS_MS) + 1),
+                "suma_ms": 0.0,
+                "sketch": DDSketch(),
+                "fases_ms": dict.fromkeys(FASES, 0.0),
+                "cache_aciertos": 0,
+                "cache_fallos": 0,
+                "sentencias": 0,
+                "filas": 0,
+                "pasos_vm": 0,
+                "bytes": 0,
+            }
+        return datos
+    
+    def registrar(self, medicion):
+        """Suma una llamada terminada (respuesta ya escrita)"""
+        total_ms = (time.perf_counter() - medicion.inicio) * 1000
+        sql_ms = medicion.sql_ms
+        fases = {
+            "espera": medicion.espera_ms,
+            "verificar": medicion.verificar_ms,
+            "sql": sql_ms,
+            "formato": max(0.0, medicion.herramienta_ms - medicion.verificar_ms - sql_ms),
+            "serializacion": medicion.serializacion_ms,
+        }
+        with self._lock:
+            datos = self._herramienta(medicion.herramienta)
+            datos["llamadas"] += 1
+            datos["errores"] += medicion.error
+            datos["cubetas"][self._cubeta(total_ms)] += 1
+            datos["suma_ms"] += total_ms
+            datos["sketch"].agregar(total_ms)
+            for fase, ms in fases.items():
+                datos["fases_ms"][fase] += ms
+            if medicion.cache is not None:
+                datos["cache_aciertos" if medicion.cache else "cache_fallos"] += 1
+            datos["bytes"] += medicion.bytes
+            for registro in medicion.sentencias:
+                datos["sentencias"] += 1
+                datos["filas"] += registro[SQL_FILAS]
+                datos["pasos_vm"] += registro[SQL_PASOS]
+                self._sumar_sentencia(registro)
+                if registro[SQL_MS] >= self.umbral_lenta_ms:
+                    self._lentas.append({
+                        "fecha": datetime.now().isoformat(timespec="seconds"),
+                        "herramienta": medicion.herramienta,
+                        "sql": registro[SQL_TEXTO],
+                        "parametros": list(registro[SQL_PARAMETROS]) if isinstance(
+                            registro[SQL_PARAMETROS], (list, tuple)) else registro[SQL_PARAMETROS],
+                        "ms": registro[SQL_MS],
+                        "filas": registro[SQL_FILAS],
+                        "pasos_vm": registro[SQL_PASOS],
+                        "plan": None,
+                    })
+    
+    @staticmethod
+    def _cubeta(ms):
+        for i, limite in enumerate(CUBETAS_MS):
+            if ms <= limite:
+                return i
+        return len(CUBETAS_MS)
+    
+    def _sumar_sentencia(self, registro):
+        datos = self._sentencias.get(registro[SQL_TEXTO])
+        if datos is None:
+            if len(self._sentencias) >= self.max_sentencias:
+                return
+            datos = self._sentencias[registro[SQL_TEXTO]] = {
+                "ejecuciones": 0, "ms": 0.0, "max_ms": 0.0, "filas": 0, "pasos_vm": 0,
+            }
+        datos["ejecuciones"] += 1
+        datos["ms"] += registro[SQL_MS]
+        datos["max_ms"] = max(datos["max_ms"], registro[SQL_MS])
+        datos["filas"] += registro[SQL_FILAS]
+        datos["pasos_vm"] += registro[SQL_PASOS]
+    
+    def herramientas(self):
+        """{herramienta: resumen} con percentiles y medias por fase"""
+        with self._lock:
+            resultado = {}
+            for nombre, datos in sorted(self._herramientas.items()):
+                llamadas = datos["llamadas"]
+                resultado[nombre] = {
+                    "llamadas": llamadas,
+                    "errores": datos["errores"],
+                    "media_ms": datos["suma_ms"] / llamadas,
+                    "p50_ms": datos["sketch"].cuantil(0.5),
+                    "p95_ms": datos["sketch"].cuantil(0.95),
+                    "p99_ms": datos["sketch"].cuantil(0.99),
+                    "max_ms": datos["sketch"].maximo,
+                    **{f"{fase}_ms": ms / llamadas for fase, ms in datos["fases_ms"].items()},
+                    "cache_aciertos": datos["cache_aciertos"],
+                    "cache_fallos": datos["cache_fallos"],
+                    "sentencias": datos["sentencias"],
+                    "filas": datos["filas"],
+                    "pasos_vm": datos["pasos_vm"],
+                    "bytes": datos["bytes"],
+                }
+            return resultado
+    
+    def sentencias(self, limite=10):
+        """Sentencias con más tiempo total en SQLite"""
+        with self._lock:
+            filas = [dict(datos, sql=sql) for sql, datos in self._sentencias.items()]
+        return sorted(filas, key=lambda fila: -fila["ms"])[:limite]
+    
+    def lentas(self, limite=10):
+        """Últimas consultas lentas (la más reciente primero)"""
+        with self._lock:
+            return list(self._lentas)[::-1][:limite]
+    
+    def perfiles(self):
+        with self._lock:
+            return list(self._perfiles)[::-1]
+    
+    def reiniciar(self):
+        with self._lock:
+            self._herramientas.clear()
+            self._sentencias.clear()
+            self._lentas.clear()
+            self.inicio = datetime.now()
+    
+    def iniciar_perfil(self):
+        """cProfile para la llamada actual si está activado y libre, o None"""
+        if self.perfil_umbral_ms <= 0 or not self._lock_perfil.acquire(blocking=False):
+            return None
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Otro perfilador activo en el intérprete
+            self._lock_perfil.release()
+            return None
+        return perfil, time.perf_counter()
+    
+    def terminar_perfil(self, perfil, herramienta):
+        """Guarda el perfil (.prof, para pstats/snakeviz) si superó el umbral"""
+        perfil, inicio = perfil
+        try:
+            perfil.disable()
+            ms = (time.perf_counter() - inicio) * 1000
+            if ms < self.perfil_umbral_ms:
+                return None
+            os.makedirs(self.perfil_dir, exist_ok=True)
+            ruta = os.path.join(
+                self.perfil_dir, f"{datetime.now():%Y%m%d_%H%M%S_%f}_{herramienta}_{ms:.0f}ms.prof"
+            )
+            perfil.dump_stats(ruta)
+            with self._lock:
+                if len(self._perfiles) == self._perfiles.maxlen:
+                    # Solo se conservan en disco los últimos perfiles
+                    try:
+                        os.remove(self._perfiles[0]["fichero"])
+                    except OSError:
+                        pass
+                self._perfiles.append({
+                    "fecha": datetime.now().isoformat(timespec="seconds"),
+                    "herramienta": herramienta,
+                    "ms": ms,
+                    "fichero": ruta,
+                })
+            return ruta
+        finally:
+            self._lock_perfil.release()
+    
+    def prometheus(self, extra=None):
+        """Métricas en formato de texto de Prometheus (segundos y bytes)"""
+        lineas = []
+        
+        def metrica(nombre, tipo, ayuda):
+            lineas.append(f"# HELP smartperlahub_{nombre} {ayuda}")
+            lineas.append(f"# TYPE smartperlahub_{nombre} {tipo}")
+        
+        def etiqueta(valor):
+            return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        
+        with self._lock:
+            herramientas = sorted(self._herramientas.items())
+            metrica("herramienta_duracion_segundos", "histogram",
+                    "Duración de tools/call hasta escribir la respuesta")
+            for nombre, datos in herramientas:
+                acumulado = 0
+                for limite, cantidad in zip(CUBETAS_MS + (None,), datos["cubetas"]):
+                    acumulado += cantidad
+                    le = "+Inf" if limite is None else repr(limite / 1000)
+                    lineas.append(
+                        f'smartperlahub_herramienta_duracion_segundos_bucket{{herramienta="{nombre}",le="{le}"}} {acumulado}'
+                    )
+                lineas.append(f'smartperlahub_herramienta_duracion_segundos_sum{{herramienta="{nombre}"}} {datos["suma_ms"] / 1000}')
+                lineas.append(f'smartperlahub_herramienta_duracion_segundos_count{{herramienta="{nombre}"}} {datos["llamadas"]}')
+            
+            metrica("herramienta_errores_total", "counter", "Llamadas que devolvieron isError")
+            for nombre, datos in herramientas:
+                lineas.append(f'smartperlahub_herramienta_errores_total{{herramienta="{nombre}"}} {datos["errores"]}')
+            metrica("herramienta_fase_segundos_total", "counter", "Tiempo acumulado por fase de la llamada")
+            for nombre, datos in herramientas:
+                for fase, ms in datos["fases_ms"].items():
+                    lineas.append(
+                        f'smartperlahub_herramienta_fase_segundos_total{{herramienta="{nombre}",fase="{fase}"}} {ms / 1000}'
+                    )
+            for clave, ayuda in (
+                ("cache_aciertos", "Resultados servidos desde la caché"),
+                ("cache_fallos", "Resultados calculados (no estaban en caché)"),
+                ("sentencias", "Sentencias SQL ejecutadas"),
+                ("filas", "Filas devueltas por SQLite"),
+                ("pasos_vm", "Instrucciones de la VM de SQLite (trabajo de recorrido)"),
+                ("bytes", "Bytes de respuesta escritos en stdout"),
+            ):
+                metrica(f"{clave}_total", "counter", ayuda)
+                for nombre, datos in herramientas:
+                    lineas.append(f'smartperlahub_{clave}_total{{herramienta="{nombre}"}} {datos[clave]}')
+            
+            # La etiqueta es la huella del SQL completo: dos sentencias con los
+            # mismos 200 primeros caracteres no se mezclan en una serie
+            por_id = {}
+            for sql, datos in self._sentencias.items():
+                sql_id, normalizado = huella_sql(sql)
+                acumulado = por_id.setdefault(sql_id, [0.0, normalizado])
+                acumulado[0] += datos["ms"]
+            metrica("sql_segundos_total", "counter", "Tiempo en SQLite por sentencia (sql_id)")
+            for sql_id, (ms, _) in por_id.items():
+                lineas.append(f'smartperlahub_sql_segundos_total{{sql_id="{sql_id}"}} {ms / 1000}')
+            metrica("sql_info", "gauge", "Texto de cada sql_id (normalizado y recortado a 200 caracteres)")
+            for sql_id, (_, normalizado) in por_id.items():
+                lineas.append(f'smartperlahub_sql_info{{sql_id="{sql_id}",sql="{etiqueta(normalizado[:200])}"}} 1')
+            metrica("consultas_lentas", "gauge", "Consultas lentas en el registro circular")
+            lineas.append(f"smartperlahub_consultas_lentas {len(self._lentas)}")
+        
+        for nombre, (tipo, ayuda, valor) in (extra or {}).items():
+            metrica(nombre, tipo, ayuda)
+            lineas.append(f"smartperlahub_{nombre} {valor}")
+        return "\n".join(lineas) + "\n"
+
+
+# Acciones que el autorizador permite en consulta_sql (solo lectura)
+ACCIONES_LECTURA = {
+    sqlite3.SQLITE_SELECT,
+    sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_FUNCTION,
+    getattr(sqlite3, "SQLITE_RECURSIVE", 33),
+}
+
+# Funciones que no deben poder llamarse desde SQL ad-hoc
+FUNCIONES_PROHIBIDAS = {"load_extension", "readfile", "writefile", "edit", "fts3_tokenizer"}
+
+PATRON_TABLAS_FROM = re.compile(
+    r'\b(?:from|join)\s+["`\[]?(\w+)["`\]]?(?:\s+(?:as\s+)?["`\[]?(\w+)["`\]]?)?',
+    re.IGNORECASE,
+)
+PALABRAS_NO_ALIAS = {
+    "where", "join", "inner", "left", "right", "full", "cross", "natural", "outer",
+    "on", "using", "group", "order", "limit", "union", "except", "intersect", "window",
+    "having",
+}
+
+
+def autorizar_solo_lectura(accion, arg1, arg2, db_name, origen):
+    """Autorizador de sqlite3: solo lecturas y funciones inofensivas"""
+    if accion not in ACCIONES_LECTURA:
+        return sqlite3.SQLITE_DENY
+    if accion == sqlite3.SQLITE_FUNCTION and (arg2 or "").lower() in FUNCIONES_PROHIBIDAS:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+def autorizar_todo(accion, arg1, arg2, db_name, origen):
+    return sqlite3.SQLITE_OK
+
+
+def quitar_autorizador(conn):
+    """Deja la conexión sin restricciones: antes de Python 3.11,
+    set_authorizer(None) no quita el autorizador sino que lo deniega todo"""
+    if sys.version_info >= (3, 11):
+        conn.set_authorizer(None)
+    else:
+        conn.set_authorizer(autorizar_todo)
+
+
+def tablas_escaneadas(plan, sql):
+    """Tablas (resolviendo alias del FROM/JOIN) que el plan recorre sin índice"""
+    alias = {}
+    for tabla, nombre in PATRON_TABLAS_FROM.findall(sql):
+        alias[tabla.lower()] = tabla
+        if nombre and nombre.lower() not in PALABRAS_NO_ALIAS:
+            alias[nombre.lower()] = tabla
+    tablas = []
+    for paso in plan:
+        coincidencia = re.match(r"SCAN (\w+)(?:\s|$)", paso)
+        if coincidencia and "INDEX" not in paso:
+            nombre = coincidencia.group(1)
+            tablas.append(alias.get(nombre.lower(), nombre))
+    return tablas
+
+
+class PresupuestoConsulta:
+    """Progress handler que aborta la consulta al superar pasos de la VM o tiempo"""
+
+    def __init__(self, max_pasos, timeout, solicitud=None, intervalo=PASOS_PROGRESO):
+        self.max_pasos = max_pasos
+        self.limite_tiempo = time.monotonic() + timeout if timeout > 0 else None
+        self.solicitud = solicitud
+        self.intervalo = intervalo
+        self.pasos = 0
+        self.motivo = None
+
+    def __call__(self):
+        # Sustituye al handler de la conexión: también cuenta los pasos
+        # de la sentencia en curso para metricas_servidor
+        if self.intervalo == PASOS_PROGRESO:
+            _contar_pasos()
+        self.pasos += self.intervalo
+        if self.max_pasos > 0 and self.pasos > self.max_pasos:
+            self.motivo = f"superó el presupuesto de {self.max_pasos:,} pasos de la VM"
+            return 1
+        if self.limite_tiempo is not None and time.monotonic() > self.limite_tiempo:
+            self.motivo = "superó el tiempo máximo de ejecución"
+            return 1
+        if self.solicitud is not None and self.solicitud.cancelada:
+            self.motivo = "cancelada por el cliente"
+            return 1
+        return 0
+
+    def instalar(self, conn):
+        conn.set_progress_handler(self, self.intervalo)
+
+    def retirar(self, conn):
+        """Vuelve a dejar el handler propio de la conexión"""
+        progreso_base(conn)
+
+
+# Ventana de tiempo común a las herramientas de análisis
+PROPIEDADES_VENTANA = {
+    "desde": {
+        "type": "string",
+        "description": "Inicio de la ventana (ISO 8601, p. ej. 2025-07-31T08:00, o relativo: -2h, -30m, -1d)"
+    },
+    "hasta": {
+        "type": "string",
+        "description": "Fin de la ventana, excluido (ISO 8601 o relativo)"
+    },
+}
+
+# Formatos de salida de las herramientas de datos
+FORMATOS = ("texto", "json", "csv", "ndjson")
+
+PROPIEDAD_FORMATO = {
+    "type": "string",
+    "enum": list(FORMATOS),
+    "description": "Formato de salida: texto (legible), json (columnas + filas), csv o ndjson",
+    "default": "texto"
+}
+
+
+def _valor_serializable(valor):
+    if isinstance(valor, bytes):
+        return base64.b64encode(valor).decode("ascii")
+    return valor
+
+
+def texto_json(objeto):
+    """JSON compacto como str (orjson si está instalado, mismo formato con json)"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(objeto, default=_valor_serializable, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(objeto, ensure_ascii=False, separators=(",", ":"), default=_valor_serializable)
+
+
+def serializar(formato, secciones, meta=None):
+    """Serializa secciones (nombre, columnas, filas) sin formatear celda a celda.
+    
+    json: {"secciones": {nombre: {"columnas": [...], "filas": [[...], ...]}}, ...meta}
+    (con una sola sección, "columnas" y "filas" van en el nivel superior).
+    csv: una cabecera por sección; varias secciones se separan con "# nombre".
+    ndjson: un objeto por fila (más "_seccion" si hay varias) y meta al final.
+    """
+    meta = meta or {}
+    varias = len(secciones) > 1
+    
+    if formato == "json":
+        if varias:
+            cuerpo = {
+                nombre: {"columnas": list(columnas), "filas": [list(fila) for fila in filas]}
+                for nombre, columnas, filas in secciones
+            }
+            documento = {"secciones": cuerpo}
+        else:
+            _, columnas, filas = secciones[0]
+            documento = {"columnas": list(columnas), "filas": [list(fila) for fila in filas]}
+        documento.update(meta)
+        return texto_json(documento)
+    
+    if formato == "csv":
+        salida = io.StringIO()
+        escritor = csv.writer(salida, lineterminator="\n")
+        for nombre, columnas, filas in secciones:
+            if varias:
+                salida.write(f"# {nombre}\n")
+            escritor.writerow(columnas)
+            escritor.writerows(
+                [_valor_serializable(valor) for valor in fila] for fila in filas
+            )
+            if varias:
+                salida.write("\n")
+        for clave, valor in meta.items():
+            salida.write(f"# {clave}: {valor}\n")
+        return salida.getvalue()
+    
+    if formato == "ndjson":
+        lineas = []
+        for nombre, columnas, filas in secciones:
+            for fila in filas:
+                objeto = dict(zip(columnas, fila))
+                if varias:
+                    objeto["_seccion"] = nombre
+                lineas.append(texto_json(objeto))
+        if meta:
+            lineas.append(texto_json({"_meta": meta}))
+        return "\n".join(lineas) + "\n" if lineas else ""
+    
+    raise ValueError(f"Formato no soportado: {formato}")
+
+
+# Recursos MCP con suscripción (notifications/resources/updated)
+RECURSO_TABLA = "smartperlahub://tablas/"
+RECURSO_PROBLEMAS = "smartperlahub://problemas_criticos"
+
+
+def entrada_afectada(cambiadas, clave):
+    """True si la entrada de caché `clave` puede depender de las tablas cambiadas"""
+    herramienta = clave[0]
+    if herramienta == "consulta_sql":
+        # Puede leer cualquier tabla, también las derivadas
+        return True
+    tablas = HERRAMIENTAS_CACHEABLES.get(herramienta)
+    if tablas is None:
+        return bool(cambiadas)
+    return any(tabla in cambiadas for tabla in tablas)
+
+
+def tamano_resultado(resultado):
+    """Bytes aproximados de un resultado de herramienta (texto UTF-8)"""
+    return sum(len(item.get("text", "").encode("utf-8")) for item in resultado.get("content", []))
+
+
+# Índices que necesitan las formas de consulta conocidas del servidor
+INDICES_RECOMENDADOS = [
+    {
+        "nombre": "idx_restrictions_hotel_tipo",
+        "tabla": "restrictions",
+        "columnas": ("hotel_id", "restriction_type"),
+        "consultas": [
+            "SELECT hotel_id, restriction_type, COUNT(*) FROM restrictions "
+            "GROUP BY hotel_id, restriction_type",
+            "SELECT restriction_type, COUNT(*) FROM restrictions "
+            "WHERE hotel_id = 22 GROUP BY restriction_type",
+            "SELECT COUNT(DISTINCT hotel_id) FROM restrictions WHERE hotel_id IS NOT NULL",
+        ],
+    },
+    {
+        "nombre": "idx_exceptions_tipo",
+        "tabla": "exceptions",
+        "columnas": ("exception_type",),
+        "consultas": [
+            "SELECT exception_type, COUNT(*) FROM exceptions GROUP BY exception_type",
+        ],
+    },
+    {
+        "nombre": "idx_exceptions_template_id",
+        "tabla": "exceptions",
+        "columnas": ("template_id",),
+        "consultas": [
+            "SELECT exception_type FROM exceptions WHERE template_id = 1 LIMIT 50",
+        ],
+    },
+] + [
+    # Bordes de las ventanas desde/hasta que no cubren una cubeta completa
+    {
+        "nombre": f"idx_{tabla}_{columna}",
+        "tabla": tabla,
+        "columnas": (columna,),
+        "consultas": [
+            f"SELECT COUNT(*) FROM {tabla} "
+            f"WHERE {columna} >= '2025-07-31T08:15:30' AND {columna} < '2025-07-31T08:16'",
+        ],
+    }
+    for tabla, columna in (
+        ("restrictions", "occurred_at"),
+        ("exceptions", "occurred_at"),
+        ("client_searches", "initiated_at"),
+        ("provider_searches", "initiated_at"),
+        ("connector_searches", "initiated_at"),
+        ("logins", "login_at"),
+    )
+]
+
+
+def columnas_tabla(conn, tabla):
+    """Columnas de una tabla (vacío si la tabla no existe)"""
+    return [fila[1] for fila in conn.execute(f'PRAGMA table_info("{tabla}")')]
+
+
+def plan_consulta(conn, sql, params=()):
+    """Detalle de EXPLAIN QUERY PLAN como lista de líneas"""
+    return [fila[-1] for fila in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def plan_con_recorrido_completo(plan, tabla):
+    """True si el plan recorre la tabla entera sin apoyarse en un índice"""
+    for paso in plan:
+        if paso.startswith(f"SCAN {tabla}") and "INDEX" not in paso:
+            return True
+    return False
+
+
+class AsesorIndices:
+    """Comprueba con EXPLAIN QUERY PLAN los índices de INDICES_RECOMENDADOS"""
+
+    def __init__(self, conn, escribible, recomendados=None):
+        self.conn = conn
+        self.escribible = escribible
+        self.recomendados = recomendados if recomendados is not None else INDICES_RECOMENDADOS
+
+    def _indice_existente(self, tabla, columnas):
+        """Nombre de un índice cuyo prefijo coincide con las columnas, si existe"""
+        for indice in self.conn.execute(f'PRAGMA index_list("{tabla}")').fetchall():
+            nombre = indice[1]
+            cols = [fila[2] for fila in self.conn.execute(f'PRAGMA index_info("{nombre}")')]
+            if tuple(cols[:len(columnas)]) == tuple(columnas):
+                return nombre
+        return None
+
+    def _planes(self, recomendado):
+        return [plan_consulta(self.conn, sql) for sql in recomendado["consultas"]]
+
+    def diagnosticar(self, crear=True):
+        resultados = []
+        creados = False
+        
+        for recomendado in self.recomendados:
+            tabla = recomendado["tabla"]
+            columnas = recomendado["columnas"]
+            resultado = {
+                "nombre": recomendado["nombre"],
+                "tabla": tabla,
+                "columnas": list(columnas),
+                "plan_antes": [],
+                "plan_despues": [],
+            }
+            resultados.append(resultado)
+            
+            existentes = set(columnas_tabla(self.conn, tabla))
+            if not existentes or not set(columnas) <= existentes:
+                resultado["estado"] = "no_aplicable"
+                continue
+            
+            resultado["plan_antes"] = self._planes(recomendado)
+            existente = self._indice_existente(tabla, columnas)
+            if existente:
+                resultado["estado"] = "existente"
+                resultado["indice"] = existente
+                continue
+            
+            if not any(plan_con_recorrido_completo(plan, tabla) for plan in resultado["plan_antes"]):
+                resultado["estado"] = "innecesario"
+                continue
+            
+            if not (crear and self.escribible):
+                resultado["estado"] = "faltante"
+                continue
+            
+            cols_sql = ", ".join(f'"{c}"' for c in columnas)
+            try:
+                inicio = time.perf_counter()
+                self.conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{recomendado["nombre"]}" ON "{tabla}" ({cols_sql})'
+                )
+                self.conn.commit()
+                resultado["duracion_ms"] = (time.perf_counter() - inicio) * 1000
+                resultado["estado"] = "creado"
+                resultado["indice"] = recomendado["nombre"]
+                resultado["plan_despues"] = self._planes(recomendado)
+                creados = True
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                resultado["estado"] = "error"
+                resultado["error"] = str(e)
+        
+        if creados:
+            # Estadísticas para el planificador sobre los índices nuevos
+            self.conn.execute("PRAGMA optimize")
+        return resultados
+
+
+# Tablas derivadas: se mantienen de forma incremental con marcas de agua de rowid
+ESQUEMA_DERIVADOS = """
+CREATE TABLE IF NOT EXISTS derived_watermarks (
+    name TEXT PRIMARY KEY,
+    last_rowid INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS exception_hotels (
+    hotel_id INTEGER NOT NULL,
+    exception_rowid INTEGER NOT NULL,
+    PRIMARY KEY (hotel_id, exception_rowid)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_table_counts (
+    table_name TEXT PRIMARY KEY,
+    row_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollup_restrictions (
+    hotel_id INTEGER,
+    restriction_type TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_restrictions
+    ON rollup_restrictions (hotel_id, restriction_type);
+CREATE TABLE IF NOT EXISTS rollup_exceptions (
+    exception_type TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_exceptions
+    ON rollup_exceptions (exception_type);
+CREATE TABLE IF NOT EXISTS rollup_restrictions_hora (
+    hotel_id INTEGER,
+    restriction_type TEXT,
+    hora TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_restrictions_hora
+    ON rollup_restrictions_hora (hora, hotel_id, restriction_type);
+CREATE TABLE IF NOT EXISTS rollup_restrictions_minuto (
+    hotel_id INTEGER,
+    restriction_type TEXT,
+    minuto TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_restrictions_minuto
+    ON rollup_restrictions_minuto (minuto, hotel_id, restriction_type);
+CREATE TABLE IF NOT EXISTS rollup_exceptions_hora (
+    exception_type TEXT,
+    hora TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_exceptions_hora
+    ON rollup_exceptions_hora (hora, exception_type);
+CREATE TABLE IF NOT EXISTS rollup_exceptions_minuto (
+    exception_type TEXT,
+    minuto TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_exceptions_minuto
+    ON rollup_exceptions_minuto (minuto, exception_type);
+CREATE TABLE IF NOT EXISTS rollup_exception_templates (
+    template_id INTEGER,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_exception_templates
+    ON rollup_exception_templates (template_id);
+CREATE TABLE IF NOT EXISTS rollup_exception_templates_hora (
+    template_id INTEGER,
+    hora TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_exception_templates_hora
+    ON rollup_exception_templates_hora (hora, template_id);
+CREATE TABLE IF NOT EXISTS rollup_exception_templates_minuto (
+    template_id INTEGER,
+    minuto TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rollup_exception_templates_minuto
+    ON rollup_exception_templates_minuto (minuto, template_id);
+CREATE TABLE IF NOT EXISTS latency_sketches (
+    source TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    clave TEXT NOT NULL,
+    hora TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    sketch TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_latency_sketches_clave
+    ON latency_sketches (source, dimension, clave, hora);
+CREATE INDEX IF NOT EXISTS idx_latency_sketches_hora
+    ON latency_sketches (source, dimension, hora, clave, n);
+"""
+
+TABLAS_AUDITORIA = ["restrictions", "exceptions", "client_searches", "provider_searches", "connector_searches", "logins"]
+
+# Columna de fecha (texto ISO 8601) de cada tabla de auditoría
+COLUMNA_FECHA = {
+    "restrictions": "occurred_at",
+    "exceptions": "occurred_at",
+    "client_searches": "initiated_at",
+    "provider_searches": "initiated_at",
+    "connector_searches": "initiated_at",
+    "logins": "login_at",
+}
+
+# Niveles de las cubetas de tiempo: nombre -> (longitud del prefijo ISO, duración)
+NIVELES_TIEMPO = {
+    "hora": (13, timedelta(hours=1)),
+    "minuto": (16, timedelta(minutes=1)),
+}
+
+# Tablas sin tipo: solo conteos por cubeta (familia rollup_<tabla>)
+TABLAS_SOLO_CONTEO = ["client_searches", "provider_searches", "connector_searches", "logins"]
+
+ESQUEMA_DERIVADOS += "".join(
+    f"CREATE TABLE IF NOT EXISTS rollup_{tabla}_{nivel} ({nivel} TEXT, row_count INTEGER NOT NULL);\n"
+    f"CREATE INDEX IF NOT EXISTS idx_rollup_{tabla}_{nivel} ON rollup_{tabla}_{nivel} ({nivel});\n"
+    for tabla in TABLAS_SOLO_CONTEO for nivel in NIVELES_TIEMPO
+)
+
+# Rollups de conteo: nombre -> (tabla base, columnas de agrupación). Los
+# sufijos _hora y _minuto agregan además por cubeta de tiempo y sirven las
+# consultas con ventana desde/hasta de la familia (nombre sin sufijo)
+ROLLUPS = {
+    "rollup_restrictions": ("restrictions", ("hotel_id", "restriction_type")),
+    "rollup_exceptions": ("exceptions", ("exception_type",)),
+    "rollup_restrictions_hora": ("restrictions", ("hotel_id", "restriction_type", "hora")),
+    "rollup_restrictions_minuto": ("restrictions", ("hotel_id", "restriction_type", "minuto")),
+    "rollup_exceptions_hora": ("exceptions", ("exception_type", "hora")),
+    "rollup_exceptions_minuto": ("exceptions", ("exception_type", "minuto")),
+    "rollup_exception_templates": ("exceptions", ("template_id",)),
+    "rollup_exception_templates_hora": ("exceptions", ("template_id", "hora")),
+    "rollup_exception_templates_minuto": ("exceptions", ("template_id", "minuto")),
+}
+for _tabla in TABLAS_SOLO_CONTEO:
+    for _nivel in NIVELES_TIEMPO:
+        ROLLUPS[f"rollup_{_tabla}_{_nivel}"] = (_tabla, (_nivel,))
+
+# Familia de rollups con el conteo por cubeta de cada tabla
+FAMILIA_CONTEO = {
+    "restrictions": "rollup_restrictions",
+    "exceptions": "rollup_exceptions",
+}
+FAMILIA_CONTEO.update({tabla: f"rollup_{tabla}" for tabla in TABLAS_SOLO_CONTEO})
+
+
+def columna_origen(tabla, clave):
+    return COLUMNA_FECHA[tabla] if clave in NIVELES_TIEMPO else clave
+
+
+def expresion_rollup(tabla, clave):
+    """Expresión para leer `clave` de la tabla base (con alias si es una cubeta)"""
+    if clave in NIVELES_TIEMPO:
+        return f"substr({COLUMNA_FECHA[tabla]}, 1, {NIVELES_TIEMPO[clave][0]}) AS {clave}"
+    return clave
+
+# Claves de context_data que identifican un hotel (sin mayúsculas ni "_")
+CLAVES_HOTEL = {"hotelid", "hotelcode", "hotel"}
+CLAVES_HOTELES = {"hotelids", "hotels"}
+PATRON_HOTEL = re.compile(r"hotel_?(?:id|code)?[\"']?\s*[:=]\s*[\"']?(\d+)\b", re.IGNORECASE)
+
+
+def _normalizar_clave(clave):
+    return str(clave).replace("_", "").replace("-", "").lower()
+
+
+def _hoteles_json(valor, hoteles):
+    if isinstance(valor, dict):
+        for clave, dato in valor.items():
+            normalizada = _normalizar_clave(clave)
+            if normalizada in CLAVES_HOTEL and not isinstance(dato, (dict, list)):
+                _agregar_hotel(dato, hoteles)
+            elif normalizada in CLAVES_HOTELES and isinstance(dato, list):
+                for item in dato:
+                    _agregar_hotel(item, hoteles)
+            else:
+                _hoteles_json(dato, hoteles)
+    elif isinstance(valor, list):
+        for item in valor:
+            _hoteles_json(item, hoteles)
+
+
+def _agregar_hotel(dato, hoteles):
+    if isinstance(dato, bool):
+        return
+    if isinstance(dato, int) or (isinstance(dato, str) and dato.strip().isdigit()):
+        hoteles.add(int(dato))
+
+
+def extraer_hoteles(context_data):
+    """IDs de hotel presentes en context_data (JSON o texto libre)"""
+    hoteles = set()
+    if not context_data:
+        return hoteles
+    try:
+        _hoteles_json(json.loads(context_data), hoteles)
+    except (TypeError, ValueError):
+        hoteles.update(int(valor) for valor in PATRON_HOTEL.findall(str(context_data)))
+    return hoteles
+
+
+def marca_agua(conn, nombre):
+    """Último rowid procesado por una tabla derivada (0 si no existe)"""
+    try:
+        fila = conn.execute(
+            "SELECT last_rowid FROM derived_watermarks WHERE name = ?", (nombre,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return fila[0] if fila else 0
+
+
+def _guardar_marca_agua(conn, nombre, rowid):
+    conn.execute(
+        "INSERT INTO derived_watermarks (name, last_rowid) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET last_rowid = excluded.last_rowid",
+        (nombre, rowid),
+    )
+
+
+def max_rowid(conn, tabla):
+    try:
+        return conn.execute(f'SELECT MAX(rowid) FROM "{tabla}"').fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return 0
+
+
+def actualizar_exception_hotels(conn, lote=5000):
+    """Añade a exception_hotels las excepciones nuevas desde la marca de agua"""
+    if "context_data" not in columnas_tabla(conn, "exceptions"):
+        return 0
+    ultimo = marca_agua(conn, "exception_hotels")
+    if max_rowid(conn, "exceptions") < ultimo:
+        # La tabla se ha recreado: reconstruir la derivada desde cero
+        conn.execute("DELETE FROM exception_hotels")
+        ultimo = 0
+    
+    procesadas = 0
+    while True:
+        filas = conn.execute(
+            "SELECT rowid, context_data FROM exceptions WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (ultimo, lote),
+        ).fetchall()
+        if not filas:
+            break
+        conn.executemany(
+            "INSERT OR IGNORE INTO exception_hotels (hotel_id, exception_rowid) VALUES (?, ?)",
+            [(hotel, rowid) for rowid, context_data in filas for hotel in extraer_hoteles(context_data)],
+        )
+        ultimo = filas[-1][0]
+        _guardar_marca_agua(conn, "exception_hotels", ultimo)
+        conn.commit()
+        procesadas += len(filas)
+    conn.commit()
+    return procesadas
+
+
+def actualizar_conteos_tablas(conn):
+    """Suma a rollup_table_counts las filas nuevas de cada tabla de auditoría"""
+    nuevas = 0
+    for tabla in TABLAS_AUDITORIA:
+        if not columnas_tabla(conn, tabla):
+            continue
+        nombre = f"rollup_table_counts:{tabla}"
+        ultimo = marca_agua(conn, nombre)
+        hasta = max_rowid(conn, tabla)
+        if hasta < ultimo:
+            conn.execute("DELETE FROM rollup_table_counts WHERE table_name = ?", (tabla,))
+            ultimo = 0
+        if hasta == ultimo:
+            continue
+        
+        cantidad = conn.execute(
+            f'SELECT COUNT(*) FROM "{tabla}" WHERE rowid > ? AND rowid <= ?', (ultimo, hasta)
+        ).fetchone()[0]
+        actualizadas = conn.execute(
+            "UPDATE rollup_table_counts SET row_count = row_count + ? WHERE table_name = ?",
+            (cantidad, tabla),
+        ).rowcount
+        if not actualizadas:
+            conn.execute(
+                "INSERT INTO rollup_table_counts (table_name, row_count) VALUES (?, ?)",
+                (tabla, cantidad),
+            )
+        _guardar_marca_agua(conn, nombre, hasta)
+        conn.commit()
+        nuevas += cantidad
+    return nuevas
+
+
+def actualizar_rollups(conn):
+    """Agrega las filas nuevas (rowid > marca de agua) en cada rollup de ROLLUPS"""
+    nuevas = 0
+    for rollup, (tabla, claves) in ROLLUPS.items():
+        if not {columna_origen(tabla, clave) for clave in claves} <= set(columnas_tabla(conn, tabla)):
+            continue
+        ultimo = marca_agua(conn, rollup)
+        hasta = max_rowid(conn, tabla)
+        if hasta < ultimo:
+            conn.execute(f"DELETE FROM {rollup}")
+            ultimo = 0
+        if hasta == ultimo:
+            continue
+        
+        cols = ", ".join(claves)
+        expresiones = ", ".join(expresion_rollup(tabla, clave) for clave in claves)
+        condicion = " AND ".join(f"{clave} IS ?" for clave in claves)
+        delta = conn.execute(
+            f'SELECT {expresiones}, COUNT(*) FROM "{tabla}" '
+            f"WHERE rowid > ? AND rowid <= ? GROUP BY {cols}",
+            (ultimo, hasta),
+        ).fetchall()
+        for fila in delta:
+            valores, cantidad = tuple(fila[:-1]), fila[-1]
+            actualizadas = conn.execute(
+                f"UPDATE {rollup} SET row_count = row_count + ? WHERE {condicion}",
+                (cantidad,) + valores,
+            ).rowcount
+            if not actualizadas:
+                marcadores = ", ".join("?" for _ in claves)
+                conn.execute(
+                    f"INSERT INTO {rollup} ({cols}, row_count) VALUES ({marcadores}, ?)",
+                    valores + (cantidad,),
+                )
+            nuevas += cantidad
+        _guardar_marca_agua(conn, rollup, hasta)
+        conn.commit()
+    return nuevas
+
+
+PATRON_RELATIVO = re.compile(r"^-(\d+)\s*([smhd])$")
+UNIDADES_RELATIVAS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+# Fracción de segundo con cualquier número de cifras (.NET escribe 7)
+PATRON_FRACCION = re.compile(r"\.(\d+)(?=[+-]\d\d:\d\d$|$)")
+
+
+def _iso(instante):
+    iso = instante.strftime("%Y-%m-%dT%H:%M:%S")
+    return iso + (f".{instante.microsecond:06d}" if instante.microsecond else "")
+
+
+def normalizar_instante(valor):
+    """Instante ISO 8601 comparable con las columnas de fecha (UTC, sin zona).
+    Admite fecha sola, espacio en lugar de "T", sufijo Z u offset, y valores
+    relativos al minuto actual como "-2h", "-30m" o "-1d"
+    """
+    if valor is None or valor == "":
+        return None
+    texto = str(valor).strip()
+    relativo = PATRON_RELATIVO.match(texto)
+    if relativo:
+        ahora = datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+        delta = timedelta(**{UNIDADES_RELATIVAS[relativo.group(2)]: int(relativo.group(1))})
+        return _iso(ahora - delta)
+    texto = texto.replace(" ", "T")
+    if texto.endswith("Z"):
+        texto = texto[:-1] + "+00:00"
+    texto = PATRON_FRACCION.sub(lambda m: "." + (m.group(1) + "00000")[:6], texto)
+    try:
+        instante = datetime.fromisoformat(texto)
+    except ValueError:
+        raise ValueError(f"Fecha no válida: '{valor}' (usar ISO 8601, p. ej. 2025-07-31T08:00, o -2h)")
+    if instante.tzinfo is not None:
+        instante = instante.astimezone(timezone.utc).replace(tzinfo=None)
+    return _iso(instante)
+
+
+def _redondear(instante, nivel, arriba):
+    """Inicio de la cubeta de `nivel` que contiene el instante (o de la siguiente)"""
+    valor = datetime.fromisoformat(instante)
+    base = valor.replace(second=0, microsecond=0)
+    if nivel == "hora":
+        base = base.replace(minute=0)
+    if arriba and base != valor:
+        base += NIVELES_TIEMPO[nivel][1]
+    return _iso(base)
+
+
+class VentanaTiempo:
+    """Intervalo [desde, hasta) sobre columnas de fecha ISO. Se divide en tramos
+    de cubetas completas (servidos por tablas agregadas por hora o minuto) y
+    tramos de filas solo en los bordes"""
+
+    def __init__(self, desde=None, hasta=None):
+        self.desde = normalizar_instante(desde)
+        self.hasta = normalizar_instante(hasta)
+        if self.desde and self.hasta and self.desde >= self.hasta:
+            raise ValueError(f"Intervalo vacío: desde {self.desde} no es anterior a hasta {self.hasta}")
+    
+    @property
+    def completa(self):
+        return self.desde is None and self.hasta is None
+    
+    def tramos(self, niveles=("hora", "minuto")):
+        """Lista de (nivel, inicio, fin): cubetas completas del nivel más grueso
+        posible y, en los bordes, "filas" (inicio/fin None = sin límite)"""
+        return self._dividir(self.desde, self.hasta, list(niveles))
+    
+    def _dividir(self, desde, hasta, niveles):
+        if desde is not None and hasta is not None and desde >= hasta:
+            return []
+        if not niveles:
+            return [("filas", desde, hasta)]
+        nivel = niveles[0]
+        inicio = _redondear(desde, nivel, arriba=True) if desde is not None else None
+        fin = _redondear(hasta, nivel, arriba=False) if hasta is not None else None
+        if inicio is not None and fin is not None and inicio >= fin:
+            return self._dividir(desde, hasta, niveles[1:])
+        tramos = []
+        if desde is not None and inicio != desde:
+            tramos += self._dividir(desde, inicio, niveles[1:])
+        tramos.append((nivel, inicio, fin))
+        if hasta is not None and fin != hasta:
+            tramos += self._dividir(fin, hasta, niveles[1:])
+        return tramos
+    
+    def condicion_tramo(self, tramo, columna):
+        """(sql, parámetros) que selecciona un tramo: sobre la columna de la
+        cubeta para los niveles de tiempo, o sobre la columna de fecha para filas"""
+        nivel, inicio, fin = tramo
+        longitud = NIVELES_TIEMPO[nivel][0] if nivel in NIVELES_TIEMPO else None
+        partes, params = [], []
+        if inicio is not None:
+            partes.append(f"{columna} >= ?")
+            params.append(inicio[:longitud] if longitud else inicio)
+        if fin is not None:
+            partes.append(f"{columna} < ?")
+            params.append(fin[:longitud] if longitud else fin)
+        return (" AND ".join(partes) or "1=1"), params
+    
+    def condicion(self, columna):
+        """Filas dentro de la ventana: (sql, parámetros)"""
+        return self.condicion_tramo(("filas", self.desde, self.hasta), columna)
+    
+    def solapa(self, primera, ultima):
+        """True si el intervalo de fechas [primera, ultima] puede tener filas
+        de la ventana (None = sin filas con fecha)"""
+        if self.completa:
+            return True
+        if primera is None:
+            return False
+        if self.desde is not None and ultima < self.desde:
+            return False
+        return self.hasta is None or primera < self.hasta
+    
+    def describir(self):
+        if self.completa:
+            return "todo el histórico"
+        return f"desde {self.desde or 'el inicio'} hasta {self.hasta or 'ahora'}"
+
+
+class DDSketch:
+    """Sketch de cuantiles con error relativo acotado (DDSketch): cubetas
+    logarítmicas de razón gamma; dos sketches se fusionan sumando cubetas.
+    El máximo se guarda exacto."""
+
+    def __init__(self, precision=0.01):
+        self.precision = precision
+        self.gamma = (1 + precision) / (1 - precision)
+        self._log_gamma = math.log(self.gamma)
+        self.cubetas = {}
+        self.ceros = 0
+        self.n = 0
+        self.maximo = None
+    
+    def agregar(self, valor, veces=1):
+        if valor is None:
+            return
+        self.n += veces
+        if self.maximo is None or valor > self.maximo:
+            self.maximo = valor
+        if valor <= 0:
+            self.ceros += veces
+            return
+        indice = math.ceil(math.log(valor) / self._log_gamma)
+        self.cubetas[indice] = self.cubetas.get(indice, 0) + veces
+    
+    def fusionar(self, otro):
+        for indice, cantidad in otro.cubetas.items():
+            self.cubetas[indice] = self.cubetas.get(indice, 0) + cantidad
+        self.ceros += otro.ceros
+        self.n += otro.n
+        if otro.maximo is not None and (self.maximo is None or otro.maximo > self.maximo):
+            self.maximo = otro.maximo
+        return self
+    
+    def cuantil(self, q):
+        """Valor aproximado del cuantil q (0-1), o None si está vacío"""
+        if not self.n:
+            return None
+        rango = q * (self.n - 1)
+        acumulado = self.ceros
+        if rango < acumulado:
+            return 0.0
+        for indice in sorted(self.cubetas):
+            acumulado += self.cubetas[indice]
+            if acumulado > rango:
+                return min(2 * self.gamma ** indice / (self.gamma + 1), self.maximo)
+        return float(self.maximo)
+    
+    def serializar(self):
+        return json.dumps(
+            {"c": self.ceros, "m": self.maximo, "b": sorted(self.cubetas.items())},
+            separators=(",", ":"),
+        )
+    
+    @classmethod
+    def deserializar(cls, texto, precision=0.01):
+        datos = json.loads(texto)
+        sketch = cls(precision)
+        sketch.cubetas = {indice: cantidad for indice, cantidad in datos["b"]}
+        sketch.ceros = datos["c"]
+        sketch.maximo = datos["m"]
+        sketch.n = sketch.ceros + sum(sketch.cubetas.values())
+        return sketch
+
+
+# Latencias de búsquedas: tabla -> dimensiones propias (además de hotel_id)
+FUENTES_LATENCIA = {
+    "client_searches": (),
+    "provider_searches": ("provider_name",),
+    "connector_searches": ("connector_name",),
+}
+PRECISION_LATENCIAS = 0.01
+
+# Agrupaciones de analizar_latencias: nombre -> [(tabla, dimensión)]
+AGRUPACIONES_LATENCIA = {
+    "tabla": [(tabla, "total") for tabla in FUENTES_LATENCIA],
+    "proveedor": [("provider_searches", "provider_name")],
+    "conector": [("connector_searches", "connector_name")],
+    "hotel": [(tabla, "hotel_id") for tabla in FUENTES_LATENCIA],
+}
+
+
+def primeras_claves(sketches, conteos, limite):
+    """Claves ordenadas por número de búsquedas (filas leídas más sketches)"""
+    totales = dict(conteos)
+    for clave, sketch in sketches.items():
+        totales[clave] = totales.get(clave, 0) + sketch.n
+    ordenadas = sorted(totales, key=lambda clave: (-totales[clave], clave))
+    return ordenadas[:limite] if limite is not None else ordenadas
+
+
+def dimensiones_latencia(conn, tabla):
+    """Dimensiones con sketch de una tabla de búsquedas ("total" incluida), o
+    None si la tabla no tiene duration_ms e initiated_at"""
+    columnas = set(columnas_tabla(conn, tabla))
+    if not {"duration_ms", "initiated_at"} <= columnas:
+        return None
+    return ["total"] + [d for d in FUENTES_LATENCIA[tabla] + ("hotel_id",) if d in columnas]
+
+
+def sketches_filas(filas, dimensiones):
+    """{(dimensión, clave, hora): DDSketch} a partir de filas
+    (duration_ms, hora, valores de las dimensiones salvo "total")"""
+    sketches = {}
+    for fila in filas:
+        duracion, hora = fila[0], fila[1]
+        if duracion is None or hora is None:
+            continue
+        claves = [("total", "")] + [
+            (dimension, str(valor)) for dimension, valor in zip(dimensiones[1:], fila[2:])
+            if valor is not None
+        ]
+        for dimension, clave in claves:
+            sketch = sketches.get((dimension, clave, hora))
+            if sketch is None:
+                sketch = sketches[(dimension, clave, hora)] = DDSketch(PRECISION_LATENCIAS)
+            sketch.agregar(duracion)
+    return sketches
+
+
+def actualizar_sketches_latencia(conn, lote=20000):
+    """Añade las búsquedas nuevas a los DDSketch por hora de latency_sketches"""
+    procesadas = 0
+    for tabla in FUENTES_LATENCIA:
+        dimensiones = dimensiones_latencia(conn, tabla)
+        if dimensiones is None:
+            continue
+        nombre = f"latency_sketches:{tabla}"
+        ultimo = marca_agua(conn, nombre)
+        if max_rowid(conn, tabla) < ultimo:
+            conn.execute("DELETE FROM latency_sketches WHERE source = ?", (tabla,))
+            ultimo = 0
+        
+        extra = "".join(f", {d}" for d in dimensiones[1:])
+        while True:
+            filas = conn.execute(
+                f"SELECT rowid, duration_ms, {expresion_rollup(tabla, 'hora')}{extra} FROM {tabla} "
+                "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (ultimo, lote),
+            ).fetchall()
+            if not filas:
+                break
+            for (dimension, clave, hora), sketch in sketches_filas([f[1:] for f in filas], dimensiones).items():
+                existente = conn.execute(
+                    "SELECT sketch FROM latency_sketches "
+                    "WHERE source = ? AND dimension = ? AND clave = ? AND hora = ?",
+                    (tabla, dimension, clave, hora),
+                ).fetchone()
+                if existente:
+                    sketch.fusionar(DDSketch.deserializar(existente[0], PRECISION_LATENCIAS))
+                    conn.execute(
+                        "UPDATE latency_sketches SET n = ?, sketch = ? "
+                        "WHERE source = ? AND dimension = ? AND clave = ? AND hora = ?",
+                        (sketch.n, sketch.serializar(), tabla, dimension, clave, hora),
+                    )
+                else:
+                    conn.execute(
+                        "INSERT INTO latency_sketches (source, dimension, clave, hora, n, sketch) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (tabla, dimension, clave, hora, sketch.n, sketch.serializar()),
+                    )
+            ultimo = filas[-1][0]
+            _guardar_marca_agua(conn, nombre, ultimo)
+            conn.commit()
+            procesadas += len(filas)
+    return procesadas
+
+
+# Pistas de dominio para las anomalías: (dimensión, texto buscado, pista, SQL)
+PISTAS_ANOMALIA = [
+    ("restriccion", "ExcludeHotelByConnection",
+     "Posible hotel fantasma: excluido por la configuración de las conexiones",
+     # La lista va entre comas para no tocar 122 o 2200 al quitar el 22
+     "UPDATE partners.\"ProviderConnections\" \n"
+     "SET \"ExcludeHotelIds\" = BTRIM(REPLACE(',' || \"ExcludeHotelIds\" || ',', ',{hotel},', ','), ',')\n"
+     "WHERE ',' || \"ExcludeHotelIds\" || ',' LIKE '%,{hotel},%';"),
+    ("excepcion", "Room mapping failed",
+     "Falta el mapeo de habitación en mapping.RoomMappings",
+     "INSERT INTO mapping.\"RoomMappings\" \n"
+     "(\"IntegrationSystemId\", \"ExternalId\", \"RoomTypeId\")\n"
+     "VALUES (1, '{codigo}', '[ID_ROOM_TYPE]');"),
+]
+
+PATRON_CODIGO_HABITACION = re.compile(r"['\"]([^'\"]+)['\"]|(\S+\|\S+)")
+
+
+def pista_anomalia(dimension, texto):
+    """(pista, plantilla SQL) de PISTAS_ANOMALIA que aplica a `texto`, o None"""
+    for dimension_pista, buscado, pista, sql in PISTAS_ANOMALIA:
+        if dimension_pista == dimension and texto and buscado in str(texto):
+            return pista, sql
+    return None
+
+
+def codigo_habitacion(mensaje):
+    """Código externo de habitación citado en un mensaje de error de mapeo"""
+    coincidencia = PATRON_CODIGO_HABITACION.search(mensaje or "")
+    if not coincidencia:
+        return "[EXTERNAL_ID]"
+    return (coincidencia.group(1) or coincidencia.group(2)).strip(".,;:")
+
+
+def detectar_anomalias(dimension, conteos, umbral_cuota=0.5, umbral_z=3.0, minimo=100, total=None):
+    """Anomalías de una dimensión a partir de {(entidad, hora): cantidad}.
+    
+    En una sola pasada calcula la cuota de cada entidad sobre el total y el
+    z-score de su última hora frente a las horas anteriores (con desviación
+    mínima de Poisson, sqrt(media)). Se marca "cuota" si la entidad supera
+    `umbral_cuota` del total y "pico" si la última hora supera `umbral_z`;
+    ambas exigen al menos `minimo` filas.
+    """
+    horas = sorted({hora for _, hora in conteos if hora is not None})
+    ultima = horas[-1] if horas else None
+    previas = len(horas) - 1
+    
+    # entidad -> [total, suma horas previas, suma de cuadrados, última hora]
+    acumulados = {}
+    for (entidad, hora), cantidad in conteos.items():
+        acumulado = acumulados.setdefault(entidad, [0, 0, 0, 0])
+        acumulado[0] += cantidad
+        if hora is None:
+            continue
+        if hora == ultima:
+            acumulado[3] += cantidad
+        else:
+            acumulado[1] += cantidad
+            acumulado[2] += cantidad * cantidad
+    if total is None:
+        total = sum(acumulado[0] for acumulado in acumulados.values())
+    
+    anomalias = []
+    for entidad, (suma, suma_previas, cuadrados, actual) in acumulados.items():
+        cuota = suma / total if total else 0.0
+        z = None
+        if previas >= 2:
+            media = suma_previas / previas
+            varianza = max(0.0, cuadrados / previas - media * media)
+            z = (actual - media) / max(math.sqrt(varianza), math.sqrt(media), 1.0)
+        
+        motivos = []
+        if suma >= minimo and cuota >= umbral_cuota:
+            motivos.append("cuota")
+        if z is not None and actual >= minimo and z >= umbral_z:
+            motivos.append("pico")
+        if motivos:
+            anomalias.append({
+                "dimension": dimension,
+                "entidad": entidad,
+                "cantidad": suma,
+                "cuota": cuota,
+                "hora": ultima if z is not None else None,
+                "cantidad_hora": actual if z is not None else None,
+                "z": z,
+                "motivos": motivos,
+            })
+    
+    anomalias.sort(key=lambda a: (-a["cuota"], -(a["z"] or 0.0), str(a["entidad"])))
+    return anomalias
+
+
+# Búsqueda de texto en excepciones: índice FTS5 de contenido externo sobre
+# exceptions, mantenido de forma incremental como el resto de derivadas
+TABLA_FTS = "exceptions_fts"
+COLUMNAS_FTS = ("exception_type", "exception_message", "context_data")
+PESOS_FTS = {"exception_type": 10.0, "exception_message": 5.0, "context_data": 1.0}
+TOKENIZADOR_FTS = "unicode61 remove_diacritics 2"
+OPERADORES_FTS = {"AND", "OR", "NOT"}
+PATRON_TERMINO_FTS = re.compile(r'"[^"]*"\*?|\S+')
+# Excepciones sin indexar que se buscan en un índice temporal en memoria; con
+# más (p. ej. sin exceptions_fts en una base de solo lectura) la búsqueda falla
+FTS_MAX_COLA = 50000
+
+# Partes variables de un mensaje que se enmascaran en su plantilla
+PATRONES_PLANTILLA = [
+    (re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"), "<guid>"),
+    (re.compile(r"'[^']*'|\"[^\"]*\""), "'<cod>'"),
+    (re.compile(r"\b0x[0-9a-fA-F]+\b|\b\d+(?:[.,]\d+)*\b"), "<n>"),
+]
+
+
+def plantilla_mensaje(texto):
+    """(plantilla, parámetros): el mensaje con GUIDs, códigos entre comillas y
+    números enmascarados, y los valores sustituidos en orden de aparición"""
+    if texto is None:
+        return None, []
+    encontrados = []
+    for patron, marcador in PATRONES_PLANTILLA:
+        for m in patron.finditer(texto):
+            if not any(m.start() < fin and inicio < m.end() for inicio, fin, _, _ in encontrados):
+                encontrados.append((m.start(), m.end(), marcador, m.group(0)))
+    encontrados.sort()
+    partes, parametros, posicion = [], [], 0
+    for inicio, fin, marcador, valor in encontrados:
+        partes.append(texto[posicion:inicio])
+        partes.append(marcador)
+        parametros.append(valor.strip("'\""))
+        posicion = fin
+    partes.append(texto[posicion:])
+    return "".join(partes), parametros
+
+
+def huella_plantilla(plantilla):
+    """template_id estable (entero de 64 bits con signo) de una plantilla: se
+    calcula igual en cualquier proceso, sin consultar la base de datos"""
+    resumen = hashlib.blake2b(plantilla.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(resumen, "big", signed=True)
+
+
+def huella_excepcion(exception_type):
+    """template_id del tipo de una excepción (None si no tiene tipo)"""
+    plantilla, _ = plantilla_mensaje(exception_type)
+    return huella_plantilla(plantilla) if plantilla is not None else None
+
+
+def sumar_plantillas(por_tipo, conteos, ejemplos, maximo=3):
+    """Acumula {(exception_type,): n} en conteos por (template_id,) y guarda
+    hasta `maximo` tipos de ejemplo de cada plantilla (en orden alfabético)"""
+    for (tipo,), cantidad in sorted(por_tipo.items(), key=lambda item: str(item[0][0])):
+        template_id = huella_excepcion(tipo)
+        conteos[(template_id,)] = conteos.get((template_id,), 0) + cantidad
+        tipos = ejemplos.setdefault(template_id, [])
+        if len(tipos) < maximo:
+            tipos.append(tipo)
+
+
+def actualizar_plantillas_excepciones(conn, lote=20000):
+    """Calcula template_id de las excepciones que no lo traen de la carga
+    (insertadas por otras herramientas). La columna la añade
+    smartperlahub_ingest.py: sin ella las consultas calculan la huella de
+    cada tipo al vuelo y aquí no se toca la tabla"""
+    if "template_id" not in columnas_tabla(conn, "exceptions"):
+        return 0
+    ultimo = marca_agua(conn, "exception_templates")
+    hasta = max_rowid(conn, "exceptions")
+    if hasta < ultimo:
+        ultimo = 0
+    
+    procesadas = 0
+    while ultimo < hasta:
+        fin = min(ultimo + lote, hasta)
+        filas = conn.execute(
+            "SELECT rowid, exception_type FROM exceptions "
+            "WHERE rowid > ? AND rowid <= ? AND template_id IS NULL",
+            (ultimo, fin),
+        ).fetchall()
+        huellas = {tipo: huella_excepcion(tipo) for _, tipo in filas if tipo is not None}
+        conn.executemany(
+            "UPDATE exceptions SET template_id = ? WHERE rowid = ?",
+            [(huellas[tipo], rowid) for rowid, tipo in filas if tipo is not None],
+        )
+        ultimo = fin
+        _guardar_marca_agua(conn, "exception_templates", ultimo)
+        conn.commit()
+        procesadas += len(filas)
+    return procesadas
+
+
+def consulta_fts(texto, columna=None):
+    """Traduce texto libre a una consulta FTS5: cada palabra es un término
+    (AND implícito), "palabra*" busca por prefijo, las comillas agrupan una
+    frase y AND/OR/NOT se respetan como operadores"""
+    terminos = []
+    for termino in PATRON_TERMINO_FTS.findall(str(texto or "")):
+        if termino in OPERADORES_FTS:
+            terminos.append(termino)
+            continue
+        prefijo = termino.endswith("*")
+        termino = termino.rstrip("*").strip('"')
+        if not termino:
+            continue
+        terminos.append('"' + termino.replace('"', '""') + '"' + ("*" if prefijo else ""))
+    while terminos and terminos[-1] in OPERADORES_FTS:
+        terminos.pop()
+    while terminos and terminos[0] in OPERADORES_FTS:
+        terminos.pop(0)
+    if not terminos:
+        raise ValueError("La búsqueda no contiene ningún término")
+    consulta = " ".join(terminos)
+    return f"{columna} : ({consulta})" if columna else consulta
+
+
+def columnas_fts(conn):
+    """Columnas de COLUMNAS_FTS presentes en exceptions (el índice usa las mismas)"""
+    existentes = set(columnas_tabla(conn, "exceptions"))
+    return [columna for columna in COLUMNAS_FTS if columna in existentes]
+
+
+def crear_indice_fts(conn, columnas):
+    """Crea exceptions_fts (contenido externo: no duplica el texto) con el
+    ranking bm25 ponderado por columna como orden por defecto (rank)"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (TABLA_FTS,)).fetchone():
+        return
+    conn.execute(
+        f"CREATE VIRTUAL TABLE {TABLA_FTS} USING fts5("
+        f"{', '.join(columnas)}, content='exceptions', tokenize='{TOKENIZADOR_FTS}')"
+    )
+    pesos = ", ".join(str(PESOS_FTS[columna]) for columna in columnas)
+    conn.execute(f"INSERT INTO {TABLA_FTS} ({TABLA_FTS}, rank) VALUES ('rank', 'bm25({pesos})')")
+
+
+def indice_fts_cola(conn, desde_rowid, columnas, ventana):
+    """Índice FTS5 en memoria con las excepciones aún no indexadas (rowid >
+    marca de agua), con las mismas tablas que la base de datos para que las
+    consultas de búsqueda sirvan sin cambios"""
+    memoria = sqlite3.connect(":memory:")
+    memoria.row_factory = sqlite3.Row
+    memoria.execute(f"CREATE TABLE exceptions (occurred_at TEXT, {', '.join(columnas)})")
+    crear_indice_fts(memoria, columnas)
+    fecha, valores = ventana.condicion("occurred_at")
+    cols = ", ".join(columnas)
+    filas = conn.execute(
+        f"SELECT rowid, occurred_at, {cols} FROM exceptions NOT INDEXED "
+        f"WHERE rowid > ? AND {fecha}",
+        [desde_rowid] + valores,
+    ).fetchall()
+    marcadores = ", ".join("?" for _ in columnas)
+    memoria.executemany(
+        f"INSERT INTO exceptions (rowid, occurred_at, {cols}) VALUES (?, ?, {marcadores})",
+        [tuple(fila) for fila in filas],
+    )
+    memoria.executemany(
+        f"INSERT INTO {TABLA_FTS} (rowid, {cols}) VALUES (?, {marcadores})",
+        [(fila[0],) + tuple(fila[2:]) for fila in filas],
+    )
+    return memoria
+
+
+def buscar_fts(conn, consulta, ventana, limite):
+    """(coincidencias, mejores, conteo por exception_type) de una consulta FTS5
+    sobre exceptions_fts unida a exceptions"""
+    fecha, valores = ventana.condicion("e.occurred_at")
+    origen = (
+        f"FROM {TABLA_FTS} f JOIN exceptions e ON e.rowid = f.rowid "
+        f"WHERE {TABLA_FTS} MATCH ? AND {fecha}"
+    )
+    params = [consulta] + valores
+    total = conn.execute(f"SELECT COUNT(*) {origen}", params).fetchone()[0]
+    if not total:
+        return 0, [], {}
+    mejores = [dict(fila) for fila in conn.execute(f"""
+        SELECT f.rowid AS rowid, e.occurred_at, e.exception_type,
+               snippet({TABLA_FTS}, -1, '[', ']', '…', 12) AS fragmento,
+               f.rank AS puntuacion
+        {origen}
+        ORDER BY f.rank
+        LIMIT ?
+    """, params + [limite])]
+    por_tipo = dict(conn.execute(
+        f"SELECT e.exception_type, COUNT(*) {origen} GROUP BY e.exception_type", params
+    ).fetchall())
+    return total, mejores, por_tipo
+
+
+def actualizar_fts_excepciones(conn, lote=20000):
+    """Indexa en exceptions_fts las excepciones nuevas desde la marca de agua"""
+    columnas = columnas_fts(conn)
+    if not columnas:
+        return 0
+    try:
+        crear_indice_fts(conn, columnas)
+    except sqlite3.OperationalError:
+        # SQLite compilado sin FTS5: buscar_excepciones devuelve un error
+        return 0
+    ultimo = marca_agua(conn, TABLA_FTS)
+    hasta = max_rowid(conn, "exceptions")
+    if hasta < ultimo:
+        # La tabla se ha recreado: reconstruir el índice desde el contenido
+        conn.execute(f"INSERT INTO {TABLA_FTS} ({TABLA_FTS}) VALUES ('rebuild')")
+        _guardar_marca_agua(conn, TABLA_FTS, hasta)
+        conn.commit()
+        return hasta
+    
+    cols = ", ".join(columnas)
+    procesadas = 0
+    while ultimo < hasta:
+        fin = min(ultimo + lote, hasta)
+        procesadas += conn.execute(
+            f"INSERT INTO {TABLA_FTS} (rowid, {cols}) "
+            f"SELECT rowid, {cols} FROM exceptions WHERE rowid > ? AND rowid <= ?",
+            (ultimo, fin),
+        ).rowcount
+        ultimo = fin
+        _guardar_marca_agua(conn, TABLA_FTS, ultimo)
+        conn.commit()
+    return procesadas
+
+
+# Etapas de actualización incremental, en orden
+DERIVADOS = [
+    ("exception_hotels", actualizar_exception_hotels),
+    ("rollup_table_counts", actualizar_conteos_tablas),
+    # Antes de los rollups: rollup_exception_templates agrupa por template_id
+    ("exception_templates", actualizar_plantillas_excepciones),
+    ("rollups", actualizar_rollups),
+    ("latency_sketches", actualizar_sketches_latencia),
+    ("exceptions_fts", actualizar_fts_excepciones),
+]
+
+
+def actualizar_derivados(conn):
+    """Crea las tablas derivadas si faltan y procesa las filas nuevas"""
+    conn.executescript(ESQUEMA_DERIVADOS)
+    return {nombre: actualizar(conn) for nombre, actualizar in DERIVADOS}
+
+
+def derivadas_faltantes(conn):
+    """Tablas derivadas (ESQUEMA_DERIVADOS y el índice FTS5) que no existen"""
+    existentes = {fila[0] for fila in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    tablas = re.findall(r"CREATE TABLE IF NOT EXISTS (\w+)", ESQUEMA_DERIVADOS)
+    if columnas_fts(conn):
+        tablas.append(TABLA_FTS)
+    return [tabla for tabla in tablas if tabla not in existentes]
+
+
+class AlmacenSQLite:
+    """Consultas analíticas sobre SQLite: rollups, sketches e índices derivados
+    hasta su marca de agua más la cola de filas aún sin procesar"""
+
+    nombre = "sqlite"
+    no_disponibles = ()
+
+    def __init__(self, pool):
+        self.pool = pool
+    
+    def conexion(self):
+        return self.pool.conexion()
+    
+    def ultimo_rowid(self, conn, tabla):
+        return max_rowid(conn, tabla)
+    
+    def conteo_tabla(self, conn, tabla, ventana=None):
+        """COUNT(*) desde rollup_table_counts más las filas aún no agregadas;
+        con ventana, desde los rollups por hora y minuto de la tabla"""
+        if ventana is not None and not ventana.completa:
+            return self.agregado(conn, FAMILIA_CONTEO[tabla], (), ventana=ventana).get((), 0)
+        ultimo = marca_agua(conn, f"rollup_table_counts:{tabla}")
+        total = 0
+        if ultimo:
+            fila = conn.execute(
+                "SELECT row_count FROM rollup_table_counts WHERE table_name = ?", (tabla,)
+            ).fetchone()
+            total = fila[0] if fila else 0
+        return total + conn.execute(
+            f'SELECT COUNT(*) FROM "{tabla}" WHERE rowid > ?', (ultimo,)
+        ).fetchone()[0]
+    
+    def agregado(self, conn, rollup, claves, where="1=1", params=(), ventana=None):
+        """Conteos por claves leyendo el rollup y agregando solo las filas
+        posteriores a su marca de agua; devuelve {tupla de claves: cantidad}.
+        
+        Con `ventana`, las horas y minutos completos se leen de {rollup}_hora y
+        {rollup}_minuto y la tabla base solo se recorre (por índice de fecha)
+        en los bordes que no llenan un minuto.
+        """
+        if ventana is None or ventana.completa:
+            return self._agregado_rollup(conn, rollup, claves, where, params)
+        
+        tabla = ROLLUPS[f"{rollup}_hora"][0]
+        conteos = {}
+        for tramo in ventana.tramos():
+            if tramo[0] == "filas":
+                fecha, valores = ventana.condicion_tramo(tramo, COLUMNA_FECHA[tabla])
+                parcial = self.conteo_filas(
+                    conn, tabla, claves, f"({where}) AND {fecha}", tuple(params) + tuple(valores)
+                )
+            else:
+                parcial = self._agregado_rollup(
+                    conn, f"{rollup}_{tramo[0]}", claves, where, params, ventana, tramo
+                )
+            for clave, cantidad in parcial.items():
+                conteos[clave] = conteos.get(clave, 0) + cantidad
+        return conteos
+    
+    def _agregado_rollup(self, conn, rollup, claves, where="1=1", params=(), ventana=None, tramo=None):
+        """Conteos de un único rollup (limitado a las cubetas de `tramo`) más
+        su cola pendiente de agregar"""
+        tabla, claves_rollup = ROLLUPS[rollup]
+        ultimo = marca_agua(conn, rollup)
+        where_rollup, params_rollup = where, tuple(params)
+        where_tabla, params_tabla = where, tuple(params)
+        if tramo is not None:
+            cubetas, valores = ventana.condicion_tramo(tramo, tramo[0])
+            where_rollup, params_rollup = f"({where}) AND {cubetas}", params_rollup + tuple(valores)
+            fecha, valores = ventana.condicion_tramo(("filas",) + tuple(tramo[1:]), COLUMNA_FECHA[tabla])
+            where_tabla, params_tabla = f"({where}) AND {fecha}", params_tabla + tuple(valores)
+        
+        conteos = {}
+        if ultimo:
+            columnas = [self._columna_rollup(clave, claves_rollup) for clave in claves]
+            agrupacion = f" GROUP BY {', '.join(claves)}" if claves else ""
+            for fila in conn.execute(
+                f"SELECT {''.join(c + ', ' for c in columnas)}SUM(row_count) "
+                f"FROM {rollup} WHERE {where_rollup}{agrupacion}",
+                params_rollup,
+            ):
+                if fila[-1]:
+                    conteos[tuple(fila[:-1])] = fila[-1]
+        
+        # La cola pendiente se lee por rango de rowid, no recorriendo índices
+        cola = self.conteo_filas(
+            conn, tabla, claves, f"rowid > ? AND ({where_tabla})", (ultimo,) + params_tabla,
+            por_rowid=bool(ultimo),
+        )
+        for clave, cantidad in cola.items():
+            conteos[clave] = conteos.get(clave, 0) + cantidad
+        return conteos
+    
+    def _columna_rollup(self, clave, claves_rollup):
+        """Columna de un rollup para `clave`; una hora se obtiene de los minutos"""
+        if clave in claves_rollup:
+            return clave
+        for nivel in claves_rollup:
+            if clave in NIVELES_TIEMPO and nivel in NIVELES_TIEMPO:
+                return f"substr({nivel}, 1, {NIVELES_TIEMPO[clave][0]}) AS {clave}"
+        raise ValueError(f"El rollup no agrega por '{clave}'")
+    
+    def conteo_filas(self, conn, tabla, claves, where, params, por_rowid=False):
+        """Conteos por claves leídos directamente de la tabla base"""
+        origen = f"{tabla} NOT INDEXED" if por_rowid else tabla
+        columnas = [expresion_rollup(tabla, clave) for clave in claves]
+        agrupacion = f" GROUP BY {', '.join(claves)}" if claves else ""
+        conteos = {}
+        for fila in conn.execute(
+            f"SELECT {''.join(c + ', ' for c in columnas)}COUNT(*) FROM {origen} WHERE {where}{agrupacion}",
+            tuple(params),
+        ):
+            if fila[-1]:
+                conteos[tuple(fila[:-1])] = fila[-1]
+        return conteos
+    
+    def excepciones_hotel(self, conn, hotel_id, ventana=None):
+        """Excepciones de un hotel vía exception_hotels; las filas aún no
+        indexadas se resuelven analizando su context_data"""
+        ultimo = marca_agua(conn, "exception_hotels")
+        fecha, valores = (ventana or VentanaTiempo()).condicion("e.occurred_at")
+        conteos = {}
+        
+        if ultimo:
+            for row in conn.execute(f"""
+            SELECT e.exception_type, COUNT(*) as cantidad
+            FROM exception_hotels eh
+            JOIN exceptions e ON e.rowid = eh.exception_rowid
+            WHERE eh.hotel_id = ? AND {fecha}
+            GROUP BY e.exception_type
+            """, [hotel_id] + valores):
+                conteos[row["exception_type"]] = row["cantidad"]
+        
+        for row in conn.execute(f"""
+        SELECT exception_type, context_data
+        FROM exceptions e
+        WHERE rowid > ? AND context_data LIKE ? AND {fecha}
+        """, [ultimo, f"%{hotel_id}%"] + valores):
+            if hotel_id in extraer_hoteles(row["context_data"]):
+                conteos[row["exception_type"]] = conteos.get(row["exception_type"], 0) + 1
+        
+        return [
+            {"exception_type": tipo, "cantidad": cantidad}
+            for tipo, cantidad in sorted(conteos.items(), key=lambda item: (-item[1], str(item[0])))
+        ]
+    
+    def excepciones_por_hotel(self, conn, ventana=None):
+        """{hotel_id: excepciones} vía exception_hotels más las filas sin indexar"""
+        ultimo = marca_agua(conn, "exception_hotels")
+        ventana = ventana or VentanaTiempo()
+        fecha, valores = ventana.condicion("e.occurred_at")
+        conteos = {}
+        if ultimo:
+            if ventana.completa:
+                sql, params = "SELECT hotel_id, COUNT(*) FROM exception_hotels GROUP BY hotel_id", []
+            else:
+                sql = (
+                    "SELECT eh.hotel_id, COUNT(*) FROM exceptions e "
+                    "JOIN exception_hotels eh ON eh.exception_rowid = e.rowid "
+                    f"WHERE {fecha} GROUP BY eh.hotel_id"
+                )
+                params = valores
+            for hotel, cantidad in conn.execute(sql, params):
+                conteos[hotel] = cantidad
+        for (context_data,) in conn.execute(
+            f"SELECT context_data FROM exceptions e WHERE rowid > ? AND {fecha}", [ultimo] + valores
+        ):
+            for hotel in extraer_hoteles(context_data):
+                conteos[hotel] = conteos.get(hotel, 0) + 1
+        return conteos
+    
+    def hoteles_excepcion(self, conn, tipo, ventana=None):
+        """{(hotel_id,): excepciones} de un tipo de excepción"""
+        ultimo = marca_agua(conn, "exception_hotels")
+        fecha, valores = (ventana or VentanaTiempo()).condicion("e.occurred_at")
+        conteos = {}
+        if ultimo:
+            for hotel, cantidad in conn.execute(f"""
+            SELECT eh.hotel_id, COUNT(*)
+            FROM exceptions e
+            JOIN exception_hotels eh ON eh.exception_rowid = e.rowid
+            WHERE e.exception_type = ? AND {fecha}
+            GROUP BY eh.hotel_id
+            """, [tipo] + valores):
+                conteos[(hotel,)] = cantidad
+        for (context_data,) in conn.execute(
+            f"SELECT context_data FROM exceptions e WHERE rowid > ? AND exception_type = ? AND {fecha}",
+            [ultimo, tipo] + valores,
+        ):
+            for hotel in extraer_hoteles(context_data):
+                conteos[(hotel,)] = conteos.get((hotel,), 0) + 1
+        return conteos
+    
+    def latencias(self, conn, tabla, dimension, ventana, limite=None):
+        """{clave: DDSketch} de una dimensión en la ventana: los sketches por
+        hora cubren las horas completas y solo se leen filas en los bordes y
+        tras la marca de agua; con `limite`, solo las claves con más búsquedas"""
+        dimensiones = dimensiones_latencia(conn, tabla)
+        if dimensiones is None or dimension not in dimensiones:
+            return {}
+        ultimo = marca_agua(conn, f"latency_sketches:{tabla}")
+        columna = "''" if dimension == "total" else dimension
+        fecha = COLUMNA_FECHA[tabla]
+        
+        tramos = ventana.tramos(("hora",)) if ultimo else [("filas", ventana.desde, ventana.hasta)]
+        consultas = []
+        for tramo in tramos:
+            if tramo[0] == "filas":
+                condicion, params = ventana.condicion_tramo(tramo, fecha)
+                if ultimo:
+                    condicion, params = f"+rowid <= ? AND {condicion}", [ultimo] + params
+                consultas.append((tabla, condicion, params))
+        if ultimo:
+            condicion, params = ventana.condicion(fecha)
+            consultas.append((f"{tabla} NOT INDEXED", f"rowid > ? AND {condicion}", [ultimo] + params))
+        
+        sketches = {}
+        for origen, where, valores in consultas:
+            for duracion, valor in conn.execute(
+                f"SELECT duration_ms, {columna} FROM {origen} WHERE {where}", valores
+            ):
+                if duracion is None or valor is None:
+                    continue
+                clave = str(valor)
+                if clave not in sketches:
+                    sketches[clave] = DDSketch(PRECISION_LATENCIAS)
+                sketches[clave].agregar(duracion)
+        
+        horas = [tramo for tramo in tramos if tramo[0] == "hora"]
+        if not horas:
+            return {clave: sketches[clave] for clave in primeras_claves(sketches, {}, limite)}
+        
+        condicion, params = ventana.condicion_tramo(horas[0], "hora")
+        filtro = f"source = ? AND dimension = ? AND {condicion}"
+        valores = [tabla, dimension] + params
+        conteos = {
+            clave: n for clave, n in conn.execute(
+                f"SELECT clave, SUM(n) FROM latency_sketches WHERE {filtro} GROUP BY clave", valores
+            )
+        }
+        claves = primeras_claves(sketches, conteos, limite)
+        for inicio in range(0, len(claves), 500):
+            grupo = claves[inicio:inicio + 500]
+            marcadores = ", ".join("?" for _ in grupo)
+            for clave, texto in conn.execute(
+                f"SELECT clave, sketch FROM latency_sketches WHERE {filtro} AND clave IN ({marcadores})",
+                valores + grupo,
+            ):
+                sketch = DDSketch.deserializar(texto, PRECISION_LATENCIAS)
+                if clave in sketches:
+                    sketch.fusionar(sketches[clave])
+                sketches[clave] = sketch
+        return {clave: sketches[clave] for clave in claves if clave in sketches}
+    
+    def plantillas_excepciones(self, conn, tipo, ventana):
+        """({(template_id,): cantidad}, {template_id: tipos de ejemplo}).
+        
+        Sin filtro se agrega rollup_exception_templates; las filas que aún no
+        tienen template_id (o una base de datos sin la columna) y el filtro
+        por tipo se resuelven agrupando por exception_type y calculando la
+        huella de cada tipo.
+        """
+        conteos, ejemplos = {}, {}
+        if tipo or "template_id" not in columnas_tabla(conn, "exceptions"):
+            where, params = ("exception_type LIKE ?", [f"%{tipo}%"]) if tipo else ("1=1", [])
+            por_tipo = self.agregado(conn, "rollup_exceptions", ("exception_type",), where, params, ventana)
+            sumar_plantillas(por_tipo, conteos, ejemplos)
+            return conteos, ejemplos
+        
+        conteos.update(self.agregado(conn, "rollup_exception_templates", ("template_id",), ventana=ventana))
+        sin_huella = conteos.pop((None,), 0)
+        if sin_huella:
+            fecha, valores = ventana.condicion("occurred_at")
+            por_tipo = self.conteo_filas(
+                conn, "exceptions", ("exception_type",),
+                f"rowid > ? AND template_id IS NULL AND {fecha}",
+                [marca_agua(conn, "exception_templates")] + valores, por_rowid=True,
+            )
+            sumar_plantillas(por_tipo, conteos, ejemplos)
+            # El resto son excepciones sin tipo, que nunca tienen huella
+            resto = sin_huella - sum(por_tipo.values())
+            if resto > 0:
+                conteos[(None,)] = conteos.get((None,), 0) + resto
+        return conteos, ejemplos
+    
+    def ejemplos_plantilla(self, conn, template_id, maximo=3):
+        """Tipos distintos de una plantilla (por idx_exceptions_template_id)"""
+        tipos = []
+        for (tipo,) in conn.execute(
+            "SELECT exception_type FROM exceptions WHERE template_id = ? ORDER BY rowid LIMIT 50",
+            (template_id,),
+        ):
+            if tipo not in tipos:
+                tipos.append(tipo)
+                if len(tipos) == maximo:
+                    break
+        return tipos
+    
+    def coincidencias_fts(self, conn, consulta, ventana, limite):
+        """Busca en exceptions_fts y, con un índice en memoria, en las filas
+        que aún no ha indexado la actualización incremental"""
+        columnas = columnas_fts(conn)
+        indexado = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?", (TABLA_FTS,)
+        ).fetchone() is not None
+        ultimo = marca_agua(conn, TABLA_FTS) if indexado else 0
+        pendientes = max_rowid(conn, "exceptions") - ultimo
+        if pendientes > FTS_MAX_COLA:
+            raise ValueError(
+                f"Índice de búsqueda no disponible: {pendientes:,} excepciones sin indexar en {TABLA_FTS} "
+                f"(máximo {FTS_MAX_COLA:,}); se indexan al cargar los logs o al arrancar el servidor "
+                "con permiso de escritura"
+            )
+        
+        total, mejores, por_tipo = 0, [], {}
+        try:
+            if ultimo:
+                total, mejores, por_tipo = buscar_fts(conn, consulta, ventana, limite)
+            if pendientes > 0:
+                memoria = indice_fts_cola(conn, ultimo, columnas, ventana)
+                try:
+                    cola = buscar_fts(memoria, consulta, ventana, limite)
+                finally:
+                    memoria.close()
+                total += cola[0]
+                # Las puntuaciones de la cola usan otra colección: orden aproximado
+                mejores = sorted(mejores + cola[1], key=lambda r: r["puntuacion"])[:limite]
+                for tipo, cantidad in cola[2].items():
+                    por_tipo[tipo] = por_tipo.get(tipo, 0) + cantidad
+        except sqlite3.OperationalError as e:
+            if "fts5" in str(e).lower() and "syntax" in str(e).lower():
+                raise ValueError(f"Búsqueda no válida: {e}")
+            if "no such module" in str(e).lower():
+                raise ValueError("Búsqueda no disponible: este SQLite no incluye FTS5")
+            raise
+        return total, mejores, por_tipo
+
+
+def rutas_particiones(db_path):
+    """Ficheros SQLite de DB_PATH: una ruta, varias separadas por os.pathsep
+    o patrones glob (p. ej. logs/smartperlahub_*.db)"""
+    rutas = []
+    for parte in db_path.split(os.pathsep):
+        if any(caracter in parte for caracter in "*?["):
+            rutas.extend(sorted(glob.glob(parte)))
+        elif parte:
+            rutas.append(parte)
+    return list(dict.fromkeys(rutas))
+
+
+def es_particionado(db_path):
+    """True si DB_PATH nombra varias bases de datos (o un patrón que puede
+    crecer con ficheros nuevos)"""
+    return os.pathsep in db_path or any(caracter in db_path for caracter in "*?[")
+
+
+def rango_fechas(conn):
+    """(primera, última) fecha de las tablas de auditoría; cada MIN/MAX va en
+    su propia consulta para que SQLite lo resuelva con el índice de fecha"""
+    primera = ultima = None
+    for tabla, columna in COLUMNA_FECHA.items():
+        if not columnas_tabla(conn, tabla):
+            continue
+        minimo = conn.execute(f"SELECT MIN({columna}) FROM {tabla}").fetchone()[0]
+        if minimo is None:
+            continue
+        maximo = conn.execute(f"SELECT MAX({columna}) FROM {tabla}").fetchone()[0]
+        primera = minimo if primera is None else min(primera, minimo)
+        ultima = maximo if ultima is None else max(ultima, maximo)
+    return primera, ultima
+
+
+class Particion:
+    """Un fichero SQLite de DB_PATH: pool de lectura, detección de cambios
+    (PRAGMA data_version) y rango de fechas para descartarlo por ventana"""
+
+    def __init__(self, db_path, pool, con_rango=False):
+        self.db_path = db_path
+        self.nombre = os.path.basename(db_path)
+        self.pool = pool
+        self.almacen = AlmacenSQLite(pool)
+        self.vigia = sqlite3.connect(pool.uri, uri=True, check_same_thread=False)
+        self.con_rango = con_rango
+        self.lock_derivados = threading.Lock()
+        self.data_version = None
+        self.firma = None
+        self.marcas = {}
+        self.rango = (None, None)
+    
+    def escribible(self):
+        """True si el fichero de la base de datos admite escritura"""
+        directorio = os.path.dirname(os.path.abspath(self.db_path))
+        return os.access(self.db_path, os.W_OK) and os.access(directorio, os.W_OK)
+    
+    def conexion_escritura(self):
+        """Conexión de escritura para la etapa de arranque, o None si es solo lectura"""
+        if not self.escribible():
+            return None
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    def firma_fichero(self):
+        """mtime y tamaño del fichero y de su WAL (detecta reemplazos del fichero)"""
+        firma = []
+        for ruta in (self.db_path, self.db_path + "-wal"):
+            try:
+                info = os.stat(ruta)
+                firma.append((info.st_ino, info.st_mtime_ns, info.st_size))
+            except OSError:
+                firma.append(None)
+        return tuple(firma)
+    
+    def comprobar(self):
+        """None si la base de datos no ha cambiado; si no, (tablas con filas
+        nuevas, True si hay que vaciar toda la caché, filas nuevas por tabla)"""
+        version = self.vigia.execute("PRAGMA data_version").fetchone()[0]
+        firma = self.firma_fichero()
+        if version == self.data_version and firma == self.firma:
+            return None
+        primera = self.data_version is None
+        reemplazada = (
+            not primera and firma[0] is not None and self.firma[0] is not None
+            and firma[0][0] != self.firma[0][0]
+        )
+        self.data_version = version
+        self.firma = firma
+        
+        # Las tablas de auditoría solo crecen: MAX(rowid) indica qué ha cambiado
+        anteriores = self.marcas
+        self.marcas = {tabla: max_rowid(self.vigia, tabla) for tabla in TABLAS_AUDITORIA}
+        if self.con_rango:
+            self.rango = rango_fechas(self.vigia)
+        if primera:
+            return set(), False, {}
+        cambiadas = {
+            tabla for tabla, marca in self.marcas.items()
+            if marca != anteriores.get(tabla, 0)
+        }
+        reiniciar = reemplazada or any(self.marcas[t] < anteriores.get(t, 0) for t in cambiadas)
+        nuevas = {tabla: max(0, self.marcas[tabla] - anteriores.get(tabla, 0)) for tabla in cambiadas}
+        return cambiadas, reiniciar, nuevas
+    
+    def actualizar_derivados(self):
+        """Procesa las filas nuevas en las tablas derivadas (None si no se
+        puede escribir)"""
+        with self.lock_derivados:
+            conn = self.conexion_escritura()
+            if conn is None:
+                return None
+            try:
+                return actualizar_derivados(conn)
+            finally:
+                conn.close()
+    
+    def cerrar(self):
+        self.pool.cerrar()
+        self.vigia.close()
+
+
+class GrupoConexiones(_Solicitud):
+    """Conexiones prestadas a la vez por un almacén particionado; se
+    registra en la petición como una sola conexión y las interrumpe todas"""
+
+    def __init__(self):
+        super().__init__(None)
+    
+    def interrupt(self):
+        self.cancelar()
+
+
+def sumar_conteos(parciales):
+    """Suma diccionarios {clave: cantidad} de varias particiones"""
+    total = {}
+    for parcial in parciales:
+        for clave, cantidad in parcial.items():
+            total[clave] = total.get(clave, 0) + cantidad
+    return total
+
+
+class AlmacenParticionado:
+    """Varias bases de datos SQLite (una por día, por entorno...) consultadas
+    en paralelo: cada partición resuelve la consulta con sus rollups y
+    sketches (AlmacenSQLite) y aquí se suman conteos y se fusionan sketches.
+    Con ventana solo se consultan las particiones cuyo rango de fechas la
+    toca"""
+
+    nombre = "particionado"
+    # consulta_sql ejecuta SQL arbitrario: no hay forma general de combinarlo
+    no_disponibles = ("consulta_sql",)
+
+    def __init__(self, particiones, hilos=8):
+        self.particiones = particiones
+        self.hilos = hilos
+        self.executor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="smartperlahub-particion")
+    
+    @contextmanager
+    def conexion(self):
+        yield GrupoConexiones()
+    
+    def cerrar(self):
+        self.executor.shutdown(wait=False)
+    
+    def _en_particion(self, grupo, particion, metodo, args):
+        with particion.pool.conexion() as conn:
+            grupo.registrar(conn)
+            try:
+                return getattr(particion.almacen, metodo)(conn, *args)
+            finally:
+                grupo.liberar(conn)
+    
+    def repartir(self, grupo, metodo, *args, ventana=None):
+        """Resultados de `metodo` en cada partición que solapa con la ventana"""
+        particiones = [
+            p for p in self.particiones
+            if ventana is None or ventana.solapa(*p.rango)
+        ]
+        if len(particiones) <= 1:
+            return [self._en_particion(grupo, p, metodo, args) for p in particiones]
+        # Cada tarea hereda la petición y la medición en curso (contextvars)
+        futuros = [
+            self.executor.submit(contextvars.copy_context().run, self._en_particion, grupo, p, metodo, args)
+            for p in particiones
+        ]
+        try:
+            return [futuro.result() for futuro in futuros]
+        except BaseException:
+            for futuro in futuros:
+                futuro.cancel()
+            grupo.cancelar()
+            raise
+    
+    def ultimo_rowid(self, conn, tabla):
+        """Suma de los MAX(rowid): crece con cada fila nueva de cualquier partición"""
+        return sum(self.repartir(conn, "ultimo_rowid", tabla))
+    
+    def conteo_tabla(self, conn, tabla, ventana=None):
+        return sum(self.repartir(conn, "conteo_tabla", tabla, ventana, ventana=ventana))
+    
+    def agregado(self, conn, rollup, claves, where="1=1", params=(), ventana=None):
+        return sumar_conteos(self.repartir(
+            conn, "agregado", rollup, claves, where, params, ventana, ventana=ventana
+        ))
+    
+    def excepciones_hotel(self, conn, hotel_id, ventana=None):
+        conteos = sumar_conteos(
+            {fila["exception_type"]: fila["cantidad"] for fila in parcial}
+            for parcial in self.repartir(conn, "excepciones_hotel", hotel_id, ventana, ventana=ventana)
+        )
+        return [
+            {"exception_type": tipo, "cantidad": cantidad}
+            for tipo, cantidad in sorted(conteos.items(), key=lambda item: (-item[1], str(item[0])))
+        ]
+    
+    def excepciones_por_hotel(self, conn, ventana=None):
+        return sumar_conteos(self.repartir(conn, "excepciones_por_hotel", ventana, ventana=ventana))
+    
+    def hoteles_excepcion(self, conn, tipo, ventana=None):
+        return sumar_conteos(self.repartir(conn, "hoteles_excepcion", tipo, ventana, ventana=ventana))
+    
+    def latencias(self, conn, tabla, dimension, ventana, limite=None):
+        """Sketches fusionados por clave; cada partición devuelve todas sus
+        claves para que el top `limite` sea el del conjunto"""
+        sketches = {}
+        for parcial in self.repartir(conn, "latencias", tabla, dimension, ventana, None, ventana=ventana):
+            for clave, sketch in parcial.items():
+                if clave in sketches:
+                    sketches[clave].fusionar(sketch)
+                else:
+                    sketches[clave] = sketch
+        return {clave: sketches[clave] for clave in primeras_claves(sketches, {}, limite)}
+    
+    def plantillas_excepciones(self, conn, tipo, ventana):
+        conteos, ejemplos = {}, {}
+        for parcial, tipos in self.repartir(conn, "plantillas_excepciones", tipo, ventana, ventana=ventana):
+            for clave, cantidad in parcial.items():
+                conteos[clave] = conteos.get(clave, 0) + cantidad
+            for template_id, lista in tipos.items():
+                union = ejemplos.setdefault(template_id, [])
+                union.extend(t for t in lista if t not in union and len(union) < 3)
+        return conteos, ejemplos
+    
+    def ejemplos_plantilla(self, conn, template_id, maximo=3):
+        """Tipos de una plantilla recorriendo las particiones en orden"""
+        tipos = []
+        for particion in list(self.particiones):
+            for tipo in self._en_particion(conn, particion, "ejemplos_plantilla", (template_id, maximo)):
+                if tipo not in tipos:
+                    tipos.append(tipo)
+            if len(tipos) >= maximo:
+                break
+        return tipos[:maximo]
+    
+    def coincidencias_fts(self, conn, consulta, ventana, limite):
+        """Coincidencias sumadas; los mejores resultados se ordenan por la
+        puntuación bm25 de cada partición (orden aproximado entre particiones)"""
+        total, mejores, por_tipo = 0, [], {}
+        for parcial in self.repartir(conn, "coincidencias_fts", consulta, ventana, limite, ventana=ventana):
+            total += parcial[0]
+            mejores += parcial[1]
+            for tipo, cantidad in parcial[2].items():
+                por_tipo[tipo] = por_tipo.get(tipo, 0) + cantidad
+        mejores.sort(key=lambda r: (r["puntuacion"], r.get("occurred_at") or ""))
+        return total, mejores[:limite], por_tipo
+
+
+# Tipos admitidos en las propiedades de inputSchema y textos aceptados como booleanos
+TIPOS_ARGUMENTO = ("string", "number", "integer", "boolean")
+VALORES_BOOLEANOS = {"true": True, "1": True, "si": True, "sí": True, "false": False, "0": False, "no": False}
+
+
+def convertir_argumento(nombre, esquema, valor):
+    """`valor` convertido al tipo de su esquema (números y booleanos también
+    como texto, números enteros como int); ValueError si no encaja"""
+    tipo = esquema.get("type")
+    if tipo in ("number", "integer"):
+        if isinstance(valor, str):
+            texto = valor.strip()
+            try:
+                valor = int(texto)
+            except ValueError:
+                try:
+                    valor = float(texto)
+                except ValueError:
+                    raise ValueError(f"'{nombre}' debe ser un número, no '{valor}'")
+        if isinstance(valor, bool) or not isinstance(valor, (int, float)) or not math.isfinite(valor):
+            raise ValueError(f"'{nombre}' debe ser un número, no {json.dumps(valor, default=str)}")
+        if isinstance(valor, float) and valor.is_integer():
+            valor = int(valor)
+        if tipo == "integer" and not isinstance(valor, int):
+            raise ValueError(f"'{nombre}' debe ser un número entero, no {valor}")
+        if "minimum" in esquema and valor < esquema["minimum"]:
+            raise ValueError(f"'{nombre}' debe ser como mínimo {esquema['minimum']}, no {valor}")
+        if "maximum" in esquema and valor > esquema["maximum"]:
+            raise ValueError(f"'{nombre}' debe ser como máximo {esquema['maximum']}, no {valor}")
+    elif tipo == "boolean":
+        if isinstance(valor, str) and valor.strip().lower() in VALORES_BOOLEANOS:
+            valor = VALORES_BOOLEANOS[valor.strip().lower()]
+        elif isinstance(valor, int) and not isinstance(valor, bool) and valor in (0, 1):
+            valor = bool(valor)
+        if not isinstance(valor, bool):
+            raise ValueError(f"'{nombre}' debe ser true o false, no {json.dumps(valor, default=str)}")
+    elif tipo == "string":
+        if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            valor = str(valor)
+        if not isinstance(valor, str):
+            raise ValueError(f"'{nombre}' debe ser un texto, no {json.dumps(valor, default=str)}")
+    if "enum" in esquema and valor not in esquema["enum"]:
+        raise ValueError(f"'{nombre}' debe ser uno de: {', '.join(map(str, esquema['enum']))}")
+    return valor
+
+
+class Herramienta:
+    """Herramienta MCP declarada una vez: esquema de entrada, manejador y
+    tablas de las que depende su caché. `manejador` es un método del servidor
+    ("_analizar_hotel") o "modulo:funcion", una función(servidor, args) que
+    se importa en la primera llamada para no retrasar el arranque"""
+    
+    def __init__(self, nombre, descripcion, propiedades, manejador, requeridos=(),
+                 cache=False, solo_sqlite=False):
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self.propiedades = propiedades
+        self.manejador = manejador
+        self.requeridos = tuple(requeridos)
+        # Tablas leídas (tupla), True = cualquiera, False = no se cachea
+        self.cache = cache
+        # Depende de SQLite (FTS5, EXPLAIN, dialecto de consulta_sql)
+        self.solo_sqlite = solo_sqlite
+    
+    @property
+    def diferido(self):
+        return ":" in self.manejador
+    
+    def descriptor(self):
+        """Entrada de tools/list"""
+        esquema = {"type": "object", "properties": self.propiedades}
+        if self.requeridos:
+            esquema["required"] = list(self.requeridos)
+        return {"name": self.nombre, "description": self.descripcion, "inputSchema": esquema}
+    
+    def validar(self):
+        """Comprueba la declaración al arrancar (ValueError si es incoherente)"""
+        if not isinstance(self.manejador, str) or not self.manejador.strip(":"):
+            raise ValueError(f"Herramienta '{self.nombre}': manejador no válido")
+        for nombre in self.requeridos:
+            if nombre not in self.propiedades:
+                raise ValueError(f"Herramienta '{self.nombre}': '{nombre}' es obligatorio pero no está en las propiedades")
+        for nombre, esquema in self.propiedades.items():
+            if esquema.get("type") not in TIPOS_ARGUMENTO:
+                raise ValueError(f"Herramienta '{self.nombre}': tipo no soportado en '{nombre}': {esquema.get('type')}")
+            for valor in esquema.get("enum", ()):
+                convertir_argumento(nombre, {"type": esquema["type"]}, valor)
+            if "default" in esquema:
+                convertir_argumento(nombre, esquema, esquema["default"])
+    
+    def importar(self):
+        """Función de un manejador "modulo:funcion" (importa el módulo)"""
+        modulo, _, funcion = self.manejador.partition(":")
+        return getattr(importlib.import_module(modulo), funcion)
+    
+    def argumentos(self, arguments):
+        """Argumentos validados y convertidos según el esquema, antes de
+        tocar la base de datos; los null cuentan como omitidos y las
+        propiedades no declaradas pasan sin cambios"""
+        convertidos = {}
+        for nombre, valor in arguments.items():
+            if valor is None:
+                continue
+            esquema = self.propiedades.get(nombre)
+            convertidos[nombre] = valor if esquema is None else convertir_argumento(nombre, esquema, valor)
+        faltan = [nombre for nombre in self.requeridos if nombre not in convertidos]
+        if faltan:
+            raise ValueError(f"Falta el argumento obligatorio '{faltan[0]}'")
+        return convertidos
+
+
+def registrar_herramientas(*herramientas):
+    """Registro nombre -> Herramienta, en el orden de tools/list"""
+    registro = OrderedDict()
+    for herramienta in herramientas:
+        herramienta.validar()
+        if herramienta.nombre in registro:
+            raise ValueError(f"Herramienta '{herramienta.nombre}' declarada dos veces")
+        registro[herramienta.nombre] = herramienta
+    return registro
+
+
+# Herramientas del servidor: para añadir una basta con declararla aquí
+HERRAMIENTAS = registrar_herramientas(
+    Herramienta(
+        "analizar_restricciones",
+        "Analizar restricciones de hoteles y patrones de exclusión",
+        {
+            "hotel_id": {
+                "type": "integer",
+                "description": "ID específico del hotel"
+            },
+            "tipo": {
+                "type": "string", 
+                "description": "Tipo de restricción"
+            },
+            "limite": {
+                "type": "number",
+                "description": "Límite de resultados",
+                "default": 50,
+                "minimum": 1
+            },
+            **PROPIEDADES_VENTANA,
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_analizar_restricciones",
+        cache=("restrictions",),
+    ),
+    Herramienta(
+        "analizar_excepciones",
+        "Analizar excepciones del sistema",
+        {
+            "tipo": {
+                "type": "string",
+                "description": "Tipo de excepción"
+            },
+            "limite": {
+                "type": "number", 
+                "description": "Límite de resultados",
+                "default": 30,
+                "minimum": 1
+            },
+            **PROPIEDADES_VENTANA,
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_analizar_excepciones",
+        cache=("exceptions",),
+    ),
+    Herramienta(
+        "resumen_sistema",
+        "Resumen completo del sistema de auditoría",
+        {
+            "detallado": {
+                "type": "boolean",
+                "description": "Incluir detalles",
+                "default": True
+            },
+            **PROPIEDADES_VENTANA,
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_resumen_sistema",
+        cache=True,
+    ),
+    Herramienta(
+        "analizar_hotel",
+        "Análisis específico de un hotel",
+        {
+            "hotel_id": {
+                "type": "integer",
+                "description": "ID del hotel"
+            },
+            **PROPIEDADES_VENTANA,
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_analizar_hotel",
+        requeridos=["hotel_id"],
+        cache=("restrictions", "exceptions"),
+    ),
+    Herramienta(
+        "problemas_criticos",
+        "Mostrar problemas críticos detectados en los datos (anomalías)",
+        {
+            "incluir_sql": {
+                "type": "boolean",
+                "description": "Incluir soluciones SQL",
+                "default": True
+            },
+            "umbral_cuota": {
+                "type": "number",
+                "description": "Fracción del total a partir de la cual una entidad es crítica (0-1)"
+            },
+            "umbral_z": {
+                "type": "number",
+                "description": "z-score de la última hora a partir del cual se marca un pico"
+            },
+            **PROPIEDADES_VENTANA,
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_problemas_criticos",
+        cache=True,
+    ),
+    Herramienta(
+        "consulta_sql",
+        "Ejecutar consulta SQL personalizada (resultados paginados)",
+        {
+            "query": {
+                "type": "string",
+                "description": "Consulta SQL SELECT (no necesaria con 'continuacion')"
+            },
+            "limite": {
+                "type": "number",
+                "description": "Filas por página", 
+                "default": 100,
+                "minimum": 1
+            },
+            "continuacion": {
+                "type": "string",
+                "description": "Token devuelto por la página anterior para leer la siguiente"
+            },
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_consulta_sql",
+        cache=True,
+        solo_sqlite=True,
+    ),
+    Herramienta(
+        "analizar_latencias",
+        "Percentiles de latencia (p50/p90/p99/máx) de las búsquedas por tabla, proveedor, conector y hotel",
+        {
+            **PROPIEDADES_VENTANA,
+            "agrupar": {
+                "type": "string",
+                "enum": list(AGRUPACIONES_LATENCIA),
+                "description": "Mostrar solo una agrupación (por defecto, todas)"
+            },
+            "limite": {
+                "type": "number",
+                "description": "Filas por agrupación",
+                "default": 20,
+                "minimum": 1
+            },
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_analizar_latencias",
+        cache=("client_searches", "provider_searches", "connector_searches"),
+    ),
+    Herramienta(
+        "buscar_excepciones",
+        "Búsqueda de texto completo en las excepciones (tipo, mensaje y context_data) con ranking por relevancia y agrupación por plantilla de mensaje",
+        {
+            "consulta": {
+                "type": "string",
+                "description": "Palabras a buscar (todas deben aparecer); 'palabra*' busca por prefijo, \"entre comillas\" una frase exacta, y admite OR/NOT"
+            },
+            "campo": {
+                "type": "string",
+                "enum": list(COLUMNAS_FTS),
+                "description": "Buscar solo en esta columna (por defecto, en todas)"
+            },
+            **PROPIEDADES_VENTANA,
+            "limite": {
+                "type": "number",
+                "description": "Número de resultados y de plantillas",
+                "default": 20,
+                "minimum": 1
+            },
+            "formato": PROPIEDAD_FORMATO
+        },
+        "_buscar_excepciones",
+        requeridos=["consulta"],
+        cache=("exceptions",),
+        solo_sqlite=True,
+    ),
+    Herramienta(
+        "diagnostico_indices",
+        "Índices que usan las consultas del servidor (creados o recomendados)",
+        {
+            "incluir_planes": {
+                "type": "boolean",
+                "description": "Incluir EXPLAIN QUERY PLAN de cada consulta",
+                "default": False
+            }
+        },
+        "_diagnostico_indices",
+        solo_sqlite=True,
+    ),
+    Herramienta(
+        "estado_servidor",
+        "Estado interno del servidor (pool de conexiones SQLite)",
+        {},
+        "_estado_servidor",
+    ),
+    Herramienta(
+        "metricas_servidor",
+        "Métricas de rendimiento: latencias por herramienta y fase, sentencias SQL más costosas, consultas lentas con su plan y perfiles cProfile",
+        {
+            "limite": {
+                "type": "number",
+                "description": "Sentencias y consultas lentas a mostrar",
+                "default": 10,
+                "minimum": 1
+            },
+            "incluir_planes": {
+                "type": "boolean",
+                "description": "Añadir EXPLAIN QUERY PLAN a las consultas lentas",
+                "default": True
+            },
+            "reiniciar": {
+                "type": "boolean",
+                "description": "Poner a cero las métricas después de leerlas",
+                "default": False
+            },
+            "formato": {
+                **PROPIEDAD_FORMATO,
+                "enum": list(FORMATOS) + ["prometheus"],
+                "description": "texto, json, csv, ndjson o prometheus (formato de exposición de texto)"
+            }
+        },
+        "_metricas_servidor",
+    ),
+)
+
+# Herramientas cuyo resultado depende solo de sus argumentos y de los datos,
+# con las tablas que leen (None = cualquiera): al llegar filas nuevas solo se
+# invalidan las entradas de caché afectadas
+HERRAMIENTAS_CACHEABLES = {
+    nombre: None if herramienta.cache is True else herramienta.cache
+    for nombre, herramienta in HERRAMIENTAS.items() if herramienta.cache
+}
+
+# Herramientas que dependen de SQLite (FTS5, EXPLAIN, dialecto de consulta_sql)
+HERRAMIENTAS_SOLO_SQLITE = tuple(
+    nombre for nombre, herramienta in HERRAMIENTAS.items() if herramienta.solo_sqlite
+)
+
+# Tablas del export Parquet: las de auditoría y exception_hotels desnormalizada
+# (hotel_id, exception_type, occurred_at), todas con _rowid de SQLite
+TABLAS_PARQUET = TABLAS_AUDITORIA + ["exception_hotels"]
+
+
+class AlmacenParquet:
+    """Consultas analíticas con DuckDB sobre el export Parquet de las tablas
+    (<directorio>/<tabla>/dia=AAAA-MM-DD/*.parquet, ver smartperlahub_ingest.py
+    --exportar-parquet). No usa rollups: el motor columnar agrega directamente
+    y la partición por día descarta los ficheros fuera de la ventana"""
+
+    nombre = "parquet"
+    no_disponibles = HERRAMIENTAS_SOLO_SQLITE
+
+    def __init__(self, ruta, hilos=None):
+        try:
+            import duckdb
+        except ImportError:
+            raise RuntimeError("ALMACEN=parquet necesita DuckDB: pip install duckdb")
+        self.ruta = os.path.abspath(ruta)
+        self._db = duckdb.connect(":memory:", config={"threads": hilos} if hilos else {})
+        self._lock = threading.Lock()
+        self.columnas = {}
+        self.recargar()
+    
+    def ficheros(self, tabla=None):
+        tablas = [tabla] if tabla else TABLAS_PARQUET
+        return sorted(str(f) for t in tablas for f in Path(self.ruta, t).rglob("*.parquet"))
+    
+    def firma(self):
+        """Ficheros con su mtime y tamaño (cambia con cada exportación)"""
+        firma = []
+        for fichero in self.ficheros():
+            try:
+                info = os.stat(fichero)
+                firma.append((fichero, info.st_mtime_ns, info.st_size))
+            except OSError:
+                continue
+        return tuple(firma)
+    
+    def recargar(self):
+        """(Re)crea una vista por tabla sobre sus ficheros Parquet"""
+        with self._lock:
+            columnas = {}
+            for tabla in TABLAS_PARQUET:
+                if not self.ficheros(tabla):
+                    self._db.execute(f"DROP VIEW IF EXISTS {tabla}")
+                    continue
+                patron = os.path.join(self.ruta, tabla, "**", "*.parquet").replace("'", "''")
+                self._db.execute(
+                    f"CREATE OR REPLACE VIEW {tabla} AS SELECT * FROM read_parquet('{patron}', "
+                    "hive_partitioning = true, hive_types = {'dia': VARCHAR}, union_by_name = true)"
+                )
+                columnas[tabla] = [fila[0] for fila in self._db.execute(f"DESCRIBE {tabla}").fetchall()]
+            self.columnas = columnas
+    
+    @contextmanager
+    def conexion(self):
+        cursor = self._db.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+    
+    def cerrar(self):
+        self._db.close()
+    
+    def _condicion(self, ventana, columna):
+        """Filtro de la ventana sobre la fecha y sobre la partición por día"""
+        if ventana is None or ventana.completa:
+            return "1=1", []
+        fecha, valores = ventana.condicion(columna)
+        partes = [fecha]
+        if ventana.desde:
+            partes.append("dia >= ?")
+            valores.append(ventana.desde[:10])
+        if ventana.hasta:
+            partes.append("dia <= ?")
+            valores.append(ventana.hasta[:10])
+        return " AND ".join(partes), valores
+    
+    def _conteo(self, conn, tabla, claves, where="1=1", params=(), ventana=None):
+        if tabla not in self.columnas:
+            return {}
+        fecha, valores = self._condicion(ventana, COLUMNA_FECHA[tabla])
+        # LIKE de SQLite no distingue mayúsculas (ASCII); en DuckDB es ILIKE
+        where = re.sub(r"\bLIKE\b", "ILIKE", where)
+        columnas = [expresion_rollup(tabla, clave) for clave in claves]
+        agrupacion = f" GROUP BY {', '.join(claves)}" if claves else ""
+        filas = conn.execute(
+            f"SELECT {''.join(c + ', ' for c in columnas)}COUNT(*) FROM {tabla} "
+            f"WHERE ({where}) AND {fecha}{agrupacion}",
+            list(params) + valores,
+        ).fetchall()
+        return {tuple(fila[:-1]): fila[-1] for fila in filas if fila[-1]}
+    
+    def ultimo_rowid(self, conn, tabla):
+        if "_rowid" not in self.columnas.get(tabla, ()):
+            return 0
+        return conn.execute(f"SELECT MAX(_rowid) FROM {tabla}").fetchone()[0] or 0
+    
+    def conteo_tabla(self, conn, tabla, ventana=None):
+        return self._conteo(conn, tabla, (), ventana=ventana).get((), 0)
+    
+    def agregado(self, conn, rollup, claves, where="1=1", params=(), ventana=None):
+        """Mismo resultado que AlmacenSQLite.agregado, leído de la tabla base"""
+        tabla = (ROLLUPS.get(rollup) or ROLLUPS[f"{rollup}_hora"])[0]
+        return self._conteo(conn, tabla, claves, where, params, ventana)
+    
+    def _por_hotel(self, conn, clave, where, params, ventana):
+        if "exception_hotels" not in self.columnas:
+            return []
+        fecha, valores = self._condicion(ventana, "occurred_at")
+        return conn.execute(
+            f"SELECT {clave}, COUNT(*) FROM exception_hotels WHERE {where} AND {fecha} GROUP BY {clave}",
+            list(params) + valores,
+        ).fetchall()
+    
+    def excepciones_hotel(self, conn, hotel_id, ventana=None):
+        filas = self._por_hotel(conn, "exception_type", "hotel_id = ?", [hotel_id], ventana)
+        return [
+            {"exception_type": tipo, "cantidad": cantidad}
+            for tipo, cantidad in sorted(filas, key=lambda fila: (-fila[1], str(fila[0])))
+        ]
+    
+    def excepciones_por_hotel(self, conn, ventana=None):
+        return dict(self._por_hotel(conn, "hotel_id", "1=1", [], ventana))
+    
+    def hoteles_excepcion(self, conn, tipo, ventana=None):
+        filas = self._por_hotel(conn, "hotel_id", "exception_type = ?", [tipo], ventana)
+        return {(hotel,): cantidad for hotel, cantidad in filas}
+    
+    def latencias(self, conn, tabla, dimension, ventana, limite=None):
+        """{clave: DDSketch} construido con los conteos por duración: mismas
+        cubetas (y percentiles) que los sketches por hora de SQLite"""
+        columnas = set(self.columnas.get(tabla, ()))
+        fecha = COLUMNA_FECHA[tabla]
+        dimensiones = ["total"] + [d for d in FUENTES_LATENCIA[tabla] + ("hotel_id",) if d in columnas]
+        if not {"duration_ms", fecha} <= columnas or dimension not in dimensiones:
+            return {}
+        columna = "''" if dimension == "total" else dimension
+        condicion, valores = self._condicion(ventana, fecha)
+        sketches = {}
+        for valor, duracion, cantidad in conn.execute(
+            f"SELECT {columna}, duration_ms, COUNT(*) FROM {tabla} "
+            f"WHERE duration_ms IS NOT NULL AND {columna} IS NOT NULL AND {fecha} IS NOT NULL "
+            f"AND {condicion} GROUP BY 1, 2",
+            valores,
+        ).fetchall():
+            clave = str(valor)
+            if clave not in sketches:
+                sketches[clave] = DDSketch(PRECISION_LATENCIAS)
+            sketches[clave].agregar(duracion, cantidad)
+        return {clave: sketches[clave] for clave in primeras_claves(sketches, {}, limite)}
+    
+    def plantillas_excepciones(self, conn, tipo, ventana):
+        conteos, ejemplos = {}, {}
+        if tipo or "template_id" not in self.columnas.get("exceptions", ()):
+            where, params = ("exception_type LIKE ?", [f"%{tipo}%"]) if tipo else ("1=1", [])
+            por_tipo = self._conteo(conn, "exceptions", ("exception_type",), where, params, ventana)
+            sumar_plantillas(por_tipo, conteos, ejemplos)
+            return conteos, ejemplos
+        conteos.update(self._conteo(conn, "exceptions", ("template_id",), "template_id IS NOT NULL", (), ventana))
+        por_tipo = self._conteo(conn, "exceptions", ("exception_type",), "template_id IS NULL", (), ventana)
+        sumar_plantillas(por_tipo, conteos, ejemplos)
+        return conteos, ejemplos
+    
+    def ejemplos_plantilla(self, conn, template_id, maximo=3):
+        tipos = []
+        for (tipo,) in conn.execute(
+            "SELECT exception_type FROM exceptions WHERE template_id = ? ORDER BY _rowid LIMIT 50",
+            [template_id],
+        ).fetchall():
+            if tipo not in tipos:
+                tipos.append(tipo)
+                if len(tipos) == maximo:
+                    break
+        return tipos
+
 
 class SmartPerlahubMCP:
     def __init__(self):
         self.db_path = os.getenv('DB_PATH', 'smartperlahub.db')
         
-        if not os.path.exists(self.db_path):
+        # DB_PATH con varias rutas (os.pathsep) o un patrón glob: una partición por fichero
+        self.particionado = es_particionado(self.db_path)
+        rutas = rutas_particiones(self.db_path) if self.particionado else [self.db_path]
+        if not rutas or not all(os.path.exists(ruta) for ruta in rutas):
             raise FileNotFoundError(f"Database not found: {self.db_path}")
         
+        # Pool acotado de hilos para el trabajo SQLite (fuera del event loop)
+        self.max_workers = max(1, int(os.getenv('MCP_WORKERS', '4')))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="smartperlahub-sql"
+        )
+        self._solicitudes = {}
+        
+        # Almacén de datos: "sqlite" (fichero .db) o "parquet" (directorio
+        # exportado con smartperlahub_ingest.py --exportar-parquet, con DuckDB)
+        self.tipo_almacen = os.getenv('ALMACEN') or ("parquet" if os.path.isdir(self.db_path) else "sqlite")
+        self.particiones = []
+        if self.tipo_almacen == "parquet":
+            self.pool = None
+            self.almacen = AlmacenParquet(self.db_path, hilos=int(os.getenv('DUCKDB_HILOS', '0')) or None)
+        elif self.tipo_almacen == "sqlite":
+            self.particiones = [self._abrir_particion(ruta) for ruta in rutas]
+            if self.particionado:
+                # Sin pool único: las consultas se reparten entre las particiones
+                self.pool = None
+                self.almacen = AlmacenParticionado(
+                    self.particiones, hilos=max(1, int(os.getenv('PARTICIONES_HILOS', '8')))
+                )
+            else:
+                self.pool = self.particiones[0].pool
+                self.almacen = self.particiones[0].almacen
+        else:
+            raise ValueError(f"ALMACEN '{self.tipo_almacen}' no soportado (usar: sqlite, parquet)")
+        
+        # Estado de la etapa de arranque que revisa índices y tablas derivadas;
+        # DB_AUTO_DERIVADOS sigue a DB_AUTO_INDICES salvo que se indique: con
+        # ambos a 0 el servidor no escribe nada en la base de datos
+        self.auto_indices = os.getenv('DB_AUTO_INDICES', '1') != '0'
+        self.auto_derivados = os.getenv('DB_AUTO_DERIVADOS', '1' if self.auto_indices else '0') != '0'
+        self.diagnostico = {"estado": "pendiente", "indices": [], "derivadas_faltantes": []}
+        
+        # Mantenimiento de las tablas derivadas en segundo plano (vigilar):
+        # un hilo propio para no ocupar los del pool de peticiones. Al empezar
+        # todas las particiones quedan pendientes: las filas que lleguen entre
+        # la etapa de arranque y la primera comprobación no se ven como nuevas
+        self.executor_fondo = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smartperlahub-fondo")
+        self._derivados_pendientes = set(self.particiones)
+        
+        # Detección de cambios (PRAGMA data_version de cada partición o
+        # ficheros Parquet); _version_datos cuenta los cambios vistos
+        self._lock_vigia = threading.Lock()
+        self._firma_fichero = None
+        self._version_datos = 0
+        self._reiniciar_pendiente = False
+        
+        # Marcas de agua (MAX(rowid)) por tabla y filas nuevas aún sin notificar
+        self._marcas_tablas = {}
+        self._filas_nuevas = dict.fromkeys(TABLAS_AUDITORIA, 0)
+        
+        # Clientes conectados (stdio o sesiones HTTP) con sus recursos
+        # suscritos: se notifican cuando una tabla acumula NOTIFICAR_FILAS
+        # filas nuevas (comprobado cada VIGILAR_INTERVALO s)
+        self.sesiones = set()
+        self.http = None
+        self.notificar_filas = max(1, int(os.getenv('NOTIFICAR_FILAS', '1000')))
+        self.intervalo_vigilancia = float(os.getenv('VIGILAR_INTERVALO', '5'))
+        
+        # Motor de anomalías: umbrales por defecto y último resultado calculado
+        self.umbral_cuota = float(os.getenv('ANOMALIA_CUOTA', '0.5'))
+        self.umbral_z = float(os.getenv('ANOMALIA_Z', '3'))
+        self.minimo_anomalia = int(os.getenv('ANOMALIA_MIN_FILAS', '100'))
+        self._anomalias = None
+        
+        # Cursores de consulta_sql pendientes de leer por páginas
+        self.max_pagina = int(os.getenv('CONSULTA_MAX_FILAS', '10000'))
+        
+        # Límites de consulta_sql: pasos de la VM y segundos por página, y
+        # filas máximas de una tabla recorrida sin índice (0 = sin comprobar)
+        self.max_pasos = int(os.getenv('CONSULTA_MAX_PASOS', '200000000'))
+        self.timeout_consulta = float(os.getenv('CONSULTA_TIMEOUT', '30'))
+        self.max_filas_escaneo = int(os.getenv('CONSULTA_MAX_FILAS_ESCANEO', '0'))
+        self.cursores = CursoresConsulta(
+            maximo=int(os.getenv('CONSULTA_CURSORES', '8')),
+            ttl=float(os.getenv('CONSULTA_CURSOR_TTL', '120')),
+        )
+        
+        # Métricas por herramienta y por sentencia, consultas lentas y perfiles
+        self.metricas = MetricasServidor(
+            umbral_lenta_ms=float(os.getenv('SQL_LENTA_MS', '250')),
+            lentas=int(os.getenv('SQL_LENTAS', '50')),
+            perfil_umbral_ms=float(os.getenv('PERFIL_UMBRAL_MS', '0')),
+            perfil_dir=os.getenv('PERFIL_DIR') or None,
+            perfiles=int(os.getenv('PERFIL_MAX', '20')),
+        )
+        self.fichero_metricas = os.getenv('METRICAS_FICHERO', '')
+        self.intervalo_metricas = float(os.getenv('METRICAS_INTERVALO', '15'))
+        
+        # Caché de resultados, invalidada cuando cambia la base de datos
+        self.cache = CacheResultados(
+            capacidad_bytes=int(float(os.getenv('CACHE_MB', '32')) * 1024 * 1024),
+            ttl=float(os.getenv('CACHE_TTL', '300')),
+        )
+        
         self.server_info = {
             "name": "smartperlahub",
             "version": "1.0.0"
         }
         
-        # Herramientas con esquemas MCP válidos
-        self.tools = [
-            {
-                "name": "analizar_restricciones",
-                "description": "Analizar restricciones de hoteles y patrones de exclusión",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "hotel_id": {
-                            "type": "number",
-                            "description": "ID específico del hotel"
-                        },
-                        "tipo": {
-                            "type": "string", 
-                            "description": "Tipo de restricción"
-                        },
-                        "limite": {
-                            "type": "number",
-                            "description": "Límite de resultados",
-                            "default": 50
-                        }
-                    }
-                }
-            },
-            {
-                "name": "analizar_excepciones",
-                "description": "Analizar excepciones del sistema",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "tipo": {
-                            "type": "string",
-                            "description": "Tipo de excepción"
-                        },
-                        "limite": {
-                            "type": "number", 
-                            "description": "Límite de resultados",
-                            "default": 30
-                        }
-                    }
-                }
-            },
-            {
-                "name": "resumen_sistema",
-                "description": "Resumen completo del sistema de auditoría",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "detallado": {
-                            "type": "boolean",
-                            "description": "Incluir detalles",
-                            "default": True
-                        }
-                    }
-                }
-            },
-            {
-                "name": "analizar_hotel",
-                "description": "Análisis específico de un hotel",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "hotel_id": {
-                            "type": "number",
-                            "description": "ID del hotel"
-                        }
-                    },
-                    "required": ["hotel_id"]
-                }
-            },
-            {
-                "name": "problemas_criticos", 
-                "description": "Mostrar problemas críticos identificados",
-                "inputSchema": {
-                    "type": "object",
-                    "properties": {
-                        "incluir_sql": {
-                            "type": "boolean",
-                            "description": "Incluir soluciones SQL",
-                            "default": True
-                        }
-                    }
-                }
-            },
-            {
-                "name": "consulta_sql",
-                "description": "Ejecutar consulta SQL personalizada",
-                "inputSchema": {
-                    "type": "object", 
-                    "properties": {
-                        "query": {
-                            "type": "string",
-                            "description": "Consulta SQL SELECT"
-                        },
-                        "limite": {
-                            "type": "number",
-                            "description": "Límite de resultados", 
-                            "default": 100
-                        }
-                    },
-                    "required": ["query"]
-                }
+        # Herramientas publicadas en tools/list (las del registro que admite el
+        # almacén) y sus manejadores; los "modulo:funcion" se importan al usarse
+        self.herramientas = OrderedDict(
+            (nombre, herramienta) for nombre, herramienta in HERRAMIENTAS.items()
+            if nombre not in self.almacen.no_disponibles
+        )
+        self.tools = [herramienta.descriptor() for herramienta in self.herramientas.values()]
+        self.manejadores = {}
+        for nombre, herramienta in self.herramientas.items():
+            if herramienta.diferido:
+                continue
+            manejador = getattr(self, herramienta.manejador, None)
+            if not callable(manejador):
+                raise ValueError(f"Herramienta '{nombre}': el servidor no tiene el método {herramienta.manejador}")
+            self.manejadores[nombre] = manejador
+    
+    @contextmanager
+    def conexion(self):
+        """Conexión del pool ligada a la petición actual para poder interrumpirla"""
+        solicitud = _solicitud_actual.get()
+        with self.almacen.conexion() as conn:
+            try:
+                if solicitud is not None:
+                    solicitud.registrar(conn)
+                yield conn
+            finally:
+                if solicitud is not None:
+                    solicitud.liberar(conn)
+    
+    def _abrir_particion(self, ruta):
+        """Partición con su pool de conexiones de solo lectura"""
+        pool = PoolConexiones(
+            ruta,
+            tamano=int(os.getenv('DB_POOL_SIZE', str(self.max_workers))),
+            mmap_mb=int(os.getenv('DB_MMAP_MB', '256')),
+            cache_mb=int(os.getenv('DB_CACHE_MB', '64')),
+            medir=os.getenv('METRICAS_SQL', '1') != '0',
+        )
+        return Particion(ruta, pool, con_rango=self.particionado)
+    
+    def _provisionar_particion(self, particion):
+        """Revisa índices y tablas derivadas de una partición:
+        (índices, tablas derivadas que faltan, escribible)"""
+        conn = particion.conexion_escritura()
+        escribible = conn is not None
+        if conn is None:
+            conn = sqlite3.connect(particion.pool.uri, uri=True)
+        try:
+            asesor = AsesorIndices(conn, escribible)
+            indices = asesor.diagnosticar(crear=self.auto_indices)
+            if escribible and self.auto_derivados:
+                with particion.lock_derivados:
+                    actualizar_derivados(conn)
+            faltantes = [{"tabla": tabla} for tabla in derivadas_faltantes(conn)]
+        finally:
+            conn.close()
+        if self.particionado:
+            for elemento in indices + faltantes:
+                elemento["particion"] = particion.nombre
+        return indices, faltantes, escribible
+    
+    def provisionar(self):
+        """Etapa de arranque: revisa el esquema y crea los índices que faltan
+        (en paralelo en cada partición)"""
+        self.diagnostico["estado"] = "en_curso"
+        inicio = time.perf_counter()
+        if not self.particiones:
+            # El export Parquet ya trae las derivadas que necesita: nada que revisar
+            self.diagnostico.update(estado="completado", escribible=False, duracion_ms=0.0)
+            return self.diagnostico
+        try:
+            if self.particionado:
+                resultados = list(self.almacen.executor.map(self._provisionar_particion, list(self.particiones)))
+            else:
+                resultados = [self._provisionar_particion(self.particiones[0])]
+            self.diagnostico["indices"] = [indice for indices, _, _ in resultados for indice in indices]
+            self.diagnostico["derivadas_faltantes"] = [tabla for _, faltantes, _ in resultados for tabla in faltantes]
+            self.diagnostico["escribible"] = all(escribible for _, _, escribible in resultados)
+            self.diagnostico["estado"] = "completado"
+        except Exception as e:
+            self.diagnostico["estado"] = "error"
+            self.diagnostico["error"] = str(e)
+        self.diagnostico["duracion_ms"] = (time.perf_counter() - inicio) * 1000
+        return self.diagnostico
+    
+    def descubrir_particiones(self):
+        """Abre y revisa los ficheros nuevos que encajan en DB_PATH y cierra
+        los que han desaparecido; True si ha cambiado el conjunto. Se llama
+        desde vigilar: las particiones nuevas se provisionan fuera de
+        _lock_vigia y bajo el lock solo se publica la lista ya lista"""
+        if self.diagnostico["estado"] == "en_curso":
+            # La etapa de arranque todavía está revisando las particiones
+            return False
+        rutas = rutas_particiones(self.db_path)
+        actuales = {particion.db_path: particion for particion in self.particiones}
+        if set(rutas) == set(actuales):
+            return False
+        nuevas, indices, faltantes = {}, [], []
+        for ruta in rutas:
+            if ruta in actuales:
+                continue
+            particion = None
+            try:
+                particion = self._abrir_particion(ruta)
+                indices_particion, faltantes_particion, _ = self._provisionar_particion(particion)
+                # Marcas de agua y rango de fechas antes de que la consulte nadie
+                particion.comprobar()
+            except Exception:
+                # Fichero a medio copiar o ilegible: se reintenta en la próxima vuelta
+                if particion is not None:
+                    particion.cerrar()
+                continue
+            nuevas[ruta] = particion
+            indices.extend(indices_particion)
+            faltantes.extend(faltantes_particion)
+        
+        particiones = [actuales.get(ruta) or nuevas[ruta] for ruta in rutas if ruta in actuales or ruta in nuevas]
+        cerradas = [particion for ruta, particion in actuales.items() if ruta not in rutas]
+        if not nuevas and not cerradas:
+            return False
+        with self._lock_vigia:
+            self.particiones = self.almacen.particiones = particiones
+            self._reiniciar_pendiente = True
+            nombres = {particion.nombre for particion in cerradas}
+            for clave, añadidos in (("indices", indices), ("derivadas_faltantes", faltantes)):
+                self.diagnostico[clave] = [
+                    elemento for elemento in self.diagnostico[clave]
+                    if elemento.get("particion") not in nombres
+                ] + añadidos
+        for particion in cerradas:
+            particion.cerrar()
+        return True
+    
+    def verificar_cambios(self):
+        """Si alguna partición ha cambiado, invalida la caché de las tablas con
+        filas nuevas y la apunta para actualizar sus tablas derivadas en
+        segundo plano (las lecturas ya suman las filas tras la marca de agua)"""
+        if not self.particiones:
+            return self._verificar_cambios_parquet()
+        with self._lock_vigia:
+            # Particiones añadidas o retiradas por descubrir_particiones
+            reiniciar, self._reiniciar_pendiente = self._reiniciar_pendiente, False
+            cambiadas, modificadas = set(), []
+            for particion in self.particiones:
+                cambio = particion.comprobar()
+                if cambio is None:
+                    continue
+                modificadas.append(particion)
+                cambiadas |= cambio[0]
+                reiniciar = reiniciar or cambio[1]
+                for tabla, filas in cambio[2].items():
+                    self._filas_nuevas[tabla] += filas
+                if cambio[0] or cambio[1]:
+                    # Las escrituras en las propias tablas derivadas no cuentan
+                    self._derivados_pendientes.add(particion)
+            if not modificadas and not reiniciar:
+                return False
+            primera = self._version_datos == 0
+            self._version_datos += 1
+            self._marcas_tablas = {
+                tabla: sum(particion.marcas.get(tabla, 0) for particion in self.particiones)
+                for tabla in TABLAS_AUDITORIA
             }
-        ]
+            if reiniciar:
+                self.cache.invalidar()
+            elif not primera:
+                self.cache.invalidar(functools.partial(entrada_afectada, cambiadas))
+        return True
     
-    def get_db_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def actualizar_derivados_pendientes(self):
+        """Procesa en las tablas derivadas las filas nuevas de las particiones
+        cambiadas; solo desde vigilar, nunca dentro de una petición"""
+        if not self.auto_derivados or self.diagnostico["estado"] in ("pendiente", "en_curso"):
+            # Sin provisionar todavía: la etapa de arranque procesa las filas pendientes
+            return 0
+        with self._lock_vigia:
+            pendientes = [p for p in self.particiones if p in self._derivados_pendientes]
+            self._derivados_pendientes.clear()
+        for particion in pendientes:
+            particion.actualizar_derivados()
+        return len(pendientes)
+    
+    def mantener(self):
+        """Trabajo periódico de vigilar: particiones nuevas, cambios en los
+        datos y tablas derivadas"""
+        if self.particionado:
+            self.descubrir_particiones()
+        cambios = self.verificar_cambios()
+        self.actualizar_derivados_pendientes()
+        return cambios
+    
+    def _verificar_cambios_parquet(self):
+        """Una nueva exportación cambia los ficheros: se recargan las vistas y
+        se invalida toda la caché"""
+        with self._lock_vigia:
+            firma = self.almacen.firma()
+            if firma == self._firma_fichero:
+                return False
+            primera = self._firma_fichero is None
+            self._firma_fichero = firma
+            self._version_datos += 1
+            if not primera:
+                self.almacen.recargar()
+                self.cache.invalidar()
+            anteriores = self._marcas_tablas
+            with self.almacen.conexion() as conn:
+                self._marcas_tablas = {
+                    tabla: self.almacen.ultimo_rowid(conn, tabla) for tabla in TABLAS_AUDITORIA
+                }
+            if not primera:
+                for tabla, marca in self._marcas_tablas.items():
+                    self._filas_nuevas[tabla] += max(0, marca - anteriores.get(tabla, 0))
+        return True
+    
+    def _normalizar_argumentos(self, tool_name, arguments):
+        """Argumentos con valores por defecto y números canónicos (clave de caché)"""
+        herramienta = self.herramientas.get(tool_name)
+        propiedades = herramienta.propiedades if herramienta else {}
+        normalizados = {}
+        for nombre, esquema in propiedades.items():
+            if "default" in esquema:
+                normalizados[nombre] = esquema["default"]
+        normalizados.update(herramienta.argumentos(arguments) if herramienta else arguments)
+        for nombre in PROPIEDADES_VENTANA:
+            if nombre in propiedades and nombre in normalizados:
+                # Los instantes relativos se resuelven una vez: misma clave, misma consulta
+                normalizados[nombre] = normalizar_instante(normalizados[nombre])
+        return normalizados
+    
+    def cerrar(self):
+        self.executor.shutdown(wait=False)
+        self.executor_fondo.shutdown(wait=False)
+        self.cursores.cerrar()
+        for particion in self.particiones:
+            particion.cerrar()
+        if self.pool is None:
+            self.almacen.cerrar()
+    
+    def cancelar_solicitud(self, clave):
+        """Aborta el SQL en curso de una petición (notifications/cancelled)"""
+        solicitud = self._solicitudes.get(clave)
+        if solicitud is not None:
+            solicitud.cancelar()
+            return True
+        return False
     
     async def handle_initialize(self, params):
+        version = params.get("protocolVersion")
         return {
-            "protocolVersion": "2024-11-05",
+            "protocolVersion": version if version in PROTOCOLOS else PROTOCOLOS[0],
             "capabilities": {
-                "tools": {}
+                "tools": {},
+                "resources": {
+                    "subscribe": True,
+                    "listChanged": False
+                }
             },
             "serverInfo": self.server_info
         }
@@ -144,32 +3686,159 @@ class SmartPerlahubMCP:
     async def handle_tools_list(self, params):
         return {"tools": self.tools}
     
-    async def handle_tools_call(self, params):
+    def _recurso(self, uri):
+        """Tabla de un recurso smartperlahub://tablas/<tabla>, "" para el de
+        problemas críticos; ErrorJSONRPC si la URI no existe"""
+        if uri == RECURSO_PROBLEMAS:
+            return ""
+        if uri.startswith(RECURSO_TABLA) and uri[len(RECURSO_TABLA):] in TABLAS_AUDITORIA:
+            return uri[len(RECURSO_TABLA):]
+        raise ErrorJSONRPC(RECURSO_NO_ENCONTRADO, f"Recurso desconocido: {uri}")
+    
+    async def handle_resources_list(self, params):
+        recursos = [
+            {
+                "uri": RECURSO_TABLA + tabla,
+                "name": f"Tabla {tabla}",
+                "description": "Filas y último rowid de la tabla (se notifica al recibir filas nuevas)",
+                "mimeType": "application/json"
+            }
+            for tabla in TABLAS_AUDITORIA
+        ]
+        recursos.append({
+            "uri": RECURSO_PROBLEMAS,
+            "name": "Problemas críticos",
+            "description": "Informe de problemas_criticos (se notifica al recibir filas nuevas)",
+            "mimeType": "text/plain"
+        })
+        return {"resources": recursos}
+    
+    async def handle_resources_read(self, params):
+        uri = params.get("uri", "")
+        tabla = self._recurso(uri)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._leer_recurso, uri, tabla)
+    
+    def _leer_recurso(self, uri, tabla):
+        if not tabla:
+            resultado = self._ejecutar_herramienta("problemas_criticos", {})
+            texto = "".join(item.get("text", "") for item in resultado["content"])
+            return {"contents": [{"uri": uri, "mimeType": "text/plain", "text": texto}]}
+        
+        self.verificar_cambios()
+        with self.conexion() as conn:
+            datos = {
+                "tabla": tabla,
+                "filas": self.almacen.conteo_tabla(conn, tabla),
+                "ultimo_rowid": self.almacen.ultimo_rowid(conn, tabla),
+            }
+        return {"contents": [{"uri": uri, "mimeType": "application/json", "text": json.dumps(datos)}]}
+    
+    async def handle_resources_subscribe(self, params, sesion):
+        uri = params.get("uri", "")
+        self._recurso(uri)
+        sesion.suscripciones.add(uri)
+        return {}
+    
+    async def handle_resources_unsubscribe(self, params, sesion):
+        sesion.suscripciones.discard(params.get("uri", ""))
+        return {}
+    
+    def suscripciones(self):
+        """URIs suscritas por alguna sesión"""
+        return set().union(*(sesion.suscripciones for sesion in list(self.sesiones)))
+    
+    def recursos_actualizados(self):
+        """URIs suscritas cuyas tablas han superado NOTIFICAR_FILAS filas nuevas
+        desde el último aviso (el contador de esas tablas vuelve a cero)"""
+        with self._lock_vigia:
+            superadas = [
+                tabla for tabla, filas in self._filas_nuevas.items()
+                if filas >= self.notificar_filas
+            ]
+            for tabla in superadas:
+                self._filas_nuevas[tabla] = 0
+        uris = [RECURSO_TABLA + tabla for tabla in superadas]
+        if superadas:
+            uris.append(RECURSO_PROBLEMAS)
+        suscritas = self.suscripciones()
+        return [uri for uri in uris if uri in suscritas]
+    
+    async def handle_tools_call(self, params, clave=None, medicion=None):
+        """Ejecuta una herramienta en el pool de hilos; `clave` identifica la
+        petición para cancelarla (sesión, id JSON-RPC)"""
         tool_name = params.get("name", "")
-        arguments = params.get("arguments", {})
-        
-        try:
-            if tool_name == "analizar_restricciones":
-                return await self._analizar_restricciones(arguments)
-            elif tool_name == "analizar_excepciones":
-                return await self._analizar_excepciones(arguments)
-            elif tool_name == "resumen_sistema":
-                return await self._resumen_sistema(arguments)
-            elif tool_name == "analizar_hotel":
-                return await self._analizar_hotel(arguments)
-            elif tool_name == "problemas_criticos":
-                return await self._problemas_criticos(arguments)
-            elif tool_name == "consulta_sql":
-                return await self._consulta_sql(arguments)
-            else:
-                return {
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": f"Herramienta '{tool_name}' no encontrada"
-                        }
-                    ]
-                }
+        arguments = params.get("arguments")
+        if arguments is None:
+            arguments = {}
+        if not isinstance(tool_name, str) or not self.herramienta_publicada(tool_name):
+            raise ErrorJSONRPC(PARAMETROS_INVALIDOS, f"Herramienta desconocida: {tool_name}")
+        if not isinstance(arguments, dict):
+            raise ErrorJSONRPC(PARAMETROS_INVALIDOS, "'arguments' debe ser un objeto")
+        try:
+            # Validar contra inputSchema aquí: un argumento mal formado no llega a SQL
+            arguments = self.herramientas[tool_name].argumentos(arguments)
+        except ValueError as e:
+            raise ErrorJSONRPC(PARAMETROS_INVALIDOS, str(e))
+        
+        solicitud = _Solicitud(clave)
+        if clave is not None:
+            self._solicitudes[clave] = solicitud
+        
+        contexto = contextvars.copy_context()
+        contexto.run(_solicitud_actual.set, solicitud)
+        contexto.run(_medicion_actual.set, medicion)
+        llamada = functools.partial(
+            contexto.run, self._ejecutar_herramienta, tool_name, arguments
+        )
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, llamada)
+        except asyncio.CancelledError:
+            solicitud.cancelar()
+            raise
+        finally:
+            if self._solicitudes.get(clave) is solicitud:
+                del self._solicitudes[clave]
+    
+    def _ejecutar_herramienta(self, tool_name, arguments):
+        medicion = _medicion_actual.get()
+        if medicion is None:
+            return self._ejecutar_sin_medir(tool_name, arguments)
+        
+        inicio = time.perf_counter()
+        medicion.espera_ms = (inicio - medicion.inicio) * 1000
+        perfil = self.metricas.iniciar_perfil()
+        try:
+            resultado = self._ejecutar_sin_medir(tool_name, arguments, medicion)
+        finally:
+            medicion.actual = None
+            medicion.herramienta_ms = (time.perf_counter() - inicio) * 1000
+            if perfil is not None:
+                self.metricas.terminar_perfil(perfil, tool_name)
+        medicion.error = bool(resultado.get("isError"))
+        return resultado
+    
+    def _ejecutar_sin_medir(self, tool_name, arguments, medicion=None):
+        try:
+            inicio = time.perf_counter()
+            self.verificar_cambios()
+            if medicion is not None:
+                medicion.verificar_ms = (time.perf_counter() - inicio) * 1000
+            
+            if tool_name not in HERRAMIENTAS_CACHEABLES:
+                return self._despachar(tool_name, arguments)
+            
+            arguments = self._normalizar_argumentos(tool_name, arguments)
+            clave = (tool_name, json.dumps(arguments, sort_keys=True, separators=(",", ":"), default=str))
+            resultado = self.cache.obtener(clave)
+            if medicion is not None:
+                medicion.cache = resultado is not None
+            if resultado is None:
+                resultado = self._despachar(tool_name, arguments)
+                if not resultado.get("isError") and "continuacion" not in resultado.get("_meta", {}):
+                    self.cache.guardar(clave, resultado, tamano_resultado(resultado))
+            return resultado
         except Exception as e:
             return {
                 "content": [
@@ -177,57 +3846,94 @@ class SmartPerlahubMCP:
                         "type": "text",
                         "text": f"Error: {str(e)}"
                     }
-                ]
+                ],
+                "isError": True
             }
     
-    async def _analizar_restricciones(self, args):
-        conn = self.get_db_connection()
-        cursor = conn.cursor()
-        
-        query = """
-        SELECT hotel_id, restriction_type, COUNT(*) as cantidad
-        FROM restrictions 
-        WHERE 1=1
-        """
+    def herramienta_publicada(self, nombre):
+        """True si `nombre` está en tools/list (las métricas solo cuentan estas)"""
+        return isinstance(nombre, str) and nombre in self.herramientas
+    
+    def _despachar(self, tool_name, arguments):
+        if tool_name in self.almacen.no_disponibles:
+            raise ValueError(f"'{tool_name}' no está disponible con el almacén {self.almacen.nombre}")
+        herramienta = self.herramientas.get(tool_name)
+        if herramienta is None:
+            return {
+                "content": [
+                    {
+                        "type": "text",
+                        "text": f"Herramienta '{tool_name}' no encontrada"
+                    }
+                ],
+                "isError": True
+            }
+        manejador = self.manejadores.get(tool_name)
+        if manejador is None:
+            # Manejador "modulo:funcion": se importa en la primera llamada
+            manejador = functools.partial(herramienta.importar(), self)
+            self.manejadores[tool_name] = manejador
+        return manejador(arguments)
+    
+    def _analizar_restricciones(self, args):
+        formato = self._formato(args)
+        where = "1=1"
         params = []
         
         if args.get("hotel_id"):
-            query += " AND hotel_id = ?"
+            where += " AND hotel_id = ?"
             params.append(int(args["hotel_id"]))
         
         if args.get("tipo"):
-            query += " AND restriction_type LIKE ?"
+            where += " AND restriction_type LIKE ?"
             params.append(f"%{args['tipo']}%")
         
-        query += " GROUP BY hotel_id, restriction_type ORDER BY cantidad DESC LIMIT ?"
-        params.append(int(args.get("limite", 50)))
-        
-        cursor.execute(query, params)
-        results = cursor.fetchall()
+        limite = int(args.get("limite", 50))
+        ventana = VentanaTiempo(args.get("desde"), args.get("hasta"))
         
-        cursor.execute("SELECT COUNT(*) FROM restrictions")
-        total = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(DISTINCT hotel_id) FROM restrictions WHERE hotel_id IS NOT NULL")
-        hoteles = cursor.fetchone()[0]
+        with self.conexion() as conn:
+            claves = ("hotel_id", "restriction_type")
+            conteos = self.almacen.agregado(conn, "rollup_restrictions", claves, where, params, ventana)
+            results = [
+                {"hotel_id": hotel_id, "restriction_type": tipo, "cantidad": cantidad}
+                for (hotel_id, tipo), cantidad in self._ordenar_conteos(conteos, limite)
+            ]
+            
+            total = self.almacen.conteo_tabla(conn, "restrictions", ventana)
+            
+            por_hotel = self.almacen.agregado(
+                conn, "rollup_restrictions", ("hotel_id",), "hotel_id IS NOT NULL", ventana=ventana
+            )
+            hoteles = len(por_hotel)
         
-        conn.close()
+        if formato != "texto":
+            return self._respuesta_estructurada(formato, [(
+                "restricciones",
+                ["hotel_id", "restriction_type", "cantidad"],
+                [(r["hotel_id"], r["restriction_type"], r["cantidad"]) for r in results],
+            )], {"total_restricciones": total, "hoteles_afectados": hoteles,
+                 "desde": ventana.desde, "hasta": ventana.hasta})
         
+        anomalias = self.anomalias(ventana=ventana)
         texto = f"ANÁLISIS DE RESTRICCIONES\n"
         texto += f"========================\n\n"
+        texto += self._linea_ventana(ventana)
         texto += f"Total restricciones: {total:,}\n"
         texto += f"Hoteles afectados: {hoteles}\n\n"
         
         if results:
             texto += "TOP RESTRICCIONES:\n"
+            avisados = set()
             for row in results[:10]:
                 hotel_id = row["hotel_id"] or "N/A"
                 tipo = row["restriction_type"]
                 cantidad = row["cantidad"]
                 texto += f"• Hotel {hotel_id}: {tipo} ({cantidad:,} veces)\n"
                 
-                if hotel_id == 22:
-                    texto += f"  ⚠️ CRÍTICO: Hotel fantasma - NO EXISTE en inventario\n"
+                if row["hotel_id"] not in avisados:
+                    avisados.add(row["hotel_id"])
+                    for nota in self._notas_anomalia(anomalias, "hotel", row["hotel_id"]):
+                        texto += f"  {nota}\n"
         
         return {
             "content": [
@@ -238,42 +3944,798 @@ class SmartPerlahubMCP:
             ]
         }
     
-    async def _analizar_excepciones(self, args):
-        conn = self.get_db_connection()
-        cursor = conn.cursor()
+    def _analizar_excepciones(self, args):
+        formato = self._formato(args)
+        limite = int(args.get("limite", 30))
+        ventana = VentanaTiempo(args.get("desde"), args.get("hasta"))
         
-        query = """
-        SELECT exception_type, COUNT(*) as cantidad
-        FROM exceptions 
-        WHERE 1=1
-        """
-        params = []
+        with self.conexion() as conn:
+            conteos, ejemplos = self.almacen.plantillas_excepciones(conn, args.get("tipo"), ventana)
+            results = []
+            for (template_id,), cantidad in self._ordenar_conteos(conteos, limite):
+                tipos = ejemplos.get(template_id) or self.almacen.ejemplos_plantilla(conn, template_id)
+                results.append({
+                    "template_id": template_id,
+                    "plantilla": plantilla_mensaje(tipos[0])[0] if tipos else None,
+                    "cantidad": cantidad,
+                    "ejemplos": [plantilla_mensaje(tipo)[1] for tipo in tipos[:3]],
+                    "tipos": tipos,
+                })
         
-        if args.get("tipo"):
-            query += " AND exception_type LIKE ?"
-            params.append(f"%{args['tipo']}%")
+        if formato != "texto":
+            return self._respuesta_estructurada(formato, [(
+                "excepciones",
+                ["template_id", "plantilla", "cantidad", "parametros_ejemplo"],
+                [
+                    (r["template_id"], r["plantilla"], r["cantidad"],
+                     " | ".join(", ".join(parametros) for parametros in r["ejemplos"]))
+                    for r in results
+                ],
+            )], None if ventana.completa else {"desde": ventana.desde, "hasta": ventana.hasta})
+        
+        anomalias = self.anomalias(ventana=ventana)
+        texto = f"ANÁLISIS DE EXCEPCIONES\n"
+        texto += f"======================\n\n"
+        texto += self._linea_ventana(ventana)
+        
+        if results:
+            for row in results:
+                plantilla = row["plantilla"] or "(sin tipo)"
+                cantidad = row["cantidad"]
+                
+                plantilla_short = plantilla[:80] + "..." if len(plantilla) > 80 else plantilla
+                texto += f"• {plantilla_short}: {cantidad:,} veces\n"
+                ejemplos = [", ".join(parametros) for parametros in row["ejemplos"] if parametros]
+                if ejemplos:
+                    texto += f"  Ejemplos: {' · '.join(ejemplos)}\n"
+                
+                avisos = []
+                for tipo in {a["entidad"] for a in anomalias if a["dimension"] == "excepcion"}:
+                    if tipo is not None and huella_excepcion(tipo) == row["template_id"]:
+                        avisos.extend(self._notas_anomalia(anomalias, "excepcion", tipo))
+                for nota in avisos:
+                    texto += f"  {nota}\n"
+        
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": texto
+                }
+            ]
+        }
+    
+    def _resumen_sistema(self, args):
+        formato = self._formato(args)
+        ventana = VentanaTiempo(args.get("desde"), args.get("hasta"))
         
-        query += " GROUP BY exception_type ORDER BY cantidad DESC LIMIT ?"
-        params.append(int(args.get("limite", 30)))
+        with self.conexion() as conn:
+            conteos = {}
+            for tabla in TABLAS_AUDITORIA:
+                conteos[tabla] = self.almacen.conteo_tabla(conn, tabla, ventana)
+            
+            por_hotel = self.almacen.agregado(
+                conn, "rollup_restrictions", ("hotel_id",), "hotel_id IS NOT NULL", ventana=ventana
+            )
+            top_hoteles = [
+                {"hotel_id": hotel_id, "cantidad": cantidad}
+                for (hotel_id,), cantidad in self._ordenar_conteos(por_hotel, 5)
+            ]
         
-        cursor.execute(query, params)
-        results = cursor.fetchall()
+        if formato != "texto":
+            return self._respuesta_estructurada(formato, [
+                ("tablas", ["tabla", "filas"], list(conteos.items())),
+                ("top_hoteles", ["hotel_id", "cantidad"],
+                 [(r["hotel_id"], r["cantidad"]) for r in top_hoteles]),
+            ], {"total_registros": sum(conteos.values()), "desde": ventana.desde, "hasta": ventana.hasta})
         
-        conn.close()
+        anomalias = self.anomalias(ventana=ventana)
+        texto = f"RESUMEN DEL SISTEMA SMARTPERLAHUB\n"
+        texto += f"=================================\n\n"
+        texto += self._linea_ventana(ventana)
+        texto += f"📊 ESTADÍSTICAS GENERALES:\n"
+        texto += f"• Restricciones: {conteos['restrictions']:,}\n"
+        texto += f"• Excepciones: {conteos['exceptions']:,}\n"
+        texto += f"• Búsquedas cliente: {conteos['client_searches']:,}\n"
+        texto += f"• Búsquedas proveedor: {conteos['provider_searches']:,}\n"
+        texto += f"• Búsquedas conector: {conteos['connector_searches']:,}\n"
+        texto += f"• Logins: {conteos['logins']:,}\n\n"
+        
+        total = sum(conteos.values())
+        texto += f"TOTAL REGISTROS: {total:,}\n\n"
+        
+        if top_hoteles:
+            texto += f"🏨 HOTELES MÁS PROBLEMÁTICOS:\n"
+            for row in top_hoteles:
+                hotel_id = row["hotel_id"]
+                cantidad = row["cantidad"]
+                texto += f"• Hotel {hotel_id}: {cantidad:,} restricciones\n"
+                
+                for nota in self._notas_anomalia(anomalias, "hotel", hotel_id):
+                    texto += f"  {nota}\n"
+        
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": texto
+                }
+            ]
+        }
+    
+    def _analizar_hotel(self, args):
+        hotel_id = int(args["hotel_id"])
+        formato = self._formato(args)
+        ventana = VentanaTiempo(args.get("desde"), args.get("hasta"))
+        
+        with self.conexion() as conn:
+            conteos = self.almacen.agregado(
+                conn, "rollup_restrictions", ("restriction_type",), "hotel_id = ?", (hotel_id,), ventana
+            )
+            restricciones = [
+                {"restriction_type": tipo, "cantidad": cantidad}
+                for (tipo,), cantidad in self._ordenar_conteos(conteos)
+            ]
+            
+            excepciones = self.almacen.excepciones_hotel(conn, hotel_id, ventana)
+        
+        if formato != "texto":
+            return self._respuesta_estructurada(formato, [
+                ("restricciones", ["restriction_type", "cantidad"],
+                 [(r["restriction_type"], r["cantidad"]) for r in restricciones]),
+                ("excepciones", ["exception_type", "cantidad"],
+                 [(r["exception_type"], r["cantidad"]) for r in excepciones]),
+            ], {"hotel_id": hotel_id, "desde": ventana.desde, "hasta": ventana.hasta})
+        
+        anomalias = self.anomalias(ventana=ventana)
+        texto = f"ANÁLISIS DEL HOTEL {hotel_id}\n"
+        texto += f"==========================\n\n"
+        texto += self._linea_ventana(ventana)
+        
+        notas = (
+            self._notas_anomalia(anomalias, "hotel", hotel_id)
+            + self._notas_anomalia(anomalias, "hotel_excepciones", hotel_id)
+        )
+        if notas:
+            texto += f"🚨 ANOMALÍAS DETECTADAS\n"
+            for nota in notas:
+                texto += f"{nota}\n"
+            texto += f"\n"
+        
+        if restricciones:
+            texto += f"📊 RESTRICCIONES:\n"
+            for row in restricciones:
+                tipo = row["restriction_type"]
+                cantidad = row["cantidad"]
+                texto += f"• {tipo}: {cantidad:,} veces\n"
+        else:
+            texto += f"✅ Sin restricciones registradas\n"
+        
+        if excepciones:
+            texto += f"\n⚡ EXCEPCIONES:\n"
+            for row in excepciones:
+                tipo = row["exception_type"][:60] + "..." if len(row["exception_type"]) > 60 else row["exception_type"]
+                cantidad = row["cantidad"]
+                texto += f"• {tipo}: {cantidad:,} veces\n"
+        
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": texto
+                }
+            ]
+        }
+    
+    def _linea_ventana(self, ventana):
+        return "" if ventana.completa else f"Ventana: {ventana.describir()}\n\n"
+    
+    def _formato(self, args):
+        formato = args.get("formato") or "texto"
+        if formato not in FORMATOS:
+            raise ValueError(f"Formato '{formato}' no soportado (usar: {', '.join(FORMATOS)})")
+        return formato
+    
+    def _respuesta_estructurada(self, formato, secciones, meta=None):
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": serializar(formato, secciones, meta)
+                }
+            ]
+        }
+    
+    def _ordenar_conteos(self, conteos, limite=None):
+        """Mayor cantidad primero; los empates se ordenan por clave (orden estable)"""
+        ordenados = sorted(conteos.items(), key=lambda item: (-item[1], [str(v) for v in item[0]]))
+        return ordenados[:limite] if limite is not None else ordenados
+    
+    def _problemas_criticos(self, args):
+        incluir_sql = args.get("incluir_sql", True)
+        formato = self._formato(args)
+        umbral_cuota = float(self.umbral_cuota if args.get("umbral_cuota") is None else args["umbral_cuota"])
+        umbral_z = float(self.umbral_z if args.get("umbral_z") is None else args["umbral_z"])
+        
+        ventana = VentanaTiempo(args.get("desde"), args.get("hasta"))
+        
+        anomalias = self.anomalias(umbral_cuota, umbral_z, ventana)
+        with self.conexion() as conn:
+            rendimiento = self._rendimiento_busquedas(conn, ventana)
+        
+        if formato != "texto":
+            columnas = ["dimension", "entidad", "cantidad", "cuota", "hora", "cantidad_hora",
+                        "z", "motivos", "principal", "pista"]
+            if incluir_sql:
+                columnas.append("sql")
+            return self._respuesta_estructurada(formato, [
+                ("anomalias", columnas, [
+                    tuple(",".join(a[c]) if c == "motivos" else a[c] for c in columnas)
+                    for a in anomalias
+                ]),
+                ("rendimiento", ["tabla", "p99_ms", "max_ms"],
+                 [(tabla, p99, maximo) for tabla, (p99, maximo) in rendimiento.items()]),
+            ], {"umbral_cuota": umbral_cuota, "umbral_z": umbral_z, "minimo_filas": self.minimo_anomalia,
+                "desde": ventana.desde, "hasta": ventana.hasta})
+        
+        texto = f"PROBLEMAS CRÍTICOS IDENTIFICADOS\n"
+        texto += f"================================\n"
+        texto += f"(umbrales: cuota ≥ {umbral_cuota:.0%}, z ≥ {umbral_z:g}, "
+        texto += f"mínimo {self.minimo_anomalia:,} filas)\n\n"
+        texto += self._linea_ventana(ventana)
+        
+        if not anomalias:
+            texto += f"✅ No se detectan anomalías con los umbrales actuales\n\n"
+        
+        for numero, a in enumerate(anomalias, 1):
+            critico = "cuota" in a["motivos"]
+            texto += f"{'🚨' if critico else '⚠️'} {numero}. {self._titulo_anomalia(a)}\n"
+            texto += f"   Problema: {self._descripcion_anomalia(a)}\n"
+            if a["z"] is not None:
+                texto += f"   Última hora ({a['hora']}): {a['cantidad_hora']:,} (z = {a['z']:.1f})\n"
+            if a["pista"]:
+                texto += f"   Diagnóstico: {a['pista']}\n"
+            if critico:
+                texto += f"   Estado: CRÍTICO - Requiere acción inmediata\n"
+            else:
+                texto += f"   Estado: VIGILAR - Pico reciente\n"
+            if incluir_sql and a["sql"]:
+                texto += f"   Solución SQL:\n"
+                for linea in a["sql"].splitlines():
+                    texto += f"   {linea}\n"
+            texto += f"\n"
+        
+        if rendimiento:
+            texto += f"📊 RENDIMIENTO (detalle en analizar_latencias)\n"
+            for tabla, (p99, maximo) in rendimiento.items():
+                texto += f"   {tabla}: p99 {p99 / 1000:,.1f} s, búsqueda más lenta {maximo / 1000:,.1f} s\n"
+            texto += f"\n"
+        
+        texto += f"PLAN DE ACCIÓN:\n"
+        if any("cuota" in a["motivos"] for a in anomalias):
+            texto += f"• Inmediato (0-2h): Aplicar las soluciones de los problemas CRÍTICOS\n"
+        if any(a["motivos"] == ["pico"] for a in anomalias):
+            texto += f"• Urgente (2-8h): Revisar los picos de la última hora\n"
+        texto += f"• Seguimiento: Suscribirse a {RECURSO_PROBLEMAS} para recibir avisos\n"
+        
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": texto
+                }
+            ]
+        }
+    
+    def anomalias(self, umbral_cuota=None, umbral_z=None, ventana=None):
+        """Anomalías de hoteles y tipos de excepción (cuota del total y picos
+        por hora) calculadas sobre los rollups; se recalculan solo si cambian
+        los datos, los umbrales o la ventana"""
+        ventana = ventana or VentanaTiempo()
+        umbrales = (
+            self.umbral_cuota if umbral_cuota is None else umbral_cuota,
+            self.umbral_z if umbral_z is None else umbral_z,
+            self.minimo_anomalia,
+        )
+        clave = (self._version_datos, umbrales, ventana.desde, ventana.hasta)
+        guardado = self._anomalias
+        if guardado is not None and guardado[0] == clave:
+            return guardado[1]
+        
+        with self.conexion() as conn:
+            total_restricciones = self.almacen.conteo_tabla(conn, "restrictions", ventana)
+            total_excepciones = self.almacen.conteo_tabla(conn, "exceptions", ventana)
+            
+            if ventana.completa:
+                por_hotel = self.almacen.agregado(
+                    conn, "rollup_restrictions_hora", ("hotel_id", "hora"), "hotel_id IS NOT NULL"
+                )
+                por_excepcion = self.almacen.agregado(conn, "rollup_exceptions_hora", ("exception_type", "hora"))
+            else:
+                por_hotel = self.almacen.agregado(
+                    conn, "rollup_restrictions", ("hotel_id", "hora"), "hotel_id IS NOT NULL", ventana=ventana
+                )
+                por_excepcion = self.almacen.agregado(
+                    conn, "rollup_exceptions", ("exception_type", "hora"), ventana=ventana
+                )
+            
+            anomalias = detectar_anomalias("hotel", por_hotel, *umbrales, total=total_restricciones)
+            anomalias += detectar_anomalias("excepcion", por_excepcion, *umbrales, total=total_excepciones)
+            anomalias += detectar_anomalias(
+                "hotel_excepciones",
+                {(hotel, None): cantidad for hotel, cantidad in self.almacen.excepciones_por_hotel(conn, ventana).items()},
+                *umbrales, total=total_excepciones,
+            )
+            
+            # Contexto de cada anomalía: tipo o hotel principal y pista de dominio
+            for a in anomalias:
+                if a["dimension"] == "hotel":
+                    tipos = self.almacen.agregado(
+                        conn, "rollup_restrictions", ("restriction_type",), "hotel_id = ?", (a["entidad"],),
+                        ventana,
+                    )
+                    a["principal"] = self._ordenar_conteos(tipos, 1)[0][0][0] if tipos else None
+                    pista = pista_anomalia("restriccion", a["principal"])
+                    hotel, codigo = a["entidad"], None
+                elif a["dimension"] == "hotel_excepciones":
+                    tipos = self.almacen.excepciones_hotel(conn, a["entidad"], ventana)
+                    a["principal"] = tipos[0]["exception_type"] if tipos else None
+                    pista = pista_anomalia("excepcion", a["principal"])
+                    hotel, codigo = a["entidad"], codigo_habitacion(a["principal"])
+                else:
+                    hoteles = self.almacen.hoteles_excepcion(conn, a["entidad"], ventana)
+                    a["principal"] = self._ordenar_conteos(hoteles, 1)[0][0][0] if hoteles else None
+                    pista = pista_anomalia("excepcion", a["entidad"])
+                    hotel, codigo = a["principal"], codigo_habitacion(a["entidad"])
+                a["pista"] = pista[0] if pista else None
+                a["sql"] = pista[1].format(hotel=hotel, codigo=codigo) if pista else None
+        
+        self._anomalias = (clave, anomalias)
+        return anomalias
+    
+    def _titulo_anomalia(self, a):
+        if a["dimension"] == "excepcion":
+            entidad = str(a["entidad"])
+            sujeto = f"EXCEPCIÓN '{entidad[:60] + '...' if len(entidad) > 60 else entidad}'"
+        else:
+            sujeto = f"HOTEL {a['entidad']}"
+        if "cuota" not in a["motivos"]:
+            return f"{sujeto} - PICO EN LA ÚLTIMA HORA"
+        origen = "RESTRICCIONES" if a["dimension"] == "hotel" else "EXCEPCIONES"
+        return f"{sujeto} - {a['cuota']:.1%} DE LAS {origen}"
+    
+    def _descripcion_anomalia(self, a):
+        principal = a["principal"]
+        if isinstance(principal, str) and len(principal) > 60:
+            principal = principal[:60] + "..."
+        if a["dimension"] == "hotel":
+            return f"{a['cantidad']:,} restricciones (tipo principal: {principal})"
+        if a["dimension"] == "hotel_excepciones":
+            return f"{a['cantidad']:,} excepciones (tipo principal: {principal})"
+        return f"{a['cantidad']:,} excepciones (hotel principal: {principal})"
+    
+    def _notas_anomalia(self, anomalias, dimension, entidad):
+        """Avisos del motor de anomalías para una entidad (vacío si es normal)"""
+        notas = []
+        for a in anomalias:
+            if a["dimension"] != dimension or a["entidad"] != entidad:
+                continue
+            origen = "restricciones" if dimension == "hotel" else "excepciones"
+            if "cuota" in a["motivos"]:
+                notas.append(f"🚨 CRÍTICO: {a['cuota']:.1%} de todas las {origen}")
+            if "pico" in a["motivos"]:
+                notas.append(f"⚠️ Pico: {a['cantidad_hora']:,} en la hora {a['hora']} (z = {a['z']:.1f})")
+            if a["pista"]:
+                notas.append(f"💡 {a['pista']}")
+        return notas
+    
+    def _rendimiento_busquedas(self, conn, ventana):
+        """{tabla: (p99, máximo)} de duration_ms de cada tabla de búsquedas"""
+        rendimiento = {}
+        for tabla in FUENTES_LATENCIA:
+            sketch = self.almacen.latencias(conn, tabla, "total", ventana).get("")
+            if sketch is not None and sketch.n:
+                rendimiento[tabla] = (sketch.cuantil(0.99), sketch.maximo)
+        return rendimiento
+    
+    def _analizar_latencias(self, args):
+        formato = self._formato(args)
+        ventana = VentanaTiempo(args.get("desde"), args.get("hasta"))
+        limite = int(args.get("limite", 20))
+        agrupar = args.get("agrupar")
+        if agrupar and agrupar not in AGRUPACIONES_LATENCIA:
+            raise ValueError(f"Agrupación '{agrupar}' no soportada (usar: {', '.join(AGRUPACIONES_LATENCIA)})")
+        agrupaciones = [agrupar] if agrupar else list(AGRUPACIONES_LATENCIA)
+        
+        resultados = {}
+        with self.conexion() as conn:
+            for nombre in agrupaciones:
+                filas = []
+                for tabla, dimension in AGRUPACIONES_LATENCIA[nombre]:
+                    for clave, sketch in self.almacen.latencias(conn, tabla, dimension, ventana, limite).items():
+                        filas.append((
+                            tabla, clave or tabla, sketch.n,
+                            round(sketch.cuantil(0.5), 1), round(sketch.cuantil(0.9), 1),
+                            round(sketch.cuantil(0.99), 1), sketch.maximo,
+                        ))
+                filas.sort(key=lambda fila: (-fila[2], fila[0], fila[1]))
+                resultados[nombre] = filas[:limite]
+        
+        if formato != "texto":
+            columnas = ["tabla", "clave", "busquedas", "p50_ms", "p90_ms", "p99_ms", "max_ms"]
+            return self._respuesta_estructurada(
+                formato,
+                [(nombre, columnas, filas) for nombre, filas in resultados.items()],
+                {"desde": ventana.desde, "hasta": ventana.hasta, "precision_relativa": PRECISION_LATENCIAS},
+            )
+        
+        titulos = {
+            "tabla": "⏱️ POR TABLA",
+            "proveedor": "🔌 POR PROVEEDOR",
+            "conector": "🔗 POR CONECTOR",
+            "hotel": "🏨 POR HOTEL",
+        }
+        texto = f"ANÁLISIS DE LATENCIAS\n"
+        texto += f"=====================\n\n"
+        texto += f"Ventana: {ventana.describir()}\n\n"
+        
+        for nombre, filas in resultados.items():
+            texto += f"{titulos[nombre]}:\n"
+            if not filas:
+                texto += f"• Sin búsquedas en la ventana\n"
+            for tabla, clave, n, p50, p90, p99, maximo in filas:
+                if nombre == "tabla":
+                    etiqueta = tabla
+                elif nombre == "hotel":
+                    etiqueta = f"Hotel {clave} ({tabla})"
+                else:
+                    etiqueta = clave
+                texto += f"• {etiqueta}: {n:,} búsquedas | p50 {p50:,.0f} ms | p90 {p90:,.0f} ms | "
+                texto += f"p99 {p99:,.0f} ms | máx {maximo:,.0f} ms\n"
+            texto += f"\n"
+        
+        texto += f"ℹ️ Percentiles aproximados (error relativo ≤ {PRECISION_LATENCIAS:.0%}); máximo exacto.\n"
+        
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": texto
+                }
+            ]
+        }
+    
+    def _buscar_excepciones(self, args):
+        formato = self._formato(args)
+        campo = args.get("campo")
+        if campo and campo not in COLUMNAS_FTS:
+            raise ValueError(f"Campo '{campo}' no soportado (usar: {', '.join(COLUMNAS_FTS)})")
+        limite = int(args.get("limite", 20))
+        ventana = VentanaTiempo(args.get("desde"), args.get("hasta"))
+        consulta = consulta_fts(args.get("consulta"), campo)
+        
+        with self.conexion() as conn:
+            total, mejores, por_tipo = self.almacen.coincidencias_fts(conn, consulta, ventana, limite)
+        
+        plantillas = {}
+        for tipo, cantidad in por_tipo.items():
+            plantilla, parametros = plantilla_mensaje(tipo)
+            grupo = plantillas.setdefault(plantilla, {"cantidad": 0, "variantes": 0, "ejemplo": parametros})
+            grupo["cantidad"] += cantidad
+            grupo["variantes"] += 1
+        grupos = sorted(plantillas.items(), key=lambda item: (-item[1]["cantidad"], str(item[0])))[:limite]
+        
+        if formato != "texto":
+            return self._respuesta_estructurada(formato, [
+                ("plantillas", ["plantilla", "cantidad", "variantes", "parametros_ejemplo"], [
+                    (plantilla, g["cantidad"], g["variantes"], ", ".join(g["ejemplo"]))
+                    for plantilla, g in grupos
+                ]),
+                ("resultados", ["rowid", "occurred_at", "exception_type", "fragmento", "puntuacion"], [
+                    (r["rowid"], r["occurred_at"], r["exception_type"], r["fragmento"], round(r["puntuacion"], 3))
+                    for r in mejores
+                ]),
+            ], {"consulta": consulta, "coincidencias": total, "desde": ventana.desde, "hasta": ventana.hasta})
+        
+        texto = f"BÚSQUEDA DE EXCEPCIONES\n"
+        texto += f"=======================\n\n"
+        texto += self._linea_ventana(ventana)
+        texto += f"Consulta: {consulta}\n"
+        texto += f"Coincidencias: {total:,}\n\n"
+        
+        if not total:
+            texto += f"• Ninguna excepción coincide con la búsqueda\n"
+        else:
+            texto += f"🧩 POR PLANTILLA DE MENSAJE:\n"
+            for plantilla, g in grupos:
+                plantilla_short = plantilla[:80] + "..." if len(plantilla) > 80 else plantilla
+                texto += f"• {plantilla_short}: {g['cantidad']:,} veces"
+                texto += f" ({g['variantes']:,} variantes)\n" if g["variantes"] > 1 else "\n"
+                if g["ejemplo"]:
+                    texto += f"  Ejemplo: {', '.join(g['ejemplo'])}\n"
+            
+            texto += f"\n🔎 RESULTADOS MÁS RELEVANTES:\n"
+            for i, r in enumerate(mejores, 1):
+                texto += f"{i}. [{r['occurred_at']}] {r['fragmento']}\n"
+        
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": texto
+                }
+            ]
+        }
+    
+    def _consulta_sql(self, args):
+        limite = max(1, min(int(args.get("limite", 100)), self.max_pagina))
+        formato = self._formato(args)
+        
+        if args.get("continuacion"):
+            entrada = self.cursores.tomar(args["continuacion"])
+            if entrada is None:
+                return {
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Error: Token de continuación desconocido o caducado; repite la consulta"
+                        }
+                    ],
+                    "isError": True
+                }
+            return self._pagina_consulta(entrada, limite, formato)
+        
+        query = args.get("query", "").strip().rstrip(";")
+        if not query:
+            return {
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "Error: Falta 'query' (o 'continuacion')"
+                    }
+                ],
+                "isError": True
+            }
+        
+        # Conexión del pool: solo se separa de él si quedan filas para otra
+        # página. El autorizador solo deja compilar lecturas (SELECT / WITH).
+        with self.conexion() as conn:
+            conn.set_authorizer(autorizar_solo_lectura)
+            entrada = {"conn": conn, "pool": True}
+            try:
+                return self._ejecutar_consulta(entrada, query, limite, formato)
+            finally:
+                if entrada.get("pool"):
+                    quitar_autorizador(conn)
+    
+    def _ejecutar_consulta(self, entrada, query, limite, formato):
+        conn = entrada["conn"]
+        presupuesto = None
+        try:
+            rechazo = self._verificar_plan(conn, query)
+            if rechazo:
+                return {
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": f"Error: {rechazo}"
+                        }
+                    ],
+                    "isError": True
+                }
+            
+            presupuesto = PresupuestoConsulta(
+                self.max_pasos, self.timeout_consulta, _solicitud_actual.get()
+            )
+            cursor = conn.cursor()
+            # Filas como tuplas (las del pool usan sqlite3.Row)
+            cursor.row_factory = None
+            presupuesto.instalar(conn)
+            try:
+                cursor.execute(query)
+            finally:
+                presupuesto.retirar(conn)
+        except Exception as e:
+            return self._error_consulta(e, presupuesto)
+        
+        entrada.update({
+            "cursor": cursor,
+            "headers": [d[0] for d in cursor.description or []],
+            "offset": 0,
+            "pendiente": None,
+            # La primera página comparte presupuesto con la ejecución
+            "presupuesto": presupuesto,
+        })
+        return self._pagina_consulta(entrada, limite, formato)
+    
+    def _verificar_plan(self, conn, query):
+        """Rechaza (devuelve el motivo) consultas que recorren sin índice una
+        tabla mayor que CONSULTA_MAX_FILAS_ESCANEO"""
+        if self.max_filas_escaneo <= 0:
+            return None
+        plan = plan_consulta(conn, query)
+        # Los conteos leen PRAGMA y tablas derivadas: sin el autorizador
+        quitar_autorizador(conn)
+        try:
+            for tabla in tablas_escaneadas(plan, query):
+                if not columnas_tabla(conn, tabla):
+                    continue
+                filas = self.almacen.conteo_tabla(conn, tabla)
+                if filas > self.max_filas_escaneo:
+                    return (
+                        f"La consulta recorre completa la tabla '{tabla}' ({filas:,} filas, "
+                        f"máximo {self.max_filas_escaneo:,}). Añade un filtro por una columna "
+                        f"indexada o consulta las herramientas de análisis."
+                    )
+        finally:
+            conn.set_authorizer(autorizar_solo_lectura)
+        return None
+    
+    def _error_consulta(self, error, presupuesto=None):
+        mensaje = str(error)
+        if isinstance(error, sqlite3.DatabaseError) and "not authorized" in mensaje:
+            mensaje = "Operación no permitida: consulta_sql solo admite lecturas (SELECT)"
+        elif presupuesto is not None and presupuesto.motivo:
+            mensaje = f"Consulta abortada: {presupuesto.motivo}"
+        elif getattr(_solicitud_actual.get(), "cancelada", False):
+            # conn.interrupt() de la cancelación antes que el progress handler
+            mensaje = "Consulta abortada: cancelada por el cliente"
+        return {
+            "content": [
+                {
+                    "type": "text",
+                    "text": f"Error en consulta SQL: {mensaje}"
+                }
+            ],
+            "isError": True
+        }
+    
+    def _cerrar_consulta(self, entrada):
+        """Cierra el cursor de una consulta terminada y su conexión, salvo la
+        del pool (vuelve a él al acabar el préstamo)"""
+        if entrada.get("pool"):
+            entrada["cursor"].close()
+        else:
+            self.cursores.cerrar(entrada)
+    
+    def _pagina_consulta(self, entrada, limite, formato="texto"):
+        """Lee hasta `limite` filas del cursor por bloques y deja el resto pendiente"""
+        solicitud = _solicitud_actual.get()
+        conn = entrada["conn"]
+        cursor = entrada["cursor"]
+        filas = []
+        presupuesto = entrada.pop("presupuesto", None) or PresupuestoConsulta(
+            self.max_pasos, self.timeout_consulta, solicitud
+        )
+        try:
+            if solicitud is not None:
+                solicitud.registrar(conn)
+            presupuesto.instalar(conn)
+            if entrada["pendiente"] is not None:
+                filas.append(entrada["pendiente"])
+                entrada["pendiente"] = None
+            while len(filas) < limite:
+                bloque = cursor.fetchmany(min(500, limite - len(filas)))
+                if not bloque:
+                    break
+                filas.extend(bloque)
+            # Una fila de más indica si quedan resultados
+            entrada["pendiente"] = cursor.fetchone() if len(filas) == limite else None
+            presupuesto.retirar(conn)
+        except Exception as e:
+            self._cerrar_consulta(entrada)
+            return self._error_consulta(e, presupuesto)
+        finally:
+            if solicitud is not None:
+                solicitud.liberar(conn)
+        
+        inicio = entrada["offset"]
+        entrada["offset"] += len(filas)
+        token = None
+        if entrada["pendiente"] is not None:
+            if entrada.pop("pool", False):
+                # El cursor sobrevive a la llamada: la conexión deja el pool
+                self.pool.separar(conn)
+            token = self.cursores.guardar(entrada)
+        else:
+            self._cerrar_consulta(entrada)
+        
+        if formato != "texto":
+            # Formatos estructurados: las filas se serializan tal cual
+            meta = {"desde_fila": inicio + 1, "filas_pagina": len(filas)}
+            if token:
+                meta["continuacion"] = token
+            resultado = self._respuesta_estructurada(
+                formato, [("resultados", entrada["headers"], filas)], meta
+            )
+        else:
+            if not filas and inicio == 0:
+                texto = "No se encontraron resultados."
+            else:
+                headers = entrada["headers"]
+                partes = [
+                    f"RESULTADOS DE CONSULTA ({len(filas)} filas",
+                    f", {inicio + 1}-{inicio + len(filas)}):\n" if inicio or token else "):\n",
+                    "=" * 50 + "\n\n",
+                ]
+                for i, row in enumerate(filas, start=inicio + 1):
+                    partes.append(f"Fila {i}:\n")
+                    partes.extend(f"  {header}: {valor}\n" for header, valor in zip(headers, row))
+                    partes.append("\n")
+                if token:
+                    partes.append(f"Hay más filas. Continuación: {token}\n")
+                texto = "".join(partes)
+            
+            resultado = {
+                "content": [
+                    {
+                        "type": "text",
+                        "text": texto
+                    }
+                ]
+            }
+        if token:
+            resultado["_meta"] = {"continuacion": token}
+        return resultado
+    
+    def _diagnostico_indices(self, args):
+        incluir_planes = args.get("incluir_planes", False)
+        diagnostico = self.diagnostico
         
-        texto = f"ANÁLISIS DE EXCEPCIONES\n"
+        texto = f"DIAGNÓSTICO DE ÍNDICES\n"
         texto += f"======================\n\n"
+        texto += f"Estado de la revisión: {diagnostico['estado']}\n"
+        if "escribible" in diagnostico:
+            modo = "escritura" if diagnostico["escribible"] else "solo lectura"
+            texto += f"Base de datos: {modo}\n"
+        if "duracion_ms" in diagnostico:
+            texto += f"Duración: {diagnostico['duracion_ms']:.0f} ms\n"
+        if "error" in diagnostico:
+            texto += f"Error: {diagnostico['error']}\n"
+        texto += "\n"
         
-        if results:
-            for row in results:
-                tipo = row["exception_type"]
-                cantidad = row["cantidad"]
-                
-                tipo_short = tipo[:80] + "..." if len(tipo) > 80 else tipo
-                texto += f"• {tipo_short}: {cantidad:,} veces\n"
-                
-                if "Room mapping failed" in tipo and "DBL|2P·CLASSIC" in tipo:
-                    texto += f"  ⚠️ Hotel 5481 (Guitart Central Park) - Falta mapeo\n"
+        iconos = {
+            "existente": "✅",
+            "creado": "🆕",
+            "innecesario": "✅",
+            "faltante": "⚠️",
+            "no_aplicable": "➖",
+            "error": "❌",
+        }
+        for indice in diagnostico["indices"]:
+            columnas = ", ".join(indice["columnas"])
+            icono = iconos.get(indice["estado"], "•")
+            texto += f"{icono} "
+            if indice.get("particion"):
+                texto += f"[{indice['particion']}] "
+            texto += f"{indice['tabla']}({columnas}): {indice['estado']}"
+            if indice.get("indice"):
+                texto += f" [{indice['indice']}]"
+            if "duracion_ms" in indice:
+                texto += f" en {indice['duracion_ms']:.0f} ms"
+            texto += "\n"
+            if indice["estado"] == "faltante":
+                texto += f"  Recomendado: CREATE INDEX {indice['nombre']} ON {indice['tabla']}({columnas});\n"
+            if indice.get("error"):
+                texto += f"  Error: {indice['error']}\n"
+            if incluir_planes:
+                for plan in indice["plan_antes"]:
+                    texto += f"  Plan: {' | '.join(plan)}\n"
+                for plan in indice["plan_despues"]:
+                    texto += f"  Plan nuevo: {' | '.join(plan)}\n"
+        
+        faltantes = diagnostico.get("derivadas_faltantes", [])
+        if faltantes:
+            texto += "\nTablas derivadas:\n"
+            for faltante in faltantes:
+                texto += "⚠️ "
+                if faltante.get("particion"):
+                    texto += f"[{faltante['particion']}] "
+                texto += f"{faltante['tabla']}: faltante\n"
+            texto += (
+                "  Las consultas recorren las tablas base. Se crean con smartperlahub_ingest.py "
+                "o arrancando con DB_AUTO_DERIVADOS=1 y permiso de escritura\n"
+            )
         
         return {
             "content": [
@@ -284,53 +4746,88 @@ class SmartPerlahubMCP:
             ]
         }
     
-    async def _resumen_sistema(self, args):
-        conn = self.get_db_connection()
-        cursor = conn.cursor()
-        
-        tablas = ["restrictions", "exceptions", "client_searches", "provider_searches", "connector_searches", "logins"]
-        conteos = {}
-        
-        for tabla in tablas:
-            cursor.execute(f"SELECT COUNT(*) FROM {tabla}")
-            conteos[tabla] = cursor.fetchone()[0]
-        
-        cursor.execute("""
-        SELECT hotel_id, COUNT(*) as cantidad
-        FROM restrictions 
-        WHERE hotel_id IS NOT NULL
-        GROUP BY hotel_id 
-        ORDER BY cantidad DESC 
-        LIMIT 5
-        """)
-        top_hoteles = cursor.fetchall()
-        
-        conn.close()
+    def _estadisticas_pool(self):
+        """Estadísticas del pool de conexiones, sumadas entre particiones"""
+        datos = {}
+        for particion in self.particiones:
+            for clave, valor in particion.pool.estadisticas().items():
+                if clave in ("mmap_mb", "cache_mb", "sentencias_cacheadas"):
+                    datos[clave] = valor
+                else:
+                    datos[clave] = datos.get(clave, 0) + valor
+        return datos
+    
+    def _texto_particiones(self):
+        texto = f"🧩 PARTICIONES ({len(self.particiones)}, {self.almacen.hilos} hilos de reparto):\n"
+        for particion in self.particiones:
+            primera, ultima = particion.rango
+            fechas = f"{primera} → {ultima}" if primera else "sin filas con fecha"
+            filas = sum(particion.marcas.values())
+            texto += f"• {particion.nombre}: {fechas} (~{filas:,} filas)\n"
+        return texto + "\n"
+    
+    def _texto_pool(self):
+        pool = self._estadisticas_pool()
+        espera_media = pool["espera_total_ms"] / pool["esperas"] if pool["esperas"] else 0.0
+        texto = f"🔌 POOL DE CONEXIONES (solo lectura):\n"
+        texto += f"• Tamaño máximo: {pool['tamano']}\n"
+        texto += f"• Abiertas: {pool['abiertas']} (libres: {pool['libres']}, en uso: {pool['en_uso']})\n"
+        texto += f"• Máximo en uso simultáneo: {pool['max_en_uso']}\n"
+        texto += f"• Préstamos: {pool['prestamos']:,}\n"
+        texto += f"• Esperas por pool agotado: {pool['esperas']:,} (media {espera_media:.1f} ms)\n"
+        texto += f"• Conexiones descartadas: {pool['descartadas']:,}\n"
+        texto += f"• Conexiones separadas para cursores de consulta_sql: {pool['separadas']:,}\n"
+        texto += f"• mmap: {pool['mmap_mb']} MB, caché de páginas: {pool['cache_mb']} MB, "
+        texto += f"sentencias cacheadas: {pool['sentencias_cacheadas']}\n"
+        texto += f"• Workers SQL: {self.max_workers}\n"
+        texto += f"• Cursores de consulta_sql abiertos: {self.cursores.abiertos()}\n\n"
+        return texto
+    
+    def _estado_servidor(self, args):
+        texto = f"ESTADO DEL SERVIDOR\n"
+        texto += f"===================\n\n"
+        if not self.particiones:
+            texto += f"🦆 ALMACÉN PARQUET (DuckDB):\n"
+            texto += f"• Directorio: {self.almacen.ruta}\n"
+            texto += f"• Ficheros Parquet: {len(self.almacen.ficheros())}\n"
+            texto += f"• Tablas: {', '.join(sorted(self.almacen.columnas)) or 'ninguna'}\n"
+            texto += f"• Workers SQL: {self.max_workers}\n\n"
+        else:
+            if self.particionado:
+                texto += self._texto_particiones()
+            texto += self._texto_pool()
         
-        texto = f"RESUMEN DEL SISTEMA SMARTPERLAHUB\n"
-        texto += f"=================================\n\n"
-        texto += f"📊 ESTADÍSTICAS GENERALES:\n"
-        texto += f"• Restricciones: {conteos['restrictions']:,}\n"
-        texto += f"• Excepciones: {conteos['exceptions']:,}\n"
-        texto += f"• Búsquedas cliente: {conteos['client_searches']:,}\n"
-        texto += f"• Búsquedas proveedor: {conteos['provider_searches']:,}\n"
-        texto += f"• Búsquedas conector: {conteos['connector_searches']:,}\n"
-        texto += f"• Logins: {conteos['logins']:,}\n\n"
+        texto += f"👀 VIGILANCIA DE CAMBIOS:\n"
+        if self.intervalo_vigilancia > 0:
+            texto += f"• Comprobación cada {self.intervalo_vigilancia:g} s, aviso cada {self.notificar_filas:,} filas nuevas\n"
+        else:
+            texto += f"• Desactivada (solo al llamar a una herramienta)\n"
+        texto += f"• Recursos suscritos: {len(self.suscripciones())}\n"
+        for tabla, marca in sorted(self._marcas_tablas.items()):
+            texto += f"• {tabla}: último rowid {marca:,} ({self._filas_nuevas[tabla]:,} filas sin notificar)\n"
+        texto += f"\n"
         
-        total = sum(conteos.values())
-        texto += f"TOTAL REGISTROS: {total:,}\n\n"
+        if self.http is not None:
+            http = self.http.estadisticas()
+            texto += f"🌐 TRANSPORTE HTTP:\n"
+            texto += f"• Endpoint: {self.http.url}\n"
+            texto += f"• Sesiones: {http['sesiones']:,} de {self.http.max_sesiones:,} "
+            texto += f"({http['streams']:,} con stream SSE, caducan tras {self.http.ttl_sesion:g} s sin uso)\n"
+            texto += f"• Peticiones en curso: {http['en_curso']:,} (por sesión: {self.http.concurrencia} a la vez, "
+            texto += f"{self.http.cola} como máximo)\n"
+            texto += f"• Peticiones HTTP: {http['peticiones']:,} — rechazadas por exceso: {http['rechazadas']:,}\n"
+            texto += f"• Sesiones creadas: {http['creadas']:,}, caducadas: {http['caducadas']:,}\n"
+            texto += f"• Notificaciones descartadas (cliente lento): {http['descartadas']:,}\n\n"
         
-        if top_hoteles:
-            texto += f"🏨 HOTELES MÁS PROBLEMÁTICOS:\n"
-            for row in top_hoteles:
-                hotel_id = row["hotel_id"]
-                cantidad = row["cantidad"]
-                texto += f"• Hotel {hotel_id}: {cantidad:,} restricciones\n"
-                
-                if hotel_id == 22:
-                    texto += f"  🚨 CRÍTICO: Hotel fantasma\n"
-                elif hotel_id == 5481:
-                    texto += f"  ⚠️ Guitart Central Park - Room mapping error\n"
+        cache = self.cache.estadisticas()
+        texto += f"🗃️ CACHÉ DE RESULTADOS:\n"
+        texto += f"• Entradas: {cache['entradas']:,} ({cache['bytes'] / 1024:,.1f} KB de "
+        texto += f"{cache['capacidad_bytes'] / (1024 * 1024):,.0f} MB, TTL {cache['ttl']:.0f} s)\n"
+        texto += f"• Aciertos: {cache['aciertos']:,} / fallos: {cache['fallos']:,} "
+        texto += f"(tasa {cache['tasa_aciertos']:.1%})\n"
+        texto += f"• Expiradas: {cache['expiradas']:,}, desalojadas (LRU): {cache['desalojos']:,}, "
+        texto += f"demasiado grandes: {cache['demasiado_grandes']:,}\n"
+        texto += f"• Invalidaciones por cambios en la base de datos: {cache['invalidaciones']:,}\n"
         
         return {
             "content": [
@@ -340,60 +4837,128 @@ class SmartPerlahubMCP:
                 }
             ]
         }
+    def metricas_prometheus(self):
+        """Texto de Prometheus con las métricas y los indicadores de pool y caché"""
+        cache = self.cache.estadisticas()
+        extra = {
+            "cache_bytes": ("gauge", "Bytes ocupados por la caché de resultados", cache["bytes"]),
+            "cache_entradas": ("gauge", "Entradas en la caché de resultados", cache["entradas"]),
+            "cursores_abiertos": ("gauge", "Cursores de consulta_sql abiertos", self.cursores.abiertos()),
+        }
+        if self.http is not None:
+            http = self.http.estadisticas()
+            extra["http_sesiones"] = ("gauge", "Sesiones HTTP abiertas", http["sesiones"])
+            extra["http_en_curso"] = ("gauge", "Peticiones HTTP en curso", http["en_curso"])
+            extra["http_rechazadas_total"] = ("counter", "Peticiones HTTP rechazadas por exceso", http["rechazadas"])
+        if self.particiones:
+            pool = self._estadisticas_pool()
+            extra["pool_en_uso"] = ("gauge", "Conexiones del pool prestadas", pool["en_uso"])
+            extra["pool_esperas_total"] = ("counter", "Esperas por pool agotado", pool["esperas"])
+            extra["pool_espera_segundos_total"] = (
+                "counter", "Tiempo esperando una conexión del pool", pool["espera_total_ms"] / 1000
+            )
+        return self.metricas.prometheus(extra)
     
-    async def _analizar_hotel(self, args):
-        hotel_id = int(args["hotel_id"])
+    def volcar_metricas(self):
+        """Escribe METRICAS_FICHERO de forma atómica (textfile collector)"""
+        if not self.fichero_metricas:
+            return
+        temporal = f"{self.fichero_metricas}.{os.getpid()}.tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write(self.metricas_prometheus())
+        os.replace(temporal, self.fichero_metricas)
+    
+    def _plan_lenta(self, lenta):
+        """EXPLAIN QUERY PLAN de una consulta lenta (se calcula una vez)"""
+        if lenta["plan"] is None:
+            if not self.particiones:
+                lenta["plan"] = []
+                return lenta["plan"]
+            try:
+                # Todas las particiones comparten esquema: basta la primera
+                with self.particiones[0].pool.conexion() as conn:
+                    lenta["plan"] = plan_consulta(conn, lenta["sql"], lenta["parametros"] or ())
+            except sqlite3.Error as e:
+                # p. ej. tablas temporales de la conexión original (índice FTS en memoria)
+                lenta["plan"] = [f"(plan no disponible: {e})"]
+        return lenta["plan"]
+    
+    def _metricas_servidor(self, args):
+        formato = args.get("formato") or "texto"
+        if formato == "prometheus":
+            resultado = {"content": [{"type": "text", "text": self.metricas_prometheus()}]}
+            if args.get("reiniciar"):
+                self.metricas.reiniciar()
+            return resultado
+        formato = self._formato(args)
+        limite = max(1, int(args.get("limite", 10)))
+        herramientas = self.metricas.herramientas()
+        sentencias = self.metricas.sentencias(limite)
+        lentas = self.metricas.lentas(limite)
+        if args.get("incluir_planes", True):
+            for lenta in lentas:
+                self._plan_lenta(lenta)
+        perfiles = self.metricas.perfiles()
+        desde = self.metricas.inicio.isoformat(timespec="seconds")
+        if args.get("reiniciar"):
+            self.metricas.reiniciar()
         
-        conn = self.get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-        SELECT restriction_type, COUNT(*) as cantidad
-        FROM restrictions 
-        WHERE hotel_id = ?
-        GROUP BY restriction_type
-        ORDER BY cantidad DESC
-        """, (hotel_id,))
-        restricciones = cursor.fetchall()
-        
-        cursor.execute("""
-        SELECT exception_type, COUNT(*) as cantidad
-        FROM exceptions 
-        WHERE context_data LIKE ?
-        GROUP BY exception_type
-        ORDER BY cantidad DESC
-        """, (f"%{hotel_id}%",))
-        excepciones = cursor.fetchall()
+        if formato != "texto":
+            columnas_herramientas = ["herramienta"] + list(next(iter(herramientas.values()), {}).keys())
+            return self._respuesta_estructurada(formato, [
+                ("herramientas", columnas_herramientas,
+                 [[nombre] + list(datos.values()) for nombre, datos in herramientas.items()]),
+                ("sentencias", ["sql", "ejecuciones", "ms", "max_ms", "filas", "pasos_vm"],
+                 [[f["sql"], f["ejecuciones"], f["ms"], f["max_ms"], f["filas"], f["pasos_vm"]] for f in sentencias]),
+                ("lentas", ["fecha", "herramienta", "ms", "filas", "pasos_vm", "sql", "parametros", "plan"],
+                 [[l["fecha"], l["herramienta"], l["ms"], l["filas"], l["pasos_vm"], l["sql"],
+                   json.dumps(l["parametros"], default=str), " | ".join(l["plan"] or [])] for l in lentas]),
+                ("perfiles", ["fecha", "herramienta", "ms", "fichero"],
+                 [[p["fecha"], p["herramienta"], p["ms"], p["fichero"]] for p in perfiles]),
+            ], {"desde": desde, "umbral_lenta_ms": self.metricas.umbral_lenta_ms})
         
-        conn.close()
+        texto = f"MÉTRICAS DEL SERVIDOR\n"
+        texto += f"=====================\n\n"
+        texto += f"Desde: {desde}\n\n"
         
-        texto = f"ANÁLISIS DEL HOTEL {hotel_id}\n"
-        texto += f"==========================\n\n"
+        texto += f"⏱️ HERRAMIENTAS (ms, de la petición a la respuesta escrita):\n"
+        if not herramientas:
+            texto += f"• Sin llamadas registradas\n"
+        for nombre, d in herramientas.items():
+            texto += f"• {nombre}: {d['llamadas']:,} llamadas ({d['errores']:,} errores) — "
+            texto += f"p50 {d['p50_ms']:,.1f} / p95 {d['p95_ms']:,.1f} / p99 {d['p99_ms']:,.1f} / máx {d['max_ms']:,.1f}\n"
+            texto += f"  Media por fase: espera {d['espera_ms']:,.1f}, verificar {d['verificar_ms']:,.1f}, "
+            texto += f"SQL {d['sql_ms']:,.1f}, formato {d['formato_ms']:,.1f}, serialización {d['serializacion_ms']:,.1f}\n"
+            texto += f"  SQL: {d['sentencias']:,} sentencias, {d['filas']:,} filas devueltas, "
+            texto += f"~{d['pasos_vm']:,} pasos VM — caché {d['cache_aciertos']:,} aciertos / {d['cache_fallos']:,} fallos — "
+            texto += f"{d['bytes'] / 1024:,.1f} KB escritos\n"
+        texto += f"\n"
         
-        if hotel_id == 22:
-            texto += f"🚨 HOTEL FANTASMA DETECTADO\n"
-            texto += f"Este hotel NO EXISTE en el inventario pero tiene restricciones activas.\n"
-            texto += f"ACCIÓN REQUERIDA: Limpiar configuración inmediatamente.\n\n"
-        elif hotel_id == 5481:
-            texto += f"🏨 GUITART CENTRAL PARK AQUA RESORT\n"
-            texto += f"Ubicación: Lloret de Mar, España\n"
-            texto += f"Problema: Room mapping 'DBL|2P·CLASSIC' faltante\n\n"
+        if sentencias:
+            texto += f"🧮 SENTENCIAS CON MÁS TIEMPO EN SQLITE:\n"
+            for f in sentencias:
+                texto += f"• {f['ms']:,.1f} ms en {f['ejecuciones']:,} ejecuciones (máx {f['max_ms']:,.1f}), "
+                texto += f"{f['filas']:,} filas, ~{f['pasos_vm']:,} pasos VM\n"
+                texto += f"  {' '.join(f['sql'].split())[:300]}\n"
+            texto += f"\n"
         
-        if restricciones:
-            texto += f"📊 RESTRICCIONES:\n"
-            for row in restricciones:
-                tipo = row["restriction_type"]
-                cantidad = row["cantidad"]
-                texto += f"• {tipo}: {cantidad:,} veces\n"
-        else:
-            texto += f"✅ Sin restricciones registradas\n"
+        texto += f"🐢 CONSULTAS LENTAS (≥ {self.metricas.umbral_lenta_ms:g} ms, más recientes primero):\n"
+        if not lentas:
+            texto += f"• Ninguna\n"
+        for l in lentas:
+            texto += f"• [{l['fecha']}] {l['herramienta']}: {l['ms']:,.1f} ms, {l['filas']:,} filas, ~{l['pasos_vm']:,} pasos VM\n"
+            texto += f"  {' '.join(l['sql'].split())[:300]}\n"
+            if l["parametros"]:
+                texto += f"  Parámetros: {json.dumps(l['parametros'], default=str)[:200]}\n"
+            for paso in l["plan"] or []:
+                texto += f"  📋 {paso}\n"
         
-        if excepciones:
-            texto += f"\n⚡ EXCEPCIONES:\n"
-            for row in excepciones:
-                tipo = row["exception_type"][:60] + "..." if len(row["exception_type"]) > 60 else row["exception_type"]
-                cantidad = row["cantidad"]
-                texto += f"• {tipo}: {cantidad:,} veces\n"
+        if perfiles or self.metricas.perfil_umbral_ms > 0:
+            texto += f"\n📸 PERFILES cProfile (llamadas > {self.metricas.perfil_umbral_ms:g} ms):\n"
+            if not perfiles:
+                texto += f"• Ninguno todavía\n"
+            for p in perfiles:
+                texto += f"• [{p['fecha']}] {p['herramienta']}: {p['ms']:,.0f} ms → {p['fichero']}\n"
         
         return {
             "content": [
@@ -403,182 +4968,829 @@ class SmartPerlahubMCP:
                 }
             ]
         }
+
+# Protocolo MCP simplificado
+async def abrir_stdin():
+    """StreamReader asíncrono sobre stdin (hilo lector si no es un pipe)"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=LIMITE_LINEA)
     
-    async def _problemas_criticos(self, args):
-        incluir_sql = args.get("incluir_sql", True)
+    modo = os.fstat(sys.stdin.fileno()).st_mode
+    if sys.platform != "win32" and (stat.S_ISFIFO(modo) or stat.S_ISSOCK(modo)):
+        protocolo = asyncio.StreamReaderProtocol(reader)
+        await loop.connect_read_pipe(lambda: protocolo, sys.stdin)
+        return reader
+    
+    # Windows, ficheros o terminales: alimentar el reader desde un hilo
+    def alimentar():
+        for linea in iter(sys.stdin.buffer.readline, b""):
+            loop.call_soon_threadsafe(reader.feed_data, linea)
+        loop.call_soon_threadsafe(reader.feed_eof)
+    
+    threading.Thread(target=alimentar, name="smartperlahub-stdin", daemon=True).start()
+    return reader
+
+
+def responder(mensaje):
+    """Encola un mensaje JSON-RPC para stdout y devuelve los bytes que ocupa"""
+    datos = codificar_json(mensaje) + b"\n"
+    SALIDA.escribir(datos)
+    return len(datos)
+
+
+def respuesta_error(msg_id, codigo, mensaje):
+    return {
+        "jsonrpc": "2.0",
+        "id": msg_id,
+        "error": {
+            "code": codigo,
+            "message": mensaje
+        }
+    }
+
+
+def id_mensaje(message):
+    """id válido de un mensaje (para responder a un mensaje mal formado) o None"""
+    msg_id = message.get("id") if isinstance(message, dict) else None
+    if isinstance(msg_id, bool) or not isinstance(msg_id, (str, int)):
+        return None
+    return msg_id
+
+
+def es_respuesta(message):
+    """Respuesta enviada por el cliente: el servidor no hace peticiones y la ignora"""
+    return isinstance(message, dict) and "method" not in message and ("result" in message or "error" in message)
+
+
+def validar_mensaje(message):
+    """Comprueba la forma de una petición o notificación JSON-RPC 2.0"""
+    if not isinstance(message, dict):
+        raise ErrorJSONRPC(SOLICITUD_INVALIDA, "El mensaje debe ser un objeto JSON")
+    if message.get("jsonrpc") != "2.0":
+        raise ErrorJSONRPC(SOLICITUD_INVALIDA, "Falta \"jsonrpc\": \"2.0\"")
+    if not isinstance(message.get("method"), str):
+        raise ErrorJSONRPC(SOLICITUD_INVALIDA, "Falta 'method'")
+    msg_id = message.get("id")
+    if msg_id is not None and (isinstance(msg_id, bool) or not isinstance(msg_id, (str, int))):
+        raise ErrorJSONRPC(SOLICITUD_INVALIDA, "'id' debe ser un texto o un entero")
+
+
+async def atender_mensaje(server, message, sesion):
+    """Ejecuta una petición JSON-RPC de una sesión y devuelve su respuesta y
+    su medición"""
+    method = message["method"]
+    params = message.get("params")
+    msg_id = message.get("id")
+    medicion = None
+    
+    try:
+        if params is None:
+            params = {}
+        elif not isinstance(params, dict):
+            raise ErrorJSONRPC(PARAMETROS_INVALIDOS, "'params' debe ser un objeto")
         
-        texto = f"PROBLEMAS CRÍTICOS IDENTIFICADOS\n"
-        texto += f"================================\n\n"
-        
-        texto += f"🚨 1. HOTEL 22 - HOTEL FANTASMA\n"
-        texto += f"   Problema: 72,787 exclusiones de hotel inexistente\n"
-        texto += f"   Impacto: 99.7% de todas las restricciones\n"
-        texto += f"   Estado: CRÍTICO - Requiere acción inmediata\n"
-        
-        if incluir_sql:
-            texto += f"   Solución SQL:\n"
-            texto += f"   UPDATE partners.\"ProviderConnections\" \n"
-            texto += f"   SET \"ExcludeHotelIds\" = REPLACE(\"ExcludeHotelIds\", '22,', '')\n"
-            texto += f"   WHERE \"ExcludeHotelIds\" LIKE '%22%';\n"
-        
-        texto += f"\n🏨 2. HOTEL 5481 - ROOM MAPPING ERROR\n"
-        texto += f"   Hotel: Guitart Central Park Aqua Resort\n"
-        texto += f"   Problema: 4,374 errores mapeo 'DBL|2P·CLASSIC'\n"
-        texto += f"   Impacto: 99.8% de todas las excepciones\n"
-        texto += f"   Estado: URGENTE - Mapeo faltante\n"
-        
-        if incluir_sql:
-            texto += f"   Solución SQL:\n"
-            texto += f"   INSERT INTO mapping.\"RoomMappings\" \n"
-            texto += f"   (\"IntegrationSystemId\", \"ExternalId\", \"RoomTypeId\")\n"
-            texto += f"   VALUES (1, 'DBL|2P·CLASSIC', '[ID_ROOM_TYPE]');\n"
-        
-        texto += f"\n📊 3. PERFORMANCE ISSUES\n"
-        texto += f"   Problema: Búsquedas de hasta 24.9 segundos\n"
-        texto += f"   Causa: Posible stress testing\n"
-        texto += f"   Estado: MONITOR - Implementar alertas\n\n"
+        # Procesar mensaje
+        if method == "initialize":
+            result = await server.handle_initialize(params)
+        elif method == "ping":
+            result = {}
+        elif method == "tools/list":
+            result = await server.handle_tools_list(params)
+        elif method == "tools/call":
+            if server.herramienta_publicada(params.get("name")):
+                medicion = Medicion(params["name"])
+            clave = sesion.clave(msg_id) if msg_id is not None else None
+            result = await server.handle_tools_call(params, clave, medicion)
+        elif method == "resources/list":
+            result = await server.handle_resources_list(params)
+        elif method == "resources/read":
+            result = await server.handle_resources_read(params)
+        elif method == "resources/subscribe":
+            result = await server.handle_resources_subscribe(params, sesion)
+        elif method == "resources/unsubscribe":
+            result = await server.handle_resources_unsubscribe(params, sesion)
+        else:
+            raise ErrorJSONRPC(METODO_NO_ENCONTRADO, f"Método no encontrado: {method}")
         
-        texto += f"PLAN DE ACCIÓN:\n"
-        texto += f"• Inmediato (0-2h): Ejecutar SQL para Hotel 22 y 5481\n"
-        texto += f"• Urgente (2-8h): Implementar monitoreo en tiempo real\n"
-        texto += f"• Seguimiento: Migrar a PostgreSQL y dashboards\n"
+        # Responder
+        response = {
+            "jsonrpc": "2.0",
+            "id": msg_id,
+            "result": result
+        }
+    except asyncio.CancelledError:
+        # Petición cancelada por el cliente: no se responde
+        raise
+    except ErrorJSONRPC as e:
+        response = respuesta_error(msg_id, e.codigo, str(e))
+    except Exception as e:
+        response = respuesta_error(msg_id, ERROR_INTERNO, str(e))
+    return response, medicion
+
+
+def codificar_respuesta(server, response, medicion):
+    """Bytes de la respuesta; registra la medición de tools/call con el
+    tiempo de serialización y el tamaño"""
+    inicio = time.perf_counter()
+    datos = codificar_json(response)
+    if medicion is not None:
+        medicion.serializacion_ms = (time.perf_counter() - inicio) * 1000
+        medicion.bytes = len(datos)
+        medicion.error = medicion.error or "error" in response
+        server.metricas.registrar(medicion)
+    return datos
+
+
+def escribir_linea(datos):
+    """Encola en stdout un mensaje ya codificado (una línea por mensaje)"""
+    SALIDA.escribir(datos + b"\n")
+
+
+class Sesion:
+    """Un cliente MCP (el de stdio o una sesión HTTP): sus peticiones en
+    curso, que se cancelan por id, y los recursos a los que está suscrito"""
+    
+    def __init__(self, server, nombre="stdio"):
+        self.server = server
+        self.id = nombre
+        self.tareas = set()
+        self.en_curso = {}
+        self.suscripciones = set()
+        server.sesiones.add(self)
+    
+    def clave(self, msg_id):
+        """Clave de la petición en el servidor: los id solo son únicos por sesión"""
+        return (self.id, msg_id)
+    
+    def notificar(self, mensaje):
+        """Envía al cliente una notificación del servidor"""
+        responder(mensaje)
+    
+    async def atender(self, message):
+        return await atender_mensaje(self.server, message, self)
+    
+    def cancelar(self, request_id):
+        """notifications/cancelled: aborta el SQL y la tarea de la petición"""
+        self.server.cancelar_solicitud(self.clave(request_id))
+        tarea = self.en_curso.pop(request_id, None)
+        if tarea is not None:
+            tarea.cancel()
+    
+    def _terminar(self, msg_id, tarea):
+        self.tareas.discard(tarea)
+        if msg_id is not None and self.en_curso.get(msg_id) is tarea:
+            del self.en_curso[msg_id]
+    
+    def despachar(self, message, escribir=None):
+        """Tarea que atiende una petición; None para notificaciones (que no
+        se responden). Con `escribir`, la tarea le pasa los bytes de la
+        respuesta; sin él, devuelve la respuesta y su medición"""
+        if "id" not in message:
+            if message["method"] == "notifications/cancelled":
+                request_id = (message.get("params") or {}).get("requestId")
+                if isinstance(request_id, (str, int)):
+                    self.cancelar(request_id)
+            return None
         
-        return {
-            "content": [
-                {
-                    "type": "text",
-                    "text": texto
-                }
-            ]
+        msg_id = message["id"]
+        if msg_id is not None and msg_id in self.en_curso:
+            # Un id repetido mientras el primero sigue en curso: la cancelación
+            # y la limpieza de esa petición acabarían apuntando a la nueva
+            atencion = respuesta_inmediata(respuesta_error(
+                msg_id, SOLICITUD_INVALIDA, f"Ya hay una petición en curso con id {msg_id}"
+            ))
+            msg_id = None
+        else:
+            atencion = self.atender(message)
+        if escribir is None:
+            tarea = asyncio.ensure_future(atencion)
+        else:
+            tarea = asyncio.ensure_future(procesar_mensaje(self.server, atencion, escribir))
+        self.tareas.add(tarea)
+        if msg_id is not None:
+            self.en_curso[msg_id] = tarea
+        tarea.add_done_callback(functools.partial(self._terminar, msg_id))
+        return tarea
+    
+    def cerrar(self):
+        """Cancela lo que quede en curso y deja de recibir notificaciones"""
+        for request_id in list(self.en_curso):
+            self.cancelar(request_id)
+        self.server.sesiones.discard(self)
+
+
+async def respuesta_inmediata(response):
+    """Atención de una petición que se responde sin ejecutarla"""
+    return response, None
+
+
+async def procesar_mensaje(server, atencion, escribir):
+    """Espera la atención de un mensaje JSON-RPC y escribe su respuesta (en
+    cualquier orden)"""
+    response, medicion = await atencion
+    escribir(codificar_respuesta(server, response, medicion))
+
+
+def recibir_lote(sesion, mensajes):
+    """Valida y despacha los elementos de un lote JSON-RPC: (respuestas ya
+    resueltas por errores de validación, tareas de las peticiones)"""
+    errores, tareas = [], []
+    for elemento in mensajes:
+        if es_respuesta(elemento):
+            continue
+        try:
+            validar_mensaje(elemento)
+        except ErrorJSONRPC as e:
+            errores.append(respuesta_error(id_mensaje(elemento), e.codigo, str(e)))
+            continue
+        tarea = sesion.despachar(elemento)
+        if tarea is not None:
+            tareas.append(tarea)
+    return errores, tareas
+
+
+async def responder_lote(server, respuestas, tareas):
+    """Un solo array JSON con las respuestas de un lote: las ya resueltas y
+    las de sus tareas (None si no hay nada que responder)"""
+    partes = [codificar_json(response) for response in respuestas]
+    resultados = await asyncio.gather(*tareas, return_exceptions=True)
+    for resultado in resultados:
+        if isinstance(resultado, BaseException):
+            # cancelada por el cliente o fallo inesperado: sin respuesta
+            continue
+        response, medicion = resultado
+        partes.append(codificar_respuesta(server, response, medicion))
+    if not partes:
+        return None
+    return b"[" + b",".join(partes) + b"]"
+
+
+async def procesar_lote(server, respuestas, tareas):
+    """Escribe en stdout las respuestas de un lote JSON-RPC"""
+    datos = await responder_lote(server, respuestas, tareas)
+    if datos is not None:
+        escribir_linea(datos)
+
+
+async def vigilar(server):
+    """Comprueba cada VIGILAR_INTERVALO s si hay filas nuevas (actualiza tablas
+    derivadas y caché) y notifica a las sesiones suscritas"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(server.intervalo_vigilancia)
+        try:
+            await loop.run_in_executor(server.executor_fondo, server.mantener)
+        except Exception:
+            continue
+        for uri in server.recursos_actualizados():
+            for sesion in list(server.sesiones):
+                if uri in sesion.suscripciones:
+                    sesion.notificar({
+                        "jsonrpc": "2.0",
+                        "method": "notifications/resources/updated",
+                        "params": {"uri": uri}
+                    })
+
+
+async def volcar_metricas(server):
+    """Escribe las métricas en METRICAS_FICHERO cada METRICAS_INTERVALO s"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(server.intervalo_metricas)
+        try:
+            await loop.run_in_executor(None, server.volcar_metricas)
+        except OSError:
+            continue
+
+
+# Transporte HTTP (streamable HTTP de MCP)
+ESTADOS_HTTP = {
+    200: "OK",
+    202: "Accepted",
+    204: "No Content",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    406: "Not Acceptable",
+    409: "Conflict",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    429: "Too Many Requests",
+    503: "Service Unavailable",
+}
+
+CABECERA_SESION = "Mcp-Session-Id"
+
+# Métodos que pasan por el límite de peticiones simultáneas de cada sesión
+METODOS_LIMITADOS = ("tools/call", "resources/read")
+
+
+class ErrorHTTP(Exception):
+    """Petición HTTP rechazada; el cuerpo es un error JSON-RPC sin id"""
+    
+    def __init__(self, estado, mensaje, cabeceras=None, codigo=SOLICITUD_INVALIDA):
+        super().__init__(mensaje)
+        self.estado = estado
+        self.cabeceras = cabeceras or {}
+        self.codigo = codigo
+
+
+class PeticionHTTP:
+    """Petición HTTP/1.1 ya leída (cabeceras en minúsculas)"""
+    
+    def __init__(self, metodo, ruta, version, cabeceras, cuerpo):
+        self.metodo = metodo
+        self.ruta = ruta
+        self.version = version
+        self.cabeceras = cabeceras
+        self.cuerpo = cuerpo
+    
+    @property
+    def mantener(self):
+        """True si la conexión sigue abierta para la siguiente petición"""
+        conexion = self.cabeceras.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return conexion == "keep-alive"
+        return conexion != "close"
+    
+    def acepta(self, tipo):
+        aceptados = self.cabeceras.get("accept", "")
+        return not aceptados or tipo in aceptados or "*/*" in aceptados
+
+
+async def leer_cuerpo_troceado(reader, limite):
+    """Cuerpo con Transfer-Encoding: chunked"""
+    partes, total = [], 0
+    while True:
+        linea = await reader.readline()
+        try:
+            tamano = int(linea.split(b";")[0].strip(), 16)
+        except ValueError:
+            raise ErrorHTTP(400, "Trozo no válido en el cuerpo")
+        if tamano == 0:
+            # Cabeceras finales (trailers) hasta la línea vacía
+            while (await reader.readline()).strip():
+                pass
+            return b"".join(partes)
+        total += tamano
+        if total > limite:
+            raise ErrorHTTP(413, "Cuerpo demasiado grande")
+        partes.append(await reader.readexactly(tamano))
+        await reader.readline()
+
+
+async def leer_peticion_http(reader, limite):
+    """Lee una petición HTTP/1.1; None si el cliente ha cerrado la conexión"""
+    linea = await reader.readline()
+    if linea in (b"\r\n", b"\n"):
+        # Se tolera una línea vacía entre peticiones
+        linea = await reader.readline()
+    if not linea:
+        return None
+    partes = linea.decode("latin-1").split()
+    if len(partes) != 3 or not partes[2].startswith("HTTP/"):
+        raise ErrorHTTP(400, "Línea de petición no válida")
+    metodo, destino, version = partes
+    
+    cabeceras = {}
+    while True:
+        linea = await reader.readline()
+        if not linea:
+            return None
+        if not linea.strip():
+            break
+        nombre, separador, valor = linea.decode("latin-1").partition(":")
+        if not separador:
+            raise ErrorHTTP(400, "Cabecera no válida")
+        cabeceras[nombre.strip().lower()] = valor.strip()
+    
+    if "chunked" in cabeceras.get("transfer-encoding", "").lower():
+        cuerpo = await leer_cuerpo_troceado(reader, limite)
+    else:
+        try:
+            longitud = int(cabeceras.get("content-length", "0"))
+        except ValueError:
+            raise ErrorHTTP(400, "Content-Length no válido")
+        if longitud > limite:
+            raise ErrorHTTP(413, "Cuerpo demasiado grande")
+        cuerpo = await reader.readexactly(longitud) if longitud > 0 else b""
+    return PeticionHTTP(metodo.upper(), urlsplit(destino).path, version.upper(), cabeceras, cuerpo)
+
+
+def respuesta_http(estado, cuerpo=b"", cabeceras=None, cerrar=False):
+    """Bytes de una respuesta HTTP/1.1 (Content-Length salvo si va troceada)"""
+    cabeceras = dict(cabeceras or {})
+    if "Transfer-Encoding" not in cabeceras and estado != 204:
+        cabeceras["Content-Length"] = str(len(cuerpo))
+    if cerrar:
+        cabeceras["Connection"] = "close"
+    lineas = [f"HTTP/1.1 {estado} {ESTADOS_HTTP.get(estado, '')}"]
+    lineas += [f"{nombre}: {valor}" for nombre, valor in cabeceras.items()]
+    return ("\r\n".join(lineas) + "\r\n\r\n").encode("latin-1") + cuerpo
+
+
+class SesionHTTP(Sesion):
+    """Sesión de un cliente HTTP: ejecuta como mucho `concurrencia`
+    peticiones a la vez y guarda sus notificaciones hasta que las lee su
+    stream SSE (una cola acotada: con un cliente lento se descartan)"""
+    
+    def __init__(self, server, concurrencia, notificaciones=256):
+        super().__init__(server, secrets.token_hex(16))
+        self.limite = asyncio.Semaphore(concurrencia)
+        self.cola = asyncio.Queue(maxsize=notificaciones)
+        self.stream = None
+        self.activa = True
+        self.descartadas = 0
+        self.ultimo_uso = time.monotonic()
+    
+    async def atender(self, message):
+        try:
+            if message["method"] not in METODOS_LIMITADOS:
+                return await atender_mensaje(self.server, message, self)
+            async with self.limite:
+                return await atender_mensaje(self.server, message, self)
+        finally:
+            self.ultimo_uso = time.monotonic()
+    
+    def notificar(self, mensaje):
+        try:
+            self.cola.put_nowait(mensaje)
+        except asyncio.QueueFull:
+            self.descartadas += 1
+    
+    def cerrar(self):
+        super().cerrar()
+        self.activa = False
+        # Despierta al stream SSE para que termine
+        if self.cola.full():
+            self.cola.get_nowait()
+        self.cola.put_nowait(None)
+
+
+class ServidorHTTP:
+    """Transporte streamable HTTP de MCP en un único endpoint
+    (MCP_HTTP_RUTA): los mensajes JSON-RPC llegan por POST y un GET abre el
+    stream SSE con las notificaciones de la sesión. Todas las sesiones
+    comparten el mismo SmartPerlahubMCP: pool de conexiones, caché de
+    resultados, rollups y pool de hilos"""
+    
+    def __init__(self, server):
+        self.server = server
+        self.host = os.getenv('MCP_HTTP_HOST', '127.0.0.1')
+        self.puerto = int(os.getenv('MCP_HTTP_PUERTO', '8765'))
+        self.ruta = os.getenv('MCP_HTTP_RUTA', '/mcp')
+        self.token = os.getenv('MCP_HTTP_TOKEN', '')
+        self.origenes = {
+            origen.strip().rstrip("/")
+            for origen in os.getenv('MCP_HTTP_ORIGENES', '').split(",") if origen.strip()
         }
+        # Límites por sesión: peticiones ejecutándose a la vez y admitidas
+        # (en ejecución o esperando turno) antes de responder 429
+        self.concurrencia = max(1, int(os.getenv('MCP_HTTP_CONCURRENCIA', '4')))
+        self.cola = max(self.concurrencia, int(os.getenv('MCP_HTTP_COLA', '32')))
+        self.max_sesiones = max(1, int(os.getenv('MCP_HTTP_SESIONES', '64')))
+        self.ttl_sesion = float(os.getenv('MCP_HTTP_SESION_TTL', '1800'))
+        self.latido = float(os.getenv('MCP_HTTP_LATIDO', '15'))
+        self.sesiones = {}
+        self._conexiones = set()
+        self._contadores = dict.fromkeys(("peticiones", "rechazadas", "creadas", "caducadas"), 0)
+        self._servidor = None
+        server.http = self
     
-    async def _consulta_sql(self, args):
-        query = args["query"].strip()
-        limite = int(args.get("limite", 100))
+    @property
+    def url(self):
+        host = f"[{self.host}]" if ":" in self.host else self.host
+        return f"http://{host}:{self.puerto}{self.ruta}"
+    
+    async def iniciar(self):
+        self._servidor = await asyncio.start_server(self._atender_conexion, self.host, self.puerto)
+        # Con MCP_HTTP_PUERTO=0 el sistema elige un puerto libre
+        self.puerto = self._servidor.sockets[0].getsockname()[1]
+        return self
+    
+    async def cerrar(self):
+        self._servidor.close()
+        for sesion in list(self.sesiones.values()):
+            self._cerrar_sesion(sesion)
+        for writer in list(self._conexiones):
+            writer.close()
+        await self._servidor.wait_closed()
+    
+    def estadisticas(self):
+        sesiones = list(self.sesiones.values())
+        return dict(
+            self._contadores,
+            sesiones=len(sesiones),
+            streams=sum(1 for sesion in sesiones if sesion.stream is not None),
+            en_curso=sum(len(sesion.tareas) for sesion in sesiones),
+            descartadas=sum(sesion.descartadas for sesion in sesiones),
+        )
+    
+    async def _atender_conexion(self, reader, writer):
+        """Peticiones de una conexión (keep-alive) hasta que se cierra"""
+        self._conexiones.add(writer)
+        try:
+            while True:
+                try:
+                    peticion = await leer_peticion_http(reader, LIMITE_LINEA)
+                except ErrorHTTP as e:
+                    # El resto de la conexión no se puede interpretar: se cierra
+                    writer.write(self._respuesta_error(e, cerrar=True))
+                    await writer.drain()
+                    break
+                if peticion is None:
+                    break
+                self._contadores["peticiones"] += 1
+                try:
+                    seguir = await self._atender(peticion, writer)
+                except ErrorHTTP as e:
+                    writer.write(self._respuesta_error(e))
+                    seguir = True
+                await writer.drain()
+                if not seguir or not peticion.mantener:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Cliente desconectado, cuerpo incompleto o línea demasiado larga
+            pass
+        finally:
+            self._conexiones.discard(writer)
+            writer.close()
+    
+    def _respuesta_error(self, error, cerrar=False):
+        cuerpo = codificar_json(respuesta_error(None, error.codigo, str(error)))
+        cabeceras = dict(error.cabeceras, **{"Content-Type": "application/json"})
+        return respuesta_http(error.estado, cuerpo, cabeceras, cerrar)
+    
+    async def _atender(self, peticion, writer):
+        """Atiende una petición; False si después hay que cerrar la conexión"""
+        if peticion.ruta != self.ruta:
+            raise ErrorHTTP(404, f"Ruta desconocida: {peticion.ruta}")
+        self._autorizar(peticion)
+        if peticion.metodo == "POST":
+            writer.write(await self._post(peticion))
+            return True
+        if peticion.metodo == "GET":
+            await self._stream(peticion, writer)
+            return False
+        if peticion.metodo == "DELETE":
+            self._cerrar_sesion(self._sesion(peticion))
+            writer.write(respuesta_http(204))
+            return True
+        raise ErrorHTTP(405, f"Método HTTP no admitido: {peticion.metodo}", {"Allow": "GET, POST, DELETE"})
+    
+    def _autorizar(self, peticion):
+        """Origin (contra DNS rebinding desde un navegador) y token Bearer"""
+        origen = peticion.cabeceras.get("origin")
+        if origen and origen.rstrip("/") not in self.origenes:
+            if urlsplit(origen).hostname not in ("localhost", "127.0.0.1", "::1"):
+                raise ErrorHTTP(403, f"Origen no permitido: {origen}")
+        if self.token:
+            recibido = peticion.cabeceras.get("authorization", "").encode("latin-1")
+            if not hmac.compare_digest(recibido, f"Bearer {self.token}".encode("latin-1")):
+                raise ErrorHTTP(401, "Token no válido", {"WWW-Authenticate": "Bearer"})
+    
+    def _sesion(self, peticion):
+        sesion_id = peticion.cabeceras.get(CABECERA_SESION.lower())
+        if not sesion_id:
+            raise ErrorHTTP(400, f"Falta la cabecera {CABECERA_SESION}")
+        sesion = self.sesiones.get(sesion_id)
+        if sesion is None:
+            raise ErrorHTTP(404, "Sesión desconocida o caducada: hay que repetir initialize")
+        sesion.ultimo_uso = time.monotonic()
+        return sesion
+    
+    def _nueva_sesion(self):
+        self._caducar_sesiones()
+        if len(self.sesiones) >= self.max_sesiones:
+            raise ErrorHTTP(503, "Demasiadas sesiones abiertas", {"Retry-After": "5"}, SERVIDOR_OCUPADO)
+        sesion = SesionHTTP(self.server, self.concurrencia)
+        self.sesiones[sesion.id] = sesion
+        self._contadores["creadas"] += 1
+        return sesion
+    
+    def _caducar_sesiones(self):
+        """Cierra las sesiones sin uso desde hace MCP_HTTP_SESION_TTL s"""
+        limite = time.monotonic() - self.ttl_sesion
+        for sesion in list(self.sesiones.values()):
+            if sesion.ultimo_uso < limite and not sesion.tareas and sesion.stream is None:
+                self._cerrar_sesion(sesion)
+                self._contadores["caducadas"] += 1
+    
+    def _cerrar_sesion(self, sesion):
+        if self.sesiones.pop(sesion.id, None) is not None:
+            sesion.cerrar()
+    
+    def _admitir(self, sesion, nuevas):
+        """Backpressure: 429 si la sesión superaría MCP_HTTP_COLA peticiones
+        pendientes (el cliente reintenta tras Retry-After)"""
+        if nuevas and len(sesion.tareas) + nuevas > self.cola:
+            self._contadores["rechazadas"] += 1
+            raise ErrorHTTP(
+                429, f"Demasiadas peticiones pendientes en la sesión (máximo {self.cola})",
+                {"Retry-After": "1"}, SERVIDOR_OCUPADO,
+            )
+    
+    async def _post(self, peticion):
+        if not peticion.acepta("application/json"):
+            raise ErrorHTTP(406, "El cliente debe aceptar application/json")
+        tipo = peticion.cabeceras.get("content-type", "application/json")
+        if "json" not in tipo.lower():
+            raise ErrorHTTP(415, "Content-Type debe ser application/json")
+        try:
+            message = decodificar_json(peticion.cuerpo)
+        except ValueError:
+            raise ErrorHTTP(400, "JSON no válido", codigo=ERROR_PARSEO)
         
-        if not query.lower().strip().startswith("select"):
-            return {
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Error: Solo se permiten consultas SELECT"
-                    }
-                ]
-            }
+        cabeceras = {}
+        inicio = (
+            isinstance(message, dict) and message.get("method") == "initialize"
+            and CABECERA_SESION.lower() not in peticion.cabeceras
+        )
+        if inicio:
+            # Solo un initialize bien formado crea la sesión
+            try:
+                validar_mensaje(message)
+            except ErrorJSONRPC as e:
+                raise ErrorHTTP(400, str(e), codigo=e.codigo)
+            if "id" not in message:
+                raise ErrorHTTP(400, "initialize debe llevar 'id'")
+            sesion = self._nueva_sesion()
+            cabeceras[CABECERA_SESION] = sesion.id
+        else:
+            sesion = self._sesion(peticion)
+        datos = await self._responder(sesion, message)
+        if datos is None:
+            return respuesta_http(202, cabeceras=cabeceras)
+        cabeceras["Content-Type"] = "application/json"
+        return respuesta_http(200, datos, cabeceras)
+    
+    async def _responder(self, sesion, message):
+        """Bytes de la respuesta JSON-RPC a un POST (None si solo trae
+        notificaciones, respuestas o peticiones canceladas)"""
+        if isinstance(message, list):
+            if not message:
+                return codificar_json(respuesta_error(None, SOLICITUD_INVALIDA, "Lote vacío"))
+            self._admitir(sesion, sum(1 for elemento in message if isinstance(elemento, dict) and "id" in elemento))
+            errores, tareas = recibir_lote(sesion, message)
+            return await responder_lote(self.server, errores, tareas)
         
-        prohibidas = ["insert", "update", "delete", "drop", "create", "alter"]
-        query_lower = query.lower()
-        for palabra in prohibidas:
-            if palabra in query_lower:
-                return {
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": f"Error: Operación '{palabra}' no permitida"
-                        }
-                    ]
-                }
+        if es_respuesta(message):
+            return None
+        try:
+            validar_mensaje(message)
+        except ErrorJSONRPC as e:
+            return codificar_json(respuesta_error(id_mensaje(message), e.codigo, str(e)))
+        self._admitir(sesion, 1 if "id" in message else 0)
+        tarea = sesion.despachar(message)
+        if tarea is None:
+            return None
+        # wait() no propaga a la tarea la cancelación de esta corrutina
+        await asyncio.wait({tarea})
+        if tarea.cancelled():
+            return None
+        response, medicion = tarea.result()
+        return codificar_respuesta(self.server, response, medicion)
+    
+    async def _stream(self, peticion, writer):
+        """GET: stream SSE con las notificaciones de la sesión; un comentario
+        cada MCP_HTTP_LATIDO s detecta los clientes desconectados"""
+        if "text/event-stream" not in peticion.cabeceras.get("accept", ""):
+            raise ErrorHTTP(405, "GET solo abre el stream SSE (Accept: text/event-stream)", {"Allow": "GET, POST, DELETE"})
+        sesion = self._sesion(peticion)
+        if sesion.stream is not None:
+            raise ErrorHTTP(409, "La sesión ya tiene un stream SSE abierto")
+        sesion.stream = writer
+        writer.write(respuesta_http(200, cabeceras={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "Transfer-Encoding": "chunked",
+        }))
+        try:
+            while sesion.activa:
+                try:
+                    mensaje = await asyncio.wait_for(sesion.cola.get(), self.latido)
+                except asyncio.TimeoutError:
+                    evento = b": ping\n\n"
+                else:
+                    if mensaje is None:
+                        break
+                    evento = b"event: message\ndata: " + codificar_json(mensaje) + b"\n\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(evento), evento))
+                # Backpressure: no se acumula salida para un cliente lento
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+        finally:
+            if sesion.stream is writer:
+                sesion.stream = None
+                sesion.ultimo_uso = time.monotonic()
+
+
+async def servir_stdio(server):
+    """Bucle de stdio: un único cliente, una línea JSON-RPC por mensaje"""
+    reader = await abrir_stdin()
+    sesion = Sesion(server)
+    
+    while True:
+        try:
+            # Leer línea de stdin
+            line = await reader.readline()
+        except ValueError:
+            # Línea mayor que LIMITE_LINEA: se descarta
+            continue
+        if not line:
+            break
+        if not line.strip():
+            continue
+        
+        try:
+            message = decodificar_json(line)
+        except ValueError:
+            responder(respuesta_error(None, ERROR_PARSEO, "JSON no válido"))
+            continue
         
-        if "limit" not in query_lower:
-            query += f" LIMIT {limite}"
+        if isinstance(message, list):
+            if not message:
+                responder(respuesta_error(None, SOLICITUD_INVALIDA, "Lote vacío"))
+                continue
+            errores, tareas_lote = recibir_lote(sesion, message)
+            if errores or tareas_lote:
+                tarea = asyncio.ensure_future(procesar_lote(server, errores, tareas_lote))
+                sesion.tareas.add(tarea)
+                tarea.add_done_callback(sesion.tareas.discard)
+            continue
         
+        if es_respuesta(message):
+            continue
         try:
-            conn = self.get_db_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute(query)
-            results = cursor.fetchall()
-            
-            conn.close()
-            
-            if not results:
-                texto = "No se encontraron resultados."
-            else:
-                headers = list(results[0].keys())
-                texto = f"RESULTADOS DE CONSULTA ({len(results)} filas):\n"
-                texto += "=" * 50 + "\n\n"
-                
-                for i, row in enumerate(results):
-                    texto += f"Fila {i+1}:\n"
-                    for header in headers:
-                        valor = row[header]
-                        texto += f"  {header}: {valor}\n"
-                    texto += "\n"
-            
-            return {
-                "content": [
-                    {
-                        "type": "text",
-                        "text": texto
-                    }
-                ]
-            }
-            
-        except Exception as e:
-            return {
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Error en consulta SQL: {str(e)}"
-                    }
-                ]
-            }
+            validar_mensaje(message)
+        except ErrorJSONRPC as e:
+            responder(respuesta_error(id_mensaje(message), e.codigo, str(e)))
+            continue
+        sesion.despachar(message, escribir_linea)
+    
+    # EOF: terminar las peticiones pendientes antes de salir
+    if sesion.tareas:
+        await asyncio.gather(*sesion.tareas, return_exceptions=True)
+    sesion.cerrar()
+
+
+async def servir_http(server):
+    """Servidor streamable HTTP hasta recibir SIGINT/SIGTERM"""
+    http = await ServidorHTTP(server).iniciar()
+    print(f"SmartPerlahub MCP escuchando en {http.url}", file=sys.stderr, flush=True)
+    
+    parar = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(senal, parar.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: Ctrl+C llega como KeyboardInterrupt
+            pass
+    try:
+        await parar.wait()
+    finally:
+        await http.cerrar()
+
 
-# Protocolo MCP simplificado
 async def main():
-    """Servidor MCP usando stdio"""
+    """Servidor MCP por stdio o, con MCP_TRANSPORTE=http, por streamable HTTP"""
+    transporte = os.getenv('MCP_TRANSPORTE', 'stdio').lower()
+    if transporte not in ("stdio", "http"):
+        raise ValueError(f"MCP_TRANSPORTE debe ser 'stdio' o 'http', no '{transporte}'")
     server = SmartPerlahubMCP()
     
-    while True:
+    # Revisión de índices en segundo plano: initialize responde al instante
+    loop = asyncio.get_running_loop()
+    provision = loop.run_in_executor(server.executor, server.provisionar)
+    vigilancia = None
+    if server.intervalo_vigilancia > 0:
+        vigilancia = asyncio.ensure_future(vigilar(server))
+    volcado = None
+    if server.fichero_metricas and server.intervalo_metricas > 0:
+        volcado = asyncio.ensure_future(volcar_metricas(server))
+    
+    if transporte == "http":
+        await servir_http(server)
+    else:
+        await servir_stdio(server)
+    
+    await asyncio.gather(provision, return_exceptions=True)
+    if vigilancia is not None:
+        vigilancia.cancel()
+        await asyncio.gather(vigilancia, return_exceptions=True)
+    if volcado is not None:
+        volcado.cancel()
+        await asyncio.gather(volcado, return_exceptions=True)
+    if server.fichero_metricas:
         try:
-            # Leer línea de stdin
-            line = sys.stdin.readline()
-            if not line:
-                break
-            
-            try:
-                message = json.loads(line.strip())
-            except json.JSONDecodeError:
-                continue
-            
-            method = message.get("method", "")
-            params = message.get("params", {})
-            msg_id = message.get("id")
-            
-            # Procesar mensaje
-            if method == "initialize":
-                result = await server.handle_initialize(params)
-            elif method == "tools/list":
-                result = await server.handle_tools_list(params)
-            elif method == "tools/call":
-                result = await server.handle_tools_call(params)
-            else:
-                result = {"error": f"Unknown method: {method}"}
-            
-            # Responder
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": result
-            }
-            
-            print(json.dumps(response))
-            sys.stdout.flush()
-            
-        except EOFError:
-            break
-        except Exception as e:
-            # Error response
-            error_response = {
-                "jsonrpc": "2.0",
-                "id": message.get("id") if 'message' in locals() else None,
-                "error": {
-                    "code": -1,
-                    "message": str(e)
-                }
-            }
-            print(json.dumps(error_response))
-            sys.stdout.flush()
+            server.volcar_metricas()
+        except OSError:
+            pass
+    SALIDA.vaciar()
+    server.cerrar()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+SmartPerlahub - Generador de datos sintéticos para pruebas de rendimiento
+
+Crea una base de datos con el esquema de smartperlahub_ingest.py y rellena las
+6 tablas de auditoría con distribuciones sesgadas como las de la muestra real
+(87.425 filas en escala 1): el hotel 22 acapara las exclusiones por conexión,
+el mapeo 'DBL|2P·CLASSIC' del hotel 5481 casi todas las excepciones, los
+hoteles de las búsquedas siguen una ley de Zipf y las latencias por proveedor
+son log-normales con cola de timeouts. Las filas se insertan en orden de fecha
+(como llegan los logs) con un perfil diario de tráfico y un pico del hotel 22
+en la última hora, y al terminar se crean los índices y las tablas derivadas.
+
+Con la misma semilla y escala el resultado es siempre el mismo.
+
+Uso:
+    python3 smartperlahub_sintetico.py --db bench_1x.db
+    python3 smartperlahub_sintetico.py --db bench_10x.db --escala 10 --dias 7
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import smartperlahub_ingest as ingest
+import smartperlahub_mcp_fixed as servidor
+
+# Filas por tabla en escala 1 (smartperlahub_report.json)
+FILAS_BASE = {
+    "restrictions": 72787,
+    "exceptions": 4382,
+    "client_searches": 5000,
+    "provider_searches": 1128,
+    "connector_searches": 3000,
+    "logins": 1128,
+}
+
+HOTELES = 6000
+HOTEL_FANTASMA = 22
+HOTEL_MAPEO = 5481
+HABITACION_MAPEO = "DBL|2P·CLASSIC"
+
+# Cuota del caso dominante en cada tabla (como en los datos reales)
+CUOTA_HOTEL_FANTASMA = 0.967
+CUOTA_ERROR_MAPEO = 0.985
+
+RESTRICCIONES = [
+    ("ExcludeHotelByConnection", 90),
+    ("ExcludeProvider", 4),
+    ("ExcludeHotelByClient", 3),
+    ("MinimumStay", 2),
+    ("ReleaseDays", 1),
+]
+
+# Proveedor: (peso, mediana en ms, sigma de la log-normal)
+PROVEEDORES = {
+    "TGX-HOB": (40, 650, 0.6),
+    "TGX-SMD": (30, 420, 0.5),
+    "TGX-DNG": (20, 900, 0.8),
+    "TGX-YPL": (10, 1500, 1.0),
+}
+CONECTORES = {
+    "HOB": (45, 300, 0.5),
+    "SMD": (30, 250, 0.5),
+    "DNG": (15, 500, 0.7),
+    "YPL": (10, 800, 0.9),
+}
+TIMEOUT_MS = 30000
+CUOTA_TIMEOUT = 0.004
+
+HABITACIONES = ["DBL|2P·CLASSIC", "SGL|STD", "TWN|CLASSIC", "DBL|SUP", "JSU|SEA", "TPL|STD", "FAM|2A2C"]
+USUARIOS = 200
+
+# Tráfico relativo por hora del día (mínimo de madrugada, máximo a media tarde)
+PERFIL_DIARIO = [0.35 + 0.65 * math.sin(math.pi * max(0, h - 5) / 19) ** 2 for h in range(24)]
+
+
+def _cuotas_zipf(n, s=1.1):
+    """Pesos acumulados de una ley de Zipf sobre n elementos"""
+    acumulado, total = [], 0.0
+    for k in range(1, n + 1):
+        total += 1.0 / k ** s
+        acumulado.append(total)
+    return acumulado
+
+
+def _elegir(rng, pesos):
+    """Elección ponderada sobre [(valor, peso)] o {valor: (peso, ...)}"""
+    if isinstance(pesos, dict):
+        pesos = [(clave, valores[0]) for clave, valores in pesos.items()]
+    valores = [valor for valor, _ in pesos]
+    return rng.choices(valores, weights=[peso for _, peso in pesos])[0]
+
+
+class Generador:
+    """Filas sintéticas con las columnas de smartperlahub_ingest.COLUMNAS"""
+
+    def __init__(self, escala=1, dias=1, inicio="2025-07-31T00:00:00", semilla=1):
+        self.escala = escala
+        self.dias = dias
+        self.inicio = datetime.fromisoformat(inicio)
+        self.rng = random.Random(semilla)
+        # Orden de popularidad de los hoteles (el 22 y el 5481 fuera del sorteo)
+        self.hoteles = [h for h in range(1, HOTELES + 1) if h not in (HOTEL_FANTASMA, HOTEL_MAPEO)]
+        self.rng.shuffle(self.hoteles)
+        self.zipf_hoteles = _cuotas_zipf(len(self.hoteles))
+        self.zipf_usuarios = _cuotas_zipf(USUARIOS, 1.3)
+
+    def filas_tabla(self, tabla):
+        return int(round(FILAS_BASE[tabla] * self.escala))
+
+    def _traza(self):
+        valor = "%032x" % self.rng.getrandbits(128)
+        return f"{valor[:8]}-{valor[8:12]}-{valor[12:16]}-{valor[16:20]}-{valor[20:]}"
+
+    def _hotel(self):
+        return self.rng.choices(self.hoteles, cum_weights=self.zipf_hoteles)[0]
+
+    def _hotel_busqueda(self):
+        sorteo = self.rng.random()
+        if sorteo < 0.08:
+            return HOTEL_FANTASMA
+        if sorteo < 0.12:
+            return HOTEL_MAPEO
+        return self._hotel()
+
+    def instantes(self, n, pico=1.0):
+        """n fechas ISO en orden creciente repartidas por el perfil diario; `pico`
+        multiplica el tráfico de la última hora"""
+        horas = 24 * self.dias
+        pesos = [PERFIL_DIARIO[h % 24] for h in range(horas)]
+        pesos[-1] *= pico
+        total = sum(pesos)
+        restantes = n
+        for h, peso in enumerate(pesos):
+            cantidad = restantes if h == horas - 1 else min(restantes, int(round(n * peso / total)))
+            restantes -= cantidad
+            base = self.inicio + timedelta(hours=h)
+            for segundos in sorted(self.rng.random() * 3600 for _ in range(cantidad)):
+                yield (base + timedelta(seconds=segundos)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+    def restrictions(self):
+        # El hotel 22 concentra el pico final: el motor de anomalías lo detecta
+        for fecha in self.instantes(self.filas_tabla("restrictions"), pico=1.5):
+            if self.rng.random() < CUOTA_HOTEL_FANTASMA:
+                hotel, tipo = HOTEL_FANTASMA, "ExcludeHotelByConnection"
+            else:
+                hotel, tipo = self._hotel(), _elegir(self.rng, RESTRICCIONES)
+            contexto = {"HotelId": hotel, "ConnectionId": self.rng.randint(1, 5), "Restriction": tipo}
+            yield (self._traza(), tipo, json.dumps(contexto), hotel, fecha)
+
+    def _excepcion(self):
+        """(exception_type, mensaje, contexto) con la cola de errores variados"""
+        if self.rng.random() < CUOTA_ERROR_MAPEO:
+            hotel, habitacion = HOTEL_MAPEO, HABITACION_MAPEO
+        else:
+            hotel, habitacion = self._hotel(), self.rng.choice(HABITACIONES)
+            sorteo = self.rng.random()
+            proveedor = _elegir(self.rng, PROVEEDORES)
+            if sorteo < 0.3:
+                tipo = f"Timeout after {self.rng.randint(5, 60) * 1000} ms calling {proveedor}"
+                return tipo, tipo + " at Perlatours.Search.ProviderClient.Send()", {
+                    "HotelId": hotel, "Provider": proveedor}
+            if sorteo < 0.45:
+                tipo = "System.NullReferenceException"
+                return tipo, "Object reference not set to an instance of an object. at Perlatours.Search.Pricing.Apply()", {
+                    "HotelId": hotel, "TraceStep": self.rng.randint(1, 9)}
+            if sorteo < 0.6:
+                tipo = f"Hotel {hotel} not found in provider {proveedor}"
+                return tipo, tipo + " at Perlatours.Mapping.HotelMapper.Resolve()", {
+                    "HotelId": hotel, "Provider": proveedor}
+        tipo = f"Room mapping failed for '{habitacion}' hotel {hotel}"
+        return tipo, tipo + " at Perlatours.Mapping.RoomMapper.Map()", {
+            "HotelId": hotel, "Room": habitacion, "Provider": "TGX-SMD"}
+
+    def exceptions(self):
+        for fecha in self.instantes(self.filas_tabla("exceptions")):
+            tipo, mensaje, contexto = self._excepcion()
+            yield (self._traza(), tipo, mensaje, json.dumps(contexto), fecha,
+                   servidor.huella_excepcion(tipo))
+
+    def _busqueda(self, opciones=None):
+        hotel = self._hotel_busqueda()
+        if opciones:
+            nombre = _elegir(self.rng, opciones)
+            _, mediana, sigma = opciones[nombre]
+        else:
+            nombre, mediana, sigma = None, 1200, 0.7
+        if self.rng.random() < CUOTA_TIMEOUT:
+            duracion = TIMEOUT_MS
+        else:
+            duracion = min(TIMEOUT_MS, int(self.rng.lognormvariate(math.log(mediana), sigma)))
+        noches = self.rng.randint(1, 14)
+        peticion = json.dumps({"HotelId": hotel, "Nights": noches, "Adults": self.rng.randint(1, 4)})
+        respuesta = json.dumps({"Hotels": 0 if hotel == HOTEL_FANTASMA else self.rng.randint(1, 40)})
+        return nombre, hotel, duracion, peticion, respuesta
+
+    def client_searches(self):
+        for fecha in self.instantes(self.filas_tabla("client_searches")):
+            _, hotel, duracion, peticion, respuesta = self._busqueda()
+            yield (self._traza(), hotel, duracion, peticion, respuesta, fecha)
+
+    def provider_searches(self):
+        for fecha in self.instantes(self.filas_tabla("provider_searches")):
+            proveedor, hotel, duracion, peticion, respuesta = self._busqueda(PROVEEDORES)
+            yield (self._traza(), proveedor, hotel, duracion, peticion, respuesta, fecha)
+
+    def connector_searches(self):
+        for fecha in self.instantes(self.filas_tabla("connector_searches")):
+            conector, hotel, duracion, peticion, respuesta = self._busqueda(CONECTORES)
+            yield (self._traza(), conector, hotel, duracion, peticion, respuesta, fecha)
+
+    def logins(self):
+        for fecha in self.instantes(self.filas_tabla("logins")):
+            usuario = self.rng.choices(range(1, USUARIOS + 1), cum_weights=self.zipf_usuarios)[0]
+            datos = {"User": f"agencia{usuario:03d}", "ClientId": usuario % 40 + 1}
+            yield (self._traza(), json.dumps(datos), fecha)
+
+
+def generar(db_path, escala=1, dias=1, inicio="2025-07-31T00:00:00", semilla=1,
+            derivados=True, filas_lote=50000, progreso=None):
+    """Crea db_path (no debe existir) con datos sintéticos; devuelve {tabla: filas}"""
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} ya existe")
+    generador = Generador(escala, dias, inicio, semilla)
+    conn = ingest.abrir_db(db_path)
+    insertadas = {}
+    try:
+        for tabla, columnas in ingest.COLUMNAS.items():
+            sentencia = f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join('?' for _ in columnas)})"
+            filas = getattr(generador, tabla)()
+            insertadas[tabla] = 0
+            conn.execute("BEGIN")
+            lote = []
+            for fila in filas:
+                lote.append(fila)
+                if len(lote) >= filas_lote:
+                    conn.executemany(sentencia, lote)
+                    insertadas[tabla] += len(lote)
+                    lote = []
+                    if progreso:
+                        progreso(tabla, insertadas[tabla])
+            conn.executemany(sentencia, lote)
+            insertadas[tabla] += len(lote)
+            conn.execute("COMMIT")
+        if derivados:
+            ingest._actualizar_derivados(conn, indices=True)
+    finally:
+        conn.close()
+    return insertadas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera una base de datos sintética de SmartPerlahub")
+    parser.add_argument("--db", required=True, help="Base de datos destino (no debe existir)")
+    parser.add_argument("--escala", type=float, default=1,
+                        help=f"Multiplicador de las {sum(FILAS_BASE.values()):,} filas de la muestra (p. ej. 1, 10, 100)")
+    parser.add_argument("--dias", type=int, default=1, help="Días que cubren los datos")
+    parser.add_argument("--inicio", default="2025-07-31T00:00:00", help="Fecha del primer registro")
+    parser.add_argument("--semilla", type=int, default=1, help="Semilla del generador aleatorio")
+    parser.add_argument("--sin-derivados", action="store_true",
+                        help="No crear índices ni tablas derivadas (los hará el servidor al arrancar)")
+    args = parser.parse_args(argv)
+
+    def progreso(tabla, filas):
+        print(f"  ... {tabla}: {filas:,} filas", file=sys.stderr)
+
+    inicio = time.perf_counter()
+    insertadas = generar(
+        args.db, escala=args.escala, dias=args.dias, inicio=args.inicio, semilla=args.semilla,
+        derivados=not args.sin_derivados, progreso=progreso,
+    )
+    print(f"✅ {sum(insertadas.values()):,} filas sintéticas en {args.db} "
+          f"({time.perf_counter() - inicio:.1f} s)")
+    for tabla, filas in insertadas.items():
+        print(f"• {tabla}: {filas:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+"""Llamadas a herramientas del servidor desde los tests"""
+
+import asyncio
+import json
+
+
+def llamar(server, herramienta, **argumentos):
+    """Resultado de tools/call (fuera de un bucle de eventos)"""
+    return asyncio.run(server.handle_tools_call({"name": herramienta, "arguments": argumentos}))
+
+
+def texto(resultado):
+    return resultado["content"][0]["text"]
+
+
+def json_resultado(server, herramienta, **argumentos):
+    """Resultado de una herramienta con formato json, ya decodificado"""
+    resultado = llamar(server, herramienta, formato="json", **argumentos)
+    assert not resultado.get("isError"), texto(resultado)
+    return json.loads(texto(resultado))
@@ -0,0 +1,67 @@
+"""Fixtures comunes: una base sintética pequeña (smartperlahub_sintetico.py)
+generada una vez por sesión y copiada para cada test que la modifica"""
+
+import os
+import shutil
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import smartperlahub_mcp_fixed as servidor  # noqa: E402
+import smartperlahub_sintetico as sintetico  # noqa: E402
+
+# ~4.400 filas: suficiente para anomalías, percentiles y paginación
+ESCALA = 0.05
+
+
+@pytest.fixture(scope="session")
+def db_base(tmp_path_factory):
+    ruta = tmp_path_factory.mktemp("sintetico") / "base.db"
+    sintetico.generar(str(ruta), escala=ESCALA)
+    return str(ruta)
+
+
+@pytest.fixture
+def db(db_base, tmp_path):
+    """Copia de la base sintética que el test puede modificar"""
+    ruta = tmp_path / "smartperlahub.db"
+    shutil.copy(db_base, ruta)
+    return str(ruta)
+
+
+@pytest.fixture
+def db_sin_derivados(tmp_path):
+    """Base sintética mínima sin índices ni tablas derivadas"""
+    ruta = tmp_path / "sin_derivados.db"
+    sintetico.generar(str(ruta), escala=0.01, derivados=False)
+    return str(ruta)
+
+
+@pytest.fixture
+def crear_servidor(monkeypatch):
+    """Crea servidores sobre DB_PATH con variables de entorno extra y los
+    cierra al terminar el test"""
+    creados = []
+    
+    def crear(db_path, provisionar=True, **entorno):
+        monkeypatch.setenv("DB_PATH", db_path)
+        for nombre, valor in entorno.items():
+            monkeypatch.setenv(nombre, str(valor))
+        server = servidor.SmartPerlahubMCP()
+        creados.append(server)
+        if provisionar:
+            server.provisionar()
+        return server
+    
+    yield crear
+    for server in creados:
+        server.cerrar()
+
+
+@pytest.fixture
+def server(db, crear_servidor):
+    return crear_servidor(db)
+
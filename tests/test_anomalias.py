@@ -0,0 +1,81 @@
+"""user-012: motor de anomalías (cuota y picos por hora) y sus pistas SQL"""
+
+import sqlite3
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado
+
+
+def horas(n):
+    return [f"2025-07-31T{h:02d}" for h in range(n)]
+
+
+def test_cuota():
+    conteos = {(22, hora): 90 for hora in horas(4)}
+    conteos.update({(7, hora): 10 for hora in horas(4)})
+    anomalias = servidor.detectar_anomalias("hotel", conteos, umbral_cuota=0.5, minimo=100)
+    assert [(a["entidad"], a["motivos"]) for a in anomalias] == [(22, ["cuota"])]
+    assert anomalias[0]["cuota"] == pytest.approx(0.9)
+    assert anomalias[0]["cantidad"] == 360
+
+
+def test_pico_en_la_ultima_hora():
+    conteos = {(7, hora): 100 for hora in horas(5)}
+    conteos[(7, horas(6)[-1])] = 400
+    conteos.update({(hotel, hora): 100 for hotel in range(1, 7) for hora in horas(6)})
+    anomalias = servidor.detectar_anomalias("hotel", conteos, umbral_cuota=0.9, umbral_z=3, minimo=100)
+    assert [(a["entidad"], a["motivos"]) for a in anomalias] == [(7, ["pico"])]
+    assert anomalias[0]["hora"] == horas(6)[-1]
+    assert anomalias[0]["cantidad_hora"] == 400
+    # Desviación mínima de Poisson: sqrt(100) = 10
+    assert anomalias[0]["z"] == pytest.approx(30)
+
+
+def test_minimo_de_filas():
+    conteos = {(22, hora): 5 for hora in horas(3)}
+    conteos[(22, "2025-07-31T03")] = 80
+    assert servidor.detectar_anomalias("hotel", conteos, minimo=100) == []
+    assert servidor.detectar_anomalias("hotel", conteos, minimo=10)
+
+
+def test_sin_horas_previas_no_hay_pico():
+    anomalias = servidor.detectar_anomalias("hotel", {(22, None): 500, (7, None): 10}, minimo=100)
+    assert anomalias[0]["motivos"] == ["cuota"] and anomalias[0]["z"] is None
+
+
+def test_problemas_criticos_detecta_los_datos_sinteticos(server):
+    filas = json_resultado(server, "problemas_criticos")["secciones"]["anomalias"]["filas"]
+    por_entidad = {(fila[0], fila[1]): fila for fila in filas}
+    hotel = por_entidad[("hotel", 22)]
+    assert hotel[8] == "ExcludeHotelByConnection"
+    assert "',22,'" in hotel[10]
+    assert por_entidad[("hotel_excepciones", 5481)][10].count("'DBL|2P·CLASSIC'") == 1
+
+
+def test_umbrales_por_llamada(server):
+    resultado = json_resultado(server, "problemas_criticos", umbral_cuota=0.99, umbral_z=1000)
+    assert resultado["secciones"]["anomalias"]["filas"] == []
+
+
+@pytest.mark.parametrize("excluidos, esperado", [
+    ("22", ""),
+    ("22,7", "7"),
+    ("7,22", "7"),
+    ("7,22,9", "7,9"),
+    ("122,220,2200", "122,220,2200"),
+    ("122,22,2200", "122,2200"),
+    ("2200,220,22", "2200,220"),
+])
+def test_sql_de_exclusion_solo_quita_el_hotel(excluidos, esperado):
+    _, plantilla = servidor.pista_anomalia("restriccion", "ExcludeHotelByConnection")
+    conn = sqlite3.connect(":memory:")
+    conn.execute("ATTACH ':memory:' AS partners")
+    # BTRIM de PostgreSQL
+    conn.create_function("BTRIM", 2, lambda texto, caracteres: texto.strip(caracteres))
+    conn.execute('CREATE TABLE partners."ProviderConnections" (id INTEGER, "ExcludeHotelIds" TEXT)')
+    conn.execute('INSERT INTO partners."ProviderConnections" VALUES (1, ?), (2, ?)', (excluidos, "122,2200"))
+    conn.execute(plantilla.format(hotel=22))
+    filas = dict(conn.execute('SELECT id, "ExcludeHotelIds" FROM partners."ProviderConnections"'))
+    assert filas == {1: esperado, 2: "122,2200"}
@@ -0,0 +1,98 @@
+"""user-015: buscar_excepciones con FTS5 y la cola de filas aún sin indexar"""
+
+import sqlite3
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado, llamar, texto
+
+
+def buscar(conn, texto_busqueda, **ventana):
+    conn.row_factory = sqlite3.Row
+    return servidor.AlmacenSQLite(None).coincidencias_fts(
+        conn, servidor.consulta_fts(texto_busqueda), servidor.VentanaTiempo(**ventana), 10
+    )
+
+
+def insertar_excepciones(db, mensajes, fecha="2025-08-01T00:00:00"):
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.executemany(
+            "INSERT INTO exceptions (trace_id, exception_type, exception_message, context_data, occurred_at) "
+            "VALUES ('t', ?, ?, '{}', ?)",
+            [(tipo, mensaje, fecha) for tipo, mensaje in mensajes],
+        )
+    conn.close()
+
+
+def coincidencias_like(db, frase):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute(
+            "SELECT COUNT(*) FROM exceptions WHERE exception_type LIKE ?1 OR exception_message LIKE ?1 "
+            "OR context_data LIKE ?1", (f"%{frase}%",)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("entrada, consulta", [
+    ("room mapping", '"room" "mapping"'),
+    ('"not found" mapp*', '"not found" "mapp"*'),
+    ("timeout OR mapping", '"timeout" OR "mapping"'),
+    ("AND timeout NOT", '"timeout"'),
+])
+def test_consulta_fts(entrada, consulta):
+    assert servidor.consulta_fts(entrada) == consulta
+
+
+def test_consulta_vacia():
+    with pytest.raises(ValueError):
+        servidor.consulta_fts("  OR ")
+
+
+def test_resultados_del_indice(server, db):
+    resultado = json_resultado(server, "buscar_excepciones", consulta='"mapping failed"')
+    assert resultado["coincidencias"] == coincidencias_like(db, "mapping failed") > 0
+    plantillas = resultado["secciones"]["plantillas"]["filas"]
+    assert plantillas[0][0] == "Room mapping failed for '<cod>' hotel <n>"
+    fragmentos = [fila[3] for fila in resultado["secciones"]["resultados"]["filas"]]
+    assert fragmentos and all("[mapping failed]" in fragmento for fragmento in fragmentos)
+
+
+def test_cola_sin_indexar_se_suma(server, db):
+    conn = sqlite3.connect(db)
+    indexadas = buscar(conn, '"mapping failed"')[0]
+    insertar_excepciones(db, [
+        ("Zarzaparrilla.Exception", "Room mapping failed for 'X' hotel 1"),
+        ("OtraException", "zarzaparrilla agotada"),
+    ])
+    marca = servidor.marca_agua(conn, servidor.TABLA_FTS)
+    assert marca < servidor.max_rowid(conn, "exceptions")
+
+    assert buscar(conn, '"mapping failed"')[0] == indexadas + 1
+    total, mejores, por_tipo = buscar(conn, "zarzaparrilla")
+    assert total == 2
+    assert por_tipo == {"Zarzaparrilla.Exception": 1, "OtraException": 1}
+    assert buscar(conn, "zarzaparrilla", hasta="2025-08-01T00:00:00")[0] == 0
+
+    # Una vez indexadas, el resultado es el mismo
+    conn.row_factory = None
+    servidor.actualizar_fts_excepciones(conn)
+    assert buscar(conn, "zarzaparrilla")[0] == 2
+    conn.close()
+
+
+def test_sin_indice_fts(crear_servidor, db_sin_derivados):
+    server = crear_servidor(db_sin_derivados, provisionar=False)
+    resultado = json_resultado(server, "buscar_excepciones", consulta='"mapping failed"')
+    assert resultado["coincidencias"] == coincidencias_like(db_sin_derivados, "mapping failed") > 0
+
+
+def test_cola_demasiado_grande(crear_servidor, db_sin_derivados, monkeypatch):
+    monkeypatch.setattr(servidor, "FTS_MAX_COLA", 10)
+    server = crear_servidor(db_sin_derivados, provisionar=False)
+    resultado = llamar(server, "buscar_excepciones", consulta="mapping")
+    assert resultado.get("isError")
+    assert "no disponible" in texto(resultado)
@@ -0,0 +1,101 @@
+"""user-006: caché LRU/TTL de resultados con invalidación por tabla"""
+
+import sqlite3
+import time
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado, llamar
+
+
+def test_lru_por_bytes():
+    cache = servidor.CacheResultados(capacidad_bytes=100, ttl=60)
+    cache.guardar("a", 1, 40)
+    cache.guardar("b", 2, 40)
+    assert cache.obtener("a") == 1
+    cache.guardar("c", 3, 40)
+    # "b" era la menos usada
+    assert cache.obtener("b") is None
+    assert cache.obtener("a") == 1 and cache.obtener("c") == 3
+    cache.guardar("enorme", 4, 101)
+    estadisticas = cache.estadisticas()
+    assert estadisticas["desalojos"] == 1
+    assert estadisticas["demasiado_grandes"] == 1
+    assert estadisticas["bytes"] == 80
+
+
+def test_ttl():
+    cache = servidor.CacheResultados(capacidad_bytes=100, ttl=0.05)
+    cache.guardar("a", 1, 10)
+    time.sleep(0.1)
+    assert cache.obtener("a") is None
+    assert cache.estadisticas()["expiradas"] == 1
+
+
+def test_desactivada():
+    cache = servidor.CacheResultados(capacidad_bytes=0)
+    cache.guardar("a", 1, 10)
+    assert cache.obtener("a") is None
+
+
+def test_invalidacion_por_tabla():
+    claves = [
+        ("analizar_restricciones", "{}"),
+        ("analizar_excepciones", "{}"),
+        ("analizar_latencias", "{}"),
+        ("resumen_sistema", "{}"),
+        ("consulta_sql", "{}"),
+    ]
+    afectadas = {clave[0] for clave in claves if servidor.entrada_afectada({"restrictions"}, clave)}
+    assert afectadas == {"analizar_restricciones", "resumen_sistema", "consulta_sql"}
+    # consulta_sql puede leer cualquier tabla, incluso sin cambios en las de auditoría
+    assert servidor.entrada_afectada(set(), ("consulta_sql", "{}"))
+    assert not servidor.entrada_afectada(set(), ("resumen_sistema", "{}"))
+
+
+def test_argumentos_equivalentes_comparten_entrada(server):
+    for hotel_id in (22, "22", 22.0):
+        llamar(server, "analizar_hotel", hotel_id=hotel_id)
+    llamar(server, "analizar_restricciones")
+    llamar(server, "analizar_restricciones", limite=50, formato="texto")
+    estadisticas = server.cache.estadisticas()
+    assert estadisticas["entradas"] == 2
+    assert estadisticas["aciertos"] == 3
+
+
+def test_filas_nuevas_invalidan_la_entrada(server, db):
+    antes = json_resultado(server, "analizar_restricciones")["total_restricciones"]
+    excepciones = json_resultado(server, "analizar_excepciones")
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.execute(
+            "INSERT INTO restrictions (trace_id, restriction_type, context_data, hotel_id, occurred_at) "
+            "VALUES ('t', 'ExcludeProvider', '{}', 22, '2025-07-31T23:59:59')"
+        )
+    conn.close()
+    assert json_resultado(server, "analizar_restricciones")["total_restricciones"] == antes + 1
+    aciertos = server.cache.estadisticas()["aciertos"]
+    # La entrada de excepciones no depende de restrictions: sigue en caché
+    assert json_resultado(server, "analizar_excepciones") == excepciones
+    assert server.cache.estadisticas()["aciertos"] == aciertos + 1
+
+
+def test_errores_no_se_cachean(server):
+    llamar(server, "analizar_restricciones", desde="2025-07-31T10:00", hasta="2025-07-31T09:00")
+    assert server.cache.estadisticas()["entradas"] == 0
+
+
+@pytest.mark.parametrize("herramienta, limite", [
+    ("analizar_restricciones", 0),
+    ("analizar_excepciones", -1),
+    ("analizar_latencias", 0.5),
+    ("buscar_excepciones", 0),
+    ("consulta_sql", -5),
+    ("metricas_servidor", 0),
+])
+def test_limite_minimo(server, herramienta, limite):
+    with pytest.raises(servidor.ErrorJSONRPC) as error:
+        llamar(server, herramienta, limite=limite, consulta="x", query="SELECT 1")
+    assert error.value.codigo == servidor.PARAMETROS_INVALIDOS
+    assert "limite" in str(error.value)
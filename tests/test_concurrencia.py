@@ -0,0 +1,118 @@
+"""user-001: peticiones atendidas en paralelo y cancelación por id"""
+
+import asyncio
+import json
+
+import smartperlahub_mcp_fixed as servidor
+
+# Consulta que tarda segundos: solo termina si se interrumpe
+CONSULTA_LENTA = (
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000000) "
+    "SELECT count(*) FROM c"
+)
+
+
+def peticion(msg_id, metodo, **params):
+    return {"jsonrpc": "2.0", "id": msg_id, "method": metodo, "params": params}
+
+
+def llamada(msg_id, herramienta, **argumentos):
+    return peticion(msg_id, "tools/call", name=herramienta, arguments=argumentos)
+
+
+def cancelacion(request_id):
+    return {"jsonrpc": "2.0", "method": "notifications/cancelled", "params": {"requestId": request_id}}
+
+
+class Cliente:
+    """Sesión en proceso que guarda las respuestas escritas por el servidor"""
+    
+    def __init__(self, server):
+        self.sesion = servidor.Sesion(server, "test")
+        self.respuestas = []
+    
+    def enviar(self, message):
+        return self.sesion.despachar(message, self._escribir)
+    
+    def _escribir(self, datos):
+        self.respuestas.append(json.loads(datos))
+    
+    def respuesta(self, msg_id):
+        return next((r for r in self.respuestas if r.get("id") == msg_id), None)
+
+
+def test_ping_no_espera_a_una_consulta_lenta(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_MAX_PASOS=0, CONSULTA_TIMEOUT=60)
+    
+    async def escenario():
+        cliente = Cliente(server)
+        lenta = cliente.enviar(llamada(1, "consulta_sql", query=CONSULTA_LENTA))
+        await asyncio.sleep(0.2)
+        await cliente.enviar(peticion(2, "ping"))
+        assert cliente.respuesta(2)["result"] == {}
+        assert not lenta.done()
+        
+        cliente.enviar(cancelacion(1))
+        await asyncio.wait([lenta], timeout=5)
+        assert lenta.done()
+        return cliente
+    
+    cliente = asyncio.run(escenario())
+    # La petición cancelada no se responde y no queda registrada
+    assert cliente.respuesta(1) is None
+    assert not server._solicitudes
+    assert not cliente.sesion.en_curso
+
+
+def test_cancelacion_interrumpe_el_sql(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_MAX_PASOS=0, CONSULTA_TIMEOUT=60)
+    
+    async def escenario():
+        tarea = asyncio.ensure_future(server.handle_tools_call(
+            {"name": "consulta_sql", "arguments": {"query": CONSULTA_LENTA}}, clave=("s", 7)
+        ))
+        await asyncio.sleep(0.2)
+        assert server.cancelar_solicitud(("s", 7))
+        return await asyncio.wait_for(tarea, 5)
+    
+    resultado = asyncio.run(escenario())
+    assert resultado["isError"]
+    assert "cancelada" in resultado["content"][0]["text"]
+
+
+def test_id_repetido_en_curso_se_rechaza(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_MAX_PASOS=0, CONSULTA_TIMEOUT=60)
+    
+    async def escenario():
+        cliente = Cliente(server)
+        primera = cliente.enviar(llamada(1, "consulta_sql", query=CONSULTA_LENTA))
+        await asyncio.sleep(0.1)
+        await cliente.enviar(llamada(1, "resumen_sistema"))
+        error = cliente.respuesta(1)["error"]
+        assert error["code"] == servidor.SOLICITUD_INVALIDA
+        # La cancelación sigue apuntando a la primera petición
+        assert cliente.sesion.en_curso[1] is primera
+        cliente.enviar(cancelacion(1))
+        await asyncio.wait([primera], timeout=5)
+        assert primera.done()
+        return cliente
+    
+    cliente = asyncio.run(escenario())
+    assert len(cliente.respuestas) == 1
+    assert not server._solicitudes
+
+
+def test_ids_iguales_en_sesiones_distintas(crear_servidor, db):
+    server = crear_servidor(db)
+    
+    async def escenario():
+        uno, otro = Cliente(server), Cliente(server)
+        uno.sesion.id, otro.sesion.id = "a", "b"
+        await asyncio.gather(
+            uno.enviar(llamada(1, "resumen_sistema")),
+            otro.enviar(llamada(1, "analizar_hotel", hotel_id=22)),
+        )
+        return uno, otro
+    
+    uno, otro = asyncio.run(escenario())
+    assert "result" in uno.respuesta(1) and "result" in otro.respuesta(1)
@@ -0,0 +1,91 @@
+"""user-007: consulta_sql paginada con tokens de continuación"""
+
+import sqlite3
+import time
+
+from ayudas import json_resultado, llamar, texto
+
+CONSULTA = "SELECT rowid, hotel_id, occurred_at FROM restrictions ORDER BY rowid LIMIT 250"
+
+
+def paginas(server, limite, **argumentos):
+    pagina = json_resultado(server, "consulta_sql", query=CONSULTA, limite=limite, **argumentos)
+    resultado = [pagina]
+    while "continuacion" in pagina:
+        pagina = json_resultado(server, "consulta_sql", continuacion=pagina["continuacion"], limite=limite)
+        resultado.append(pagina)
+    return resultado
+
+
+def test_paginas_completas_y_en_orden(server, db):
+    leidas = paginas(server, 100)
+    assert [p["filas_pagina"] for p in leidas] == [100, 100, 50]
+    assert [p["desde_fila"] for p in leidas] == [1, 101, 201]
+    filas = [tuple(fila) for pagina in leidas for fila in pagina["filas"]]
+    conn = sqlite3.connect(db)
+    try:
+        assert filas == conn.execute(CONSULTA).fetchall()
+    finally:
+        conn.close()
+    assert leidas[0]["columnas"][1:] == ["hotel_id", "occurred_at"]
+    assert server.cursores.abiertos() == 0
+
+
+def test_una_pagina_usa_el_pool(crear_servidor, db):
+    server = crear_servidor(db, DB_POOL_SIZE=1, CACHE_MB=0)
+    for _ in range(5):
+        pagina = json_resultado(server, "consulta_sql", query="SELECT count(*) FROM logins")
+        assert "continuacion" not in pagina
+    estadisticas = server.pool.estadisticas()
+    assert estadisticas["abiertas"] == 1
+    assert estadisticas["separadas"] == 0
+    # La conexión vuelve al pool sin el autorizador de solo lectura
+    assert not llamar(server, "analizar_hotel", hotel_id=22).get("isError")
+    with server.pool.conexion() as conn:
+        assert conn.execute("SELECT count(*) FROM logins").fetchone()[0] > 0
+
+
+def test_el_cursor_pendiente_separa_su_conexion(crear_servidor, db):
+    server = crear_servidor(db, DB_POOL_SIZE=1, CACHE_MB=0)
+    primera = json_resultado(server, "consulta_sql", query=CONSULTA, limite=10)
+    assert "continuacion" in primera
+    assert server.pool.estadisticas()["separadas"] == 1
+    # El pool sigue atendiendo otras herramientas con el cursor abierto
+    assert not llamar(server, "analizar_hotel", hotel_id=22).get("isError")
+    siguiente = json_resultado(server, "consulta_sql", continuacion=primera["continuacion"], limite=10)
+    assert siguiente["desde_fila"] == 11
+
+
+def test_token_desconocido(server):
+    resultado = llamar(server, "consulta_sql", continuacion="no-existe")
+    assert resultado["isError"]
+    assert "continuación" in texto(resultado)
+
+
+def test_token_de_un_solo_uso(server):
+    primera = json_resultado(server, "consulta_sql", query=CONSULTA, limite=10)
+    llamar(server, "consulta_sql", continuacion=primera["continuacion"])
+    assert llamar(server, "consulta_sql", continuacion=primera["continuacion"])["isError"]
+
+
+def test_cursores_acotados_y_caducados(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_CURSORES=1, CONSULTA_CURSOR_TTL=0.2)
+    primera = json_resultado(server, "consulta_sql", query=CONSULTA, limite=10)
+    segunda = json_resultado(server, "consulta_sql", query=CONSULTA + " OFFSET 1", limite=10)
+    assert server.cursores.abiertos() == 1
+    # El cursor más antiguo se cierra para dejar sitio al nuevo
+    assert llamar(server, "consulta_sql", continuacion=primera["continuacion"])["isError"]
+    time.sleep(0.3)
+    assert llamar(server, "consulta_sql", continuacion=segunda["continuacion"])["isError"]
+    assert server.cursores.abiertos() == 0
+
+
+def test_limite_acotado_por_consulta_max_filas(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_MAX_FILAS=30)
+    assert json_resultado(server, "consulta_sql", query=CONSULTA, limite=1000)["filas_pagina"] == 30
+
+
+def test_texto_indica_la_continuacion(server):
+    resultado = texto(llamar(server, "consulta_sql", query=CONSULTA, limite=2))
+    assert "(2 filas, 1-2)" in resultado
+    assert "Continuación:" in resultado
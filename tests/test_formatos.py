@@ -0,0 +1,67 @@
+"""user-008: salida estructurada (json, csv, ndjson) de las herramientas"""
+
+import csv
+import io
+import json
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado, llamar, texto
+
+SECCIONES = [
+    ("a", ["x", "y"], [(1, "uno"), (2, b"\x00\x01")]),
+    ("b", ["z"], [(None,)]),
+]
+
+
+def test_json_una_seccion():
+    documento = json.loads(servidor.serializar("json", SECCIONES[:1], {"total": 2}))
+    assert documento == {"columnas": ["x", "y"], "filas": [[1, "uno"], [2, "AAE="]], "total": 2}
+
+
+def test_json_varias_secciones():
+    documento = json.loads(servidor.serializar("json", SECCIONES))
+    assert documento["secciones"]["b"] == {"columnas": ["z"], "filas": [[None]]}
+
+
+def test_csv():
+    salida = servidor.serializar("csv", SECCIONES[:1], {"total": 2})
+    lineas = salida.splitlines()
+    assert list(csv.reader(io.StringIO("\n".join(lineas[:3])))) == [["x", "y"], ["1", "uno"], ["2", "AAE="]]
+    assert lineas[-1] == "# total: 2"
+    assert "# b" in servidor.serializar("csv", SECCIONES)
+
+
+def test_ndjson():
+    lineas = servidor.serializar("ndjson", SECCIONES, {"total": 3}).splitlines()
+    objetos = [json.loads(linea) for linea in lineas]
+    assert objetos[0] == {"x": 1, "y": "uno", "_seccion": "a"}
+    assert objetos[-1] == {"_meta": {"total": 3}}
+    assert servidor.serializar("ndjson", [("a", ["x"], [])]) == ""
+
+
+def test_formato_desconocido():
+    with pytest.raises(ValueError):
+        servidor.serializar("xml", SECCIONES)
+
+
+@pytest.mark.parametrize("herramienta, argumentos", [
+    ("analizar_restricciones", {}),
+    ("analizar_excepciones", {}),
+    ("resumen_sistema", {}),
+    ("analizar_hotel", {"hotel_id": 22}),
+    ("problemas_criticos", {}),
+    ("analizar_latencias", {}),
+    ("buscar_excepciones", {"consulta": "mapping"}),
+    ("consulta_sql", {"query": "SELECT hotel_id, count(*) FROM restrictions GROUP BY hotel_id LIMIT 5"}),
+])
+def test_formatos_coinciden(server, herramienta, argumentos):
+    documento = json_resultado(server, herramienta, **argumentos)
+    filas_json = documento["filas"] if "filas" in documento else [
+        fila for seccion in documento["secciones"].values() for fila in seccion["filas"]
+    ]
+    lineas = texto(llamar(server, herramienta, formato="ndjson", **argumentos)).splitlines()
+    filas_ndjson = [json.loads(linea) for linea in lineas if not linea.startswith('{"_meta"')]
+    assert len(filas_ndjson) == len(filas_json)
+    assert texto(llamar(server, herramienta, formato="csv", **argumentos))
@@ -0,0 +1,115 @@
+"""user-004: exception_hotels con los hoteles de context_data"""
+
+import json
+import sqlite3
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado, llamar, texto
+
+
+@pytest.mark.parametrize("context_data, hoteles", [
+    ('{"HotelId": 22}', {22}),
+    ('{"hotel_id": "22", "Provider": "TGX"}', {22}),
+    ('{"Request": {"HotelCode": 5481}}', {5481}),
+    ('{"HotelIds": [1, "2", 3]}', {1, 2, 3}),
+    ('{"HotelId": true, "Nights": 22}', set()),
+    ('HotelId=122; provider TGX', {122}),
+    ('hotel: 2200', {2200}),
+    ("", set()),
+    (None, set()),
+])
+def test_extraer_hoteles(context_data, hoteles):
+    assert servidor.extraer_hoteles(context_data) == hoteles
+
+
+def insertar_excepciones(db, filas):
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.executemany(
+            "INSERT INTO exceptions (trace_id, exception_type, exception_message, context_data, occurred_at) "
+            "VALUES ('t', ?, 'm', ?, '2025-07-31T23:59:00')",
+            filas,
+        )
+    conn.close()
+
+
+def excepciones_hotel(server, hotel_id):
+    filas = json_resultado(server, "analizar_hotel", hotel_id=hotel_id)["secciones"]["excepciones"]["filas"]
+    return dict(filas)
+
+
+def test_hotel_22_no_cuenta_122_ni_2200(server, db):
+    antes = excepciones_hotel(server, 22)
+    insertar_excepciones(db, [
+        ("Prueba hotel 122", json.dumps({"HotelId": 122})),
+        ("Prueba hotel 2200", json.dumps({"HotelId": 2200})),
+        ("Prueba hotel 220", "HotelId=220"),
+        ("Prueba hotel 22", json.dumps({"HotelIds": [22, 122]})),
+    ])
+    despues = excepciones_hotel(server, 22)
+    nuevas = {tipo: cantidad - antes.get(tipo, 0) for tipo, cantidad in despues.items()}
+    assert {tipo for tipo, cantidad in nuevas.items() if cantidad} == {"Prueba hotel 22"}
+    assert excepciones_hotel(server, 122) == {"Prueba hotel 122": 1, "Prueba hotel 22": 1}
+
+
+def test_marca_agua_incremental(db):
+    conn = sqlite3.connect(db)
+    try:
+        servidor.actualizar_derivados(conn)
+        antes = conn.execute("SELECT count(*) FROM exception_hotels").fetchone()[0]
+        assert servidor.actualizar_exception_hotels(conn) == 0
+        conn.execute(
+            "INSERT INTO exceptions (trace_id, exception_type, exception_message, context_data, occurred_at) "
+            "VALUES ('t', 'x', 'm', '{\"HotelId\": 9}', '2025-07-31T23:59:00')"
+        )
+        conn.commit()
+        assert servidor.actualizar_exception_hotels(conn) == 1
+        assert conn.execute("SELECT count(*) FROM exception_hotels").fetchone()[0] == antes + 1
+        assert servidor.marca_agua(conn, "exception_hotels") == servidor.max_rowid(conn, "exceptions")
+    finally:
+        conn.close()
+
+
+def test_las_peticiones_no_actualizan_las_derivadas(server, db):
+    conn = sqlite3.connect(db)
+    marca = servidor.marca_agua(conn, "exception_hotels")
+    insertar_excepciones(db, [("Prueba hotel 7", json.dumps({"HotelId": 7}))])
+    # La cola tras la marca de agua se suma al leer, sin escribir en las derivadas
+    assert excepciones_hotel(server, 7) == {"Prueba hotel 7": 1}
+    assert servidor.marca_agua(conn, "exception_hotels") == marca
+    # vigilar las pone al día en segundo plano
+    server.mantener()
+    assert servidor.marca_agua(conn, "exception_hotels") == servidor.max_rowid(conn, "exceptions")
+    assert excepciones_hotel(server, 7) == {"Prueba hotel 7": 1}
+    conn.close()
+
+
+def esquema(db):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute("SELECT type, name FROM sqlite_master ORDER BY name").fetchall()
+    finally:
+        conn.close()
+
+
+def test_sin_auto_derivados_no_se_escribe(db_sin_derivados, crear_servidor):
+    antes = esquema(db_sin_derivados)
+    server = crear_servidor(db_sin_derivados, DB_AUTO_INDICES=0)
+    assert not server.auto_derivados
+    insertar_excepciones(db_sin_derivados, [("Prueba hotel 7", json.dumps({"HotelId": 7}))])
+    assert excepciones_hotel(server, 7) == {"Prueba hotel 7": 1}
+    server.mantener()
+    assert esquema(db_sin_derivados) == antes
+
+    faltantes = {faltante["tabla"] for faltante in server.diagnostico["derivadas_faltantes"]}
+    assert {"exception_hotels", "rollup_restrictions", "derived_watermarks"} <= faltantes
+    informe = texto(llamar(server, "diagnostico_indices"))
+    assert "exception_hotels: faltante" in informe
+
+
+def test_auto_derivados_sin_auto_indices(db_sin_derivados, crear_servidor):
+    server = crear_servidor(db_sin_derivados, DB_AUTO_INDICES=0, DB_AUTO_DERIVADOS=1)
+    assert server.diagnostico["derivadas_faltantes"] == []
+    assert not any(indice["estado"] == "creado" for indice in server.diagnostico["indices"])
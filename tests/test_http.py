@@ -0,0 +1,231 @@
+"""user-022: transporte streamable HTTP (sesiones, 429, SSE, origen y token)"""
+
+import asyncio
+import json
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from test_concurrencia import CONSULTA_LENTA, llamada, peticion
+
+INICIO = peticion(0, "initialize", protocolVersion="2025-03-26", capabilities={},
+                  clientInfo={"name": "pytest", "version": "1"})
+
+
+class Respuesta:
+    def __init__(self, estado, cabeceras, cuerpo):
+        self.estado = estado
+        self.cabeceras = cabeceras
+        self.cuerpo = cuerpo
+
+    def json(self):
+        return json.loads(self.cuerpo)
+
+
+async def leer_respuesta(reader):
+    """Estado, cabeceras (en minúsculas) y cuerpo con Content-Length"""
+    estado = int((await reader.readline()).split()[1])
+    cabeceras = {}
+    while True:
+        linea = (await reader.readline()).decode("latin-1").strip()
+        if not linea:
+            break
+        nombre, _, valor = linea.partition(":")
+        cabeceras[nombre.strip().lower()] = valor.strip()
+    longitud = int(cabeceras.get("content-length", "0"))
+    cuerpo = await reader.readexactly(longitud) if longitud else b""
+    return Respuesta(estado, cabeceras, cuerpo)
+
+
+class ClienteHTTP:
+    """Conexión keep-alive con el ServidorHTTP en proceso"""
+
+    def __init__(self, http):
+        self.http = http
+        self.conexion = None
+
+    async def abrir(self):
+        self.conexion = await asyncio.open_connection(self.http.host, self.http.puerto)
+        return self
+
+    async def enviar(self, metodo, cuerpo=None, sesion=None, ruta=None, **cabeceras):
+        datos = b"" if cuerpo is None else cuerpo if isinstance(cuerpo, bytes) else json.dumps(cuerpo).encode()
+        enviadas = {"Host": "localhost", "Accept": "application/json, text/event-stream",
+                    "Content-Type": "application/json", "Content-Length": str(len(datos))}
+        if sesion:
+            enviadas[servidor.CABECERA_SESION] = sesion
+        enviadas.update((nombre.replace("_", "-"), valor) for nombre, valor in cabeceras.items())
+        lineas = [f"{metodo} {ruta or self.http.ruta} HTTP/1.1"]
+        lineas += [f"{nombre}: {valor}" for nombre, valor in enviadas.items()]
+        reader, writer = self.conexion
+        writer.write(("\r\n".join(lineas) + "\r\n\r\n").encode("latin-1") + datos)
+        await writer.drain()
+        return await leer_respuesta(reader)
+
+    async def iniciar(self):
+        respuesta = await self.enviar("POST", INICIO)
+        assert respuesta.estado == 200
+        return respuesta.cabeceras["mcp-session-id"]
+
+    def cerrar(self):
+        self.conexion[1].close()
+
+
+def con_http(server, escenario):
+    """Ejecuta escenario(http) con un ServidorHTTP en un puerto libre"""
+    async def ejecutar():
+        http = await servidor.ServidorHTTP(server).iniciar()
+        try:
+            return await escenario(http)
+        finally:
+            await http.cerrar()
+
+    return asyncio.run(ejecutar())
+
+
+@pytest.fixture
+def server_http(db, crear_servidor):
+    return crear_servidor(db, MCP_HTTP_PUERTO=0)
+
+
+def test_sesiones(server_http):
+    async def escenario(http):
+        cliente = await ClienteHTTP(http).abrir()
+        sesion = await cliente.iniciar()
+        otra = await cliente.iniciar()
+        assert sesion != otra and set(http.sesiones) == {sesion, otra}
+
+        respuesta = await cliente.enviar("POST", llamada(1, "resumen_sistema", formato="json"), sesion)
+        assert respuesta.estado == 200
+        assert json.loads(respuesta.json()["result"]["content"][0]["text"])["total_registros"] > 0
+        notificacion = {"jsonrpc": "2.0", "method": "notifications/initialized"}
+        assert (await cliente.enviar("POST", notificacion, sesion)).estado == 202
+        lote = await cliente.enviar("POST", [peticion(2, "ping"), peticion(3, "ping")], sesion)
+        assert sorted(r["id"] for r in lote.json()) == [2, 3]
+
+        # Sin sesión, con una desconocida o tras cerrarla
+        assert (await cliente.enviar("POST", peticion(4, "ping"))).estado == 400
+        assert (await cliente.enviar("POST", peticion(5, "ping"), "no-existe")).estado == 404
+        assert (await cliente.enviar("DELETE", sesion=sesion)).estado == 204
+        assert (await cliente.enviar("POST", peticion(6, "ping"), sesion)).estado == 404
+        assert set(http.sesiones) == {otra}
+        cliente.cerrar()
+
+    con_http(server_http, escenario)
+
+
+def test_errores_http(server_http):
+    async def escenario(http):
+        cliente = await ClienteHTTP(http).abrir()
+        sesion = await cliente.iniciar()
+        estados = [
+            (await cliente.enviar("POST", peticion(1, "ping"), sesion, ruta="/otra")).estado,
+            (await cliente.enviar("PUT", peticion(1, "ping"), sesion)).estado,
+            (await cliente.enviar("POST", b"{no es json", sesion)).estado,
+            (await cliente.enviar("POST", peticion(1, "ping"), sesion, Content_Type="text/plain")).estado,
+            (await cliente.enviar("GET", sesion=sesion, Accept="application/json")).estado,
+        ]
+        assert estados == [404, 405, 400, 415, 405]
+        respuesta = await cliente.enviar("POST", [], sesion)
+        assert respuesta.json()["error"]["code"] == servidor.SOLICITUD_INVALIDA
+        cliente.cerrar()
+
+    con_http(server_http, escenario)
+
+
+def test_429_con_la_cola_llena(crear_servidor, db):
+    server = crear_servidor(db, MCP_HTTP_PUERTO=0, MCP_HTTP_CONCURRENCIA=1, MCP_HTTP_COLA=1,
+                            CONSULTA_MAX_PASOS=0, CONSULTA_TIMEOUT=60)
+
+    async def escenario(http):
+        lenta, rapida = await ClienteHTTP(http).abrir(), await ClienteHTTP(http).abrir()
+        sesion = await lenta.iniciar()
+        consulta = asyncio.ensure_future(
+            lenta.enviar("POST", llamada(1, "consulta_sql", query=CONSULTA_LENTA), sesion)
+        )
+        await asyncio.sleep(0.2)
+        rechazada = await rapida.enviar("POST", llamada(2, "resumen_sistema"), sesion)
+        assert rechazada.estado == 429
+        assert rechazada.cabeceras["retry-after"] == "1"
+        assert rechazada.json()["error"]["code"] == servidor.SERVIDOR_OCUPADO
+        assert http.estadisticas()["rechazadas"] == 1
+
+        # Las notificaciones no ocupan sitio en la cola
+        cancelar = {"jsonrpc": "2.0", "method": "notifications/cancelled", "params": {"requestId": 1}}
+        assert (await rapida.enviar("POST", cancelar, sesion)).estado == 202
+        assert (await asyncio.wait_for(consulta, 5)).estado == 202
+        assert (await rapida.enviar("POST", llamada(3, "resumen_sistema"), sesion)).estado == 200
+        lenta.cerrar()
+        rapida.cerrar()
+
+    con_http(server, escenario)
+
+
+def test_stream_sse(server_http):
+    async def escenario(http):
+        cliente = await ClienteHTTP(http).abrir()
+        sesion = await cliente.iniciar()
+        reader, writer = await asyncio.open_connection(http.host, http.puerto)
+        writer.write((
+            f"GET {http.ruta} HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n"
+            f"Mcp-Session-Id: {sesion}\r\n\r\n"
+        ).encode())
+        cabecera = await leer_respuesta(reader)
+        assert cabecera.estado == 200
+        assert cabecera.cabeceras["content-type"] == "text/event-stream"
+        # Un segundo stream en la misma sesión se rechaza
+        assert (await cliente.enviar("GET", sesion=sesion, Accept="text/event-stream")).estado == 409
+
+        aviso = {"jsonrpc": "2.0", "method": "notifications/resources/updated",
+                 "params": {"uri": servidor.RECURSO_TABLA + "restrictions"}}
+        http.sesiones[sesion].notificar(aviso)
+        tamano = int(await reader.readline(), 16)
+        evento = await reader.readexactly(tamano)
+        await reader.readline()
+        assert evento == b"event: message\ndata: " + servidor.codificar_json(aviso) + b"\n\n"
+
+        # Cerrar la sesión termina el stream
+        assert (await cliente.enviar("DELETE", sesion=sesion)).estado == 204
+        assert await asyncio.wait_for(reader.read(), 5) == b"0\r\n\r\n"
+        writer.close()
+        cliente.cerrar()
+
+    con_http(server_http, escenario)
+
+
+def test_origen_y_token(db, crear_servidor):
+    server = crear_servidor(db, MCP_HTTP_PUERTO=0, MCP_HTTP_TOKEN="secreto",
+                            MCP_HTTP_ORIGENES="https://panel.example.com/")
+
+    async def escenario(http):
+        cliente = await ClienteHTTP(http).abrir()
+        sin_token = await cliente.enviar("POST", INICIO)
+        assert sin_token.estado == 401
+        assert sin_token.cabeceras["www-authenticate"] == "Bearer"
+        assert (await cliente.enviar("POST", INICIO, Authorization="Bearer otro")).estado == 401
+
+        autorizado = {"Authorization": "Bearer secreto"}
+        for origen, estado in [
+            ("https://malicioso.example.com", 403),
+            ("https://panel.example.com", 200),
+            ("http://localhost:3000", 200),
+        ]:
+            respuesta = await cliente.enviar("POST", INICIO, Origin=origen, **autorizado)
+            assert respuesta.estado == estado, origen
+        cliente.cerrar()
+
+    con_http(server, escenario)
+
+
+def test_limite_de_sesiones(crear_servidor, db):
+    server = crear_servidor(db, MCP_HTTP_PUERTO=0, MCP_HTTP_SESIONES=1)
+
+    async def escenario(http):
+        cliente = await ClienteHTTP(http).abrir()
+        await cliente.iniciar()
+        respuesta = await cliente.enviar("POST", INICIO)
+        assert respuesta.estado == 503
+        assert respuesta.cabeceras["retry-after"] == "5"
+        cliente.cerrar()
+
+    con_http(server, escenario)
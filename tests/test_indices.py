@@ -0,0 +1,62 @@
+"""user-003: asesor de índices con EXPLAIN QUERY PLAN"""
+
+import sqlite3
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import texto, llamar
+
+
+def estados(resultados):
+    return {resultado["nombre"]: resultado["estado"] for resultado in resultados}
+
+
+def test_crea_los_indices_que_faltan(db_sin_derivados):
+    conn = sqlite3.connect(db_sin_derivados)
+    try:
+        resultados = servidor.AsesorIndices(conn, escribible=True).diagnosticar()
+        creados = [r for r in resultados if r["estado"] == "creado"]
+        assert creados
+        for resultado in creados:
+            assert any(servidor.plan_con_recorrido_completo(plan, resultado["tabla"])
+                       for plan in resultado["plan_antes"])
+            assert not any(servidor.plan_con_recorrido_completo(plan, resultado["tabla"])
+                           for plan in resultado["plan_despues"])
+        
+        # Segunda pasada: nada que crear
+        segunda = estados(servidor.AsesorIndices(conn, escribible=True).diagnosticar())
+        assert "creado" not in segunda.values()
+        assert all(segunda[r["nombre"]] == "existente" for r in creados)
+    finally:
+        conn.close()
+
+
+def test_sin_escritura_solo_recomienda(db_sin_derivados):
+    conn = sqlite3.connect(db_sin_derivados)
+    try:
+        indices = "SELECT name FROM sqlite_master WHERE type = 'index' ORDER BY name"
+        antes = conn.execute(indices).fetchall()
+        resultados = servidor.AsesorIndices(conn, escribible=False).diagnosticar()
+        assert conn.execute(indices).fetchall() == antes
+        assert "faltante" in estados(resultados).values()
+        assert "creado" not in estados(resultados).values()
+    finally:
+        conn.close()
+
+
+def test_tabla_sin_columnas_no_aplicable(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "vacia.db"))
+    try:
+        conn.execute("CREATE TABLE restrictions (id INTEGER)")
+        resultados = servidor.AsesorIndices(conn, escribible=True).diagnosticar()
+        assert set(estados(resultados).values()) == {"no_aplicable"}
+    finally:
+        conn.close()
+
+
+def test_el_servidor_provisiona_al_arrancar(db_sin_derivados, crear_servidor):
+    server = crear_servidor(db_sin_derivados)
+    assert server.diagnostico["estado"] == "completado"
+    assert server.diagnostico["escribible"]
+    assert any(indice["estado"] == "creado" for indice in server.diagnostico["indices"])
+    informe = texto(llamar(server, "diagnostico_indices"))
+    assert "creado" in informe.lower() or "✅" in informe
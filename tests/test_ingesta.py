@@ -0,0 +1,214 @@
+"""user-010: carga por lotes con checkpoints, reanudación y fechas en UTC"""
+
+import gzip
+import json
+import sqlite3
+
+import pytest
+
+import smartperlahub_ingest as ingesta
+
+REGISTROS = [
+    {"AuditType": "Restriction", "Restriction": 11, "TraceId": "r1", "HotelId": 22,
+     "CreatedAtUtc": "2025-07-31T08:00:00Z"},
+    {"AuditType": "Exception", "ExceptionType": "TimeoutException: proveedor 17 no responde",
+     "Context": {"HotelId": 122}, "CreatedAtUtc": "2025-07-31T10:00:00+02:00"},
+    {"DurationMs": 350, "Provider": "TGX", "HotelId": 7, "InitiatedAt": "2025-07-31 08:00:01"},
+    {"DurationMs": "120", "Connector": "Hotelbeds", "StartedAt": 1753948800},
+    {"DurationMs": 80, "Request": {"HotelCode": 5481}, "time": 1753948800500},
+    {"User": {"Name": "ana"}, "LoginAt": "2025-07-31"},
+]
+
+
+def escribir(ruta, registros, basura=()):
+    lineas = [json.dumps(r) for r in registros] + list(basura)
+    datos = "".join(linea + "\n" for linea in lineas).encode()
+    if str(ruta).endswith(".gz"):
+        with gzip.open(ruta, "wb") as f:
+            f.write(datos)
+    else:
+        with open(ruta, "wb") as f:
+            f.write(datos)
+    return str(ruta)
+
+
+def registros(n, desde=0):
+    return [
+        {"AuditType": "Restriction", "Restriction": 11, "TraceId": f"t{i}", "HotelId": 22,
+         "CreatedAtUtc": f"2025-07-31T08:{i // 60 % 60:02d}:{i % 60:02d}Z"}
+        for i in range(desde, desde + n)
+    ]
+
+
+def contar(db, tabla="restrictions"):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def checkpoint(db, ruta):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute("SELECT offset, rows FROM ingest_checkpoints WHERE path = ?", (ruta,)).fetchone()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("valor, esperado", [
+    ("2025-07-31T08:00:00Z", "2025-07-31T08:00:00.000000"),
+    ("2025-07-31T10:00:00+02:00", "2025-07-31T08:00:00.000000"),
+    ("2025-07-31 08:00:00", "2025-07-31T08:00:00.000000"),
+    ("2025-07-31", "2025-07-31T00:00:00.000000"),
+    ("2025-07-31T08:00:00.1234567Z", "2025-07-31T08:00:00.123456"),
+    ("2025-07-31T08:00:00.5", "2025-07-31T08:00:00.500000"),
+    (1753948800, "2025-07-31T08:00:00.000000"),
+    (1753948800500, "2025-07-31T08:00:00.500000"),
+    ("", None),
+    (None, None),
+])
+def test_fecha_normalizada(valor, esperado):
+    assert ingesta._fecha(valor) == esperado
+
+
+@pytest.mark.parametrize("valor", ["ayer", "-2h", "31/07/2025"])
+def test_fecha_no_valida(valor):
+    with pytest.raises(ValueError):
+        ingesta._fecha(valor)
+
+
+def test_convertir_registros(tmp_path):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / "audit.log", REGISTROS, basura=["{no es json", '{"Otro": 1}', ""])
+    estadisticas = ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+    assert estadisticas["errores"] == 2
+    assert estadisticas["filas"] == {
+        "restrictions": 1, "exceptions": 1, "client_searches": 1,
+        "provider_searches": 1, "connector_searches": 1, "logins": 1,
+    }
+
+    conn = sqlite3.connect(db)
+    assert conn.execute("SELECT restriction_type, hotel_id, occurred_at FROM restrictions").fetchone() == (
+        "ExcludeHotelByConnection", 22, "2025-07-31T08:00:00.000000")
+    tipo, fecha, plantilla = conn.execute(
+        "SELECT exception_type, occurred_at, template_id FROM exceptions").fetchone()
+    assert fecha == "2025-07-31T08:00:00.000000" and plantilla is not None
+    assert conn.execute("SELECT hotel_id, initiated_at FROM provider_searches").fetchone() == (
+        7, "2025-07-31T08:00:01.000000")
+    assert conn.execute("SELECT duration_ms, initiated_at FROM connector_searches").fetchone() == (
+        120, "2025-07-31T08:00:00.000000")
+    assert conn.execute("SELECT hotel_id, initiated_at FROM client_searches").fetchone() == (
+        5481, "2025-07-31T08:00:00.500000")
+    assert conn.execute("SELECT user_data, login_at FROM logins").fetchone() == (
+        '{"Name":"ana"}', "2025-07-31T00:00:00.000000")
+    conn.close()
+
+
+def test_pool_de_procesos_igual_que_sin_pool(tmp_path):
+    ruta = escribir(tmp_path / "audit.log", registros(300))
+    sin_pool = ingesta.ingerir(str(tmp_path / "a.db"), [ruta], procesos=0, tamano_lote=50, derivados=False)
+    con_pool = ingesta.ingerir(str(tmp_path / "b.db"), [ruta], procesos=2, tamano_lote=50, derivados=False)
+    assert sin_pool["filas"] == con_pool["filas"]
+    assert contar(str(tmp_path / "a.db")) == contar(str(tmp_path / "b.db")) == 300
+
+
+def test_reanudar_sin_duplicar(tmp_path):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / "audit.log", registros(100))
+    ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+    assert ingesta.ingerir(db, [ruta], procesos=0, derivados=False)["filas"]["restrictions"] == 0
+
+    # El fichero crece: solo se cargan las líneas nuevas
+    with open(ruta, "ab") as f:
+        f.write("".join(json.dumps(r) + "\n" for r in registros(20, desde=100)).encode())
+    assert ingesta.ingerir(db, [ruta], procesos=0, derivados=False)["filas"]["restrictions"] == 20
+    assert contar(db) == 120
+    assert checkpoint(db, ruta) == (len(open(ruta, "rb").read()), 120)
+
+
+def test_linea_incompleta_se_deja_para_despues(tmp_path):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / "audit.log", registros(10))
+    with open(ruta, "ab") as f:
+        f.write(json.dumps(registros(1, desde=10)[0])[:30].encode())
+    ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+    assert contar(db) == 10
+
+    with open(ruta, "ab") as f:
+        f.write(json.dumps(registros(1, desde=10)[0])[30:].encode() + b"\n")
+    ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+    assert contar(db) == 11
+
+
+def test_carga_interrumpida_conserva_lo_confirmado(tmp_path):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / "audit.log", registros(100))
+    conn = ingesta.abrir_db(db)
+    llamadas = []
+
+    def progreso(cargador):
+        llamadas.append(1)
+        if len(llamadas) == 3:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        ingesta.cargar(conn, [ruta], procesos=0, tamano_lote=10, filas_transaccion=20, progreso=progreso)
+    conn.close()
+    # Confirmados los dos primeros lotes; el tercero se deshace con su checkpoint
+    assert contar(db) == 20
+    assert checkpoint(db, ruta)[1] == 20
+
+    ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+    conn = sqlite3.connect(db)
+    trazas = [fila[0] for fila in conn.execute("SELECT trace_id FROM restrictions ORDER BY id")]
+    conn.close()
+    assert trazas == [f"t{i}" for i in range(100)]
+
+
+@pytest.mark.parametrize("nombre", ["audit.log", "audit.log.gz"])
+def test_fichero_rotado_se_lee_desde_el_principio(tmp_path, nombre):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / nombre, registros(50))
+    ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+
+    # Rotación: el mismo nombre con un contenido más corto que el checkpoint
+    escribir(tmp_path / nombre, registros(5, desde=50))
+    assert ingesta.ingerir(db, [ruta], procesos=0, derivados=False)["filas"]["restrictions"] == 5
+    assert contar(db) == 55
+
+
+def test_gz_reanuda_por_offset_sin_comprimir(tmp_path):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / "audit.log.gz", registros(30))
+    ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+    escribir(tmp_path / "audit.log.gz", registros(40))
+    assert ingesta.ingerir(db, [ruta], procesos=0, derivados=False)["filas"]["restrictions"] == 10
+
+
+def test_reiniciar_con_base_vacia(tmp_path):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / "audit.log", registros(10))
+    conn = ingesta.abrir_db(db)
+    conn.execute("INSERT INTO ingest_checkpoints VALUES (?, 99999, 10, 'x')", (ruta,))
+    conn.close()
+
+    # Sin --reiniciar el checkpoint (mayor que el fichero) cuenta como rotación;
+    # con --reiniciar se borra y las filas del checkpoint empiezan de cero
+    ingesta.ingerir(db, [ruta], procesos=0, reiniciar=True, derivados=False)
+    assert contar(db) == 10
+    assert checkpoint(db, ruta)[1] == 10
+
+
+def test_reiniciar_con_filas_cargadas_se_rechaza(tmp_path):
+    db = str(tmp_path / "carga.db")
+    ruta = escribir(tmp_path / "audit.log", registros(10))
+    ingesta.ingerir(db, [ruta], procesos=0, derivados=False)
+    with pytest.raises(ValueError, match="--reiniciar"):
+        ingesta.ingerir(db, [ruta], procesos=0, reiniciar=True, derivados=False)
+    assert contar(db) == 10
+    assert checkpoint(db, ruta) is not None
+
+    with pytest.raises(SystemExit):
+        ingesta.main(["--db", db, "--reiniciar", "--procesos", "0", ruta])
+    assert contar(db) == 10
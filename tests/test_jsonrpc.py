@@ -0,0 +1,159 @@
+"""user-020: transporte stdio JSON-RPC (códec, lotes, errores y escrituras)"""
+
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peticion(msg_id, metodo, **params):
+    return {"jsonrpc": "2.0", "id": msg_id, "method": metodo, "params": params}
+
+
+def stdio(db, *mensajes):
+    """Respuestas del servidor real por stdio a las líneas enviadas (hasta EOF)"""
+    lineas = [m if isinstance(m, str) else json.dumps(m) for m in mensajes]
+    entorno = dict(os.environ, DB_PATH=db, VIGILAR_INTERVALO="0", DB_AUTO_INDICES="0")
+    proceso = subprocess.run(
+        [sys.executable, os.path.join(RAIZ, "smartperlahub_mcp_fixed.py")],
+        input="\n".join(lineas) + "\n", capture_output=True, text=True, env=entorno, timeout=60,
+    )
+    return [json.loads(linea) for linea in proceso.stdout.splitlines() if linea.strip()]
+
+
+def por_id(respuestas):
+    return {r.get("id"): r for r in respuestas if isinstance(r, dict)}
+
+
+@pytest.mark.parametrize("mensaje", [
+    {"jsonrpc": "2.0", "id": 1, "method": "x", "params": {"n": 2 ** 70}},
+    {"jsonrpc": "2.0", "id": "a", "result": {"texto": "ñandú €", "lista": [1.5, None, True]}},
+])
+def test_codec_ida_y_vuelta(mensaje):
+    assert servidor.decodificar_json(servidor.codificar_json(mensaje)) == mensaje
+
+
+def test_codec_valores_no_json():
+    instante = datetime(2025, 7, 31, 8, 0)
+    datos = servidor.decodificar_json(servidor.codificar_json({"fecha": instante}))
+    assert datos["fecha"].startswith("2025-07-31")
+    with pytest.raises(ValueError):
+        servidor.decodificar_json(b'{"jsonrpc": ')
+
+
+def test_codec_sin_orjson(monkeypatch):
+    mensaje = {"jsonrpc": "2.0", "id": 7, "result": {"content": [{"type": "text", "text": "a\n\"b\" ñ"}]}}
+    con_codec = servidor.codificar_json(mensaje)
+    monkeypatch.setattr(servidor, "orjson", None)
+    assert json.loads(servidor.codificar_json(mensaje)) == json.loads(con_codec) == mensaje
+
+
+def test_escritor_agrupa_las_escrituras(monkeypatch):
+    class Salida:
+        def __init__(self):
+            self.buffer = io.BytesIO()
+            self.escrituras = 0
+            escribir = self.buffer.write
+
+            def contar(datos):
+                self.escrituras += 1
+                return escribir(datos)
+
+            self.buffer.write = contar
+
+    salida = Salida()
+    monkeypatch.setattr(sys, "stdout", salida)
+    escritor = servidor.EscritorSalida()
+
+    async def escenario():
+        for i in range(5):
+            escritor.escribir(b"%d\n" % i)
+        await asyncio.sleep(0)
+
+    asyncio.run(escenario())
+    assert salida.buffer.getvalue() == b"0\n1\n2\n3\n4\n"
+    assert salida.escrituras == 1
+
+    # Pasado ESCRITURA_MAX se escribe sin esperar a la vuelta del bucle
+    monkeypatch.setattr(servidor, "ESCRITURA_MAX", 4)
+    escritor.escribir(b"12345\n")
+    assert salida.escrituras == 2
+
+
+def test_errores_de_protocolo(db):
+    respuestas = stdio(
+        db,
+        "{no es json",
+        {"id": 1, "method": "ping"},
+        {"jsonrpc": "2.0", "id": True, "method": "ping"},
+        peticion(2, "metodo/inexistente"),
+        peticion(3, "tools/call", name="no_existe", arguments={}),
+        peticion(4, "tools/call", name="resumen_sistema", arguments=[1]),
+        peticion(5, "ping"),
+        {"jsonrpc": "2.0", "method": "notifications/initialized"},
+        {"jsonrpc": "2.0", "id": 99, "result": {}},
+    )
+    codigos = [(r.get("id"), r["error"]["code"]) for r in respuestas if "error" in r]
+    assert sorted(codigos, key=repr) == sorted([
+        (None, servidor.ERROR_PARSEO),
+        (1, servidor.SOLICITUD_INVALIDA),
+        (None, servidor.SOLICITUD_INVALIDA),
+        (2, servidor.METODO_NO_ENCONTRADO),
+        (3, servidor.PARAMETROS_INVALIDOS),
+        (4, servidor.PARAMETROS_INVALIDOS),
+    ], key=repr)
+    # Ni la notificación ni la respuesta del cliente se contestan
+    assert len(respuestas) == 7
+    assert por_id(respuestas)[5]["result"] == {}
+
+
+def test_lotes(db):
+    respuestas = stdio(
+        db,
+        [
+            peticion(1, "ping"),
+            peticion("dos", "tools/call", name="resumen_sistema", arguments={"formato": "json"}),
+            {"jsonrpc": "2.0", "method": "notifications/initialized"},
+            {"jsonrpc": "2.0", "id": 3},
+            peticion(4, "metodo/inexistente"),
+        ],
+        [],
+        [{"jsonrpc": "2.0", "method": "notifications/initialized"}],
+        peticion(5, "ping"),
+    )
+    lote = next(r for r in respuestas if isinstance(r, list))
+    assert sorted(map(repr, por_id(lote))) == sorted(map(repr, [1, "dos", 3, 4]))
+    assert por_id(lote)[1]["result"] == {}
+    assert json.loads(por_id(lote)["dos"]["result"]["content"][0]["text"])["total_registros"] > 0
+    assert por_id(lote)[3]["error"]["code"] == servidor.SOLICITUD_INVALIDA
+    assert por_id(lote)[4]["error"]["code"] == servidor.METODO_NO_ENCONTRADO
+
+    sueltas = [r for r in respuestas if isinstance(r, dict)]
+    # El lote vacío es una petición no válida; el de solo notificaciones no se responde
+    assert sorted((repr(r["id"]), r.get("error", {}).get("code")) for r in sueltas) == [
+        (repr(5), None), (repr(None), servidor.SOLICITUD_INVALIDA),
+    ]
+    assert len(respuestas) == 3
+
+
+def test_initialize_y_herramientas(db):
+    respuestas = por_id(stdio(
+        db,
+        peticion(1, "initialize", protocolVersion="2024-11-05", capabilities={},
+                 clientInfo={"name": "pytest", "version": "1"}),
+        peticion(2, "initialize", protocolVersion="1999-01-01", capabilities={}),
+        peticion(3, "tools/list"),
+    ))
+    assert respuestas[1]["result"]["protocolVersion"] == "2024-11-05"
+    assert respuestas[2]["result"]["protocolVersion"] == servidor.PROTOCOLOS[0]
+    nombres = {herramienta["name"] for herramienta in respuestas[3]["result"]["tools"]}
+    assert nombres == set(servidor.HERRAMIENTAS)
@@ -0,0 +1,103 @@
+"""user-013: percentiles de latencia con DDSketch (error relativo acotado)"""
+
+import random
+import sqlite3
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado
+
+CUANTILES = (0.5, 0.9, 0.99)
+
+
+def exacto(valores, q):
+    """Cuantil por rango, como DDSketch.cuantil: el valor en floor(q * (n - 1))"""
+    ordenados = sorted(valores)
+    return ordenados[int(q * (len(ordenados) - 1))]
+
+
+def latencias(n, semilla=1):
+    rng = random.Random(semilla)
+    return [int(rng.lognormvariate(4.5, 1.2)) + 1 for _ in range(n)]
+
+
+@pytest.mark.parametrize("precision", [0.01, 0.05])
+def test_error_relativo_acotado(precision):
+    valores = latencias(5000)
+    sketch = servidor.DDSketch(precision)
+    for valor in valores:
+        sketch.agregar(valor)
+    for q in CUANTILES + (0.0, 0.25, 0.999, 1.0):
+        assert sketch.cuantil(q) == pytest.approx(exacto(valores, q), rel=precision)
+    # El máximo no sale de las cubetas: se guarda exacto
+    assert sketch.maximo == max(valores)
+    assert sketch.cuantil(1.0) <= max(valores)
+
+
+def test_fusionar_equivale_a_un_solo_sketch():
+    valores = latencias(3000)
+    completo, a, b = servidor.DDSketch(), servidor.DDSketch(), servidor.DDSketch()
+    for i, valor in enumerate(valores):
+        completo.agregar(valor)
+        (a if i % 3 else b).agregar(valor)
+    a.fusionar(b)
+    assert a.cubetas == completo.cubetas
+    assert (a.n, a.maximo) == (completo.n, completo.maximo)
+    assert [a.cuantil(q) for q in CUANTILES] == [completo.cuantil(q) for q in CUANTILES]
+
+
+def test_ceros_maximo_y_vacio():
+    sketch = servidor.DDSketch()
+    assert sketch.cuantil(0.5) is None
+    sketch.agregar(None)
+    sketch.agregar(0, veces=6)
+    sketch.agregar(1234, veces=4)
+    assert sketch.n == 10
+    assert sketch.cuantil(0.5) == 0.0
+    assert sketch.cuantil(0.99) == pytest.approx(1234, rel=sketch.precision)
+    assert sketch.maximo == 1234
+
+
+def test_serializacion():
+    sketch = servidor.DDSketch()
+    for valor in latencias(500) + [0, 0]:
+        sketch.agregar(valor)
+    copia = servidor.DDSketch.deserializar(sketch.serializar())
+    assert (copia.n, copia.ceros, copia.maximo, copia.cubetas) == (
+        sketch.n, sketch.ceros, sketch.maximo, sketch.cubetas)
+
+
+def comprobar_proveedores(server, db):
+    filas = json_resultado(server, "analizar_latencias", agrupar="proveedor")["filas"]
+    conn = sqlite3.connect(db)
+    for _, proveedor, busquedas, p50, p90, p99, maximo in filas:
+        valores = [fila[0] for fila in conn.execute(
+            "SELECT duration_ms FROM provider_searches WHERE provider_name = ? AND duration_ms IS NOT NULL",
+            (proveedor,),
+        )]
+        assert busquedas == len(valores)
+        assert maximo == max(valores)
+        for q, valor in zip(CUANTILES, (p50, p90, p99)):
+            # Redondeado a 0,1 ms en la salida
+            assert valor == pytest.approx(exacto(valores, q), rel=servidor.PRECISION_LATENCIAS, abs=0.05)
+    conn.close()
+    return filas
+
+
+def test_analizar_latencias_frente_a_percentiles_exactos(server, db):
+    assert comprobar_proveedores(server, db)
+
+
+def test_filas_nuevas_se_suman_a_los_sketches(server, db):
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.executemany(
+            "INSERT INTO provider_searches (trace_id, provider_name, hotel_id, duration_ms, initiated_at) "
+            "VALUES ('t', 'NUEVO', 1, ?, '2025-08-01T00:00:00')",
+            [(valor,) for valor in latencias(200, semilla=2) + [99999]],
+        )
+    conn.close()
+    filas = comprobar_proveedores(server, db)
+    nuevo = next(fila for fila in filas if fila[1] == "NUEVO")
+    assert nuevo[2] == 201 and nuevo[6] == 99999
@@ -0,0 +1,89 @@
+"""user-019: métricas por herramienta y exportación para Prometheus"""
+
+import asyncio
+import json
+import re
+
+import smartperlahub_mcp_fixed as servidor
+from test_concurrencia import Cliente, llamada
+
+PATRON_MUESTRA = re.compile(r'^smartperlahub_[a-z_]+(\{[a-z_]+="(?:[^"\\]|\\.)*"(,[a-z_]+="(?:[^"\\]|\\.)*")*\})? \S+$')
+
+# Dos sentencias con los mismos 200 primeros caracteres
+PREFIJO = "SELECT " + "1 AS columna_de_relleno, " * 10
+CONSULTAS = [PREFIJO + "1 AS a", PREFIJO + "2 AS b", PREFIJO + "2   AS\n b"]
+
+
+def ejecutar(server, llamadas):
+    async def escenario():
+        cliente = Cliente(server)
+        for i, (herramienta, argumentos) in enumerate(llamadas, 1):
+            await cliente.enviar(llamada(i, herramienta, **argumentos))
+        return cliente
+
+    return asyncio.run(escenario())
+
+
+def muestras(texto, nombre):
+    return [linea for linea in texto.splitlines() if linea.startswith(f"smartperlahub_{nombre}{{")]
+
+
+def test_huella_sql():
+    assert servidor.huella_sql(CONSULTAS[1]) == servidor.huella_sql(CONSULTAS[2])
+    assert servidor.huella_sql(CONSULTAS[0])[0] != servidor.huella_sql(CONSULTAS[1])[0]
+    assert servidor.huella_sql(" SELECT\n  1 ") == (servidor.huella_sql("SELECT 1")[0], "SELECT 1")
+
+
+def test_prometheus_separa_sentencias_con_el_mismo_prefijo(server):
+    ejecutar(server, [("consulta_sql", {"query": consulta}) for consulta in CONSULTAS])
+    texto = server.metricas_prometheus()
+    for linea in texto.splitlines():
+        assert linea.startswith("# ") or PATRON_MUESTRA.match(linea), linea
+
+    ids = {servidor.huella_sql(consulta)[0] for consulta in CONSULTAS}
+    assert len(ids) == 2
+    segundos = muestras(texto, "sql_segundos_total")
+    info = muestras(texto, "sql_info")
+    for sql_id in ids:
+        assert sum(f'sql_id="{sql_id}"' in linea for linea in segundos) == 1
+        assert sum(f'sql_id="{sql_id}"' in linea for linea in info) == 1
+    # Las series de tiempo no llevan el texto; el de sql_info va recortado
+    assert all("sql=" not in linea for linea in segundos)
+    assert all(len(re.search(r'sql="(.*)"', linea).group(1)) <= 200 for linea in info)
+
+
+def test_metricas_por_herramienta(server):
+    cliente = ejecutar(server, [
+        ("resumen_sistema", {}),
+        ("resumen_sistema", {}),
+        ("consulta_sql", {"query": "SELECT COUNT(*) FROM restrictions"}),
+        ("consulta_sql", {"query": "DELETE FROM restrictions"}),
+    ])
+    assert all("result" in respuesta for respuesta in cliente.respuestas)
+
+    herramientas = server.metricas.herramientas()
+    assert herramientas["resumen_sistema"]["llamadas"] == 2
+    assert herramientas["resumen_sistema"]["cache_aciertos"] == 1
+    assert herramientas["consulta_sql"]["llamadas"] == 2
+    assert herramientas["consulta_sql"]["errores"] == 1
+    assert herramientas["consulta_sql"]["sentencias"] >= 1
+    for datos in herramientas.values():
+        assert datos["p50_ms"] <= datos["max_ms"] * (1 + servidor.PRECISION_LATENCIAS)
+
+    texto = server.metricas_prometheus()
+    assert 'smartperlahub_herramienta_duracion_segundos_count{herramienta="resumen_sistema"} 2' in texto
+    assert 'smartperlahub_herramienta_errores_total{herramienta="consulta_sql"} 1' in texto
+
+
+def test_reiniciar_y_volcar_fichero(crear_servidor, db, tmp_path):
+    fichero = tmp_path / "smartperlahub.prom"
+    server = crear_servidor(db, METRICAS_FICHERO=str(fichero))
+    ejecutar(server, [("resumen_sistema", {})])
+    server.volcar_metricas()
+    assert 'herramienta="resumen_sistema"' in fichero.read_text(encoding="utf-8")
+
+    cliente = ejecutar(server, [("metricas_servidor", {"formato": "json", "reiniciar": True})])
+    datos = json.loads(cliente.respuestas[0]["result"]["content"][0]["text"])
+    assert [fila[0] for fila in datos["secciones"]["herramientas"]["filas"]] == ["resumen_sistema"]
+    # Tras reiniciar solo queda la propia llamada a metricas_servidor
+    assert list(server.metricas.herramientas()) == ["metricas_servidor"]
@@ -0,0 +1,58 @@
+"""user-017: almacén Parquet (DuckDB) con los mismos resultados que SQLite"""
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import llamar, texto
+
+pytest.importorskip("duckdb")
+
+import smartperlahub_ingest as ingesta  # noqa: E402
+
+VENTANAS = [
+    {},
+    {"desde": "2025-07-31T08:00", "hasta": "2025-07-31T09:30:30"},
+    {"desde": "2025-07-31T08:10:15", "hasta": "2025-07-31T08:10:50"},
+]
+
+LLAMADAS = [
+    ("analizar_restricciones", {}),
+    ("analizar_restricciones", {"hotel_id": 22}),
+    ("analizar_excepciones", {}),
+    ("analizar_hotel", {"hotel_id": 22}),
+    ("analizar_hotel", {"hotel_id": 5481}),
+    ("problemas_criticos", {}),
+    ("resumen_sistema", {"detallado": True}),
+    ("analizar_latencias", {}),
+]
+
+
+@pytest.fixture
+def servidores(db, tmp_path, crear_servidor):
+    destino = tmp_path / "parquet"
+    exportadas = ingesta.exportar_parquet(db, str(destino))
+    assert exportadas["restrictions"] > 0
+    sqlite = crear_servidor(db)
+    parquet = crear_servidor(str(destino), ALMACEN="parquet")
+    assert parquet.almacen.nombre == "parquet"
+    return sqlite, parquet
+
+
+@pytest.mark.parametrize("ventana", VENTANAS)
+@pytest.mark.parametrize("formato", ["texto", "json"])
+def test_mismos_resultados(servidores, ventana, formato):
+    sqlite, parquet = servidores
+    for herramienta, argumentos in LLAMADAS:
+        argumentos = dict(argumentos, formato=formato, **ventana)
+        esperado = llamar(sqlite, herramienta, **argumentos)
+        assert not esperado.get("isError"), texto(esperado)
+        assert llamar(parquet, herramienta, **argumentos) == esperado, herramienta
+
+
+def test_herramientas_solo_sqlite(servidores):
+    sqlite, parquet = servidores
+    publicadas = {herramienta["name"] for herramienta in parquet.tools}
+    assert publicadas.isdisjoint(servidor.HERRAMIENTAS_SOLO_SQLITE)
+    assert publicadas | set(servidor.HERRAMIENTAS_SOLO_SQLITE) == {h["name"] for h in sqlite.tools}
+    with pytest.raises(servidor.ErrorJSONRPC):
+        llamar(parquet, "consulta_sql", query="SELECT 1")
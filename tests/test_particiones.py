@@ -0,0 +1,189 @@
+"""user-021: DB_PATH repartido en varios ficheros SQLite consultados en paralelo"""
+
+import os
+import sqlite3
+
+import pytest
+
+import smartperlahub_ingest as ingesta
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado, llamar
+
+# Muestras que dependen de cómo se reparten las filas: cada partición tiene
+# sus propios rowid y elige sus tipos de ejemplo entre sus primeras filas
+COLUMNAS_MUESTRA = {"parametros_ejemplo", "rowid"}
+
+# Tres particiones por fecha: madrugada, día y noche del día sintético
+CORTES = [None, "2025-07-31T08:00", "2025-07-31T16:00", None]
+
+VENTANAS = [
+    {},
+    {"desde": "2025-07-31T08:00", "hasta": "2025-07-31T09:30:30"},
+    {"desde": "2025-07-31T07:30", "hasta": "2025-07-31T16:30"},
+    {"hasta": "2025-07-31T05:00"},
+]
+
+LLAMADAS = [
+    ("analizar_restricciones", {}),
+    ("analizar_restricciones", {"hotel_id": 22}),
+    ("analizar_excepciones", {}),
+    ("buscar_excepciones", {"consulta": "Room mapp*", "limite": 5}),
+    ("analizar_hotel", {"hotel_id": 22}),
+    ("problemas_criticos", {}),
+    ("resumen_sistema", {}),
+    ("analizar_latencias", {}),
+]
+
+
+def comparable(datos):
+    """Resultado JSON sin las columnas de muestra (en todas las secciones)"""
+    if isinstance(datos, dict):
+        if "columnas" in datos and "filas" in datos:
+            conservar = [i for i, columna in enumerate(datos["columnas"]) if columna not in COLUMNAS_MUESTRA]
+            datos = dict(
+                datos,
+                columnas=[datos["columnas"][i] for i in conservar],
+                filas=[[fila[i] for i in conservar] for fila in datos["filas"]],
+            )
+        return {clave: comparable(valor) for clave, valor in datos.items()}
+    return datos
+
+
+def repartir_db(origen, directorio):
+    """Copia las tablas de auditoría de `origen` en un fichero por tramo de CORTES"""
+    rutas = []
+    for i, (desde, hasta) in enumerate(zip(CORTES, CORTES[1:])):
+        ruta = os.path.join(directorio, f"smartperlahub_{i}.db")
+        conn = ingesta.abrir_db(ruta)
+        conn.execute("ATTACH DATABASE ? AS origen", (origen,))
+        conn.execute("BEGIN")
+        for tabla, columnas in ingesta.COLUMNAS.items():
+            fecha = servidor.COLUMNA_FECHA[tabla]
+            condiciones, params = ["1=1"], []
+            if desde:
+                condiciones.append(f"{fecha} >= ?")
+                params.append(desde)
+            if hasta:
+                condiciones.append(f"{fecha} < ?")
+                params.append(hasta)
+            lista = ", ".join(columnas)
+            conn.execute(
+                f"INSERT INTO {tabla} ({lista}) SELECT {lista} FROM origen.{tabla} "
+                f"WHERE {' AND '.join(condiciones)} ORDER BY id",
+                params,
+            )
+        conn.execute("COMMIT")
+        conn.execute("DETACH DATABASE origen")
+        ingesta._actualizar_derivados(conn, indices=True)
+        conn.close()
+        rutas.append(ruta)
+    return rutas
+
+
+@pytest.fixture
+def particiones(db, tmp_path):
+    directorio = tmp_path / "particiones"
+    directorio.mkdir()
+    return repartir_db(db, str(directorio))
+
+
+def test_rutas_particiones(tmp_path):
+    for nombre in ("b.db", "a.db", "c.txt"):
+        (tmp_path / nombre).touch()
+    patron = str(tmp_path / "*.db")
+    assert servidor.rutas_particiones(patron) == [str(tmp_path / "a.db"), str(tmp_path / "b.db")]
+    unidas = os.pathsep.join(["x.db", patron, "x.db", ""])
+    assert servidor.rutas_particiones(unidas) == ["x.db", str(tmp_path / "a.db"), str(tmp_path / "b.db")]
+    assert servidor.es_particionado(patron) and servidor.es_particionado(unidas)
+    assert not servidor.es_particionado("smartperlahub.db")
+
+
+def test_reparto_completo(db, particiones):
+    conn = sqlite3.connect(db)
+    for tabla in ingesta.COLUMNAS:
+        total = conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+        partes = [sqlite3.connect(ruta).execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0] for ruta in particiones]
+        assert sum(partes) == total, tabla
+        assert all(partes), tabla
+    conn.close()
+
+
+@pytest.mark.parametrize("ventana", VENTANAS)
+def test_mismos_resultados_que_un_fichero(db, particiones, ventana, crear_servidor):
+    unico = crear_servidor(db)
+    repartido = crear_servidor(os.pathsep.join(particiones))
+    assert isinstance(repartido.almacen, servidor.AlmacenParticionado)
+    assert len(repartido.almacen.particiones) == 3
+    for herramienta, argumentos in LLAMADAS:
+        argumentos = dict(argumentos, **ventana)
+        esperado = comparable(json_resultado(unico, herramienta, **argumentos))
+        assert comparable(json_resultado(repartido, herramienta, **argumentos)) == esperado, (herramienta, argumentos)
+
+
+def test_patron_glob(particiones, crear_servidor):
+    directorio = os.path.dirname(particiones[0])
+    repartido = crear_servidor(os.path.join(directorio, "smartperlahub_*.db"))
+    assert [particion.db_path for particion in repartido.particiones] == particiones
+    assert json_resultado(repartido, "resumen_sistema") == \
+        json_resultado(crear_servidor(os.pathsep.join(particiones)), "resumen_sistema")
+
+
+def test_ventana_descarta_particiones(particiones, crear_servidor, monkeypatch):
+    repartido = crear_servidor(os.pathsep.join(particiones))
+    consultadas = []
+    original = servidor.AlmacenParticionado._en_particion
+
+    def contar(self, grupo, particion, metodo, args):
+        consultadas.append(particion.nombre)
+        return original(self, grupo, particion, metodo, args)
+
+    monkeypatch.setattr(servidor.AlmacenParticionado, "_en_particion", contar)
+    json_resultado(repartido, "analizar_restricciones", desde="2025-07-31T09:00", hasta="2025-07-31T10:00")
+    assert set(consultadas) == {"smartperlahub_1.db"}
+
+    consultadas.clear()
+    json_resultado(repartido, "analizar_restricciones")
+    assert set(consultadas) == {os.path.basename(ruta) for ruta in particiones}
+
+
+def test_consulta_sql_no_disponible(particiones, crear_servidor):
+    repartido = crear_servidor(os.pathsep.join(particiones))
+    assert "consulta_sql" not in {herramienta["name"] for herramienta in repartido.tools}
+    with pytest.raises(servidor.ErrorJSONRPC):
+        llamar(repartido, "consulta_sql", query="SELECT 1")
+
+
+def test_particion_inexistente(particiones, monkeypatch):
+    monkeypatch.setenv("DB_PATH", os.pathsep.join(particiones + ["no_existe.db"]))
+    with pytest.raises(FileNotFoundError):
+        servidor.SmartPerlahubMCP()
+
+
+def test_particiones_nuevas_en_segundo_plano(particiones, crear_servidor, monkeypatch):
+    directorio = os.path.dirname(particiones[0])
+    repartido = crear_servidor(os.path.join(directorio, "smartperlahub_*.db"))
+    total = json_resultado(repartido, "resumen_sistema")["total_registros"]
+    nueva = os.path.join(directorio, "smartperlahub_3.db")
+    with sqlite3.connect(particiones[0]) as origen, sqlite3.connect(nueva) as destino:
+        origen.backup(destino)
+    abiertas = []
+    original = servidor.SmartPerlahubMCP._abrir_particion
+
+    def contar(self, ruta):
+        abiertas.append(ruta)
+        return original(self, ruta)
+
+    monkeypatch.setattr(servidor.SmartPerlahubMCP, "_abrir_particion", contar)
+    # Las peticiones no abren ni provisionan el fichero nuevo
+    assert json_resultado(repartido, "resumen_sistema")["total_registros"] == total
+    assert repartido.verificar_cambios() is False
+    assert not abiertas and len(repartido.particiones) == 3
+
+    assert repartido.mantener() is True
+    assert abiertas == [nueva] and len(repartido.particiones) == 4
+    assert json_resultado(repartido, "resumen_sistema")["total_registros"] > total
+
+    os.remove(nueva)
+    assert repartido.mantener() is True
+    assert [particion.db_path for particion in repartido.particiones] == particiones
+    assert json_resultado(repartido, "resumen_sistema")["total_registros"] == total
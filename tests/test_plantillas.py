@@ -0,0 +1,118 @@
+"""user-016: plantillas de mensaje y template_id estable entre procesos"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import smartperlahub_ingest as ingesta
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("mensaje, plantilla, parametros", [
+    ("Room mapping failed for 'DBL|2P·CLASSIC' hotel 5481",
+     "Room mapping failed for '<cod>' hotel <n>", ["DBL|2P·CLASSIC", "5481"]),
+    ("Timeout after 5795 ms", "Timeout after <n> ms", ["5795"]),
+    ("Trace 3f2504e0-4f89-11d3-9a0c-0305e82c3301 lost at 0x1F",
+     "Trace <guid> lost at <n>", ["3f2504e0-4f89-11d3-9a0c-0305e82c3301", "0x1F"]),
+    ('Price "12,50" rejected (1.234 EUR)', "Price '<cod>' rejected (<n> EUR)", ["12,50", "1.234"]),
+    ("Sin variables", "Sin variables", []),
+    (None, None, []),
+])
+def test_plantilla_mensaje(mensaje, plantilla, parametros):
+    assert servidor.plantilla_mensaje(mensaje) == (plantilla, parametros)
+
+
+def test_variantes_comparten_template_id():
+    a = servidor.huella_excepcion("Timeout after 5795 ms")
+    assert a == servidor.huella_excepcion("Timeout after 12 ms")
+    assert a != servidor.huella_excepcion("Timeout before 12 ms")
+    assert servidor.huella_excepcion(None) is None
+    assert -2 ** 63 <= a < 2 ** 63
+
+
+def test_template_id_igual_en_otro_proceso():
+    mensajes = ["Timeout after 5795 ms", "Room mapping failed for 'X' hotel 1", "ñandú €"]
+    codigo = (
+        "import smartperlahub_mcp_fixed as s; "
+        f"print(*[s.huella_excepcion(m) for m in {mensajes!r}])"
+    )
+    # Otra semilla de hash(): la huella no puede depender de ella
+    entorno = dict(os.environ, PYTHONHASHSEED="12345", PYTHONIOENCODING="utf-8")
+    salida = subprocess.run(
+        [sys.executable, "-c", codigo], cwd=RAIZ, env=entorno, capture_output=True, text=True, check=True
+    ).stdout.split()
+    assert [int(valor) for valor in salida] == [servidor.huella_excepcion(m) for m in mensajes]
+
+
+def test_template_id_de_la_carga_y_del_servidor_coinciden(db):
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "INSERT INTO exceptions (trace_id, exception_type, exception_message, context_data, occurred_at) "
+        "VALUES ('t', 'Timeout after 1 ms', 'm', '{}', '2025-08-01T00:00:00')"
+    )
+    conn.commit()
+    servidor.actualizar_plantillas_excepciones(conn)
+    distintas = conn.execute(
+        "SELECT exception_type, template_id FROM exceptions "
+        "WHERE template_id IS NOT NULL GROUP BY exception_type, template_id"
+    ).fetchall()
+    assert distintas
+    for tipo, template_id in distintas:
+        assert template_id == servidor.huella_excepcion(tipo), tipo
+    conn.close()
+
+
+def test_analizar_excepciones_agrupa_por_plantilla(server, db):
+    filas = json_resultado(server, "analizar_excepciones", limite=1000)["filas"]
+    conn = sqlite3.connect(db)
+    directo = {}
+    for tipo, cantidad in conn.execute("SELECT exception_type, COUNT(*) FROM exceptions GROUP BY exception_type"):
+        plantilla, _ = servidor.plantilla_mensaje(tipo)
+        directo[plantilla] = directo.get(plantilla, 0) + cantidad
+    conn.close()
+    assert {fila[1]: fila[2] for fila in filas} == directo
+    assert all(fila[0] == servidor.huella_plantilla(fila[1]) for fila in filas)
+
+
+def quitar_columna_plantilla(db):
+    """Base de datos como las anteriores a exceptions.template_id"""
+    conn = sqlite3.connect(db)
+    conn.execute("DROP INDEX IF EXISTS idx_exceptions_template_id")
+    conn.execute("ALTER TABLE exceptions DROP COLUMN template_id")
+    conn.commit()
+    conn.close()
+
+
+def columnas_excepciones(db):
+    conn = sqlite3.connect(db)
+    try:
+        return servidor.columnas_tabla(conn, "exceptions")
+    finally:
+        conn.close()
+
+
+def plantillas(server):
+    """(template_id, plantilla, cantidad) de analizar_excepciones, sin los ejemplos"""
+    return [fila[:3] for fila in json_resultado(server, "analizar_excepciones", limite=1000)["filas"]]
+
+
+def test_el_servidor_no_anade_la_columna(db, crear_servidor):
+    esperado = plantillas(crear_servidor(db))
+    quitar_columna_plantilla(db)
+    server = crear_servidor(db)
+    server.mantener()
+    assert "template_id" not in columnas_excepciones(db)
+    # Sin la columna, la huella de cada tipo se calcula al vuelo
+    assert plantillas(server) == esperado
+
+
+def test_la_carga_anade_la_columna(db):
+    quitar_columna_plantilla(db)
+    ingesta.abrir_db(db).close()
+    assert "template_id" in columnas_excepciones(db)
@@ -0,0 +1,101 @@
+"""user-002: pool de conexiones SQLite de solo lectura"""
+
+import sqlite3
+import threading
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import llamar
+
+
+@pytest.fixture
+def pool(db):
+    pool = servidor.PoolConexiones(db, tamano=2)
+    yield pool
+    pool.cerrar()
+
+
+def test_reutiliza_la_conexion(pool):
+    with pool.conexion() as primera:
+        primera.execute("SELECT count(*) FROM restrictions").fetchone()
+    with pool.conexion() as segunda:
+        pass
+    assert primera is segunda
+    estadisticas = pool.estadisticas()
+    assert estadisticas["prestamos"] == 2
+    assert estadisticas["abiertas"] == 1
+    assert estadisticas["en_uso"] == 0
+
+
+def test_conexiones_de_solo_lectura(pool):
+    with pool.conexion() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM restrictions")
+        assert conn.execute("PRAGMA query_only").fetchone()[0] == 1
+
+
+def test_tamano_acotado_y_esperas(pool):
+    dentro = threading.Barrier(2)
+    soltar = threading.Event()
+    
+    def ocupar():
+        with pool.conexion():
+            dentro.wait()
+            soltar.wait()
+    
+    hilos = [threading.Thread(target=ocupar) for _ in range(2)]
+    for hilo in hilos:
+        hilo.start()
+    
+    def esperar():
+        with pool.conexion():
+            pass
+    
+    esperando = threading.Thread(target=esperar)
+    esperando.start()
+    esperando.join(0.2)
+    assert esperando.is_alive()
+    soltar.set()
+    esperando.join(5)
+    for hilo in hilos:
+        hilo.join()
+    estadisticas = pool.estadisticas()
+    assert estadisticas["abiertas"] == 2
+    assert estadisticas["esperas"] == 1
+    assert estadisticas["max_en_uso"] == 2
+
+
+def test_conexion_rota_se_descarta(pool):
+    with pytest.raises(sqlite3.ProgrammingError):
+        with pool.conexion() as conn:
+            conn.close()
+            conn.execute("SELECT 1")
+    estadisticas = pool.estadisticas()
+    assert estadisticas["descartadas"] == 1
+    assert estadisticas["abiertas"] == 0
+    with pool.conexion() as conn:
+        assert conn.execute("SELECT 1").fetchone()[0] == 1
+
+
+def test_transaccion_abierta_se_deshace_al_devolver(pool):
+    with pool.conexion() as conn:
+        conn.execute("BEGIN")
+        conn.execute("SELECT count(*) FROM logins").fetchone()
+    assert not conn.in_transaction
+
+
+def test_pool_cerrado(pool):
+    pool.cerrar()
+    with pytest.raises(sqlite3.ProgrammingError):
+        with pool.conexion():
+            pass
+
+
+def test_servidor_comparte_el_pool(crear_servidor, db):
+    server = crear_servidor(db, DB_POOL_SIZE=2, CACHE_MB=0)
+    for _ in range(5):
+        assert not llamar(server, "analizar_hotel", hotel_id=22).get("isError")
+    estadisticas = server.pool.estadisticas()
+    assert estadisticas["abiertas"] <= 2
+    assert estadisticas["prestamos"] >= 5
@@ -0,0 +1,137 @@
+"""user-023: registro declarativo de herramientas y validación por esquema"""
+
+import sys
+from collections import OrderedDict
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import llamar, texto
+
+NUMERO = {"type": "number", "minimum": 1, "maximum": 10}
+
+
+@pytest.mark.parametrize("esquema, valor, esperado", [
+    (NUMERO, "3", 3),
+    (NUMERO, " 2.5 ", 2.5),
+    (NUMERO, 4.0, 4),
+    ({"type": "integer"}, "7", 7),
+    ({"type": "boolean"}, "sí", True),
+    ({"type": "boolean"}, "false", False),
+    ({"type": "boolean"}, 1, True),
+    ({"type": "string"}, 22, "22"),
+    ({"type": "string", "enum": ["texto", "json"]}, "json", "json"),
+])
+def test_convertir_argumento(esquema, valor, esperado):
+    convertido = servidor.convertir_argumento("x", esquema, valor)
+    assert convertido == esperado
+    assert type(convertido) is type(esperado)
+
+
+@pytest.mark.parametrize("esquema, valor, mensaje", [
+    (NUMERO, "tres", "debe ser un número"),
+    (NUMERO, True, "debe ser un número"),
+    (NUMERO, float("nan"), "debe ser un número"),
+    (NUMERO, 0, "como mínimo 1"),
+    (NUMERO, "11", "como máximo 10"),
+    ({"type": "integer"}, 1.5, "número entero"),
+    ({"type": "boolean"}, "quizá", "true o false"),
+    ({"type": "boolean"}, 2, "true o false"),
+    ({"type": "string"}, ["a"], "debe ser un texto"),
+    ({"type": "string", "enum": ["texto", "json"]}, "xml", "uno de: texto, json"),
+])
+def test_convertir_argumento_no_valido(esquema, valor, mensaje):
+    with pytest.raises(ValueError, match=mensaje):
+        servidor.convertir_argumento("x", esquema, valor)
+
+
+def test_argumentos_de_una_herramienta():
+    herramienta = servidor.HERRAMIENTAS["analizar_hotel"]
+    assert herramienta.argumentos({"hotel_id": "22", "desde": None, "extra": [1]}) == {"hotel_id": 22, "extra": [1]}
+    with pytest.raises(ValueError, match="obligatorio 'hotel_id'"):
+        herramienta.argumentos({"hotel_id": None})
+
+
+@pytest.mark.parametrize("nombre", ["analizar_hotel", "analizar_restricciones"])
+def test_hotel_id_entero(nombre):
+    herramienta = servidor.HERRAMIENTAS[nombre]
+    assert herramienta.argumentos({"hotel_id": "22"})["hotel_id"] == 22
+    assert herramienta.argumentos({"hotel_id": 22.0})["hotel_id"] == 22
+    # Sin truncar: 22.5 no es el hotel 22
+    with pytest.raises(ValueError, match="número entero"):
+        herramienta.argumentos({"hotel_id": 22.5})
+
+
+def test_errores_de_validacion_en_tools_call(server):
+    for argumentos, mensaje in [
+        ({}, "obligatorio 'hotel_id'"),
+        ({"hotel_id": "abc"}, "debe ser un número"),
+        ({"hotel_id": 22, "formato": "xml"}, "debe ser uno de"),
+    ]:
+        with pytest.raises(servidor.ErrorJSONRPC, match=mensaje) as error:
+            llamar(server, "analizar_hotel", **argumentos)
+        assert error.value.codigo == servidor.PARAMETROS_INVALIDOS
+    with pytest.raises(servidor.ErrorJSONRPC, match="mínimo 1"):
+        llamar(server, "analizar_restricciones", limite=0)
+    assert not llamar(server, "analizar_hotel", hotel_id="22").get("isError")
+
+
+def test_descriptores_de_tools_list():
+    for herramienta in servidor.HERRAMIENTAS.values():
+        descriptor = herramienta.descriptor()
+        assert descriptor["name"] == herramienta.nombre
+        esquema = descriptor["inputSchema"]
+        assert esquema["type"] == "object"
+        assert esquema.get("required", []) == list(herramienta.requeridos)
+    assert servidor.HERRAMIENTAS["analizar_hotel"].descriptor()["inputSchema"]["required"] == ["hotel_id"]
+
+
+@pytest.mark.parametrize("declaracion, mensaje", [
+    (dict(manejador=":"), "manejador no válido"),
+    (dict(requeridos=["falta"]), "'falta' es obligatorio"),
+    (dict(propiedades={"x": {"type": "array"}}), "tipo no soportado"),
+    (dict(propiedades={"x": {"type": "number", "enum": ["a"]}}), "debe ser un número"),
+    (dict(propiedades={"x": {"type": "number", "minimum": 1, "default": 0}}), "como mínimo 1"),
+])
+def test_declaraciones_no_validas(declaracion, mensaje):
+    argumentos = dict(nombre="prueba", descripcion="", propiedades={}, manejador="_prueba")
+    argumentos.update(declaracion)
+    with pytest.raises(ValueError, match=mensaje):
+        servidor.registrar_herramientas(servidor.Herramienta(**argumentos))
+
+
+def test_nombre_repetido():
+    herramienta = servidor.Herramienta("prueba", "", {}, "_prueba")
+    with pytest.raises(ValueError, match="declarada dos veces"):
+        servidor.registrar_herramientas(herramienta, herramienta)
+
+
+def con_herramienta(monkeypatch, herramienta):
+    registro = OrderedDict(servidor.HERRAMIENTAS)
+    registro[herramienta.nombre] = herramienta
+    monkeypatch.setattr(servidor, "HERRAMIENTAS", registro)
+
+
+def test_manejador_sin_metodo_en_el_servidor(db, crear_servidor, monkeypatch):
+    con_herramienta(monkeypatch, servidor.Herramienta("prueba", "", {}, "_no_existe"))
+    with pytest.raises(ValueError, match="no tiene el método _no_existe"):
+        crear_servidor(db, provisionar=False)
+
+
+def test_manejador_diferido(db, crear_servidor, monkeypatch, tmp_path):
+    (tmp_path / "herramienta_eco.py").write_text(
+        "def eco(servidor, args):\n"
+        "    return {'content': [{'type': 'text', 'text': f\"{servidor.db_path} {args['veces']}\"}]}\n",
+        encoding="utf-8",
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    con_herramienta(monkeypatch, servidor.Herramienta(
+        "eco", "Eco", {"veces": {"type": "integer", "minimum": 1}}, "herramienta_eco:eco", requeridos=["veces"],
+    ))
+    server = crear_servidor(db)
+    assert "eco" in {herramienta["name"] for herramienta in server.tools}
+    # El módulo no se importa hasta la primera llamada
+    assert "herramienta_eco" not in sys.modules
+    assert texto(llamar(server, "eco", veces="3")) == f"{db} 3"
+    assert "herramienta_eco" in sys.modules
+    monkeypatch.delitem(sys.modules, "herramienta_eco")
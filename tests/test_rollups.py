@@ -0,0 +1,87 @@
+"""user-005: tablas de resumen con refresco incremental por marca de agua"""
+
+import sqlite3
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado
+
+
+def contenido_rollup(conn, rollup):
+    _, claves = servidor.ROLLUPS[rollup]
+    cols = ", ".join(claves)
+    return sorted(
+        conn.execute(f"SELECT {cols}, row_count FROM {rollup}").fetchall(), key=repr
+    )
+
+
+def conteo_directo(conn, rollup):
+    tabla, claves = servidor.ROLLUPS[rollup]
+    expresiones = ", ".join(servidor.expresion_rollup(tabla, clave) for clave in claves)
+    return sorted(conn.execute(
+        f"SELECT {expresiones}, COUNT(*) FROM {tabla} GROUP BY {', '.join(claves)}"
+    ).fetchall(), key=repr)
+
+
+def comprobar_rollups(conn):
+    for rollup, (tabla, _) in servidor.ROLLUPS.items():
+        assert contenido_rollup(conn, rollup) == conteo_directo(conn, rollup), rollup
+        assert servidor.marca_agua(conn, rollup) == servidor.max_rowid(conn, tabla), rollup
+    for tabla, cantidad in conn.execute("SELECT table_name, row_count FROM rollup_table_counts"):
+        assert cantidad == conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0], tabla
+
+
+@pytest.fixture
+def conn(db):
+    conn = sqlite3.connect(db)
+    servidor.actualizar_derivados(conn)
+    yield conn
+    conn.close()
+
+
+def test_rollups_coinciden_con_el_sql(conn):
+    comprobar_rollups(conn)
+
+
+def test_refresco_incremental(conn):
+    conn.executemany(
+        "INSERT INTO restrictions (trace_id, restriction_type, context_data, hotel_id, occurred_at) "
+        "VALUES ('t', ?, '{}', ?, ?)",
+        [
+            ("ExcludeHotelByConnection", 22, "2025-07-31T23:59:59"),
+            ("TipoNuevo", 987654, "2025-08-01T00:00:01"),
+            ("TipoNuevo", None, "2025-08-01T00:00:02"),
+        ],
+    )
+    conn.execute(
+        "INSERT INTO logins (trace_id, user_data, login_at) VALUES ('t', '{}', '2025-08-01T00:05:00')"
+    )
+    conn.commit()
+    assert servidor.actualizar_rollups(conn) > 0
+    assert servidor.actualizar_conteos_tablas(conn) == 4
+    comprobar_rollups(conn)
+    # Sin filas nuevas no hay nada que agregar
+    assert servidor.actualizar_rollups(conn) == 0
+
+
+def test_tabla_recortada_se_reconstruye(conn):
+    conn.execute("DELETE FROM restrictions WHERE rowid > (SELECT MAX(rowid) - 10 FROM restrictions)")
+    conn.commit()
+    servidor.actualizar_derivados(conn)
+    comprobar_rollups(conn)
+
+
+def test_resumen_sistema_desde_rollups(server, db):
+    resumen = json_resultado(server, "resumen_sistema")
+    conn = sqlite3.connect(db)
+    try:
+        for tabla, filas in resumen["secciones"]["tablas"]["filas"]:
+            assert filas == conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+        top = conn.execute(
+            "SELECT hotel_id, COUNT(*) AS n FROM restrictions WHERE hotel_id IS NOT NULL "
+            "GROUP BY hotel_id ORDER BY n DESC LIMIT 1"
+        ).fetchone()
+    finally:
+        conn.close()
+    assert resumen["secciones"]["top_hoteles"]["filas"][0] == list(top)
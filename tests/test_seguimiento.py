@@ -0,0 +1,139 @@
+"""user-011: modo seguimiento (micro-lotes) y notificaciones de recursos"""
+
+import asyncio
+import json
+import sqlite3
+
+import smartperlahub_ingest as ingesta
+import smartperlahub_mcp_fixed as servidor
+from test_rollups import comprobar_rollups
+
+
+def restricciones(desde, n):
+    return "".join(
+        json.dumps({"AuditType": "Restriction", "Restriction": 11, "TraceId": f"s{i}", "HotelId": 22,
+                    "CreatedAtUtc": f"2025-08-01T00:00:{i % 60:02d}Z"}) + "\n"
+        for i in range(desde, desde + n)
+    )
+
+
+def insertar_restricciones(db, n):
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.executemany(
+            "INSERT INTO restrictions (trace_id, restriction_type, context_data, hotel_id, occurred_at) "
+            "VALUES ('t', 'ExcludeHotelByConnection', '{}', 22, '2025-08-01T00:00:00')",
+            [()] * n,
+        )
+    conn.close()
+
+
+class SesionPrueba(servidor.Sesion):
+    """Sesión que guarda las notificaciones en lugar de escribirlas en stdout"""
+    
+    def __init__(self, server):
+        super().__init__(server, "test")
+        self.notificaciones = []
+    
+    def notificar(self, mensaje):
+        self.notificaciones.append(mensaje)
+
+
+def test_seguir_carga_lineas_y_ficheros_nuevos(db, tmp_path):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "a.log").write_text(restricciones(0, 10))
+    avisos = []
+
+    def aviso(cargador):
+        avisos.append(dict(cargador.insertadas))
+        if len(avisos) == 1:
+            with open(logs / "a.log", "a") as f:
+                f.write(restricciones(10, 5))
+            (logs / "b.log").write_text(restricciones(100, 3))
+
+    conn = sqlite3.connect(db)
+    antes = conn.execute("SELECT COUNT(*) FROM restrictions").fetchone()[0]
+    ingesta.seguir(db, [str(logs)], intervalo=0, aviso=aviso, ciclos=3)
+
+    # Primer ciclo: el fichero inicial; segundo: lo añadido y el fichero nuevo;
+    # tercero: sin cambios, no hay aviso
+    assert [a["restrictions"] for a in avisos] == [10, 8]
+    assert conn.execute("SELECT COUNT(*) FROM restrictions").fetchone()[0] == antes + 18
+    # Las tablas derivadas ya están al día con las filas nuevas
+    comprobar_rollups(conn)
+    assert servidor.actualizar_rollups(conn) == 0
+    conn.close()
+
+
+def test_recursos_actualizados_al_superar_el_umbral(crear_servidor, db):
+    server = crear_servidor(db, NOTIFICAR_FILAS=5)
+    sesion = SesionPrueba(server)
+    asyncio.run(server.handle_resources_subscribe({"uri": servidor.RECURSO_TABLA + "restrictions"}, sesion))
+    asyncio.run(server.handle_resources_subscribe({"uri": servidor.RECURSO_PROBLEMAS}, sesion))
+    server.verificar_cambios()
+
+    insertar_restricciones(db, 3)
+    assert server.verificar_cambios()
+    assert server.recursos_actualizados() == []
+
+    insertar_restricciones(db, 3)
+    assert server.verificar_cambios()
+    assert sorted(server.recursos_actualizados()) == sorted([
+        servidor.RECURSO_TABLA + "restrictions", servidor.RECURSO_PROBLEMAS,
+    ])
+    # El contador vuelve a cero tras el aviso; la escritura de las tablas
+    # derivadas del propio servidor (vigilar) no cuenta como filas nuevas
+    assert server.recursos_actualizados() == []
+    server.mantener()
+    server.verificar_cambios()
+    assert not server.verificar_cambios()
+    assert server.recursos_actualizados() == []
+
+
+def test_sin_suscripcion_no_hay_avisos(crear_servidor, db):
+    server = crear_servidor(db, NOTIFICAR_FILAS=1)
+    sesion = SesionPrueba(server)
+    asyncio.run(server.handle_resources_subscribe({"uri": servidor.RECURSO_TABLA + "logins"}, sesion))
+    server.verificar_cambios()
+    insertar_restricciones(db, 2)
+    server.verificar_cambios()
+    assert server.recursos_actualizados() == []
+
+
+def test_vigilar_notifica_a_las_sesiones_suscritas(crear_servidor, db):
+    server = crear_servidor(db, NOTIFICAR_FILAS=2, VIGILAR_INTERVALO=0.01)
+    suscrita = SesionPrueba(server)
+    otra = SesionPrueba(server)
+    uri = servidor.RECURSO_TABLA + "restrictions"
+    asyncio.run(server.handle_resources_subscribe({"uri": uri}, suscrita))
+    server.verificar_cambios()
+    insertar_restricciones(db, 2)
+
+    async def escenario():
+        vigia = asyncio.ensure_future(servidor.vigilar(server))
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if suscrita.notificaciones:
+                break
+        vigia.cancel()
+
+    asyncio.run(escenario())
+    assert suscrita.notificaciones == [{
+        "jsonrpc": "2.0",
+        "method": "notifications/resources/updated",
+        "params": {"uri": uri},
+    }]
+    assert otra.notificaciones == []
+
+
+def test_leer_recurso_de_tabla(crear_servidor, db):
+    server = crear_servidor(db)
+    uri = servidor.RECURSO_TABLA + "restrictions"
+    insertar_restricciones(db, 1)
+    contenido = asyncio.run(server.handle_resources_read({"uri": uri}))["contents"][0]
+    datos = json.loads(contenido["text"])
+    conn = sqlite3.connect(db)
+    assert datos["filas"] == conn.execute("SELECT COUNT(*) FROM restrictions").fetchone()[0]
+    assert datos["ultimo_rowid"] == conn.execute("SELECT MAX(rowid) FROM restrictions").fetchone()[0]
+    conn.close()
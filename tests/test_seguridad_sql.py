@@ -0,0 +1,94 @@
+"""user-009: autorizador de solo lectura y presupuesto de consulta_sql"""
+
+import asyncio
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado, llamar, texto
+
+RECURSIVA = (
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000000) "
+    "SELECT count(*) FROM c"
+)
+
+
+@pytest.mark.parametrize("query", [
+    "DELETE FROM restrictions",
+    "INSERT INTO logins (trace_id) VALUES ('x')",
+    "UPDATE restrictions SET hotel_id = 1",
+    "DROP TABLE logins",
+    "ATTACH DATABASE ':memory:' AS otra",
+    "PRAGMA writable_schema = ON",
+    "SELECT load_extension('x')",
+    "CREATE TABLE t (x)",
+])
+def test_escrituras_rechazadas(server, query):
+    resultado = llamar(server, "consulta_sql", query=query)
+    assert resultado["isError"]
+    assert "no permitida" in texto(resultado) or "not authorized" in texto(resultado)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT count(*) FROM restrictions WHERE hotel_id = 22",
+    "WITH t AS (SELECT hotel_id FROM restrictions) SELECT count(*) FROM t",
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 10) SELECT sum(x) FROM c",
+    "SELECT upper('delete from restrictions')",
+])
+def test_lecturas_permitidas(server, query):
+    assert not llamar(server, "consulta_sql", query=query).get("isError")
+
+
+def test_presupuesto_de_pasos(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_MAX_PASOS=100000)
+    resultado = llamar(server, "consulta_sql", query=RECURSIVA)
+    assert resultado["isError"]
+    assert "presupuesto" in texto(resultado)
+    # La conexión vuelve al pool sana
+    assert not llamar(server, "consulta_sql", query="SELECT 1").get("isError")
+
+
+def test_tiempo_maximo(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_MAX_PASOS=0, CONSULTA_TIMEOUT=0.2)
+    resultado = llamar(server, "consulta_sql", query=RECURSIVA)
+    assert resultado["isError"]
+    assert "tiempo máximo" in texto(resultado)
+
+
+def test_limite_de_recorrido_completo(crear_servidor, db):
+    server = crear_servidor(db, CONSULTA_MAX_FILAS_ESCANEO=100)
+    resultado = llamar(server, "consulta_sql", query="SELECT count(*) FROM restrictions r WHERE r.context_data LIKE '%x%'")
+    assert resultado["isError"]
+    assert "'restrictions'" in texto(resultado)
+    # Una tabla pequeña o un filtro indexado sí pasan
+    assert not llamar(server, "consulta_sql", query="SELECT count(*) FROM restrictions WHERE hotel_id = 22").get("isError")
+
+
+def test_tablas_escaneadas_resuelve_alias():
+    plan = ["SCAN r", "SEARCH e USING INDEX idx (hotel_id=?)", "SCAN logins USING COVERING INDEX i"]
+    sql = "SELECT * FROM restrictions AS r JOIN exception_hotels e ON e.hotel_id = r.hotel_id, logins"
+    assert servidor.tablas_escaneadas(plan, sql) == ["restrictions"]
+
+
+def pasos_sentencia(server, sql):
+    filas = json_resultado(server, "metricas_servidor", limite=50)["secciones"]["sentencias"]["filas"]
+    return next(fila[-1] for fila in filas if fila[0] == sql)
+
+
+def test_pasos_de_consulta_sql_en_metricas(crear_servidor, db):
+    server = crear_servidor(db, DB_POOL_SIZE=1, CACHE_MB=0)
+    query = "SELECT count(*) FROM restrictions WHERE context_data LIKE '%Connection%'"
+    
+    async def medir():
+        for _ in range(2):
+            medicion = servidor.Medicion("consulta_sql")
+            await server.handle_tools_call({"name": "consulta_sql", "arguments": {"query": query}}, None, medicion)
+            server.metricas.registrar(medicion)
+    
+    asyncio.run(medir())
+    # Las dos ejecuciones cuentan pasos: el presupuesto no deja la
+    # conexión del pool sin su contador
+    pasos = pasos_sentencia(server, query)
+    assert pasos >= 2 * servidor.PASOS_PROGRESO
+    with server.pool.conexion() as conn:
+        assert isinstance(conn, servidor.ConexionMedida)
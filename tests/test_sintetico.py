@@ -0,0 +1,69 @@
+"""user-018: generador de datos sintéticos y benchmark del servidor"""
+
+import hashlib
+import sqlite3
+
+import pytest
+
+import smartperlahub_benchmark as benchmark
+import smartperlahub_ingest as ingesta
+import smartperlahub_sintetico as sintetico
+
+
+def huella_tablas(db):
+    conn = sqlite3.connect(db)
+    resumen = hashlib.sha256()
+    for tabla, columnas in ingesta.COLUMNAS.items():
+        for fila in conn.execute(f"SELECT {', '.join(columnas)} FROM {tabla} ORDER BY id"):
+            resumen.update(repr(fila).encode())
+    conn.close()
+    return resumen.hexdigest()
+
+
+def test_misma_semilla_mismos_datos(tmp_path):
+    a, b, c = (str(tmp_path / nombre) for nombre in ("a.db", "b.db", "c.db"))
+    assert sintetico.generar(a, escala=0.01, derivados=False) == sintetico.generar(b, escala=0.01, derivados=False)
+    sintetico.generar(c, escala=0.01, semilla=2, derivados=False)
+    assert huella_tablas(a) == huella_tablas(b) != huella_tablas(c)
+
+
+def test_escala_y_distribucion(db_base, tmp_path):
+    pequena = sintetico.generar(str(tmp_path / "pequena.db"), escala=0.01, derivados=False)
+    conn = sqlite3.connect(db_base)
+    grande = {tabla: conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0] for tabla in pequena}
+    for tabla, filas in pequena.items():
+        assert filas > 0
+        assert grande[tabla] == pytest.approx(filas * 5, rel=0.05), tabla
+
+    # El hotel 22 concentra la mayoría de las restricciones
+    hoteles = conn.execute(
+        "SELECT hotel_id, COUNT(*) AS n FROM restrictions GROUP BY hotel_id ORDER BY n DESC LIMIT 2"
+    ).fetchall()
+    total = grande["restrictions"]
+    assert hoteles[0][0] == 22 and hoteles[0][1] / total > 0.8
+    conn.close()
+
+
+def test_no_sobrescribe(db_base):
+    with pytest.raises(FileExistsError):
+        sintetico.generar(db_base, escala=0.01)
+
+
+def test_benchmark_stdio(db):
+    informe = benchmark.ejecutar(db, peticiones=20, concurrencia=2, calentamiento=0)
+    assert informe["total"]["llamadas"] == 20
+    assert informe["total"]["errores"] == 0
+    assert sum(datos["llamadas"] for datos in informe["herramientas"].values()) == 20
+    for datos in informe["herramientas"].values():
+        assert datos["p50_ms"] <= datos["p95_ms"] <= datos["max_ms"]
+
+    # Un p95 peor que la tolerancia cuenta como regresión
+    peor = {
+        "configuracion": informe["configuracion"],
+        "total": dict(informe["total"]),
+        "herramientas": {nombre: dict(datos, p95_ms=datos["p95_ms"] * 2)
+                         for nombre, datos in informe["herramientas"].items()},
+    }
+    _, regresiones = benchmark.comparar(informe, peor, tolerancia=0.2)
+    assert sorted(regresiones) == sorted(n for n, d in informe["herramientas"].items() if d["p95_ms"])
+    assert benchmark.comparar(informe, informe)[1] == []
@@ -0,0 +1,95 @@
+"""user-014: ventanas desde/hasta servidas por rollups por hora y minuto"""
+
+import sqlite3
+
+import pytest
+
+import smartperlahub_mcp_fixed as servidor
+from ayudas import json_resultado, llamar, texto
+
+VENTANAS = [
+    ("2025-07-31T08:00", "2025-07-31T10:00"),
+    ("2025-07-31T08:20:30", "2025-07-31T10:05"),
+    ("2025-07-31T10:00:00.5+02:00", "2025-07-31 09:59:59"),
+    ("2025-07-31T23:30", None),
+    (None, "2025-07-31T00:45:10"),
+    ("2025-08-01", None),
+]
+
+
+@pytest.mark.parametrize("valor, esperado", [
+    ("2025-07-31", "2025-07-31T00:00:00"),
+    ("2025-07-31 08:00", "2025-07-31T08:00:00"),
+    ("2025-07-31T08:00:00Z", "2025-07-31T08:00:00"),
+    ("2025-07-31T10:00:00+02:00", "2025-07-31T08:00:00"),
+    ("2025-07-31T08:00:00.250", "2025-07-31T08:00:00.250000"),
+    (None, None),
+    ("", None),
+])
+def test_normalizar_instante(valor, esperado):
+    assert servidor.normalizar_instante(valor) == esperado
+
+
+def test_normalizar_instante_relativo():
+    assert servidor.normalizar_instante("-2h") < servidor.normalizar_instante("-30m")
+
+
+def test_tramos():
+    ventana = servidor.VentanaTiempo("2025-07-31T08:20:30", "2025-07-31T10:05")
+    assert ventana.tramos() == [
+        ("filas", "2025-07-31T08:20:30", "2025-07-31T08:21:00"),
+        ("minuto", "2025-07-31T08:21:00", "2025-07-31T09:00:00"),
+        ("hora", "2025-07-31T09:00:00", "2025-07-31T10:00:00"),
+        ("minuto", "2025-07-31T10:00:00", "2025-07-31T10:05:00"),
+    ]
+    assert servidor.VentanaTiempo("2025-07-31T08:00", None).tramos() == [
+        ("hora", "2025-07-31T08:00:00", None),
+    ]
+    assert servidor.VentanaTiempo().completa
+
+
+def test_intervalo_vacio(server):
+    with pytest.raises(ValueError):
+        servidor.VentanaTiempo("2025-07-31T10:00", "2025-07-31T09:00")
+    resultado = llamar(server, "resumen_sistema", desde="2025-07-31T10:00", hasta="2025-07-31T10:00")
+    assert resultado.get("isError")
+    assert "Intervalo vacío" in texto(resultado)
+
+
+def condicion(desde, hasta, columna):
+    return servidor.VentanaTiempo(desde, hasta).condicion(columna)
+
+
+def comprobar_ventana(server, db, desde, hasta):
+    argumentos = {k: v for k, v in (("desde", desde), ("hasta", hasta)) if v is not None}
+    conn = sqlite3.connect(db)
+    tablas = json_resultado(server, "resumen_sistema", **argumentos)["secciones"]["tablas"]["filas"]
+    for tabla, filas in tablas:
+        sql, params = condicion(desde, hasta, servidor.COLUMNA_FECHA[tabla])
+        assert filas == conn.execute(f"SELECT COUNT(*) FROM {tabla} WHERE {sql}", params).fetchone()[0], tabla
+
+    restricciones = json_resultado(server, "analizar_restricciones", limite=100000, **argumentos)["filas"]
+    sql, params = condicion(desde, hasta, "occurred_at")
+    directo = conn.execute(
+        "SELECT hotel_id, restriction_type, COUNT(*) FROM restrictions "
+        f"WHERE hotel_id IS NOT NULL AND {sql} GROUP BY hotel_id, restriction_type", params
+    ).fetchall()
+    conn.close()
+    assert sorted(map(tuple, restricciones)) == sorted(directo)
+
+
+@pytest.mark.parametrize("desde, hasta", VENTANAS)
+def test_conteos_con_ventana_igual_que_el_sql(server, db, desde, hasta):
+    comprobar_ventana(server, db, desde, hasta)
+
+
+def test_ventana_con_filas_aun_sin_agregar(server, db):
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.executemany(
+            "INSERT INTO restrictions (trace_id, restriction_type, context_data, hotel_id, occurred_at) "
+            "VALUES ('t', 'ExcludeHotelByConnection', '{}', 22, ?)",
+            [("2025-07-31T08:20:45",), ("2025-07-31T09:30:00",), ("2025-07-31T10:04:59.900000",)],
+        )
+    conn.close()
+    comprobar_ventana(server, db, "2025-07-31T08:20:30", "2025-07-31T10:05")